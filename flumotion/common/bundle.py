@@ -21,17 +21,45 @@ bundles of files used to implement caching over the network
 
 import StringIO
 import errno
+import fcntl
 import os
+import shutil
 import sys
 import tempfile
+import time
 import zipfile
 
-from flumotion.common import errors, dag, python
+from twisted.internet import defer, task, threads
+
+from flumotion.common import errors, dag, log, python
 from flumotion.common.python import makedirs
 
+try:
+    from twisted.internet import inotify
+    from twisted.python import filepath
+except ImportError:
+    inotify = None
+
 __all__ = ['Bundle', 'Bundler', 'Unbundler', 'BundlerBasket']
 __version__ = "$Rev$"
 
+# how often the files of the bundles are checked for changes when
+# inotify is not available, in seconds
+POLL_INTERVAL = 5
+
+# how many versions of each bundle the Unbundler keeps when cleaning up
+KEEP_VERSIONS = 2
+# age in seconds after which unused bundle versions, and the leftovers of
+# unpacking them, may be removed
+STALE_AGE = 60 * 60
+TEMP_PREFIX = '.unbundling-'
+# file written in a bundle version once it is completely unpacked; the
+# processes using the version hold a shared lock on it
+UNBUNDLED_NAME = '.unbundled'
+
+# path of a bundle version -> fd of the lease this process holds on it
+_leases = {}
+
 
 def rename(source, dest):
     return os.rename(source, dest)
@@ -146,6 +174,12 @@ class Unbundler:
     """
     I unbundle bundles by unpacking them in the given directory
     under directories with the bundle's md5sum.
+
+    Bundles are unpacked atomically, so a directory for a bundle's
+    md5sum holds the complete bundle once it exists, and can be shared
+    by all the processes using the same directory. The processes using a
+    version of a bundle hold a lease on it, so that it is not cleaned up
+    under them.
     """
 
     def __init__(self, directory):
@@ -164,6 +198,15 @@ class Unbundler:
         """
         return self.unbundlePathByInfo(bundle.name, bundle.md5sum)
 
+    def isUnbundled(self, name, md5sum):
+        """
+        Check if the bundle with the given name and md5sum was unbundled.
+
+        @rtype: bool
+        """
+        return os.path.exists(os.path.join(
+            self.unbundlePathByInfo(name, md5sum), UNBUNDLED_NAME))
+
     def unbundle(self, bundle):
         """
         Unbundle the given bundle.
@@ -174,31 +217,165 @@ class Unbundler:
         @returns: the full path to the directory where it was unpacked
         """
         directory = self.unbundlePath(bundle)
+        if self.isUnbundled(bundle.name, bundle.md5sum):
+            return directory
 
         filelike = StringIO.StringIO(bundle.getZip())
         zipFile = zipfile.ZipFile(filelike, "r")
         zipFile.testzip()
 
-        filepaths = zipFile.namelist()
-        for filepath in filepaths:
-            path = os.path.join(directory, filepath)
-            parent = os.path.split(path)[0]
+        # unpack next to the final directory and rename it in place,
+        # see #373
+        parent = os.path.dirname(directory)
+        try:
+            makedirs(parent)
+        except OSError, err:
+            # Reraise error unless if it's an already existing
+            if err.errno != errno.EEXIST or not os.path.isdir(parent):
+                raise
+        if os.path.isdir(directory):
+            # left incomplete by an older version; cleaned up later as
+            # any leftover of unpacking
+            self._moveAside(directory)
+        tempdir = tempfile.mkdtemp(prefix=TEMP_PREFIX, dir=parent)
+        try:
+            for filepath in zipFile.namelist():
+                path = os.path.join(tempdir, filepath)
+                parent = os.path.dirname(path)
+                if not os.path.isdir(parent):
+                    makedirs(parent)
+                handle = open(path, 'wb')
+                handle.write(zipFile.read(filepath))
+                handle.close()
+            open(os.path.join(tempdir, UNBUNDLED_NAME), 'w').close()
             try:
-                makedirs(parent)
-            except OSError, err:
-                # Reraise error unless if it's an already existing
-                if err.errno != errno.EEXIST or not os.path.isdir(parent):
+                os.rename(tempdir, directory)
+            except OSError:
+                # unpacked by another process in the meantime
+                if not self.isUnbundled(bundle.name, bundle.md5sum):
                     raise
-            data = zipFile.read(filepath)
-
-            # atomically write to path, see #373
-            fd, tempname = tempfile.mkstemp(dir=parent)
-            handle = os.fdopen(fd, 'wb')
-            handle.write(data)
-            handle.close()
-            rename(tempname, path)
+        finally:
+            if os.path.exists(tempdir):
+                shutil.rmtree(tempdir, ignore_errors=True)
         return directory
 
+    def markUsed(self, name, md5sum):
+        """
+        Mark the bundle with the given name and md5sum as just used, so
+        that it is the last one of its versions to be cleaned up.
+        """
+        try:
+            os.utime(self.unbundlePathByInfo(name, md5sum), None)
+        except OSError:
+            pass
+
+    def lease(self, name, md5sum):
+        """
+        Hold a lease on the unbundled bundle with the given name and md5sum
+        for as long as this process runs, so that no process cleans it up.
+
+        @rtype:   bool
+        @returns: whether the bundle is unbundled and was leased
+        """
+        path = self.unbundlePathByInfo(name, md5sum)
+        if path in _leases:
+            return True
+        try:
+            fd = os.open(os.path.join(path, UNBUNDLED_NAME), os.O_RDONLY)
+        except OSError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except IOError:
+            # being removed
+            os.close(fd)
+            return False
+        _leases[path] = fd
+        return True
+
+    def cleanup(self, names, keep=KEEP_VERSIONS, exclude=()):
+        """
+        Remove the versions of the given bundles that were used the
+        least recently, keeping the last keep ones of each bundle, the
+        ones in exclude, and any version used in the last STALE_AGE
+        seconds. The versions leased by other processes are kept; the
+        leases of this process are given up, its versions in use have to
+        be in exclude. Unpacking leftovers of processes that died are
+        removed too.
+
+        @type  names:   list of str
+        @param names:   the names of the bundles to clean up
+        @type  keep:    int
+        @type  exclude: list of str
+        @param exclude: paths of bundle versions that are still in use
+
+        @rtype:   list of str
+        @returns: the paths that were removed
+        """
+        removed = []
+        now = time.time()
+        for name in names:
+            directory = os.path.join(self._undir, name)
+            try:
+                entries = os.listdir(directory)
+            except OSError:
+                continue
+            versions = []
+            for entry in entries:
+                path = os.path.join(directory, entry)
+                try:
+                    mtime = os.stat(path).st_mtime
+                except OSError:
+                    continue
+                if not entry.startswith(TEMP_PREFIX):
+                    versions.append((mtime, path))
+                elif mtime < now - STALE_AGE:
+                    shutil.rmtree(path, ignore_errors=True)
+                    removed.append(path)
+            versions.sort()
+            versions.reverse()
+            for mtime, path in versions[keep:]:
+                if path in exclude or mtime >= now - STALE_AGE:
+                    continue
+                if self._remove(path):
+                    removed.append(path)
+        return removed
+
+
+    ## Private Methods ##
+
+    def _moveAside(self, directory):
+        aside = tempfile.mkdtemp(prefix=TEMP_PREFIX,
+                                 dir=os.path.dirname(directory))
+        try:
+            # replaces the empty directory
+            os.rename(directory, aside)
+        except OSError:
+            # moved aside or replaced by another process in the meantime
+            os.rmdir(aside)
+
+    def _remove(self, path):
+        # remove a version unless another process holds a lease on it
+        fd = _leases.pop(path, None)
+        if fd is not None:
+            os.close(fd)
+        try:
+            fd = os.open(os.path.join(path, UNBUNDLED_NAME), os.O_RDONLY)
+        except OSError:
+            # incomplete, nobody can lease it
+            fd = None
+        try:
+            if fd is not None:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    return False
+            shutil.rmtree(path, ignore_errors=True)
+            return True
+        finally:
+            if fd is not None:
+                os.close(fd)
+
 
 class Bundler:
     """
@@ -265,11 +442,17 @@ class Bundler:
         return data
 
 
-class BundlerBasket:
+class BundlerBasket(log.Loggable):
     """
     I manage bundlers that are registered through me.
+
+    I can also serve their bundles, zipped in a thread. Once I watch the
+    files of the bundlers for changes, I keep the bundles until one of
+    their files changes.
     """
 
+    logCategory = 'bundlerbasket'
+
     def __init__(self, mtime=None):
         """
         Create a new bundler basket.
@@ -278,12 +461,21 @@ class BundlerBasket:
 
         self._files = {}        # filename          -> bundle name
         self._imports = {}      # import statements -> bundle name
+        self._sources = {}      # source path       -> list of bundle names
 
         self._graph = dag.DAG()
 
         self._mtime = mtime     # Registry modifcation time when the basket was
                                 # created
 
+        self._bundles = {}      # bundle name -> Bundle, while unchanged
+        self._building = {}     # bundle name -> list of Deferreds waiting
+        self._generations = {}  # bundle name -> number of changes seen
+        self._watching = False
+        self._notifier = None   # inotify.INotify
+        self._poller = None     # task.LoopingCall polling the files
+        self._stats = {}        # source path -> (mtime, size) when polled
+
     def isUptodate(self, mtime):
         return self._mtime >= mtime
 
@@ -309,6 +501,11 @@ class BundlerBasket:
             raise Exception("Cannot add %s to bundle %s, already in %s" % (
                 location, bundleName, self._files[location]))
         self._files[location] = bundleName
+        path = os.path.abspath(source)
+        self._sources.setdefault(path, []).append(bundleName)
+        if self._notifier is not None:
+            self._watchDirectory(os.path.dirname(path))
+        self._invalidate(bundleName)
 
         # add possible imports from this file
         package = None
@@ -388,6 +585,175 @@ class BundlerBasket:
         """
         return self._bundlers.keys()
 
+    def getBundles(self, bundlerNames):
+        """
+        Get the bundles of the given bundlers. Bundles that are not
+        cached are zipped in a thread; I start watching the files of my
+        bundlers the first time I am called.
+
+        @type bundlerNames: list of str
+
+        @rtype:   L{twisted.internet.defer.Deferred} firing a dict of
+                  bundle name -> L{Bundle}
+        """
+        if not self._watching:
+            self.startWatching()
+        bundles = {}
+        missing = []
+        for name in bundlerNames:
+            if name in bundles or name in missing:
+                continue
+            bundle = self._bundles.get(name, None)
+            if bundle is not None:
+                bundles[name] = bundle
+            elif name in self._bundlers:
+                missing.append(name)
+            else:
+                return defer.fail(errors.NoBundleError(
+                    'The bundle named "%s" was not found' % (name, )))
+        if not missing:
+            return defer.succeed(bundles)
+        d = defer.DeferredList([self._getBundle(name) for name in missing],
+                               fireOnOneErrback=True, consumeErrors=True)
+
+        def gotBundles(results):
+            for name, (success, bundle) in zip(missing, results):
+                bundles[name] = bundle
+            return bundles
+
+        def failed(failure):
+            failure.trap(defer.FirstError)
+            return failure.value.subFailure
+        d.addCallbacks(gotBundles, failed)
+        return d
+
+    def startWatching(self, pollInterval=POLL_INTERVAL):
+        """
+        Watch the files of my bundlers, to forget the bundles cached for
+        files that changed. I use inotify where available, and check the
+        files every pollInterval seconds otherwise.
+        """
+        if self._watching:
+            return
+        self._watching = True
+        if inotify is not None:
+            try:
+                self._watchWithINotify()
+                return
+            except Exception, e:
+                self.info('Cannot watch bundle files with inotify, '
+                          'polling them instead: %s',
+                          log.getExceptionMessage(e))
+                self._stopINotify()
+        self._stats = self._statSources()
+        self._poller = task.LoopingCall(self._poll)
+        self._poller.start(pollInterval, now=False)
+
+    def stopWatching(self):
+        """
+        Stop watching the files of my bundlers, and forget the cached
+        bundles.
+        """
+        self._watching = False
+        self._stopINotify()
+        if self._poller is not None:
+            self._poller.stop()
+            self._poller = None
+        self._stats = {}
+        for name in self._bundles.keys():
+            self._invalidate(name)
+
+
+    ## Private Methods ##
+
+    def _getBundle(self, name):
+        bundle = self._bundles.get(name, None)
+        if bundle is not None:
+            return defer.succeed(bundle)
+        d = defer.Deferred()
+        if name in self._building:
+            self._building[name].append(d)
+            return d
+        self._building[name] = [d]
+        generation = self._generations.get(name, 0)
+        build = threads.deferToThread(self._build, self._bundlers[name])
+        build.addBoth(self._built, name, generation)
+        return d
+
+    def _build(self, bundler):
+        # in a thread
+        bundle = bundler.bundle()
+        return bundle.getZip(), bundle.md5sum
+
+    def _built(self, result, name, generation):
+        waiting = self._building.pop(name)
+        if isinstance(result, tuple):
+            # a copy, the bundler changes its bundle when it rebuilds it
+            bundle = Bundle(name)
+            bundle.zip, bundle.md5sum = result
+            result = bundle
+            if self._watching and generation == self._generations.get(name,
+                                                                       0):
+                self._bundles[name] = bundle
+        for d in waiting:
+            if isinstance(result, Bundle):
+                d.callback(result)
+            else:
+                d.errback(result)
+
+    def _invalidate(self, name):
+        self._bundles.pop(name, None)
+        self._generations[name] = self._generations.get(name, 0) + 1
+
+    def _fileChanged(self, path):
+        for name in self._sources.get(path, ()):
+            self.debug('file %s of bundle %s changed', path, name)
+            for bundledFile in self._bundlers[name]._bundledFiles.values():
+                if os.path.abspath(bundledFile.source) == path:
+                    # check its md5 sum again, even if its mtime is the same
+                    bundledFile._last_timestamp = None
+            self._invalidate(name)
+
+    def _watchWithINotify(self):
+        self._notifier = inotify.INotify()
+        self._notifier.startReading()
+        directories = python.set([os.path.dirname(path)
+                                  for path in self._sources])
+        for directory in directories:
+            self._watchDirectory(directory)
+
+    def _watchDirectory(self, directory):
+        mask = (inotify.IN_MODIFY | inotify.IN_ATTRIB |
+                inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_FROM |
+                inotify.IN_MOVED_TO | inotify.IN_CREATE | inotify.IN_DELETE)
+        self._notifier.watch(filepath.FilePath(directory), mask,
+                             callbacks=[self._notified])
+
+    def _notified(self, ignored, path, mask):
+        self._fileChanged(path.path)
+
+    def _stopINotify(self):
+        if self._notifier is not None:
+            self._notifier.loseConnection()
+            self._notifier = None
+
+    def _statSources(self):
+        stats = {}
+        for path in self._sources:
+            try:
+                stat = os.stat(path)
+                stats[path] = (stat.st_mtime, stat.st_size)
+            except OSError:
+                stats[path] = None
+        return stats
+
+    def _poll(self):
+        stats = self._statSources()
+        for path, stat in stats.items():
+            if self._stats.get(path, None) != stat:
+                self._fileChanged(path)
+        self._stats = stats
+
 
 class MergedBundler(Bundler):
     """
@@ -21,6 +21,9 @@
 import os
 import sys
 
+from twisted.internet import defer, reactor
+from twisted.python import failure
+
 from flumotion.common import bundle, errors, log, package
 from flumotion.configure import configure
 
@@ -32,17 +35,34 @@ class BundleLoader(log.Loggable):
     """
     I am an object that can get and set up bundles from a PB server.
 
+    Bundles are unpacked in the cache directory shared by all the
+    processes of this host, under directories named after their md5sum,
+    and only fetched when missing there. Concurrent requests for the
+    same bundles share the calls to the server.
+
     @cvar remote: a remote reference to an avatar on the PB server.
     """
     remote = None
     _unbundler = None
 
-    def __init__(self, callRemote):
+    def __init__(self, callRemote, sumsTTL=0, clock=reactor):
         """
         @type  callRemote: callable
+        @type  sumsTTL:    int
+        @param sumsTTL:    seconds during which the sums of the bundles
+                           needed for a request are reused without asking
+                           the server again
         """
         self.callRemote = callRemote
         self._unbundler = bundle.Unbundler(configure.cachedir)
+        self._sumsTTL = sumsTTL
+        self._clock = clock
+        # request -> (expiration, list of (name, md5sum))
+        self._sums = {}
+        # request -> list of deferreds waiting for its sums
+        self._gettingSums = {}
+        # (name, md5sum) -> list of deferreds waiting for it to be unpacked
+        self._fetching = {}
 
     def getBundles(self, **kwargs):
         # FIXME: later on, split out this method into getBundles which does
@@ -58,65 +78,9 @@ class BundleLoader(log.Loggable):
                   bundlePath is the directory to register
                   for this package.
         """
-
-        def annotated(d, *extraVals):
-
-            def annotatedReturn(ret):
-                return (ret, ) + extraVals
-            d.addCallback(annotatedReturn)
-            return d
-
-        def getZips(sums):
-            # sums is a list of name, sum tuples, highest to lowest
-            # figure out which bundles we're missing
-            toFetch = []
-            for name, md5 in sums:
-                path = os.path.join(configure.cachedir, name, md5)
-                if os.path.exists(path):
-                    self.log('%s is up to date', name)
-                else:
-                    self.log('%s needs fetching', name)
-                # FIXME: We cannot be completelly sure the bundle has the
-                # correct content only by checking that the directory exists.
-                # The worker/manager could have died during a download leaving
-                # the package incomplete.
-                toFetch.append(name)
-            if toFetch:
-                return annotated(self.callRemote('getBundleZips', toFetch),
-                                 toFetch, sums)
-            else:
-                return {}, [], sums
-
-        def unpackAndRegister((zips, toFetch, sums)):
-            for name in toFetch:
-                if name not in zips:
-                    msg = "Missing bundle %s was not received"
-                    self.warning(msg, name)
-                    raise errors.NoBundleError(msg % name)
-
-                b = bundle.Bundle(name)
-                b.setZip(zips[name])
-                path = self._unbundler.unbundle(b)
-
-            # register all package paths; to do so we need to reverse sums
-            sums.reverse()
-            ret = []
-            for name, md5 in sums:
-                self.log('registerPackagePath for %s' % name)
-                path = os.path.join(configure.cachedir, name, md5)
-                if not os.path.exists(path):
-                    self.warning("path %s for bundle %s does not exist",
-                        path, name)
-                else:
-                    package.getPackager().registerPackagePath(path, name)
-                ret.append((name, path))
-
-            return ret
-
-        # get sums for all bundles we need
-        d = self.callRemote('getBundleSums', **kwargs)
-        d.addCallback(getZips)
-        d.addCallback(unpackAndRegister)
+        d = self._getSums(kwargs)
+        d.addCallback(self._fetchMissing)
+        d.addCallback(self._register)
         return d
 
     def loadModule(self, moduleName):
@@ -185,3 +149,123 @@ class BundleLoader(log.Loggable):
         d = self.getBundles(fileName=fileName)
         d.addCallback(gotBundles)
         return d
+
+
+    ## Private Methods ##
+
+    def _getSums(self, kwargs):
+        key = []
+        for name, value in kwargs.items():
+            if isinstance(value, list):
+                value = tuple(value)
+            key.append((name, value))
+        key.sort()
+        key = tuple(key)
+
+        cached = self._sums.get(key, None)
+        if cached is not None:
+            expiration, sums = cached
+            if expiration > self._clock.seconds():
+                self.log('reusing bundle sums for %r', kwargs)
+                return defer.succeed(list(sums))
+            del self._sums[key]
+
+        d = defer.Deferred()
+        if key in self._gettingSums:
+            self._gettingSums[key].append(d)
+            return d
+        self._gettingSums[key] = [d]
+        # get sums for all bundles we need
+        sums = self.callRemote('getBundleSums', **kwargs)
+        sums.addBoth(self._gotSums, key)
+        return d
+
+    def _gotSums(self, result, key):
+        waiting = self._gettingSums.pop(key)
+        if isinstance(result, list):
+            if self._sumsTTL:
+                expiration = self._clock.seconds() + self._sumsTTL
+                self._sums[key] = (expiration, result)
+            for d in waiting:
+                d.callback(list(result))
+        else:
+            for d in waiting:
+                d.errback(result)
+
+    def _fetchMissing(self, sums):
+        # sums is a list of name, sum tuples, highest to lowest
+        # figure out which bundles we're missing
+        toFetch = []
+        waiting = []
+        for name, md5 in sums:
+            if self._unbundler.isUnbundled(name, md5):
+                self.log('%s is up to date', name)
+                continue
+            d = defer.Deferred()
+            waiting.append(d)
+            if (name, md5) in self._fetching:
+                self.log('%s is already being fetched', name)
+                self._fetching[(name, md5)].append(d)
+            else:
+                self.log('%s needs fetching', name)
+                self._fetching[(name, md5)] = [d]
+                toFetch.append((name, md5))
+        if toFetch:
+            zips = self.callRemote('getBundleZips',
+                                   [name for name, md5 in toFetch])
+            zips.addBoth(self._gotZips, toFetch)
+        if not waiting:
+            return sums
+
+        def failed(failure):
+            failure.trap(defer.FirstError)
+            return failure.value.subFailure
+        d = defer.DeferredList(waiting, fireOnOneErrback=True,
+                               consumeErrors=True)
+        d.addCallbacks(lambda _: sums, failed)
+        return d
+
+    def _gotZips(self, zips, toFetch):
+        for name, md5 in toFetch:
+            waiting = self._fetching.pop((name, md5))
+            result = zips
+            if isinstance(zips, dict):
+                try:
+                    result = self._unpack(name, zips)
+                except Exception, e:
+                    result = failure.Failure(e)
+            for d in waiting:
+                if isinstance(result, failure.Failure):
+                    d.errback(result)
+                else:
+                    d.callback(result)
+
+    def _unpack(self, name, zips):
+        if name not in zips:
+            msg = "Missing bundle %s was not received"
+            self.warning(msg, name)
+            raise errors.NoBundleError(msg % name)
+
+        b = bundle.Bundle(name)
+        b.setZip(zips[name])
+        return self._unbundler.unbundle(b)
+
+    def _register(self, sums):
+        # register all package paths; to do so we need to reverse sums
+        sums.reverse()
+        ret = []
+        for name, md5 in sums:
+            self.log('registerPackagePath for %s' % name)
+            path = self._unbundler.unbundlePathByInfo(name, md5)
+            if not os.path.exists(path):
+                self.warning("path %s for bundle %s does not exist",
+                    path, name)
+            else:
+                self._unbundler.markUsed(name, md5)
+                if not self._unbundler.lease(name, md5):
+                    self.warning("could not lease bundle %s in %s",
+                                 name, path)
+                package.getPackager().registerPackagePath(path, name)
+            ret.append((name, path))
+
+        return ret
@@ -44,6 +44,9 @@ class BaseMedium(fpb.Referenceable):
                         which perspective_(methodName) methods can be called
     @type remote:       L{twisted.spread.pb.RemoteReference}
     @type bundleLoader: L{flumotion.common.bundleclient.BundleLoader}
+    @cvar bundleSumsTTL: seconds during which the bundleLoader reuses the
+                         sums of the bundles it asked for
+    @type bundleSumsTTL: int
     """
 
     # subclasses will need to set this to the specific medium type
@@ -54,6 +57,7 @@ class BaseMedium(fpb.Referenceable):
 
     remote = None
     bundleLoader = None
+    bundleSumsTTL = 0
 
     def setRemoteReference(self, remoteReference):
         """
@@ -70,7 +74,8 @@ class BaseMedium(fpb.Referenceable):
             self.remote = None
         self.remote.notifyOnDisconnect(nullRemote)
 
-        self.bundleLoader = bundleclient.BundleLoader(self.callRemote)
+        self.bundleLoader = bundleclient.BundleLoader(
+            self.callRemote, sumsTTL=self.bundleSumsTTL)
 
         # figure out connection addresses if it's an internet address
         tarzan = None
@@ -133,6 +133,35 @@ def ipv4IntToString(n):
     return '.'.join(map(str, l))
 
 
+def ipv6StringToInt(s):
+    try:
+        high, low = struct.unpack('!QQ', socket.inet_pton(socket.AF_INET6, s))
+    except (socket.error, TypeError):
+        raise ValueError(s)
+    return (high << 64) | low
+
+
+def ipv6IntToString(n):
+    return socket.inet_ntop(socket.AF_INET6, struct.pack(
+        '!QQ', n >> 64, n & 0xffffffffffffffffL))
+
+
+def _parseAddress(s):
+    # (IPv6, int) of an address string; IPv4-mapped IPv6 addresses are
+    # returned as IPv4 addresses
+    if ':' in s:
+        n = ipv6StringToInt(s)
+        if n >> 32 == 0xffff:
+            return False, n & 0xffffffffL
+        return True, n
+    try:
+        # faster than ipv4StringToInt, but stricter
+        return False, struct.unpack('!I', socket.inet_pton(socket.AF_INET,
+                                                           s))[0]
+    except (socket.error, TypeError):
+        return False, ipv4StringToInt(s)
+
+
 def countTrailingZeroes32(n):
     tz = 0
     if n == 0:
@@ -144,7 +173,71 @@ def countTrailingZeroes32(n):
     return tz
 
 
+class _PrefixTable(object):
+    """
+    I find the routes of the longest prefixes matching an address, with
+    one hash table per prefix length. A lookup costs one dict lookup per
+    prefix length in use, whatever the number of prefixes.
+    """
+
+    def __init__(self, width):
+        self._width = width
+        self._tables = {} # prefix length -> {net -> [route, ...]}
+        self._masks = [] # [(mask, table)], longest prefix first
+
+    def add(self, net, length, route):
+        table = self._tables.get(length, None)
+        if table is None:
+            table = self._tables[length] = {}
+            self._compile()
+        routes = table.setdefault(net, [])
+        routes.append(route)
+        # in the order the routing table iterates them
+        routes.sort()
+        routes.reverse()
+
+    def remove(self, net, length, route):
+        table = self._tables[length]
+        routes = table[net]
+        routes.remove(route)
+        if not routes:
+            del table[net]
+            if not table:
+                del self._tables[length]
+                self._compile()
+
+    def lookup(self, address):
+        for mask, table in self._masks:
+            routes = table.get(address & mask, None)
+            if routes is not None:
+                return routes[0]
+        return None
+
+    def iterRoutes(self, address):
+        for mask, table in self._masks:
+            for route in table.get(address & mask, ()):
+                yield route
+
+
+    ## Private Methods ##
+
+    def _compile(self):
+        lengths = self._tables.keys()
+        lengths.sort()
+        lengths.reverse()
+        full = (1L << self._width) - 1
+        self._masks = [(full ^ ((1L << (self._width - length)) - 1),
+                        self._tables[length]) for length in lengths]
+
+
 class RoutingTable(object):
+    """
+    I map IPv4 and IPv6 subnets to routes, and find the routes of the
+    most specific subnets an address belongs to.
+
+    The subnets are kept sorted in AVL trees for iteration, and in hash
+    tables per prefix length for routing.
+    """
 
     def fromFile(klass, f, requireNames=True, defaultRouteName='*default*'):
         """
@@ -154,6 +247,8 @@ class RoutingTable(object):
         The entries are expected to have the form:
         IP-ADDRESS/MASK-BITS ROUTE-NAME
 
+        where IP-ADDRESS is an IPv4 or IPv6 address.
+
         The `#' character denotes a comment. Empty lines are allowed.
 
         @param f: file from whence to read a routing table
@@ -168,9 +263,10 @@ class RoutingTable(object):
         comment = re.compile(r'^\s*#')
         empty = re.compile(r'^\s*$')
         entry = re.compile(r'^\s*'
-                           r'(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})'
+                           r'(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}'
+                           r'|[0-9a-fA-F:]*:[0-9a-fA-F:.]*)'
                            r'/'
-                           r'(\d{1,2})'
+                           r'(\d{1,3})'
                            r'(\s+([^\s](.*[^\s])?))?\s*$')
         ret = klass()
         n = 0
@@ -199,64 +295,98 @@ class RoutingTable(object):
 
     def __init__(self):
         self.avltree = avltree.AVLTree()
+        self.avltree6 = avltree.AVLTree()
         self.routeNames = []
+        self._table = _PrefixTable(32)
+        self._table6 = _PrefixTable(128)
 
     def getRouteNames(self):
         return self.routeNames
 
-    def _parseSubnet(self, ipv4String, maskBits):
-        return (ipv4StringToInt(ipv4String),
-                ~((1 << (32 - maskBits)) - 1))
-
-    def addSubnet(self, route, ipv4String, maskBits=32):
-        ipv4Int, mask = self._parseSubnet(ipv4String, maskBits)
-        if not ipv4Int & mask == ipv4Int:
+    def _parseSubnet(self, ipString, maskBits):
+        if ':' in ipString:
+            width = 128
+            ipInt = ipv6StringToInt(ipString)
+        else:
+            width = 32
+            ipInt = ipv4StringToInt(ipString)
+        if maskBits < 0 or maskBits > width:
+            raise ValueError('Invalid mask with %d bits for net %s'
+                             % (maskBits, ipString))
+        return width == 128, ipInt, ~((1L << (width - maskBits)) - 1)
+
+    def addSubnet(self, route, ipString, maskBits=32):
+        ipv6, ipInt, mask = self._parseSubnet(ipString, maskBits)
+        if not ipInt & mask == ipInt:
             raise ValueError('Net %s too specific for mask with %d bits'
-                             % (ipv4String, maskBits))
-        self.avltree.insert((mask, ipv4Int, route))
-
-    def removeSubnet(self, route, ipv4String, maskBits=32):
-        ipv4Int, mask = self._parseSubnet(ipv4String, maskBits)
-        self.avltree.delete((mask, ipv4Int, route))
+                             % (ipString, maskBits))
+        if ipv6:
+            self.avltree6.insert((mask, ipInt, route))
+            self._table6.add(ipInt, maskBits, route)
+        else:
+            self.avltree.insert((mask, ipInt, route))
+            self._table.add(ipInt, maskBits, route)
+
+    def removeSubnet(self, route, ipString, maskBits=32):
+        ipv6, ipInt, mask = self._parseSubnet(ipString, maskBits)
+        if ipv6:
+            self.avltree6.delete((mask, ipInt, route))
+            self._table6.remove(ipInt, maskBits, route)
+        else:
+            self.avltree.delete((mask, ipInt, route))
+            self._table.remove(ipInt, maskBits, route)
 
     def __iter__(self):
-        return self.avltree.iterreversed()
+        """
+        Iterate the (mask, net, route) of the IPv4 subnets, then those
+        of the IPv6 subnets, the most specific first.
+        """
+        for entry in self.avltree.iterreversed():
+            yield entry
+        for entry in self.avltree6.iterreversed():
+            yield entry
 
     def iterHumanReadable(self):
-        for mask, net, route in self:
+        for mask, net, route in self.avltree.iterreversed():
             yield route, ipv4IntToString(net), 32-countTrailingZeroes32(mask)
+        for mask, net, route in self.avltree6.iterreversed():
+            bits = 128
+            while bits and not mask & (1L << (128 - bits)):
+                bits -= 1
+            yield route, ipv6IntToString(net), bits
 
     def __len__(self):
-        return len(self.avltree)
+        return len(self.avltree) + len(self.avltree6)
 
     def route(self, ip):
         """
         Return the preferred route for this IP.
 
         @param ip: The IP to use for routing decisions.
-        @type  ip: An integer or string representing an IPv4 address
+        @type  ip: An integer representing an IPv4 address, or a string
+                   representing an IPv4 or IPv6 address
         """
-        if isinstance(ip, str):
-            ip = ipv4StringToInt(ip)
-
-        for netmask, net, route in self:
-            if ip & netmask == net:
-                return route
-
-        return None
+        if isinstance(ip, basestring):
+            ipv6, ip = _parseAddress(ip)
+            if ipv6:
+                return self._table6.lookup(ip)
+        return self._table.lookup(ip)
 
     def route_iter(self, ip):
         """
         Return an iterator yielding routes in order of preference.
 
         @param ip: The IP to use for routing decisions.
-        @type  ip: An integer or string representing an IPv4 address
+        @type  ip: An integer representing an IPv4 address, or a string
+                   representing an IPv4 or IPv6 address
         """
-        if isinstance(ip, str):
-            ip = ipv4StringToInt(ip)
-        for mask, net, route in self:
-            if ip & mask == net:
-                yield route
+        table = self._table
+        if isinstance(ip, basestring):
+            ipv6, ip = _parseAddress(ip)
+            if ipv6:
+                table = self._table6
+        for route in table.iterRoutes(ip):
+            yield route
         # Yield the default route
         yield None
 
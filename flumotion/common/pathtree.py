@@ -0,0 +1,199 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_common_pathtree -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""radix tree keyed on strings.
+A pure python radix (compressed prefix) tree with a dict-like interface,
+used for longest-prefix lookups of paths. Lookups cost O(len(key))
+instead of O(number of keys).
+"""
+
+__version__ = "$Rev$"
+
+_NOTHING = object()
+
+
+class _Node(object):
+    __slots__ = ('label', 'value', 'children')
+
+    def __init__(self, label, value=_NOTHING):
+        # the label of the edge leading to this node
+        self.label = label
+        self.value = value
+        # first character of the child's label -> child node
+        self.children = {}
+
+
+def _commonPrefixLength(a, b):
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+class PathTree(object):
+    """
+    I map strings to values, like a dict, and can additionally find the
+    value registered under the longest key that is a prefix of a given
+    string.
+
+    Prefixes are plain string prefixes: '/foo' is a prefix of both
+    '/foo/bar' and '/foobar'.
+    """
+
+    def __init__(self, items=()):
+        self._root = _Node('')
+        self._len = 0
+        for key, value in items:
+            self[key] = value
+
+    def _find(self, key):
+        # return the path of nodes leading to the node for key, or None
+        node = self._root
+        path = [node]
+        i = 0
+        while i < len(key):
+            child = node.children.get(key[i])
+            if child is None or not key.startswith(child.label, i):
+                return None
+            i += len(child.label)
+            node = child
+            path.append(node)
+        return path
+
+    def __setitem__(self, key, value):
+        node = self._root
+        i = 0
+        while i < len(key):
+            first = key[i]
+            child = node.children.get(first)
+            if child is None:
+                node.children[first] = _Node(key[i:], value)
+                self._len += 1
+                return
+            common = _commonPrefixLength(child.label, key[i:])
+            if common < len(child.label):
+                # split the edge to child at the divergence point
+                middle = _Node(child.label[:common])
+                child.label = child.label[common:]
+                middle.children[child.label[0]] = child
+                node.children[first] = middle
+                child = middle
+            node = child
+            i += common
+        if node.value is _NOTHING:
+            self._len += 1
+        node.value = value
+
+    def __getitem__(self, key):
+        path = self._find(key)
+        if path is None or path[-1].value is _NOTHING:
+            raise KeyError(key)
+        return path[-1].value
+
+    def __delitem__(self, key):
+        path = self._find(key)
+        if path is None or path[-1].value is _NOTHING:
+            raise KeyError(key)
+        node = path.pop()
+        node.value = _NOTHING
+        self._len -= 1
+
+        # prune the now useless nodes, merging single-child chains again
+        while path:
+            parent = path.pop()
+            if node.value is not _NOTHING:
+                break
+            if not node.children:
+                del parent.children[node.label[0]]
+            elif len(node.children) == 1:
+                child, = node.children.values()
+                child.label = node.label + child.label
+                parent.children[child.label[0]] = child
+            else:
+                break
+            node = parent
+
+    def __contains__(self, key):
+        path = self._find(key)
+        return path is not None and path[-1].value is not _NOTHING
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def iteritems(self):
+        stack = [('', self._root)]
+        while stack:
+            prefix, node = stack.pop()
+            key = prefix + node.label
+            if node.value is not _NOTHING:
+                yield key, node.value
+            for child in node.children.values():
+                stack.append((key, child))
+
+    def iterkeys(self):
+        for key, value in self.iteritems():
+            yield key
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def longestPrefix(self, key, default=None):
+        """
+        Find the longest registered key that is a prefix of the given key.
+
+        @param key:     the string to match
+        @type  key:     str
+        @param default: what to return if no registered key matches
+
+        @returns: a (prefix, value) tuple, or default if nothing matched
+        """
+        node = self._root
+        found = default
+        if node.value is not _NOTHING:
+            found = ('', node.value)
+        i = 0
+        while i < len(key):
+            child = node.children.get(key[i])
+            if child is None or not key.startswith(child.label, i):
+                break
+            i += len(child.label)
+            node = child
+            if node.value is not _NOTHING:
+                found = (key[:i], node.value)
+        return found
+
+    def longestPrefixValue(self, key, default=None):
+        """
+        Like L{longestPrefix}, but only return the value.
+        """
+        found = self.longestPrefix(key)
+        if found is None:
+            return default
+        return found[1]
@@ -0,0 +1,241 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_common_timerwheel -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""hashed timer wheel for large numbers of coarse timeouts.
+Scheduling, cancelling and resetting a timer costs O(1), and all the
+timers of a wheel share a single delayed call of the reactor.
+"""
+
+import math
+
+from twisted.internet import reactor
+
+from flumotion.common import log
+
+__version__ = "$Rev$"
+
+DEFAULT_RESOLUTION = 1.0
+DEFAULT_SIZE = 512
+
+
+class Timer(object):
+    """
+    I am a call scheduled on a L{TimerWheel}. Like the delayed calls of
+    the reactor, I can be cancelled or reset.
+
+    @ivar deadline: the time at which I should be called
+    @type deadline: float
+    """
+    __slots__ = ('deadline', 'tick', 'call', 'args', 'kwargs',
+                 '_wheel', '_slot')
+
+    def __init__(self, wheel, deadline, call, args, kwargs):
+        self.deadline = deadline
+        self.tick = None
+        self.call = call
+        self.args = args
+        self.kwargs = kwargs
+        self._wheel = wheel
+        self._slot = None
+
+    def active(self):
+        """
+        @returns: whether I still have to be called
+        @rtype:   bool
+        """
+        return self._slot is not None
+
+    def cancel(self):
+        """
+        Make sure I will not be called. Cancelling a timer that was
+        already called or cancelled does nothing.
+        """
+        self._wheel.cancel(self)
+
+    def reset(self, delay):
+        """
+        Call me in delay seconds instead of at my current deadline,
+        rescheduling me if I was already called or cancelled.
+        """
+        self._wheel.touch(self, delay)
+
+
+class TimerWheel(object, log.Loggable):
+    """
+    I call many timers with a coarse resolution, using a single delayed
+    call of the reactor while I have timers.
+
+    Timers are hashed into a ring of slots by the tick of their
+    deadline, a tick being my resolution. Every tick I only look at the
+    timers of one slot; those with a deadline more than a revolution
+    away stay in the slot until their tick comes. Timers are called at
+    the first tick after their deadline, so up to one resolution late.
+    """
+
+    logCategory = 'timerwheel'
+
+    def __init__(self, resolution=DEFAULT_RESOLUTION, size=DEFAULT_SIZE,
+                 clock=reactor):
+        """
+        @param resolution: length of a tick, in seconds
+        @type  resolution: float
+        @param size:       number of slots of the wheel
+        @type  size:       int
+        @param clock:      the provider of the time and delayed calls
+        @type  clock:      L{twisted.internet.interfaces.IReactorTime}
+        """
+        self.resolution = resolution
+        self._size = size
+        self._clock = clock
+        self._slots = [set() for i in range(size)]
+        self._count = 0
+        self._current = None # the last tick that was run
+        self._call = None
+
+    def __len__(self):
+        return self._count
+
+    def schedule(self, delay, call, *args, **kwargs):
+        """
+        Call a function in delay seconds.
+
+        @returns: the timer, to cancel or reset the call
+        @rtype:   L{Timer}
+        """
+        timer = Timer(self, self._clock.seconds() + delay, call,
+                      args, kwargs)
+        self._insert(timer)
+        return timer
+
+    def cancel(self, timer):
+        """
+        Make sure the call of a timer will not happen.
+
+        @type timer: L{Timer}
+        """
+        if timer._slot is None:
+            # it may be due in the current tick, and not called yet
+            timer.tick = None
+            return
+        timer._slot.discard(timer)
+        timer._slot = None
+        self._count -= 1
+        if not self._count:
+            self.stop()
+
+    def touch(self, timer, delay):
+        """
+        Move the deadline of a timer to delay seconds from now.
+
+        @type timer: L{Timer}
+        """
+        deadline = self._clock.seconds() + delay
+        if timer._slot is not None and deadline >= timer.deadline:
+            # a timer pushed back is only moved when its slot comes
+            timer.deadline = deadline
+            return
+        if timer._slot is not None:
+            timer._slot.discard(timer)
+            timer._slot = None
+            self._count -= 1
+        timer.deadline = deadline
+        self._insert(timer)
+
+    def stop(self):
+        """
+        Stop ticking. I start again when a timer is scheduled.
+        Timers still scheduled are called late.
+        """
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+        self._current = None
+
+
+    ## Private Methods ##
+
+    def _insert(self, timer):
+        if self._call is None:
+            now = self._clock.seconds()
+            self._current = int(now / self.resolution)
+            self._reschedule(now)
+        tick = self._tickOf(timer.deadline)
+        self._place(timer, max(tick, self._current + 1))
+        self._count += 1
+
+    def _tickOf(self, deadline):
+        return int(math.ceil(deadline / self.resolution))
+
+    def _place(self, timer, tick):
+        timer.tick = tick
+        timer._slot = self._slots[tick % self._size]
+        timer._slot.add(timer)
+
+    def _reschedule(self, now):
+        delay = (self._current + 1) * self.resolution - now
+        self._call = self._clock.callLater(max(delay, 0), self._tick)
+
+    def _tick(self):
+        now = self._clock.seconds()
+        target = int(now / self.resolution)
+        # after a long stall every slot is looked at once
+        ticks = min(target - self._current, self._size)
+        start = self._current + 1
+        self._current = target
+        due = []
+        for tick in range(start, start + ticks):
+            slot = self._slots[tick % self._size]
+            if not slot:
+                continue
+            for timer in [timer for timer in slot if timer.tick <= target]:
+                slot.discard(timer)
+                tick = self._tickOf(timer.deadline)
+                if tick > target:
+                    # it was pushed back
+                    self._place(timer, tick)
+                else:
+                    timer._slot = None
+                    due.append(timer)
+        self._count -= len(due)
+        self._call = None
+        if self._count:
+            self._reschedule(now)
+        else:
+            self._current = None
+        for timer in due:
+            # skip the timers cancelled or reset by an earlier call
+            if timer.tick is None or timer._slot is not None:
+                continue
+            try:
+                timer.call(*timer.args, **timer.kwargs)
+            except Exception, e:
+                self.warning("timer %r failed: %s", timer.call,
+                             log.getExceptionMessage(e))
+
+
+_wheel = None
+
+
+def getTimerWheel():
+    """
+    @returns: the timer wheel shared by the timeouts of the process
+    @rtype:   L{TimerWheel}
+    """
+    global _wheel
+    if _wheel is None:
+        _wheel = TimerWheel()
+    return _wheel
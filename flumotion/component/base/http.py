@@ -15,8 +15,8 @@
 #
 # Headers in this file shall remain intact.
 
-import struct
 import socket
+from collections import deque
 
 from twisted.web import http
 from twisted.internet import reactor, defer
@@ -26,7 +26,7 @@ from flumotion.configure import configure
 from flumotion.common import errors
 from flumotion.twisted.credentials import cryptChallenge
 
-from flumotion.common import log, keycards
+from flumotion.common import log, keycards, netutils, timerwheel
 
 #__all__ = ['HTTPStreamingResource', 'MultifdSinkStreamer']
 __version__ = "$Rev$"
@@ -48,6 +48,8 @@ ERROR_TEMPLATE = """<!doctype html public "-//IETF//DTD HTML 2.0//EN">
 
 HTTP_SERVER = '%s/%s' % (HTTP_SERVER_NAME, HTTP_SERVER_VERSION)
 
+AUTH_CACHE_SIZE = 10000
+
 ### This is new Issuer code that eventually should move to e.g.
 ### flumotion.common.keycards or related
 
@@ -76,6 +78,142 @@ class HTTPGenericIssuer(log.Loggable):
         return keycard
 
 
+class AuthenticationCache(object):
+    """
+    I remember the decisions of a bouncer on keycards for a while, so
+    that clients presenting the same credentials again are authorized
+    or refused without asking the bouncer.
+
+    Keycards are told apart by their class, username, password, address,
+    token and domain; caching assumes the bouncer decides on those only,
+    and not on the path or the arguments of the request.
+    When I hold too many decisions, the oldest are forgotten first.
+    """
+
+    def __init__(self, ttl, size=None, negativeTTL=None, clock=reactor):
+        """
+        @param ttl:         seconds an authorization is remembered
+        @type  ttl:         float
+        @param size:        maximum number of decisions remembered
+        @type  size:        int
+        @param negativeTTL: seconds a refusal is remembered, defaults to ttl
+        @type  negativeTTL: float
+        @param clock:       the provider of the time
+        @type  clock:       L{twisted.internet.interfaces.IReactorTime}
+        """
+        self.ttl = ttl
+        self.size = size or AUTH_CACHE_SIZE
+        if negativeTTL is None:
+            negativeTTL = ttl
+        self.negativeTTL = negativeTTL
+        self._clock = clock
+        self._entries = {} # key -> (expiration time, keycard or None, serial)
+        self._order = deque() # (key, serial), oldest first
+        self._serial = 0
+        self._keys = {} # id of a cached keycard -> key
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def getKey(self, keycard):
+        return (keycard.__class__.__name__, keycard.username,
+                keycard.password, keycard.address, keycard.token,
+                keycard.domain)
+
+    def lookup(self, key):
+        """
+        @returns: whether the decision for the key is known, and the
+                  keycard authorized by the bouncer or None if refused
+        @rtype:   tuple of (bool, L{flumotion.common.keycards.Keycard})
+        """
+        entry = self._entries.get(key, None)
+        if entry is not None:
+            if entry[0] > self._clock.seconds():
+                self.hits += 1
+                return True, entry[1]
+            self._remove(key)
+        self.misses += 1
+        return False, None
+
+    def store(self, key, keycard):
+        """
+        Remember the decision of the bouncer for a key.
+
+        @param keycard: the keycard authorized by the bouncer, or None
+        """
+        if key in self._entries:
+            self._remove(key)
+        if keycard is None:
+            expiration = self._clock.seconds() + self.negativeTTL
+        else:
+            expiration = self._clock.seconds() + self.ttl
+            self._keys[keycard.id] = key
+        self._serial += 1
+        self._entries[key] = (expiration, keycard, self._serial)
+        self._order.append((key, self._serial))
+        while len(self._entries) > self.size:
+            key, serial = self._order.popleft()
+            entry = self._entries.get(key, None)
+            # skip what was removed or stored again since
+            if entry is not None and entry[2] == serial:
+                self._remove(key)
+
+    def invalidate(self, keycardId):
+        """
+        Forget the authorization of a keycard expired by the bouncer.
+
+        @returns: whether the keycard was cached
+        @rtype:   bool
+        """
+        key = self._keys.get(keycardId, None)
+        if key is None:
+            return False
+        self._remove(key)
+        return True
+
+    def getExpiration(self, keycardId):
+        """
+        @returns: when the authorization of a cached keycard expires, or
+                  None if it is not cached
+        @rtype:   float
+        """
+        key = self._keys.get(keycardId, None)
+        if key is None:
+            return None
+        return self._entries[key][0]
+
+    def clear(self):
+        self._entries.clear()
+        self._order.clear()
+        self._keys.clear()
+
+    def getStats(self):
+        """
+        @returns: the hits, misses, hit ratio and size of the cache
+        @rtype:   dict
+        """
+        lookups = self.hits + self.misses
+        ratio = 0.0
+        if lookups:
+            ratio = float(self.hits) / lookups
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit-ratio': ratio,
+                'size': len(self._entries)}
+
+
+    ## Private Methods ##
+
+    def _remove(self, key):
+        expiration, keycard, serial = self._entries.pop(key)
+        if keycard is not None:
+            self._keys.pop(keycard.id, None)
+        if not self._entries:
+            self._order.clear()
+
+
 BOUNCER_SOCKET = 'flumotion.component.bouncers.plug.BouncerPlug'
 BUS_SOCKET = 'flumotion.component.plugs.bus.BusPlug'
 
@@ -96,8 +234,9 @@ class HTTPAuthentication(log.Loggable):
         self.component = component
         self._fdToKeycard = {}         # request fd -> Keycard
         self._idToKeycard = {}         # keycard id -> Keycard
-        self._fdToDurationCall = {}    # request fd -> IDelayedCall
+        self._fdToDurationCall = {}    # request fd -> timerwheel.Timer
                                        # for duration
+        self._timerWheel = timerwheel.getTimerWheel()
         self._domain = None            # used for auth challenge and on keycard
         self._issuer = HTTPGenericIssuer() # issues keycards;default for compat
         self.bouncerName = None
@@ -109,6 +248,14 @@ class HTTPAuthentication(log.Loggable):
                                        # or with allowing the connection
         self._pendingCleanups = []
         self._keepAlive = None
+        self._cache = None             # AuthenticationCache, if enabled
+        self._cachedIds = {}           # cached keycard id -> set of ids
+                                       # of the keycards copied from it
+        self._held = {}                # cached keycard id -> (bouncerName,
+                                       # keycard, release call) when its
+                                       # client left
+        self._copies = 0
+        self._clock = reactor
 
         if (BOUNCER_SOCKET in self.component.plugs
             and self.component.plugs[BOUNCER_SOCKET]):
@@ -177,6 +324,44 @@ class HTTPAuthentication(log.Loggable):
     def setAllowDefault(self, allowDefault):
         self._allowDefault = allowDefault
 
+    def enableCache(self, ttl, size=None, negativeTTL=None, clock=reactor):
+        """
+        Remember the decisions of the remote bouncer for ttl seconds, and
+        authorize clients presenting the same credentials again without
+        asking the bouncer.
+
+        @type ttl:         float
+        @param size:       maximum number of decisions remembered
+        @type size:        int
+        @param negativeTTL: seconds a refusal is remembered, defaults to ttl
+        @type negativeTTL: float
+        @param clock:      the provider of the time
+        @type clock:       L{twisted.internet.interfaces.IReactorTime}
+        """
+        self._cache = AuthenticationCache(ttl, size, negativeTTL, clock)
+        self._clock = clock
+
+    def getCacheStats(self):
+        """
+        @returns: the statistics of the authentication cache, or None if
+                  it is not enabled
+        @rtype:   dict
+        """
+        if self._cache is None:
+            return None
+        return self._cache.getStats()
+
+    def logCacheStats(self):
+        """
+        Log the statistics of the authentication cache, if it is enabled.
+        """
+        stats = self.getCacheStats()
+        if stats is not None:
+            self.info('authentication cache: %d hits, %d misses, '
+                      'hit ratio %.2f, %d decisions cached',
+                      stats['hits'], stats['misses'], stats['hit-ratio'],
+                      stats['size'])
+
     def authenticate(self, request):
         """
         Returns: a deferred returning a keycard or None
@@ -199,9 +384,26 @@ class HTTPAuthentication(log.Loggable):
             return defer.succeed(keycard)
         else:
             keycard.ttl = self.KEYCARD_TTL
+            if self._cache is not None:
+                key = self._cache.getKey(keycard)
+                known, cached = self._cache.lookup(key)
+                if known:
+                    self.debug('using the cached decision of bouncer %r',
+                               self.bouncerName)
+                    if cached is None:
+                        return defer.succeed(None)
+                    copy = self._copyKeycard(cached, keycard)
+                    if copy is not None:
+                        return defer.succeed(copy)
+                    # its duration ran out, ask the bouncer again
+                    self._cache.invalidate(cached.id)
+                    self._releaseKeycard(cached.id)
             self.debug('sending keycard to remote bouncer %r',
                        self.bouncerName)
-            return self.authenticateKeycard(self.bouncerName, keycard)
+            d = self.authenticateKeycard(self.bouncerName, keycard)
+            if self._cache is not None:
+                d.addCallback(self._cacheKeycard, key)
+            return d
 
     def authenticateKeycard(self, bouncerName, keycard):
         return self.component.medium.authenticate(bouncerName, keycard)
@@ -231,7 +433,11 @@ class HTTPAuthentication(log.Loggable):
             d.addErrback(cleanupLater, (bouncerName, keycard))
         pending = self._pendingCleanups
         self._pendingCleanups = []
-        cleanup(bouncerName, keycard)
+        # the bouncer doesn't know the keycards copied from the cache, and
+        # keeps the cached ones while they can be copied
+        if (getattr(keycard, '_cachedId', None) is None
+            and not self._holdKeycard(bouncerName, keycard)):
+            cleanup(bouncerName, keycard)
         for bouncerName, keycard in pending:
             cleanup(bouncerName, keycard)
 
@@ -250,6 +456,13 @@ class HTTPAuthentication(log.Loggable):
             keycard = self._fdToKeycard[fd]
             del self._fdToKeycard[fd]
             del self._idToKeycard[keycard.id]
+            cachedId = getattr(keycard, '_cachedId', None)
+            if cachedId in self._cachedIds:
+                ids = self._cachedIds[cachedId]
+                ids.discard(keycard.id)
+                if not ids:
+                    del self._cachedIds[cachedId]
+                    self._releaseKeycard(cachedId)
         if fd in self._fdToDurationCall:
             self.debug('[fd %5d] canceling later expiration call' % fd)
             self._fdToDurationCall[fd].cancel()
@@ -261,7 +474,7 @@ class HTTPAuthentication(log.Loggable):
         """
         self.debug('[fd %5d] duration exceeded, expiring client' % fd)
 
-        # we're called from a callLater, so we've already run; just delete
+        # we're called from a timer, so we've already run; just delete
         if fd in self._fdToDurationCall:
             del self._fdToDurationCall[fd]
 
@@ -289,6 +502,20 @@ class HTTPAuthentication(log.Loggable):
         """
         expired = 0
         for keycardId in keycardIds:
+            if self._cache is not None:
+                cached = self._cache.invalidate(keycardId)
+                # the bouncer forgot it, no need to remove it anymore
+                held = self._held.pop(keycardId, None)
+                if held is not None and held[2].active():
+                    held[2].cancel()
+                # expire the clients authorized from the cache as well
+                copies = self._cachedIds.pop(keycardId, ())
+                for copyId in list(copies):
+                    self.expireKeycard(copyId)
+                    expired += 1
+                if ((cached or held or copies)
+                    and keycardId not in self._idToKeycard):
+                    continue
             try:
                 self.expireKeycard(keycardId)
                 expired += 1
@@ -332,17 +559,75 @@ class HTTPAuthentication(log.Loggable):
 
                 self._fdToKeycard[fd] = keycard
                 self._idToKeycard[keycard.id] = keycard
+                cachedId = getattr(keycard, '_cachedId', None)
+                if cachedId is not None:
+                    self._cachedIds.setdefault(cachedId, set()).add(
+                        keycard.id)
 
             duration = keycard.duration or self._defaultDuration
 
             if duration:
                 self.debug('new connection on %d will expire in %f seconds' % (
                     fd, duration))
-                self._fdToDurationCall[fd] = reactor.callLater(
+                self._fdToDurationCall[fd] = self._timerWheel.schedule(
                     duration, self._durationCallLater, fd)
 
         return None
 
+    def _cacheKeycard(self, keycard, key):
+        if keycard is not None:
+            keycard._cachedAt = self._clock.seconds()
+        self._cache.store(key, keycard)
+        return keycard
+
+    def _copyKeycard(self, cached, keycard):
+        # the keycard issued for the request, authorized like the cached one
+        # for the time it has left; None if that ran out
+        duration = cached.duration
+        if duration:
+            duration -= self._clock.seconds() - cached._cachedAt
+            if duration <= 0:
+                return None
+        self._copies += 1
+        keycard.id = (cached.id, self._copies)
+        keycard.state = cached.state
+        keycard.avatarId = cached.avatarId
+        keycard.duration = duration
+        keycard._cachedId = cached.id
+        return keycard
+
+    def _holdKeycard(self, bouncerName, keycard):
+        # keep a cached keycard with the bouncer after its client left,
+        # while it can be copied or its copies are connected, so that the
+        # bouncer can still expire them
+        if self._cache is None:
+            return False
+        expiration = self._cache.getExpiration(keycard.id)
+        if expiration is None and keycard.id not in self._cachedIds:
+            return False
+        delay = max((expiration or 0) - self._clock.seconds(), 0)
+        call = self._clock.callLater(delay, self._releaseKeycard, keycard.id)
+        self.debug('keeping cached keycard id %s for %.1f seconds',
+                   keycard.id, delay)
+        self._held[keycard.id] = (bouncerName, keycard, call)
+        return True
+
+    def _releaseKeycard(self, keycardId):
+        # have the bouncer remove a held keycard, once it can't be copied
+        # anymore and its copies are gone
+        if keycardId not in self._held:
+            return
+        expiration = self._cache.getExpiration(keycardId)
+        if expiration is not None and expiration > self._clock.seconds():
+            return
+        self._cache.invalidate(keycardId)
+        if keycardId in self._cachedIds:
+            return
+        bouncerName, keycard, call = self._held.pop(keycardId)
+        if call.active():
+            call.cancel()
+        self.doCleanupKeycard(bouncerName, keycard)
+
     def _authenticatedErrback(self, failure, request):
         failure.trap(errors.NotAuthenticatedError)
         self._handleUnauthorized(request, http.UNAUTHORIZED)
@@ -384,12 +669,13 @@ class HTTPAuthentication(log.Loggable):
 class LogFilter:
 
     def __init__(self):
-        self.filters = [] # list of (network, mask)
+        # the networks, routed to True
+        self._table = netutils.RoutingTable()
 
     def addIPFilter(self, filter):
         """
         Add an IP filter of the form IP/prefix-length (CIDR syntax), or just
-        a single IP address
+        a single IP address. IPv4 and IPv6 addresses are accepted.
         """
         definition = filter.split('/')
         if len(definition) == 2:
@@ -397,31 +683,42 @@ class LogFilter:
             prefixlen = int(prefixlen)
         elif len(definition) == 1:
             net = definition[0]
-            prefixlen = 32
+            prefixlen = None
         else:
             raise errors.ConfigError(
                 "Cannot parse filter definition %s" % filter)
 
-        if prefixlen < 0 or prefixlen > 32:
+        if ':' in net:
+            family, width = socket.AF_INET6, 128
+        else:
+            family, width = socket.AF_INET, 32
+        if prefixlen is None:
+            prefixlen = width
+        if prefixlen < 0 or prefixlen > width:
             raise errors.ConfigError("Invalid prefix length")
 
-        mask = ~((1 << (32 - prefixlen)) - 1)
         try:
-            net = struct.unpack(">I", socket.inet_pton(socket.AF_INET, net))[0]
+            socket.inet_pton(family, net)
         except socket.error:
             raise errors.ConfigError(
                 "Failed to parse network address %s" % net)
-        net = net & mask # just in case
+        mask = ~((1L << (width - prefixlen)) - 1)
+        # just in case
+        if family == socket.AF_INET:
+            net = netutils.ipv4IntToString(
+                netutils.ipv4StringToInt(net) & mask)
+        else:
+            net = netutils.ipv6IntToString(
+                netutils.ipv6StringToInt(net) & mask)
 
-        self.filters.append((net, mask))
+        try:
+            self._table.addSubnet(True, net, prefixlen)
+        except ValueError:
+            # already filtered
+            pass
 
     def isInRange(self, ip):
         """
         Return true if ip is in any of the defined network(s) for this filter
         """
-        # Handles IPv4 only.
-        realip = struct.unpack(">I", socket.inet_pton(socket.AF_INET, ip))[0]
-        for f in self.filters:
-            if (realip & f[1]) == f[0]:
-                return True
-        return False
+        return self._table.route(ip) is not None
@@ -84,7 +84,7 @@ import time
 
 from twisted.internet import defer, reactor
 
-from flumotion.common import keycards, errors, python, poller
+from flumotion.common import keycards, errors, python, timerwheel
 from flumotion.common.componentui import WorkerComponentUIState
 
 from flumotion.component import component
@@ -162,16 +162,14 @@ class Bouncer(component.BaseComponent):
     componentMediumClass = BouncerMedium
     logCategory = 'bouncer'
 
-    KEYCARD_EXPIRE_INTERVAL = 2 * 60 # expire every 2 minutes
-
     def init(self):
         self._idCounter = 0
         self._idFormat = time.strftime('%Y%m%d%H%M%S-%%d')
         self._keycards = {} # keycard id -> Keycard
-
-        self._expirer = poller.Poller(self._expire,
-                            self.KEYCARD_EXPIRE_INTERVAL,
-                            start=False)
+        self._issuerKeycards = {} # issuer name -> {keycard id -> Keycard}
+        self._requesterKeycards = {} # requester id -> set of keycard ids
+        self._keycardTimers = {} # keycard id -> Timer expiring it
+        self._timerWheel = timerwheel.getTimerWheel()
         self.enabled = True
 
     def setDomain(self, name):
@@ -197,7 +195,6 @@ class Bouncer(component.BaseComponent):
             # If we were enabled and are being set to disabled, eject the warp
             # core^w^w^w^wexpire all existing keycards
             self.enabled = False
-            self._expirer.stop()
             d = self.expireAllKeycards()
             d.addCallback(callAndPassthru, self.on_disabled)
             return d
@@ -222,31 +219,11 @@ class Bouncer(component.BaseComponent):
             return None
 
         if self.enabled:
-            if not self._expirer.running and hasattr(keycard, 'ttl'):
-                self.debug('installing keycard timeout poller')
-                self._expirer.start()
             return defer.maybeDeferred(self.do_authenticate, keycard)
         else:
             self.debug("Bouncer disabled, refusing authentication")
             return None
 
-    def do_expireKeycards(self, elapsed):
-        """
-        Override to expire keycards managed by sub-classes.
-
-        @param elapsed: time in second since the last expiration call.
-        @type elapsed: int
-        @returns: if there is more keycard to expire. If False is returned,
-                  the expirer poller MAY be stopped.
-        @rtype: bool
-        """
-        for k in self._keycards.values():
-            if hasattr(k, 'ttl'):
-                k.ttl -= elapsed
-                if k.ttl <= 0:
-                    self.expireKeycardId(k.id)
-        return len(self._keycards) > 0
-
     def do_validate(self, keycard):
         """
         Override to check keycards before authentication steps.
@@ -305,7 +282,9 @@ class Bouncer(component.BaseComponent):
         """
 
     def hasKeycard(self, keycard):
-        return keycard in self._keycards.values()
+        keycardId = getattr(keycard, 'id', None)
+        return (keycardId is not None
+                and self._keycards.get(keycardId, None) is keycard)
 
     def generateKeycardId(self):
         # FIXME: what if it already had one ?
@@ -344,6 +323,10 @@ class Bouncer(component.BaseComponent):
             raise KeyError
 
         del self._keycards[keycard.id]
+        self._unindexKeycard(keycard)
+        timer = self._keycardTimers.pop(keycard.id, None)
+        if timer is not None:
+            timer.cancel()
         self.on_keycardRemoved(keycard)
 
         self.info("removed keycard with id %s" % keycard.id)
@@ -357,12 +340,17 @@ class Bouncer(component.BaseComponent):
         self.removeKeycard(keycard)
 
     def keepAlive(self, issuerName, ttl):
-        for k in self._keycards.itervalues():
-            if hasattr(k, 'issuerName') and k.issuerName == issuerName:
-                k.ttl = ttl
+        for k in self._issuerKeycards.get(issuerName, {}).itervalues():
+            k.ttl = ttl
+            self._scheduleExpiry(k)
 
     def expireAllKeycards(self):
-        return self.expireKeycardIds(self._keycards.keys())
+        # grouped by requester, so that most blocks of keycards are
+        # expired with a single remote call
+        keycardIds = []
+        for ids in self._requesterKeycards.values():
+            keycardIds.extend(ids)
+        return self.expireKeycardIds(keycardIds)
 
     def expireKeycardId(self, keycardId):
         self.log("expiring keycard with id %r", keycardId)
@@ -384,39 +372,42 @@ class Bouncer(component.BaseComponent):
         self._expireNextKeycardBlock(0, keycardIds, d)
         return d
 
-    def _expireNextKeycardBlock(self, total, keycardIds, finished):
+    def _expireNextKeycardBlock(self, total, keycardIds, finished, start=0):
         # We can't expire all keycards in a single blocking call because
         # there might be so many that the component goes lost.
         # This call will trigger expiring all keycards by chunking them
         # across separate deferreds.
-
-        keycardBlock = keycardIds[:EXPIRE_BLOCK_SIZE]
-        keycardIds = keycardIds[EXPIRE_BLOCK_SIZE:]
-        idByReq = {}
-
-        for keycardId in keycardBlock:
-            if keycardId in self._keycards:
-                keycard = self._keycards[keycardId]
-                requesterId = keycard.requesterId
-                idByReq.setdefault(requesterId, []).append(keycardId)
-                self.removeKeycardId(keycardId)
-
-        if not (idByReq and self.medium):
-            # instead of serializing each block by chaining deferreds, which
-            # can trigger maximum recursion depth, we just callback once
-            # on the passed-in deferred
-            finished.callback(total)
-            return
-
-        defs = [self.medium.callRemote('expireKeycards', rid, ids)
-                for rid, ids in idByReq.items()]
-        dl = defer.DeferredList(defs, consumeErrors=True)
+        # The blocks are taken from an offset in the list, slicing the
+        # rest of the list for every block would be quadratic.
 
         def countExpirations(results, total):
             return sum([v for s, v in results if s and v]) + total
 
-        dl.addCallback(countExpirations, total)
-        dl.addCallback(self._expireNextKeycardBlock, keycardIds, finished)
+        while start < len(keycardIds):
+            keycardBlock = keycardIds[start:start + EXPIRE_BLOCK_SIZE]
+            start += EXPIRE_BLOCK_SIZE
+            idByReq = {}
+
+            for keycardId in keycardBlock:
+                if keycardId in self._keycards:
+                    keycard = self._keycards[keycardId]
+                    requesterId = keycard.requesterId
+                    idByReq.setdefault(requesterId, []).append(keycardId)
+                    self.removeKeycardId(keycardId)
+
+            if idByReq and self.medium:
+                defs = [self.medium.callRemote('expireKeycards', rid, ids)
+                        for rid, ids in idByReq.items()]
+                dl = defer.DeferredList(defs, consumeErrors=True)
+                dl.addCallback(countExpirations, total)
+                dl.addCallback(self._expireNextKeycardBlock, keycardIds,
+                               finished, start)
+                return
+
+        # instead of serializing each block by chaining deferreds, which
+        # can trigger maximum recursion depth, we just callback once
+        # on the passed-in deferred
+        finished.callback(total)
 
     def _addKeycard(self, keycard):
         """
@@ -424,16 +415,48 @@ class Bouncer(component.BaseComponent):
         Used by sub-class knowing what they do.
         """
         self._keycards[keycard.id] = keycard
+        self._indexKeycard(keycard)
+        if hasattr(keycard, 'ttl'):
+            self._scheduleExpiry(keycard)
         self.on_keycardAdded(keycard)
 
         self.debug("added keycard with id %s, ttl %r", keycard.id,
                    getattr(keycard, 'ttl', None))
 
-    def _expire(self):
-        if not self.do_expireKeycards(self._expirer.timeout):
-            if self._expirer.running:
-                self.debug('no more keycards, removing timeout poller')
-                self._expirer.stop()
+    def _indexKeycard(self, keycard):
+        issuerName = getattr(keycard, 'issuerName', None)
+        if issuerName is not None:
+            self._issuerKeycards.setdefault(issuerName, {})[keycard.id] = \
+                keycard
+        self._requesterKeycards.setdefault(keycard.requesterId,
+                                           set()).add(keycard.id)
+
+    def _unindexKeycard(self, keycard):
+        issuerName = getattr(keycard, 'issuerName', None)
+        issued = self._issuerKeycards.get(issuerName, None)
+        if issued is not None:
+            issued.pop(keycard.id, None)
+            if not issued:
+                del self._issuerKeycards[issuerName]
+        ids = self._requesterKeycards.get(keycard.requesterId, None)
+        if ids is not None:
+            ids.discard(keycard.id)
+            if not ids:
+                del self._requesterKeycards[keycard.requesterId]
+
+    def _scheduleExpiry(self, keycard):
+        # expire the keycard in keycard.ttl seconds
+        timer = self._keycardTimers.get(keycard.id, None)
+        if timer is None:
+            self._keycardTimers[keycard.id] = self._timerWheel.schedule(
+                keycard.ttl, self._keycardExpired, keycard.id)
+        else:
+            timer.reset(keycard.ttl)
+
+    def _keycardExpired(self, keycardId):
+        del self._keycardTimers[keycardId]
+        self.debug("keycard with id %s timed out", keycardId)
+        self.expireKeycardId(keycardId)
 
 
 class AuthSessionBouncer(Bouncer):
@@ -445,10 +468,14 @@ class AuthSessionBouncer(Bouncer):
     def init(self):
         # Keycards pending to be authenticated
         self._sessions = {} # keycard id -> (ttl, data)
+        self._sessionTimers = {} # keycard id -> Timer expiring the session
 
     def on_disabled(self):
         # Removing all pending authentication
         self._sessions.clear()
+        for timer in self._sessionTimers.values():
+            timer.cancel()
+        self._sessionTimers.clear()
 
     def do_extractKeycardInfo(self, keycard, oldData):
         """
@@ -549,7 +576,7 @@ class AuthSessionBouncer(Bouncer):
         @raise KeyError: when there is no session associated with the keycard.
         """
         keycard.state = keycards.REFUSED
-        del self._sessions[keycard.id]
+        self._removeAuthSession(keycard.id)
 
     def confirmAuthSession(self, keycard):
         """
@@ -576,7 +603,7 @@ class AuthSessionBouncer(Bouncer):
             keycard.state = keycards.REFUSED
             return False
 
-        del self._sessions[keycardId]
+        self._removeAuthSession(keycardId)
 
         # Check if there already an authenticated keycard with the same id
         if keycardId in self._keycards:
@@ -603,18 +630,21 @@ class AuthSessionBouncer(Bouncer):
         ttl, _oldData = self._sessions.get(keycard.id, (None, None))
         if ttl is None:
             ttl = getattr(keycard, 'ttl', None)
+            if ttl is not None:
+                self._sessionTimers[keycard.id] = self._timerWheel.schedule(
+                    ttl, self._authSessionExpired, keycard.id)
         self._sessions[keycard.id] = (ttl, data)
 
-    def do_expireKeycards(self, elapsed):
-        cont = Bouncer.do_expireKeycards(self, elapsed)
-        for sessionId, (ttl, data) in self._sessions.items():
-            if ttl is not None:
-                ttl -= elapsed
-                self._sessions[sessionId] = (ttl, data)
-                if ttl <= 0:
-                    del self._sessions[sessionId]
+    def _removeAuthSession(self, keycardId):
+        del self._sessions[keycardId]
+        timer = self._sessionTimers.pop(keycardId, None)
+        if timer is not None:
+            timer.cancel()
 
-        return cont and len(self._sessions) > 0
+    def _authSessionExpired(self, keycardId):
+        del self._sessionTimers[keycardId]
+        self.debug("authentication session with id %s timed out", keycardId)
+        del self._sessions[keycardId]
 
     def _updateInfoFromKeycard(self, keycard):
         oldData = self.getAuthSessionInfo(keycard)
@@ -27,12 +27,11 @@ from zope.interface import implements
 
 from flumotion.common import errors
 from flumotion.common import messages, netutils, interfaces
-from flumotion.common import format as formatting
 from flumotion.component import feedcomponent
 from flumotion.component.base import http
 from flumotion.component.component import moods
 from flumotion.component.misc.porter import porterclient
-from flumotion.twisted import fdserver
+from flumotion.twisted import fdserver, flavors
 
 from flumotion.common.i18n import N_, gettexter
 
@@ -42,6 +41,8 @@ __version__ = "$Rev$"
 STATS_POLL_INTERVAL = 10
 UI_UPDATE_THROTTLE_PERIOD = 2.0 # Don't update UI more than once every two
                                 # seconds
+# Minimum relative change for the statistics to be published
+UI_UPDATE_MIN_CHANGE = 0.01
 T_ = gettexter()
 
 
@@ -165,33 +166,29 @@ class Stats(object):
         bytes_received = c.getBytesReceived()
         uptime = c.getUptime()
 
+        # The values are published raw, the admin formats them;
+        # the -raw keys are kept for older admins
         set('stream-mime', c.get_mime())
         set('stream-url', c.getUrl())
-        set('stream-uptime', formatting.formatTime(uptime))
+        set('stream-uptime', uptime)
         bitspeed = bytes_received * 8 / uptime
         currentbitrate = self.getCurrentBitrate()
-        set('stream-bitrate', formatting.formatStorage(bitspeed) + 'bit/s')
-        set('stream-current-bitrate',
-            formatting.formatStorage(currentbitrate) + 'bit/s')
-        set('stream-totalbytes',
-            formatting.formatStorage(bytes_received) + 'Byte')
+        set('stream-bitrate', bitspeed)
+        set('stream-current-bitrate', currentbitrate)
+        set('stream-totalbytes', bytes_received)
         set('stream-bitrate-raw', bitspeed)
         set('stream-totalbytes-raw', bytes_received)
 
-        set('clients-current', str(c.getClients()))
-        set('clients-max', str(c.getMaxClients()))
-        set('clients-peak', str(c.getPeakClients()))
+        set('clients-current', c.getClients())
+        set('clients-max', c.getMaxClients())
+        set('clients-peak', c.getPeakClients())
         set('clients-peak-time', c.getPeakEpoch())
-        set('clients-average', str(int(c.getAverageClients())))
+        set('clients-average', int(c.getAverageClients()))
 
         bitspeed = bytes_sent * 8 / uptime
-        set('consumption-bitrate',
-            formatting.formatStorage(bitspeed) + 'bit/s')
-        set('consumption-bitrate-current',
-            formatting.formatStorage(
-                currentbitrate * c.getClients()) + 'bit/s')
-        set('consumption-totalbytes',
-            formatting.formatStorage(bytes_sent) + 'Byte')
+        set('consumption-bitrate', bitspeed)
+        set('consumption-bitrate-current', currentbitrate * c.getClients())
+        set('consumption-totalbytes', bytes_sent)
         set('consumption-bitrate-raw', bitspeed)
         set('consumption-totalbytes-raw', bytes_sent)
 
@@ -306,12 +303,31 @@ class Streamer(feedcomponent.ParseLaunchComponent, Stats):
                   'consumption-bitrate-current',
                   'consumption-totalbytes', 'stream-bitrate-raw',
                   'stream-totalbytes-raw', 'consumption-bitrate-raw',
-                  'consumption-totalbytes-raw', 'stream-url'):
+                  'consumption-totalbytes-raw', 'stream-url',
+                  'auth-cache-hits', 'auth-cache-misses',
+                  'auth-cache-hit-ratio', 'auth-cache-size'):
             self.uiState.addKey(i, None)
 
+        self._uiPublisher = flavors.StatePublisher(self.uiState)
+        self._uiPublisher.setPolicy('stream-uptime',
+                                    minInterval=STATS_POLL_INTERVAL)
+        for i in ('stream-current-bitrate', 'stream-bitrate',
+                  'stream-totalbytes', 'consumption-bitrate',
+                  'consumption-bitrate-current', 'consumption-totalbytes',
+                  'stream-bitrate-raw', 'stream-totalbytes-raw',
+                  'consumption-bitrate-raw', 'consumption-totalbytes-raw'):
+            self._uiPublisher.setPolicy(i, minChange=UI_UPDATE_MIN_CHANGE)
+
     def getDescription(self):
         return self.description
 
+    def updateState(self, set):
+        Stats.updateState(self, set)
+        stats = self.httpauth and self.httpauth.getCacheStats()
+        if stats:
+            for key, value in stats.items():
+                set('auth-cache-' + key, value)
+
     def get_pipeline_string(self, properties):
         return self.pipe_template
 
@@ -388,6 +404,12 @@ class Streamer(feedcomponent.ParseLaunchComponent, Stats):
         if 'allow-default' in properties:
             self.httpauth.setAllowDefault(properties['allow-default'])
 
+        if 'auth-cache-ttl' in properties:
+            self.httpauth.enableCache(
+                float(properties['auth-cache-ttl']),
+                properties.get('auth-cache-size', None),
+                properties.get('auth-cache-negative-ttl', None))
+
         if 'duration' in properties:
             self.httpauth.setDefaultDuration(
                 float(properties['duration']))
@@ -483,20 +505,23 @@ class Streamer(feedcomponent.ParseLaunchComponent, Stats):
         return (deltaadded * bitrate, deltaremoved * bitrate, bytes_sent,
             clients_connected, current_load)
 
+    def _updateUIStateNow(self):
+        self._updateUI_DC = None
+        self.update_ui_state()
+
     def update_ui_state(self):
         """Update the uiState object.
         Such updates (through this function) are throttled to a maximum rate,
         to avoid saturating admin clients with traffic when many clients are
         connecting/disconnecting.
+        Nothing is updated while nobody observes the uiState object.
         """
 
-        def setIfChanged(k, v):
-            if self.uiState.get(k) != v:
-                self.uiState.set(k, v)
-
-        def update_ui_state_later():
-            self._updateUI_DC = None
-            self.update_ui_state()
+        if not self._uiPublisher.isObserved():
+            if self._updateUI_DC:
+                self._updateUI_DC.cancel()
+                self._updateUI_DC = None
+            return
 
         now = time.time()
 
@@ -507,22 +532,38 @@ class Streamer(feedcomponent.ParseLaunchComponent, Stats):
                 self._updateUI_DC = None
 
             self._lastUpdate = now
-            # fixme: have updateState just update what changed itself
-            # without the hack above
-            self.updateState(setIfChanged)
+            self.uiState.beginBatch()
+            try:
+                self.updateState(self._uiPublisher.update)
+            finally:
+                self.uiState.commitBatch()
         elif not self._updateUI_DC:
             # Otherwise, schedule doing this in a few seconds (unless an update
             # was already scheduled)
             self._updateUI_DC = reactor.callLater(UI_UPDATE_THROTTLE_PERIOD,
-                                                  update_ui_state_later)
+                                                  self._updateUIStateNow)
+
+    def observerAppend(self, observer, num):
+        feedcomponent.ParseLaunchComponent.observerAppend(self, observer, num)
+        if num == 1 and not self._updateUI_DC:
+            # Catch up with the updates skipped while nobody observed,
+            # once the observer got the uiState object
+            self._lastUpdate = 0
+            self._updateUI_DC = reactor.callLater(0, self._updateUIStateNow)
 
     def do_stop(self):
         if self._updateCallLaterId:
             self._updateCallLaterId.cancel()
             self._updateCallLaterId = None
 
+        if self._updateUI_DC:
+            self._updateUI_DC.cancel()
+            self._updateUI_DC = None
+        self._uiPublisher.stop()
+
         if self.httpauth:
             self.httpauth.stopKeepAlive()
+            self.httpauth.logCacheStats()
 
         if self._tport:
             self._tport.stopListening()
@@ -850,13 +850,17 @@ class BaseComponent(common.InitMixin, log.Loggable):
         deltaClock = nowClock - self._lastClock
         self._lastTime = nowTime
         self._lastClock = nowClock
-        # deltaClock can be < 0 if time.clock() wrapped around
-        if deltaClock >= 0:
-            CPU = deltaClock/deltaTime
-            self.log('latest CPU use: %r', CPU)
-            self.uiState.set('cpu-percent', CPU)
-
-        self.uiState.set('current-time', nowTime)
+        self.uiState.beginBatch()
+        try:
+            # deltaClock can be < 0 if time.clock() wrapped around
+            if deltaClock >= 0:
+                CPU = deltaClock/deltaTime
+                self.log('latest CPU use: %r', CPU)
+                self.uiState.set('cpu-percent', CPU)
+
+            self.uiState.set('current-time', nowTime)
+        finally:
+            self.uiState.commitBatch()
 
     def _pollMemory(self):
         self._memoryPollerDC = None
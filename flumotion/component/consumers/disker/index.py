@@ -0,0 +1,560 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_component_disker -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+# The keyframe index of the disker recordings. It doesn't depend on
+# GStreamer, so it can also be used to seek in the recordings when
+# serving them.
+
+import array
+import bisect
+import struct
+
+from twisted.internet import reactor
+
+from flumotion.common import log, messages, common
+from flumotion.common.i18n import N_, gettexter
+
+__all__ = ['Index']
+__version__ = "$Rev$"
+T_ = gettexter()
+
+# The index entries are written to disk at least this often (in seconds)
+INDEX_FLUSH_INTERVAL = 10
+# or when this many entries are waiting to be written
+INDEX_FLUSH_ENTRIES = 100
+
+# The index entries are kept in arrays of 64 bits integers when the
+# platform has them, and of floats otherwise, exact up to 2^53
+if array.array('l').itemsize >= 8:
+    _INDEX_ARRAY_TYPE = 'l'
+else:
+    _INDEX_ARRAY_TYPE = 'd'
+
+
+def _openFile(loggable, component, location, mode):
+    # used by both Disker and Index
+    try:
+        handle = open(location, mode)
+        return handle
+    except IOError, e:
+        loggable.warning("Failed to open output file %s: %s",
+                   location, log.getExceptionMessage(e))
+        if component is not None:
+            m = messages.Error(T_(N_(
+                "Failed to open output file '%s' for writing. "
+                "Check permissions on the file."), location))
+            component.addMessage(m)
+        return None
+
+
+class _IndexEntries(object):
+    """
+    I hold the entries of an L{Index} in one array per field, instead of
+    one dict per entry.
+
+    Entries are returned as dicts built when requested.
+    """
+
+    __slots__ = ('offset', 'length', 'timestamp', 'duration', 'keyframe',
+                 'tdt', 'tdtDuration')
+
+    # (entry key, attribute) in the order of the entry dicts
+    FIELDS = [('offset', 'offset'), ('length', 'length'),
+              ('timestamp', 'timestamp'), ('duration', 'duration'),
+              ('keyframe', 'keyframe'), ('tdt', 'tdt'),
+              ('tdt-duration', 'tdtDuration')]
+    ATTRIBUTES = dict(FIELDS)
+
+    def __init__(self):
+        self.clear()
+
+    def __len__(self):
+        return len(self.offset)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self._entry(i)
+                    for i in xrange(*item.indices(len(self.offset)))]
+        if item < 0:
+            item += len(self.offset)
+        if not 0 <= item < len(self.offset):
+            raise IndexError(item)
+        return self._entry(item)
+
+    def column(self, key):
+        """
+        @returns: the array of the values of a field of the entries
+        """
+        return getattr(self, self.ATTRIBUTES[key])
+
+    def append(self, offset, timestamp, keyframe, tdt):
+        self.offset.append(offset)
+        self.length.append(-1)
+        self.timestamp.append(timestamp)
+        self.duration.append(-1)
+        self.keyframe.append(keyframe and 1 or 0)
+        self.tdt.append(tdt)
+        self.tdtDuration.append(-1)
+
+    def updateLast(self, offset, timestamp, tdt):
+        self.length[-1] = offset - self.offset[-1]
+        self.duration[-1] = timestamp - self.timestamp[-1]
+        self.tdtDuration[-1] = tdt - self.tdt[-1]
+
+    def trim(self, count):
+        """
+        Remove the first entries.
+        """
+        for key, attr in self.FIELDS:
+            del getattr(self, attr)[:count]
+
+    def clear(self):
+        for key, attr in self.FIELDS:
+            if attr == 'keyframe':
+                setattr(self, attr, array.array('b'))
+            else:
+                setattr(self, attr, array.array(_INDEX_ARRAY_TYPE))
+
+    def _entry(self, i):
+        return {'offset': int(self.offset[i]),
+                'length': int(self.length[i]),
+                'timestamp': int(self.timestamp[i]),
+                'duration': int(self.duration[i]),
+                'keyframe': self.keyframe[i],
+                'tdt': int(self.tdt[i]),
+                'tdt-duration': int(self.tdtDuration[i])}
+
+
+class Index(log.Loggable):
+    '''
+    Creates an index of keyframes for a file, than can be used later for
+    seeking in non indexed formats or whithout parsing the headers.
+
+    The format of the index is very similar to the AVI Index, but it can also
+    include information about the real time of each entry in UNIX time.
+    (see 'man aviindex')
+
+    If the index is for an indexed format, the offset of the first entry will
+    not start from 0. This offset is the size of the headers.
+
+    The index can be written as text, or in a binary format with the same
+    headers followed by fixed size records of the same fields.
+    New entries are written to disk in batches; call L{flush} to write
+    them right away.  '''
+
+    # CHK:      Chunk number starting from 0
+    # POS:      Absolute byte position of the chunk in the file
+    # LEN:      Length in bytes of the chunk
+    # TS:       Timestamp of the chunk (ns)
+    # DUR:      Duration of the chunk (ns)
+    # KF:       Whether it starts with a keyframe or not
+    # TDT:      Time and date using a UNIX timestamp (s)
+    # TDUR:     Duration of the chunk in UNIX time (s)
+    INDEX_HEADER = "FLUIDX1 #Flumotion\n"
+    BINARY_INDEX_HEADER = "FLUIDXB1 #Flumotion\n"
+    INDEX_KEYS = ['CHK', 'POS', 'LEN', 'TS', 'DUR', 'KF', 'TDT', 'TDUR']
+    INDEX_EXTENSION = 'index'
+    # little endian, one signed 64 bits integer per key but KF
+    BINARY_ENTRY_FORMAT = '<qqqqqbqq'
+    BINARY_ENTRY_SIZE = struct.calcsize(BINARY_ENTRY_FORMAT)
+
+    logCategory = "index"
+
+    def __init__(self, component=None, location=None, binary=False):
+        self._index = _IndexEntries()
+        self._headers_size = 0
+        self._binary = binary
+        self._pending = [] # entries formatted but not written yet
+        self._flushCall = None
+        self.comp = component
+        self.location = location
+
+    def __len__(self):
+        return len(self._index)
+
+    ### Public methods ###
+
+    def updateStart(self, timestamp):
+        '''
+        Remove entries in the index older than this timestamp
+        '''
+        self.debug("Removing entries older than %s", timestamp)
+        self._index.trim(bisect.bisect_left(self._index.timestamp, timestamp))
+
+    def addEntry(self, offset, timestamp, keyframe, tdt=0, writeIndex=True):
+        '''
+        Add a new entry to the the index and writes it to disk if
+        writeIndex is True
+        '''
+        # The TDT is a UNIX timestamp in seconds
+        tdt = int(tdt)
+        entries = self._index
+        if len(entries) > 0:
+            # Check that new entries have increasing timestamp, offset and tdt
+            if not self._checkEntriesContinuity(offset, timestamp, tdt):
+                return
+            # And update the length and duration of the last entry
+            entries.updateLast(offset, timestamp, tdt)
+            # Then queue the last updated index entry to be written to disk
+            if writeIndex and self.location:
+                off = entries.offset[0] - self._headers_size
+                self._pending.append(
+                    self._format_index_entry(len(entries) - 1, off,
+                                             len(entries) - 1))
+                self._scheduleFlush()
+
+        entries.append(offset, timestamp, keyframe, tdt)
+
+        self.log("Added new entry to the index: offset=%s timestamp=%s "
+                 "keyframe=%s tdt=%s", offset, timestamp, keyframe, tdt)
+
+    def flush(self):
+        '''
+        Write the entries waiting to be written to disk
+        '''
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+            self._flushCall = None
+        if not self._pending:
+            return True
+        pending, self._pending = self._pending, []
+        f = _openFile(self, self.comp, self.location, 'ab')
+        if not f:
+            return False
+        try:
+            f.write(''.join(pending))
+        finally:
+            f.close()
+        return True
+
+    def setLocation(self, location):
+        self.flush()
+        self.location = location
+
+    def setHeadersSize(self, size):
+        '''
+        Set the headers size in bytes. Multifdsink append the stream headers
+        to each client. This size is then used to adjust the offset of the
+        index entries
+        '''
+        self._headers_size = size
+
+    def getHeaders(self):
+        '''
+        Return an index entry corresponding to the headers, which is a chunk
+        with 'offset' 0 and 'length' equals to the headers size
+        '''
+        if self._headers_size == 0:
+            return None
+        return {'offset': 0, 'length': self._headers_size,
+                'timestamp': 0, 'duration': -1,
+                'keyframe': 0, 'tdt': 0, 'tdt-duration': -1}
+
+    def getFirstTimestamp(self):
+        if len(self._index) == 0:
+            return -1
+        return int(self._index.timestamp[0])
+
+    def getFirstTDT(self):
+        if len(self._index) == 0:
+            return -1
+        return int(self._index.tdt[0])
+
+    def clipTimestamp(self, start, stop):
+        '''
+        Clip the current index to a start and stop time, returning all the
+        entries matching the boundaries using the 'timestamp'
+        '''
+        return self._clip('timestamp', 'duration', start, stop)
+
+    def clipTDT(self, start, stop):
+        '''
+        Clip the current index to a start and stop time, returning all the
+        entries matching the boundaries using the 'tdt'
+        '''
+        return self._clip('tdt', 'tdt-duration', start, stop)
+
+    def clear(self):
+        '''
+        Clears the index
+        '''
+        self.flush()
+        self._index.clear()
+
+    def save(self, start=None, stop=None):
+        '''
+        Saves the index in a file, using the entries from 'start' to 'stop'
+        '''
+        if self.location is None:
+            self.warning("Couldn't save the index, the location is not set.")
+            return False
+        # The entries waiting to be written are saved too
+        self._pending = []
+        self.flush()
+        f = _openFile(self, self.comp, self.location, 'wb+')
+        if not f:
+            return False
+
+        try:
+            self._write_index_headers(f)
+            if len(self._index) == 0:
+                return True
+            self._write_index_entries(f, *self._filter_index(start, stop))
+        finally:
+            f.close()
+        self.info("Index saved successfully. start=%s stop=%s location=%s ",
+                   start, stop, self.location)
+        return True
+
+    def loadIndexFile(self, location):
+        '''
+        Loads the entries of the index from an index file
+        '''
+        if not location.endswith(self.INDEX_EXTENSION):
+            self._invalidIndex("the extension of this file is not '%s'" %
+                               self.INDEX_EXTENSION)
+            return False
+        try:
+            self.info("Loading index file %s", location)
+            handle = open(location, 'rb')
+            data = handle.read()
+            handle.close()
+        except IOError, e:
+            self._invalidIndex("error reading index file (%r)" % e)
+            return False
+        return self.loadIndexData(data) is not None
+
+    def loadIndexData(self, data, partial=False):
+        '''
+        Loads the entries of the index from the content of an index file.
+        If partial is True, the content can end with an entry still being
+        written, which is ignored.
+
+        @returns: the size of the parsed content, or None if it is not
+                  a valid index
+        '''
+        # Check if the file is not empty
+        if len(data) == 0:
+            return self._invalidIndex("the file is empty")
+        # Check headers
+        binary = data.startswith(self.BINARY_INDEX_HEADER)
+        if not binary and not data.startswith('FLUIDX1 #'):
+            return self._invalidIndex('header is not FLUIDX1')
+        # Check index keys declaration
+        keysStr = ' '.join(self.INDEX_KEYS)
+        lines = data.split('\n', 2)
+        if len(lines) < 2 or lines[1] != keysStr:
+            return self._invalidIndex('keys definition is not: %s' % keysStr)
+        body = len(lines) > 2 and lines[2] or ''
+        self._binary = binary
+        parsed = self._addIndexEntries(body, partial)
+        if parsed is None:
+            return None
+        self.info("Index parsed successfully")
+        return len(data) - len(body) + parsed
+
+    def appendIndexData(self, data):
+        '''
+        Adds the entries written to the index file after the content
+        given to L{loadIndexData}. The content can end with an entry
+        still being written, which is ignored.
+
+        @returns: the size of the parsed content, or None if the entries
+                  are not valid
+        '''
+        return self._addIndexEntries(data, True)
+
+    def seekTimestamp(self, timestamp):
+        '''
+        Find the entry of the last keyframe at or before a timestamp.
+        Timestamps before the first entry seek to the first keyframe.
+
+        @returns: the entry, or None if the timestamp is after the end of
+                  the index
+        '''
+        return self._seek('timestamp', 'duration', timestamp)
+
+    def seekTDT(self, tdt):
+        '''
+        Find the entry of the last keyframe at or before a UNIX time.
+        Times before the first entry seek to the first keyframe.
+
+        @returns: the entry, or None if the time is after the end of
+                  the index
+        '''
+        return self._seek('tdt', 'tdt-duration', tdt)
+
+    ### Private methods ###
+
+    def _invalidIndex(self, reason):
+        self.warning("This file is not a valid index: %s", reason)
+        return None
+
+    def _addIndexEntries(self, body, partial):
+        if partial:
+            if self._binary:
+                body = body[:len(body) - len(body) % self.BINARY_ENTRY_SIZE]
+            else:
+                body = body[:body.rfind('\n') + 1]
+        if self._binary:
+            entries = self._parseBinaryEntries(body)
+        else:
+            entries = self._parseTextEntries(body)
+        setHeaders = len(self._index) == 0
+        try:
+            for e in entries:
+                self.addEntry(e[1], e[3], e[5], e[6], False)
+                if setHeaders:
+                    self._headers_size = e[1]
+                    setHeaders = False
+        except ValueError, e:
+            return self._invalidIndex(str(e))
+        return len(body)
+
+    def _parseTextEntries(self, body):
+        count = len(self.INDEX_KEYS)
+        for entryLine in body.splitlines():
+            e = entryLine.split(' ')
+            if len(e) < count:
+                raise ValueError("one of the entries doesn't have enough "
+                                 "parameters (needed=%d, provided=%d)" %
+                                 (count, len(e)))
+            try:
+                yield (int(e[0]), int(e[1]), int(e[2]), int(e[3]), int(e[4]),
+                       common.strToBool(e[5]), int(e[6]), int(e[7]))
+            except Exception, e:
+                raise ValueError("could not parse one of the entries: %r"
+                                 % e)
+
+    def _parseBinaryEntries(self, body):
+        size = self.BINARY_ENTRY_SIZE
+        if len(body) % size:
+            raise ValueError("the binary entries are truncated")
+        for i in xrange(0, len(body), size):
+            yield struct.unpack(self.BINARY_ENTRY_FORMAT, body[i:i + size])
+
+    def _checkEntriesContinuity(self, offset, timestamp, tdt):
+        entries = self._index
+        if (offset >= entries.offset[-1] and
+            timestamp >= entries.timestamp[-1] and tdt >= entries.tdt[-1]):
+            return True
+        for key, value in [('offset', offset), ('timestamp', timestamp),
+                           ('tdt', tdt)]:
+            last = entries.column(key)[-1]
+            if value < last:
+                self.warning("Could not add entries with a decreasing %s "
+                         "(last=%s, new=%s)", key, int(last), value)
+                return False
+        return True
+
+    def _clip(self, keyTS, keyDur, start, stop):
+        '''
+        Clip the index to a start and stop time. For an index with 10
+        entries of 10 seconds starting from 0, cliping from 15 to 35 will
+        return the entries 1, 2, and 3.
+        '''
+        if start >= stop or len(self._index) == 0:
+            return None
+
+        keys = self._index.column(keyTS)
+
+        # If the last entry has a duration, the index ends with it
+        first = keys[0]
+        end = keys[-1]
+        lastDuration = self._index.column(keyDur)[-1]
+        if lastDuration != -1:
+            end += lastDuration
+
+        # Return if the start and stop time are not inside the boundaries
+        if stop <= first or start >= end:
+            return None
+
+        # Set the start and stop time to match the boundaries so that we don't
+        # get indexes outside the array boundaries
+        if start <= first:
+            start = first
+        if stop >= end:
+            stop = end - 1
+
+        # Do the bisection
+        i_start = bisect.bisect_right(keys, start) - 1
+        i_stop = bisect.bisect_right(keys, stop)
+
+        return self._index[i_start:i_stop]
+
+    def _seek(self, keyTS, keyDur, position):
+        if len(self._index) == 0:
+            return None
+        keys = self._index.column(keyTS)
+        # An entry without duration is the last one of an index still
+        # being written, it lasts until the next one is added
+        lastDuration = self._index.column(keyDur)[-1]
+        if lastDuration != -1 and position >= keys[-1] + lastDuration:
+            return None
+        i = max(bisect.bisect_right(keys, position) - 1, 0)
+        keyframes = self._index.keyframe
+        while i > 0 and not keyframes[i]:
+            i -= 1
+        return self._index[i]
+
+    def _filter_index(self, start=None, stop=None):
+        '''
+        Filter the index with a start and stop time, returning the range
+        of the matching entries.
+        '''
+        timestamps = self._index.timestamp
+        if not start:
+            i_start = 0
+        else:
+            i_start = bisect.bisect_left(timestamps, start)
+        if not stop:
+            i_stop = len(timestamps)
+        else:
+            i_stop = bisect.bisect_right(timestamps, stop)
+        return i_start, i_stop
+
+    def _scheduleFlush(self):
+        if len(self._pending) >= INDEX_FLUSH_ENTRIES:
+            self.flush()
+        elif self._flushCall is None:
+            self._flushCall = reactor.callLater(INDEX_FLUSH_INTERVAL,
+                                                self.flush)
+
+    def _write_index_headers(self, file):
+        if self._binary:
+            file.write(self.BINARY_INDEX_HEADER)
+        else:
+            file.write(self.INDEX_HEADER)
+        file.write("%s\n" % ' '.join(self.INDEX_KEYS))
+
+    def _format_index_entry(self, i, offset, count):
+        e = self._index
+        values = (count, e.offset[i] - offset, e.length[i], e.timestamp[i],
+                  e.duration[i], e.keyframe[i], e.tdt[i], e.tdtDuration[i])
+        if self._binary:
+            return struct.pack(self.BINARY_ENTRY_FORMAT,
+                               *[int(v) for v in values])
+        return "%d %d %d %d %d %d %d %d\n" % values
+
+    def _write_index_entries(self, file, i_start, i_stop):
+        # the saved entries start right after the headers
+        if i_start >= i_stop:
+            return
+        offset = self._index.offset[i_start] - self._headers_size
+        file.write(''.join([self._format_index_entry(i, offset, i - i_start)
+                            for i in xrange(i_start, i_stop)]))
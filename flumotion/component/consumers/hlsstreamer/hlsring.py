@@ -28,6 +28,9 @@ from flumotion.component.common.streamer.fragmentedresource import\
 class Playlister:
     """
     I write HTTP Live Streaming playlists based on added fragments.
+
+    The playlists are rendered once per update and kept, split at the
+    places where the query arguments of the requests are inserted.
     """
 
     def __init__(self):
@@ -47,6 +50,8 @@ class Playlister:
         self._dummyFragments = []
         self._counter = 0
         self._isAutoUpdate = False
+        self._targetDuration = None
+        self._playlists = {} # {PLAYLIST: [TEXT]}, joined by the query args
 
     def setHostname(self, hostname):
         if hostname.startswith('/'):
@@ -56,17 +61,18 @@ class Playlister:
         if not hostname.startswith('http://'):
             hostname = 'http://' + hostname
         self._hostname = hostname
+        self._playlists = {}
 
     def setAllowCache(self, allowed):
         self.allowCache = allowed
+        self._playlists = {}
 
     def _getFragmentName(self, sequenceNumber):
         return '%s-%s.%s' % (self.fragmentPrefix, sequenceNumber,
                              self.filenameExt)
 
     def _getTargetDuration(self):
-        sorted_list = sorted(self._fragments, key=lambda fragment: fragment[1])
-        return int(sorted_list[0][1])
+        return int(self._targetDuration)
 
     def _autoUpdate(self, count):
         if self._counter == count:
@@ -81,13 +87,18 @@ class Playlister:
             self._fragments.append((sequenceNumber, duration, encrypted,
                 sequenceNumber != self._counter and self._counter != 0))
             self._counter = sequenceNumber + 1
+            if self._targetDuration is None or duration < self._targetDuration:
+                self._targetDuration = duration
             # Remove fragments that are out of the window
             while len(self._fragments) > self.window:
                 # If it's a dummy fragment, remove it from the list too
                 fragName = self._getFragmentName(self._fragments[0][0])
                 if fragName in self._dummyFragments:
                     self._dummyFragments.remove(fragName)
-                del self._fragments[0]
+                removed = self._fragments.pop(0)
+                if removed[1] == self._targetDuration:
+                    self._targetDuration = min([f[1] for f in self._fragments])
+            self._playlists = {}
 
         # Auto update the playlist when the next fragment was not added
         # If the fragment was automatically added update again after 'duration'
@@ -108,20 +119,21 @@ class Playlister:
         return '?' + '&'.join(["%s=%s" % (k, v[0]) for k, v in
                               args.iteritems()])
 
-    def _renderMainPlaylist(self, args):
+    def _renderMainPlaylistParts(self):
         lines = []
 
         lines.append("#EXTM3U")
         #The bandwith value is not significant for single bitrate
         lines.append("#EXT-X-STREAM-INF:PROGRAM-ID=1,BANDWIDTH=%s" %
                 self.streamBitrate)
-        lines.append("".join([self._hostname, self.streamPlaylist,
-            self.renderArgs(args)]))
-        lines.append("")
+        lines.append("".join([self._hostname, self.streamPlaylist]))
+        # The query arguments are inserted between the parts
+        parts = ["\n".join(lines), "\n"]
 
-        return "\n".join(lines)
+        return parts
 
-    def _renderStreamPlaylist(self, args):
+    def _renderStreamPlaylistParts(self):
+        parts = []
         lines = []
 
         lines.append("#EXTM3U")
@@ -136,25 +148,45 @@ class Playlister:
             # FIXME: Not fully implemented yet
             if encrypted:
                 lines.append('#EXT-X-KEY:METHOD=AES-128,URI="%s?key=%s"' %
-                        (self.keysURI, fragment))
+                        (self.keysURI, self._getFragmentName(sequenceNumber)))
             lines.append("#EXTINF:%d,%s" % (duration, self.title))
             lines.append(''.join([self._hostname,
-                self._getFragmentName(sequenceNumber), self.renderArgs(args)]))
+                self._getFragmentName(sequenceNumber)]))
+            # The query arguments are inserted after each fragment URL
+            parts.append("\n".join(lines))
+            lines = [""]
 
         lines.append("")
+        parts.append("\n".join(lines))
+
+        return parts
+
+    def _getPlaylistParts(self, playlist):
+        parts = self._playlists.get(playlist)
+        if parts is None:
+            if playlist == self.mainPlaylist:
+                parts = self._renderMainPlaylistParts()
+            elif playlist == self.streamPlaylist:
+                parts = self._renderStreamPlaylistParts()
+            else:
+                raise PlaylistNotFound()
+            self._playlists[playlist] = parts
+        return parts
 
-        return "\n".join(lines)
+    def _renderMainPlaylist(self, args):
+        parts = self._getPlaylistParts(self.mainPlaylist)
+        return self.renderArgs(args).join(parts)
+
+    def _renderStreamPlaylist(self, args):
+        parts = self._getPlaylistParts(self.streamPlaylist)
+        return self.renderArgs(args).join(parts)
 
     def renderPlaylist(self, playlist, args):
         '''
         Returns a string representation of the requested playlist or raise
         an Exception if the playlist is not found
         '''
-        if playlist == self.mainPlaylist:
-            return self._renderMainPlaylist(args)
-        elif playlist == self.streamPlaylist:
-            return self._renderStreamPlaylist(args)
-        raise PlaylistNotFound()
+        return self.renderArgs(args).join(self._getPlaylistParts(playlist))
 
 
 class HLSRing(Playlister):
@@ -235,6 +267,8 @@ class HLSRing(Playlister):
         self._dummyFragments = []
         self._lastSequence = None
         self._counter = 0
+        self._targetDuration = None
+        self._playlists = {}
 
     def addFragment(self, fragment, sequenceNumber, duration):
         '''
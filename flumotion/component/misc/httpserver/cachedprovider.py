@@ -29,6 +29,7 @@ from flumotion.component.misc.httpserver import cachestats
 from flumotion.component.misc.httpserver import cachemanager
 from flumotion.component.misc.httpserver import fileprovider
 from flumotion.component.misc.httpserver import localpath
+from flumotion.component.misc.httpserver import memorycache
 from flumotion.component.misc.httpserver.fileprovider import FileClosedError
 from flumotion.component.misc.httpserver.fileprovider import FileError
 from flumotion.component.misc.httpserver.fileprovider import NotFoundError
@@ -37,6 +38,7 @@ from flumotion.component.misc.httpserver.fileprovider import NotFoundError
 SEEK_SET = 0 # os.SEEK_SET is not defined in python 2.4
 FILE_COPY_BUFFER_SIZE = abstract.FileDescriptor.bufferSize
 MAX_LOGNAME_SIZE = 30 # maximum number of characters to use for logging a path
+DEFAULT_MEMORY_CACHE_MAX_FILE_SIZE = 512 # in KB
 
 
 LOG_CATEGORY = "fileprovider-localcached"
@@ -88,6 +90,11 @@ class FileProviderLocalCachedPlug(fileprovider.FileProviderPlug,
     lots of files are copied at the same time.
     Simulations with real request logs show that using a thread
     gives better results than the equivalent asynchronous implementation.
+
+    If the property memory-cache-size is set, I'm also keeping small
+    files in memory. A file is kept in memory the first time it's served
+    from the disk cache, so files requested only once don't evict
+    the popular ones; the least recently used files are evicted first.
     """
 
     logCategory = LOG_CATEGORY
@@ -104,6 +111,9 @@ class FileProviderLocalCachedPlug(fileprovider.FileProviderPlug,
         cleanupEnabled = props.get('cleanup-enabled')
         cleanupHighWatermark = props.get('cleanup-high-watermark')
         cleanupLowWatermark = props.get('cleanup-low-watermark')
+        memorySizeInMB = props.get('memory-cache-size')
+        memoryFileSizeInKB = props.get('memory-cache-max-file-size',
+                                       DEFAULT_MEMORY_CACHE_MAX_FILE_SIZE)
 
         self._sessions = {} # {CopySession: None}
         self._index = {} # {path: CopySession}
@@ -116,6 +126,12 @@ class FileProviderLocalCachedPlug(fileprovider.FileProviderPlug,
                                                cleanupHighWatermark,
                                                cleanupLowWatermark)
 
+        self.memory = None
+        if memorySizeInMB:
+            self.memory = memorycache.MemoryCache(self.stats,
+                                                  memorySizeInMB * 10 ** 6,
+                                                  memoryFileSizeInKB * 10 ** 3)
+
         common.ensureDir(self._sourceDir, "source")
 
         # Startup copy thread
@@ -130,11 +146,14 @@ class FileProviderLocalCachedPlug(fileprovider.FileProviderPlug,
     def stop(self, component):
         self.debug('Stopping cachedprovider plug for component %r', component)
         self._thread.stop()
+        self.cache.tearDown()
         dl = []
         for s in self._index.values():
             d = s.close()
             if d:
                 dl.append(d)
+        if self.memory is not None:
+            self.memory.clear()
         if len(dl) != 0:
             return defer.DeferredList(dl)
 
@@ -414,6 +433,10 @@ class CopySession(log.Loggable):
         # Cancel the copy, close the source file and the writing temp file.
         self._cancelCopy(True, True)
         self._closeReadTempFile()
+        if self._allocTag:
+            # The space of a cancelled copy isn't used anymore
+            self.plug.cache.releaseCacheSpace(self._allocTag)
+            self._allocTag = None
         self.plug.removeCopySession(self)
         self.plug = None
 
@@ -639,6 +662,12 @@ class CopySession(log.Loggable):
                 self.warning("Failed to rename temporary file: %s",
                              log.getExceptionMessage(e))
             self._cancelSession()
+        else:
+            if self._allocTag:
+                # The allocated space is now used by the cached file
+                self.plug.cache.commitCacheSpace(self._allocTag,
+                                                 self.sourcePath)
+                self._allocTag = None
         # Complete all pending source read operations with the temporary file.
         for position, size, d in self._pending:
             try:
@@ -807,12 +836,46 @@ class CachedFileDelegate(DirectFileDelegate):
         stats.onBytesRead(0, len(data), 0)
         return data
 
+    def fileno(self):
+        return self._file.fileno()
+
     def close(self):
         if self._file is not None:
             self.log("Closing cached file [fd %d]", self._file.fileno())
             DirectFileDelegate.close(self)
 
 
+class MemoryFileDelegate(log.Loggable):
+
+    logCategory = LOG_CATEGORY
+
+    def __init__(self, plug, path, data, mtime):
+        self.logName = plug.getLogName(path)
+        self.mtime = mtime
+        self.size = len(data)
+        self._data = data
+        self._position = 0
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset):
+        self._position = offset
+
+    def read(self, size, stats):
+        position = self._position
+        if position == 0 and size >= self.size:
+            data = self._data
+        else:
+            data = self._data[position:position + size]
+        self._position += len(data)
+        stats.onBytesRead(0, len(data), 0)
+        return data
+
+    def close(self):
+        self._data = None
+
+
 class CachedFile(fileprovider.File, log.Loggable):
 
     logCategory = LOG_CATEGORY
@@ -847,8 +910,9 @@ class CachedFile(fileprovider.File, log.Loggable):
         failure.trap(NotFoundError)
         self.debug("Source file %r not found", self._path)
         self.plug.outdateCopySession(self._path)
-        cachedPath = self.plug.cache.getCachePath(self._path)
-        self._removeCachedFile(cachedPath)
+        if self.plug.memory is not None:
+            self.plug.memory.remove(self._path)
+        self._removeCachedFile(self._path)
         raise failure
 
     def __str__(self):
@@ -897,6 +961,18 @@ class CachedFile(fileprovider.File, log.Loggable):
     def __del__(self):
         self.close()
 
+    def getFileDescriptor(self):
+        if self._delegate is None:
+            raise FileClosedError("File closed")
+        # Only completely cached files can be sent directly,
+        # temporary files are still being written by the copy thread
+        if isinstance(self._delegate, CachedFileDelegate):
+            return self._delegate.fileno()
+        return None
+
+    def onBytesSent(self, size):
+        self.stats.onBytesRead(0, size, 0)
+
     def getLogFields(self):
         return self.stats.getLogFields()
 
@@ -917,6 +993,23 @@ class CachedFile(fileprovider.File, log.Loggable):
                  sourcePath, sourceFile.fileno())
         # Update the log name
         self.logName = self.plug.getLogName(self._path, sourceFile.fileno())
+        # Looking in memory first
+        memory = self.plug.memory
+        if memory is not None:
+            data = memory.get(sourcePath, sourceInfo[stat.ST_MTIME],
+                              sourceInfo[stat.ST_SIZE])
+            if data is not None:
+                self._closeSourceFile(sourceFile)
+                # Keep the hottest files from being evicted from the disk
+                # cache, without indexing the ones already evicted
+                self.plug.cache.touchCachedFile(sourcePath, len(data),
+                                                add=False)
+                self.debug("Serving '%s' from memory", sourcePath)
+                delegate = MemoryFileDelegate(self.plug, sourcePath, data,
+                                              sourceInfo[stat.ST_MTIME])
+                self.stats.onStarted(delegate.size, cachestats.MEMORY_HIT)
+                return delegate
+            self.plug.stats.onMemoryMiss()
         # Opening cached file
         cachedPath = self.plug.cache.getCachePath(sourcePath)
         try:
@@ -927,10 +1020,11 @@ class CachedFile(fileprovider.File, log.Loggable):
             return self._tryTempFile(sourcePath, sourceFile, sourceInfo)
         except FileError, e:
             self.debug("Failed to open cached file: %s", str(e))
-            self._removeCachedFile(cachedPath)
+            self._removeCachedFile(sourcePath)
             return self._tryTempFile(sourcePath, sourceFile, sourceInfo)
         # Found a cached file, now check the modification time
         self.debug("Found cached file '%s'", cachedPath)
+        self.plug.cache.touchCachedFile(sourcePath, cachedInfo[stat.ST_SIZE])
         sourceTime = sourceInfo[stat.ST_MTIME]
         cacheTime = cachedInfo[stat.ST_MTIME]
         if sourceTime != cacheTime:
@@ -939,23 +1033,50 @@ class CachedFile(fileprovider.File, log.Loggable):
                        sourceTime, cacheTime)
             self.stats.onCacheOutdated()
             self.plug.outdateCopySession(sourcePath)
-            self._removeCachedFile(cachedPath)
+            self._removeCachedFile(sourcePath)
             return self._cacheFile(sourcePath, sourceFile, sourceInfo)
         self._closeSourceFile(sourceFile)
-        # We have a valid cached file, just delegate to it.
+        # We have a valid cached file, keep it in memory if it's small
+        if memory is not None and memory.accepts(cachedInfo[stat.ST_SIZE]):
+            delegate = self._loadCachedFile(sourcePath, cachedFile,
+                                            cachedInfo)
+            if delegate is not None:
+                self.stats.onStarted(delegate.size, cachestats.CACHE_HIT)
+                return delegate
+            cachedFile.seek(0, SEEK_SET)
+        # otherwise just delegate to it.
         self.debug("Serving cached file '%s'", cachedPath)
         delegate = CachedFileDelegate(self.plug, cachedPath,
                                       cachedFile, cachedInfo)
         self.stats.onStarted(delegate.size, cachestats.CACHE_HIT)
         return delegate
 
-    def _removeCachedFile(self, cachePath):
+    def _loadCachedFile(self, sourcePath, cachedFile, cachedInfo):
+        size = cachedInfo[stat.ST_SIZE]
+        try:
+            data = cachedFile.read(size)
+        except IOError, e:
+            self.warning("Failed to read cached file: %s",
+                         log.getExceptionMessage(e))
+            return None
+        if len(data) != size:
+            return None
+        self.log("Closing cached file [fd %d]", cachedFile.fileno())
+        cachedFile.close()
+        mtime = cachedInfo[stat.ST_MTIME]
+        self.plug.memory.put(sourcePath, mtime, data)
+        self.debug("Serving cached file '%s' from memory", sourcePath)
+        return MemoryFileDelegate(self.plug, sourcePath, data, mtime)
+
+    def _removeCachedFile(self, sourcePath):
+        cachePath = self.plug.cache.getCachePath(sourcePath)
         try:
             os.remove(cachePath)
             self.debug("Deleted cached file '%s'", cachePath)
         except OSError, e:
             if e.errno != errno.ENOENT:
                 self.warning("Error deleting cached file: %s", str(e))
+        self.plug.cache.forgetCachedFile(sourcePath)
 
     def _tryTempFile(self, sourcePath, sourceFile, sourceInfo):
         session = self.plug.getCopySession(sourcePath)
@@ -0,0 +1,424 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_cache_manager -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+import errno
+import fcntl
+import heapq
+import os
+import tempfile
+import time
+
+from flumotion.common import log
+
+LOG_CATEGORY = "cache-index"
+
+JOURNAL_NAME = ".cache-index"
+# Minimum time in seconds between two journaled accesses of the same file
+TOUCH_RESOLUTION = 60
+# The journal is compacted when it has more records than this
+# and more than twice the number of indexed files
+COMPACT_MIN_RECORDS = 10000
+READ_BUFFER_SIZE = 64 * 1024
+
+
+class CacheIndex(log.Loggable):
+    """
+    I keep track of the size and the last access time of the files
+    in a cache directory, so the cache usage is known without scanning
+    the directory, and the least recently accessed files can be found
+    in logarithmic time.
+
+    The index is persisted in an append-only journal file in the cache
+    directory. Multiple processes sharing the same cache directory append
+    to the same journal and read each other's records when synchronizing.
+    The journal is compacted to a snapshot of the index when it grows too
+    big; while compacting, the journal is locked exclusively.
+
+    When there is no journal yet, the cache directory is scanned once.
+
+    @ivar usage:  the total size of the indexed files, in bytes
+    @type usage:  int
+    @ivar loaded: whether the index has been loaded
+    @type loaded: bool
+    """
+
+    logCategory = LOG_CATEGORY
+
+    def __init__(self, directory, ignoredSuffix=None,
+                 journalName=JOURNAL_NAME):
+        """
+        @param directory:     the cache directory
+        @type  directory:     str
+        @param ignoredSuffix: suffix of files not to index when scanning
+                              the directory, like temporary files
+        @type  ignoredSuffix: str
+        """
+        self.usage = 0
+        self.loaded = False
+        self._directory = directory
+        self._ignoredSuffix = ignoredSuffix
+        self._journalPath = os.path.join(directory, journalName)
+        # Two flat dictionaries instead of one of lists, so the hundreds
+        # of thousands of entries are not tracked by the garbage collector
+        self._sizes = {} # {name: size}
+        self._atimes = {} # {name: atime}
+        self._heap = None # [(atime, name)], may contain outdated items
+        self._fd = None
+        self._inode = None
+        self._offset = 0 # how far the journal has been read
+        self._records = 0 # how many records the journal has
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def __contains__(self, name):
+        return name in self._sizes
+
+    def getSize(self, name):
+        """
+        @returns: the size of an indexed file, or None
+        """
+        return self._sizes.get(name)
+
+    def load(self):
+        """
+        Load the index from the journal, scanning the cache directory
+        if there is no journal. This is blocking, so it should be called
+        from a thread.
+
+        @raise: OSError
+        """
+        self._open()
+        self._lock(fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size == 0:
+                self._scan()
+            else:
+                self._readRecords()
+                if self._shouldCompact():
+                    self._compact()
+        finally:
+            self._lock(fcntl.LOCK_UN)
+        self._rebuildHeap()
+        self.loaded = True
+        self.debug("Loaded %d cached files using %d bytes",
+                   len(self._sizes), self.usage)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def sync(self):
+        """
+        Read the records appended by other processes sharing the cache.
+        """
+        if self._fd is None:
+            return
+        try:
+            self._lock(fcntl.LOCK_SH)
+            try:
+                self._checkReplaced(fcntl.LOCK_SH)
+                self._readRecords()
+            finally:
+                self._lock(fcntl.LOCK_UN)
+        except (OSError, IOError), e:
+            self._journalFailed(e)
+            return
+        if self._shouldCompact():
+            self.compact()
+
+    def add(self, name, size, atime=None):
+        if atime is None:
+            atime = int(time.time())
+        self._append("+ %s %d %d\n" % (name, size, atime))
+        self._set(name, size, atime)
+
+    def touch(self, name, size, atime=None):
+        """
+        Update the access time of a file, adding it if it's not indexed.
+        """
+        if atime is None:
+            atime = int(time.time())
+        if self._sizes.get(name) != size:
+            self.add(name, size, atime)
+            return
+        if atime - self._atimes[name] < TOUCH_RESOLUTION:
+            return
+        self._append("* %s %d\n" % (name, atime))
+        self._setAccessTime(name, atime)
+
+    def remove(self, name):
+        if name in self._sizes:
+            self._append("- %s\n" % name)
+            self._unset(name)
+
+    def popOldest(self):
+        """
+        Remove the least recently accessed file from the index.
+
+        @returns: the name and size of the removed file, or None
+        @rtype:   (str, int)
+        """
+        name = self._oldest()
+        if name is None:
+            return None
+        size = self._sizes[name]
+        self.remove(name)
+        return name, size
+
+    def evict(self, usage):
+        """
+        Remove the least recently accessed files from the index
+        until the usage is not bigger than the given one.
+
+        @returns: the names of the removed files
+        @rtype:   list of str
+        """
+        names = []
+        while self.usage > usage:
+            name = self._oldest()
+            if name is None:
+                break
+            # Unset right away so the outdated items of the same file
+            # left in the heap are skipped
+            self._unset(name)
+            names.append(name)
+        if names:
+            self._append("".join(["- %s\n" % name for name in names]))
+        return names
+
+    def compact(self):
+        """
+        Replace the journal by a snapshot of the index.
+        """
+        if self._fd is None:
+            return
+        try:
+            self._lock(fcntl.LOCK_EX)
+            try:
+                self._checkReplaced(fcntl.LOCK_EX)
+                self._readRecords()
+                self._compact()
+            finally:
+                self._lock(fcntl.LOCK_UN)
+        except (OSError, IOError), e:
+            self._journalFailed(e)
+
+
+    ## Private Methods ##
+
+    def _open(self):
+        self._fd = os.open(self._journalPath,
+                           os.O_RDWR | os.O_APPEND | os.O_CREAT, 0644)
+        self._inode = os.fstat(self._fd).st_ino
+        self._offset = 0
+        self._records = 0
+
+    def _lock(self, operation):
+        fcntl.flock(self._fd, operation)
+
+    def _shouldCompact(self):
+        return self._records > max(COMPACT_MIN_RECORDS, 2 * len(self._sizes))
+
+    def _compact(self):
+        # Called with the journal locked exclusively
+        self.debug("Compacting journal of %d records for %d files",
+                   self._records, len(self._sizes))
+        fd, path = tempfile.mkstemp(".tmp", JOURNAL_NAME, self._directory)
+        try:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_APPEND)
+            os.fchmod(fd, 0644)
+            self._writeSnapshot(fd)
+            os.rename(path, self._journalPath)
+        except:
+            os.close(fd)
+            os.unlink(path)
+            raise
+        # The lock on the replaced journal is released by closing it
+        os.close(self._fd)
+        self._fd = fd
+        self._inode = os.fstat(fd).st_ino
+        self._offset = os.fstat(fd).st_size
+        self._records = len(self._sizes)
+
+    def _checkReplaced(self, operation):
+        # The journal is replaced when another process compacts it
+        try:
+            inode = os.stat(self._journalPath).st_ino
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            inode = None
+        if inode == self._inode:
+            return
+        self._lock(fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._open()
+        self._lock(operation)
+        if os.fstat(self._fd).st_size == 0:
+            self.debug("Journal removed, writing the index to a new one")
+            self._writeSnapshot(self._fd)
+            self._offset = os.fstat(self._fd).st_size
+            self._records = len(self._sizes)
+            return
+        self.debug("Journal replaced, reloading the index")
+        self._sizes = {}
+        self._atimes = {}
+        self._heap = None
+        self.usage = 0
+        self._readRecords()
+        self._rebuildHeap()
+
+    def _scan(self):
+        self.debug("No journal found, scanning '%s'", self._directory)
+        for name in os.listdir(self._directory):
+            if name.startswith('.'):
+                continue
+            if self._ignoredSuffix and name.endswith(self._ignoredSuffix):
+                continue
+            try:
+                info = os.stat(os.path.join(self._directory, name))
+            except OSError, e:
+                if e.errno == errno.ENOENT:
+                    continue
+                raise
+            self._set(name, info.st_size, int(info.st_atime))
+        self._writeSnapshot(self._fd)
+        self._offset = os.fstat(self._fd).st_size
+        self._records = len(self._sizes)
+
+    def _writeSnapshot(self, fd):
+        atimes = self._atimes
+        lines = ["+ %s %d %d\n" % (name, size, atimes[name])
+                 for name, size in self._sizes.iteritems()]
+        data = "".join(lines)
+        while data:
+            written = os.write(fd, data)
+            data = data[written:]
+
+    def _readRecords(self, end=None):
+        # Read the records from the current offset, up to the given one
+        os.lseek(self._fd, self._offset, 0)
+        pending = ""
+        while True:
+            size = READ_BUFFER_SIZE
+            if end is not None:
+                size = min(size, end - self._offset - len(pending))
+                if size <= 0:
+                    break
+            data = os.read(self._fd, size)
+            if not data:
+                break
+            data = pending + data
+            lineEnd = data.rfind("\n") + 1
+            pending = data[lineEnd:]
+            for line in data[:lineEnd].splitlines():
+                self._replay(line)
+            self._offset += lineEnd
+        # An incomplete line is being written by another process,
+        # it will be read the next time.
+
+    def _replay(self, line):
+        self._records += 1
+        fields = line.split(" ")
+        try:
+            op = fields[0]
+            if op == "+":
+                self._set(fields[1], int(fields[2]), int(fields[3]))
+            elif op == "*":
+                if fields[1] in self._sizes:
+                    self._setAccessTime(fields[1], int(fields[2]))
+            elif op == "-":
+                self._unset(fields[1])
+            else:
+                raise ValueError(op)
+        except (IndexError, ValueError):
+            self.warning("Invalid journal record: %r", line)
+
+    def _set(self, name, size, atime):
+        self.usage += size - self._sizes.get(name, 0)
+        self._sizes[name] = size
+        self._atimes[name] = atime
+        self._push(name, atime)
+
+    def _setAccessTime(self, name, atime):
+        if atime > self._atimes[name]:
+            self._atimes[name] = atime
+            self._push(name, atime)
+
+    def _unset(self, name):
+        size = self._sizes.pop(name, None)
+        if size is None:
+            return False
+        del self._atimes[name]
+        self.usage -= size
+        return True
+
+    def _push(self, name, atime):
+        # While loading, the heap is built at once afterward
+        if self._heap is None:
+            return
+        heapq.heappush(self._heap, (atime, name))
+        # Drop the outdated items when they are the majority
+        if len(self._heap) > 2 * len(self._sizes) + 1000:
+            self._rebuildHeap()
+
+    def _rebuildHeap(self):
+        self._heap = [(atime, name)
+                      for name, atime in self._atimes.iteritems()]
+        heapq.heapify(self._heap)
+
+    def _oldest(self):
+        heap = self._heap
+        atimes = self._atimes
+        while heap:
+            atime, name = heapq.heappop(heap)
+            if atimes.get(name) == atime:
+                return name
+        return None
+
+    def _append(self, record):
+        if self._fd is None:
+            return
+        try:
+            self._lock(fcntl.LOCK_SH)
+            try:
+                self._checkReplaced(fcntl.LOCK_SH)
+                os.write(self._fd, record)
+                # Read the records other processes appended before ours,
+                # and skip ours, already applied
+                end = os.lseek(self._fd, 0, 1)
+                self._readRecords(end - len(record))
+                self._offset = end
+                self._records += record.count("\n")
+            finally:
+                self._lock(fcntl.LOCK_UN)
+        except (OSError, IOError), e:
+            self._journalFailed(e)
+
+    def _journalFailed(self, e):
+        self.warning("Cache index journal '%s' failed, "
+                     "not persisting the index anymore: %s",
+                     self._journalPath, log.getExceptionMessage(e))
+        if self._fd is not None:
+            try:
+                os.close(self._fd)
+            except OSError:
+                pass
+            self._fd = None
@@ -21,10 +21,11 @@ import tempfile
 import time
 import stat
 
-from twisted.internet import defer, threads, reactor, utils
+from twisted.internet import defer, threads, reactor
 
 from flumotion.common import log, common, python, errors
 from flumotion.common import format as formatting
+from flumotion.component.misc.httpserver import cacheindex
 
 LOG_CATEGORY = "cache-manager"
 
@@ -38,6 +39,14 @@ TEMP_FILE_POSTFIX = ".tmp"
 
 
 class CacheManager(object, log.Loggable):
+    """
+    I manage the space used by a cache directory.
+
+    The size and last access time of the cached files are kept in a
+    L{cacheindex.CacheIndex}, that has to be informed when files are
+    cached, accessed or removed. Space allocated for files being cached
+    is accounted for until it's released or the file is complete.
+    """
 
     logCategory = LOG_CATEGORY
 
@@ -78,9 +87,11 @@ class CacheManager(object, log.Loggable):
 
         common.ensureDir(self._cacheDir, "cache")
 
+        self._index = cacheindex.CacheIndex(self._cacheDir, TEMP_FILE_POSTFIX)
+        self._allocations = {} # {tag: None}
+        self._allocated = 0 # in bytes
+        self._lastTag = 0
         self._cacheUsage = None
-        self._cacheUsageLastUpdate = None
-        self._lastCacheTime = None
 
         self._cacheMaxUsage = self._cacheSize * highWatermark # in bytes
         self._cacheMinUsage = self._cacheSize * lowWatermark # in bytes
@@ -92,8 +103,13 @@ class CacheManager(object, log.Loggable):
         @return a defer
         @raise: OSError or FlumotionError
         """
-        # Initialize cache usage
-        return self.updateCacheUsage()
+        # Loading the index may involve scanning the cache directory
+        d = threads.deferToThread(self._loadIndex)
+        d.addCallback(lambda _: self.updateCacheUsage())
+        return d
+
+    def tearDown(self):
+        self._index.close()
 
     def getIdentifier(self, path):
         """
@@ -135,87 +151,68 @@ class CacheManager(object, log.Loggable):
     def updateCacheUsageStatistics(self):
         self.stats.onEstimateCacheUsage(self._cacheUsage, self._cacheSize)
 
-    def _updateCacheUsage(self, usage):
-        self.log('Disk usage for path %r is %d bytes', self._cacheDir, usage)
-        self._cacheUsageLastUpdate = time.time()
+    def _updateCacheUsage(self):
+        usage = self._index.usage + self._allocated
+        self.log('Cache usage for path %r is %d bytes', self._cacheDir, usage)
         self._cacheUsage = usage
         self.updateCacheUsageStatistics()
         return usage
 
+    def _loadIndex(self):
+        if not self._index.loaded:
+            self._index.load()
+
     def updateCacheUsage(self):
         """
         @return: a defered with the cache usage in bytes.
         @raise: OSError or FlumotionError
         """
-
-        # Only calculate cache usage if the cache directory
-        # modification time changed since the last time we looked at it.
         try:
-            cacheTime = os.path.getmtime(self._cacheDir)
+            self._loadIndex()
         except OSError, e:
             return defer.fail(e)
+        # Take into account the changes done by other processes
+        self._index.sync()
+        return defer.succeed(self._updateCacheUsage())
 
-        if ((self._cacheUsage is None) or (self._lastCacheTime < cacheTime)):
-            self._lastCacheTime = cacheTime
-            self.log('Getting disk usage for path %r', self._cacheDir)
-            d = utils.getProcessOutput('du', ['-bs', self._cacheDir])
-            d.addCallback(lambda o: int(o.split('\t', 1)[0]))
-            d.addCallback(self._updateCacheUsage)
-            return d
-        else:
-            return defer.succeed(self._cacheUsage)
+    def touchCachedFile(self, path, size, add=True):
+        """
+        Inform that the cached file for a path has been accessed.
+        Unless add is False, the file is indexed if it was not.
+        """
+        name = self.getIdentifier(path)
+        if add or name in self._index:
+            self._index.touch(name, size)
+
+    def forgetCachedFile(self, path):
+        """
+        Inform that the cached file for a path has been removed.
+        """
+        name = self.getIdentifier(path)
+        if name in self._index:
+            self._index.remove(name)
+            self._updateCacheUsage()
 
     def _rmfiles(self, files):
-        try:
-            for path in files:
+        for path in files:
+            try:
                 os.remove(path)
-        except OSError, e:
-            if e.errno != errno.ENOENT:
-                # TODO: is warning() thread safe?
-                self.warning("Error cleaning cached file: %s", str(e))
-
-    def _setCacheUsage(self, _, usage):
-        # Update the cache usage
-        self._cacheUsage = usage
-        self._cacheUsageLastUpdate = time.time()
-        return usage
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    # TODO: is warning() thread safe?
+                    self.warning("Error cleaning cached file: %s", str(e))
 
     def _cleanUp(self):
         # Update cleanup statistics
         self.stats.onCleanup()
-        # List the cached files with file state
-        try:
-            listdir = os.listdir(self._cacheDir)
-        except OSError, e:
-            return defer.fail(e)
-
-        files = []
-        for f in listdir:
-            f = os.path.join(self._cacheDir, f)
-            # There's a possibility of getting an error on os.stat here.
-            try:
-                files.append((f, os.stat(f)))
-            except OSError, e:
-                if e.errno == errno.ENOENT:
-                    pass
-                else:
-                    return defer.fail(e)
-
-        # Calculate the cached file total size
-        usage = sum([d[1].st_size for d in files])
         # Delete the cached file starting by the oldest accessed ones
-        files.sort(key=lambda d: d[1].st_atime)
-        rmlist = []
-        for path, info in files:
-            usage -= info.st_size
-            rmlist.append(path)
-            if usage <= self._cacheMinUsage:
-                # We reach the cleanup limit
-                self.debug('cleaned up, cache use is now %sbytes',
-                    formatting.formatStorage(usage))
-                break
+        names = self._index.evict(self._cacheMinUsage - self._allocated)
+        rmlist = [os.path.join(self._cacheDir, name) for name in names]
+        usage = self._updateCacheUsage()
+        self.debug('cleaned up, cache use is now %sbytes',
+                   formatting.formatStorage(usage))
         d = threads.deferToThread(self._rmfiles, rmlist)
-        d.addBoth(self._setCacheUsage, usage)
+        d.addBoth(lambda _: usage)
         return d
 
     def _allocateCacheSpaceAfterCleanUp(self, usage, size):
@@ -228,15 +225,19 @@ class CacheManager(object, log.Loggable):
             return None
 
         # There is enough space to allocate, allocation succeed
-        self._cacheUsage += size
-        self.updateCacheUsageStatistics()
-        return (self._cacheUsageLastUpdate, size)
+        return self._newAllocation(size)
+
+    def _newAllocation(self, size):
+        self._lastTag += 1
+        tag = (self._lastTag, size)
+        self._allocations[tag] = None
+        self._allocated += size
+        self._updateCacheUsage()
+        return tag
 
     def _allocateCacheSpace(self, usage, size):
         if usage + size < self._cacheMaxUsage:
-            self._cacheUsage += size
-            self.updateCacheUsageStatistics()
-            return defer.succeed((self._cacheUsageLastUpdate, size))
+            return defer.succeed(self._newAllocation(size))
 
         self.debug('cache usage will be %sbytes, need more cache',
             formatting.formatStorage(usage + size))
@@ -261,11 +262,8 @@ class CacheManager(object, log.Loggable):
         the fraction specified by the property cleanup-low-threshold.
 
         Returns a 'tag' that should be used to 'free' the cache space
-        using releaseCacheSpace.
-        This tag is needed to better estimate the cache usage,
-        if the cache usage has been updated since cache space
-        has been allocated, freeing up the space should not change
-        the cache usage estimation.
+        using releaseCacheSpace, or to account it to the cached file
+        using commitCacheSpace once the file is complete.
 
         @param size: size to reserve, in bytes
         @type  size: int
@@ -281,10 +279,21 @@ class CacheManager(object, log.Loggable):
         """
         Low-level function to release reserved cache space.
         """
-        lastUpdate, size = tag
-        if lastUpdate == self._cacheUsageLastUpdate:
-            self._cacheUsage -= size
-            self.updateCacheUsageStatistics()
+        if tag in self._allocations:
+            del self._allocations[tag]
+            self._allocated -= tag[1]
+            self._updateCacheUsage()
+
+    def commitCacheSpace(self, tag, path):
+        """
+        Low-level function to account reserved cache space
+        to the completed cached file for a path.
+        """
+        if tag in self._allocations:
+            del self._allocations[tag]
+            self._allocated -= tag[1]
+        self._index.add(self.getIdentifier(path), tag[1])
+        self._updateCacheUsage()
 
     def openCacheFile(self, path):
         """
@@ -303,6 +312,7 @@ class CacheManager(object, log.Loggable):
         try:
             return TempFile(self, path, tag, size, mtime)
         except OSError:
+            self.releaseCacheSpace(tag)
             return None
 
     def newTempFile(self, path, size, mtime=None):
@@ -329,10 +339,13 @@ class CachedFile:
 
         cachemgr.log("Opened cached file %s [fd %d]",
                      cachedPath, handle.fileno())
+        cachemgr.touchCachedFile(resPath, stat.st_size)
 
         self.name = cachedPath
         self.file = handle
         self.stat = stat
+        self._cachemgr = cachemgr
+        self._resPath = resPath
 
     def unlink(self):
         """
@@ -346,6 +359,8 @@ class CachedFile:
             os.unlink(self.name)
         except OSError:
             pass
+        else:
+            self._cachemgr.forgetCachedFile(self._resPath)
 
     def __getattr__(self, name):
         a = getattr(self.__dict__['file'], name)
@@ -366,6 +381,7 @@ class TempFile:
         self.tag = tag
         self.cachemgr = cachemgr
         self._completed = False
+        self._resPath = resPath
         self._finishPath = cachemgr.getCachePath(resPath)
         self.mtime = mtime
         self.file = None
@@ -468,6 +484,7 @@ class TempFile:
                 if mtime > self.mtime:
                     self.cachemgr.log("Did not complete(), "
                                       "a more recent version exists already")
+                    self.cachemgr.releaseCacheSpace(self.tag)
                     os.unlink(self.name)
                     self.name = self._finishPath
                     return
@@ -485,6 +502,7 @@ class TempFile:
                 return
 
         self.setModificationTime()
+        self.cachemgr.commitCacheSpace(self.tag, self._resPath)
 
         self.name = self._finishPath
         self.cachemgr.log("Temporary file renamed to '%s' [fd %d]",
@@ -26,10 +26,26 @@ from flumotion.common import log
 MIN_REQUEST_SIZE = 64 * 1024 + 1
 # Statistics update period
 STATS_UPDATE_PERIOD = 10
+# Minimum interval in seconds between two publications
+# of the statistics updated for each request
+PUBLISH_INTERVAL = 1
+
+REQUEST_KEYS = ("cache-hit-count", "cache-miss-count", "temp-hit-count",
+                "cache-outdate-count", "memory-hit-count",
+                "memory-miss-count", "memory-eviction-count",
+                "memory-usage", "memory-usage-ratio", "memory-file-count",
+                "upstream-request-count", "queued-request-count",
+                "coalesced-request-count", "upstream-connections",
+                "upstream-waiting", "new-connection-count",
+                "reused-connection-count", "connection-reuse-ratio",
+                "current-copy-count", "finished-copy-count",
+                "cancelled-copy-count", "mean-copy-ratio",
+                "mean-bytes-copied")
 
 CACHE_MISS = 0
 CACHE_HIT = 1
 TEMP_HIT = 2
+MEMORY_HIT = 3
 
 
 class RequestStatistics(object):
@@ -63,6 +79,11 @@ class RequestStatistics(object):
             cs.cacheHitCount += 1
             cs.tempHitCount += 1
             self._status = "temp-hit"
+        elif cacheStatus == MEMORY_HIT:
+            cs.cacheHitCount += 1
+            cs.memoryHitCount += 1
+            self._status = "memory-hit"
+            cs._set("memory-hit-count", cs.memoryHitCount)
         elif cacheStatus == CACHE_MISS:
             cs.cacheMissCount += 1
             if self._outdated:
@@ -93,7 +114,7 @@ class RequestStatistics(object):
         """
         Provide the following log fields:
             cache-status:  value can be 'cache-miss', 'cache-outdate',
-                           'cache-hit', or 'temp-hit'
+                           'cache-hit', 'temp-hit', or 'memory-hit'
             cache-read:    how many bytes where read from the cache for
                            this resource. the difference from resource-read
                            was read from the source file (network file system?)
@@ -121,6 +142,21 @@ class CacheStatistics(object):
         self.cacheMissCount = 0
         self.cacheOutdateCount = 0
         self.cleanupCount = 0
+        # For the memory cache
+        self.memoryHitCount = 0
+        self.memoryMissCount = 0
+        self.memoryEvictionCount = 0
+        self._memoryUsage = 0
+        self._memoryUsageRatio = 0.0
+        self._memoryFileCount = 0
+        # For upstream requests
+        self.upstreamRequestCount = 0
+        self.queuedRequestCount = 0
+        self.coalescedRequestCount = 0
+        self._upstreamConnections = 0
+        self._upstreamWaiting = 0
+        self.newConnectionCount = 0
+        self.reusedConnectionCount = 0
         # For real file reading statistics
         self.bytesReadFromSource = 0L
         self.bytesReadFromCache = 0L
@@ -133,7 +169,14 @@ class CacheStatistics(object):
         self._copyRatios = 0.0
 
     def startUpdates(self, updater):
+        """
+        @param updater: the L{flavors.StatePublisher} to publish
+                        the statistics with
+        """
         self._updater = updater
+        if updater:
+            for key in REQUEST_KEYS:
+                updater.setPolicy(key, minInterval=PUBLISH_INTERVAL)
         if updater and (self._callId is None):
             self._set("cache-usage-estimation", self._cacheUsage)
             self._set("cache-usage-ratio-estimation", self._cacheUsageRatio)
@@ -144,6 +187,20 @@ class CacheStatistics(object):
             self._set("cancelled-copy-count", self.cancelledCopyCount)
             self._set("mean-copy-ratio", self.meanCopyRatio)
             self._set("mean-bytes-copied", self.meanBytesCopied)
+            self._set("memory-hit-count", self.memoryHitCount)
+            self._set("memory-miss-count", self.memoryMissCount)
+            self._set("memory-eviction-count", self.memoryEvictionCount)
+            self._set("memory-usage", self._memoryUsage)
+            self._set("memory-usage-ratio", self._memoryUsageRatio)
+            self._set("memory-file-count", self._memoryFileCount)
+            self._set("upstream-request-count", self.upstreamRequestCount)
+            self._set("queued-request-count", self.queuedRequestCount)
+            self._set("coalesced-request-count", self.coalescedRequestCount)
+            self._set("upstream-connections", self._upstreamConnections)
+            self._set("upstream-waiting", self._upstreamWaiting)
+            self._set("new-connection-count", self.newConnectionCount)
+            self._set("reused-connection-count", self.reusedConnectionCount)
+            self._set("connection-reuse-ratio", self.connectionReuseRatio)
             self._update()
 
     def stopUpdates(self):
@@ -171,6 +228,13 @@ class CacheStatistics(object):
         return self._copyRatios / self.finishedCopyCount
     meanCopyRatio = property(getMeanCopyRatio)
 
+    def getConnectionReuseRatio(self):
+        total = self.newConnectionCount + self.reusedConnectionCount
+        if total == 0:
+            return 0
+        return float(self.reusedConnectionCount) / total
+    connectionReuseRatio = property(getConnectionReuseRatio)
+
     def onEstimateCacheUsage(self, usage, max):
         self._cacheUsage = usage
         self._cacheUsageRatio = float(usage) / max
@@ -182,6 +246,49 @@ class CacheStatistics(object):
         self._set("cleanup-count", self.cleanupCount)
         self._set("last-cleanup-time", time.time())
 
+    def onMemoryMiss(self):
+        self.memoryMissCount += 1
+        self._set("memory-miss-count", self.memoryMissCount)
+
+    def onMemoryEviction(self):
+        self.memoryEvictionCount += 1
+        self._set("memory-eviction-count", self.memoryEvictionCount)
+
+    def onMemoryUsage(self, usage, max, count):
+        self._memoryUsage = usage
+        self._memoryUsageRatio = float(usage) / max
+        self._memoryFileCount = count
+        self._set("memory-usage", self._memoryUsage)
+        self._set("memory-usage-ratio", self._memoryUsageRatio)
+        self._set("memory-file-count", self._memoryFileCount)
+
+    def onUpstreamRequest(self):
+        self.upstreamRequestCount += 1
+        self._set("upstream-request-count", self.upstreamRequestCount)
+
+    def onUpstreamQueued(self):
+        self.queuedRequestCount += 1
+        self._set("queued-request-count", self.queuedRequestCount)
+
+    def onUpstreamUsage(self, connections, waiting):
+        self._upstreamConnections = connections
+        self._upstreamWaiting = waiting
+        self._set("upstream-connections", self._upstreamConnections)
+        self._set("upstream-waiting", self._upstreamWaiting)
+
+    def onUpstreamConnection(self, reused):
+        if reused:
+            self.reusedConnectionCount += 1
+            self._set("reused-connection-count", self.reusedConnectionCount)
+        else:
+            self.newConnectionCount += 1
+            self._set("new-connection-count", self.newConnectionCount)
+        self._set("connection-reuse-ratio", self.connectionReuseRatio)
+
+    def onRequestCoalesced(self):
+        self.coalescedRequestCount += 1
+        self._set("coalesced-request-count", self.coalescedRequestCount)
+
     def onCopyStarted(self):
         self.currentCopyCount += 1
         self.totalCopyCount += 1
@@ -234,15 +341,30 @@ class CacheStatistics(object):
             PAC: coPy cAncellation Count
             MCS: Mean Copy Size
             MCR: Mean Copy Ratio
+            MHC: Memory Hit Count
+            MMC: Memory Miss Count
+            MEC: Memory Eviction Count
+            MCU: Memory Current Usage
+            URC: Upstream Request Count
+            UQC: Upstream Queued request Count
+            RCC: Request Coalesced Count
+            UCC: Upstream Current Connections
+            CRU: Connection ReUse ratio
         """
         log.debug("stats-local-cache",
                   "CRR: %.4f; CMC: %d; CHC: %d; THC: %d; COC: %d; "
                   "CCC: %d; CCU: %d; CUR: %.5f; "
-                  "PTC: %d; PCC: %d; PAC: %d; MCS: %d; MCR: %.4f",
+                  "PTC: %d; PCC: %d; PAC: %d; MCS: %d; MCR: %.4f; "
+                  "MHC: %d; MMC: %d; MEC: %d; MCU: %d; "
+                  "URC: %d; UQC: %d; RCC: %d; UCC: %d; CRU: %.4f",
                   self.cacheReadRatio, self.cacheMissCount,
                   self.cacheHitCount, self.tempHitCount,
                   self.cacheOutdateCount, self.cleanupCount,
                   self._cacheUsage, self._cacheUsageRatio,
                   self.totalCopyCount, self.currentCopyCount,
                   self.cancelledCopyCount, self.meanBytesCopied,
-                  self.meanCopyRatio)
+                  self.meanCopyRatio, self.memoryHitCount,
+                  self.memoryMissCount, self.memoryEvictionCount,
+                  self._memoryUsage, self.upstreamRequestCount,
+                  self.queuedRequestCount, self.coalescedRequestCount,
+                  self._upstreamConnections, self.connectionReuseRatio)
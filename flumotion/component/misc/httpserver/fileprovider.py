@@ -167,6 +167,26 @@ class File(object):
         Close and cleanup the file.
         """
 
+    def getFileDescriptor(self):
+        """
+        Used to send the file with sendfile(2) instead of reading it.
+        Only return a descriptor when the file is complete, local and
+        won't change while it is being sent.
+
+        @returns: a file descriptor open on the file data, or None
+        @rtype:   int
+        """
+        return None
+
+    def onBytesSent(self, size):
+        """
+        Called when data was sent straight from the descriptor returned by
+        L{getFileDescriptor}, without being read.
+
+        @param size: the amount of bytes sent
+        @type  size: int
+        """
+
     def getLogFields(self):
         """
         @returns: a dictionary of log fields related to the file usage
@@ -190,6 +210,15 @@ class FileProviderPlug(plugbase.ComponentPlug):
         Stop updating statistics.
         """
 
+    def setServerStatistics(self, stats):
+        """
+        Give me the statistics of the whole server, to report the time
+        spent waiting for file operations to.
+
+        @type stats: L{flumotion.component.misc.httpserver.serverstats.
+                       ServerStatistics}
+        """
+
     def getRootPath(self):
         """
         @return: the root of the file repository
@@ -39,6 +39,8 @@ DEFAULT_SERVER_PORT = 3128
 DEFAULT_PROXY_PRIORITY = 1
 DEFAULT_CONN_TIMEOUT = 2
 DEFAULT_IDLE_TIMEOUT = 5
+DEFAULT_MAX_SERVER_CONNECTIONS = 0 # No limit
+DEFAULT_MAX_IDLE_CONNECTIONS = 4
 
 
 class FileReaderHTTPCachedPlug(log.Loggable):
@@ -49,6 +51,10 @@ class FileReaderHTTPCachedPlug(log.Loggable):
      - Load-balanced HTTP servers with priority level (fall-back).
      - More than one IP by server hostname with periodic DNS refresh.
      - Connection resuming if HTTP connection got disconnected.
+     - Persistent HTTP connections reused for the following requests.
+     - Limited number of concurrent connections by HTTP server.
+     - Range requests for parts of a resource already being retrieved
+       waiting for the retrieved data instead of requesting it again.
     """
 
     logCategory = LOG_CATEGORY
@@ -115,9 +121,17 @@ class FileReaderHTTPCachedPlug(log.Loggable):
         connTimeout = props.get('connection-timeout', DEFAULT_CONN_TIMEOUT)
         idleTimeout = props.get('idle-timeout', DEFAULT_IDLE_TIMEOUT)
 
-        client = http_client.StreamRequester(connTimeout, idleTimeout)
+        maxIdleConnections = props.get('max-idle-connections',
+                                       DEFAULT_MAX_IDLE_CONNECTIONS)
 
-        reqmgr = request_manager.RequestManager(selector, client)
+        client = http_client.StreamRequester(connTimeout, idleTimeout,
+                                             maxIdleConnections, self.stats)
+
+        maxConnections = props.get('max-server-connections',
+                                   DEFAULT_MAX_SERVER_CONNECTIONS)
+
+        reqmgr = request_manager.RequestManager(selector, client,
+                                                maxConnections, self.stats)
 
         cacheTTL = props.get('cache-ttl', DEFAULT_CACHE_TTL)
 
@@ -94,14 +94,23 @@ class StreamInfo(object):
 
 class StreamRequester(log.Loggable):
     """
-    Allows retrieval of data streams using HTTP 1.0.
+    Allows retrieval of data streams using HTTP 1.1.
+
+    When a maximum number of idle connections is given, the connections
+    are kept alive after a stream has been retrieved, and reused for
+    the next requests to the same server.
     """
 
     logCategory = LOG_CATEGORY
 
-    def __init__(self, connTimeout=0, idleTimeout=0):
+    def __init__(self, connTimeout=0, idleTimeout=0,
+                 maxIdleConnections=0, stats=None):
         self.connTimeout = connTimeout
         self.idleTimeout = idleTimeout
+        self.stats = stats
+        self.pool = None
+        if maxIdleConnections:
+            self.pool = ConnectionPool(maxIdleConnections, idleTimeout)
 
     def retrieve(self, consumer, url, proxyAddress=None, proxyPort=None,
                  ifModifiedSince=None, ifUnmodifiedSince=None,
@@ -119,23 +128,210 @@ class StreamRequester(log.Loggable):
         getter = StreamGetter(consumer, url,
                               ifModifiedSince, ifUnmodifiedSince,
                               start, size, self.idleTimeout)
-        getter.connect(proxyAddress, proxyPort, self.connTimeout)
+        getter.connect(proxyAddress, proxyPort, self.connTimeout, self.pool)
+        if self.stats is not None:
+            self.stats.onUpstreamConnection(getter.reused)
         return getter
 
+    def cleanup(self):
+        if self.pool is not None:
+            self.pool.clear()
+
+
+class ConnectionPool(log.Loggable):
+    """
+    Keeps the idle persistent connections to the HTTP servers,
+    up to a maximum number by server, to be reused by the next requests.
+
+    An idle connection is closed after the idle timeout.
+    """
+
+    logCategory = LOG_CATEGORY
+
+    def __init__(self, maxIdle, idleTimeout=0):
+        self.maxIdle = maxIdle
+        self.idleTimeout = idleTimeout
+        self._idle = {} # {(HOST, PORT): [StreamConnection]}
+
+    def __len__(self):
+        return sum(map(len, self._idle.values()))
+
+    def get(self, host, port):
+        """
+        @returns: an idle connection to the server, or None
+        @rtype:   L{StreamConnection}
+        """
+        connections = self._idle.get((host, port))
+        if not connections:
+            return None
+        # The most recently used connection is the least likely
+        # to have been closed by the server
+        connection = connections.pop()
+        if not connections:
+            del self._idle[(host, port)]
+        self._cancelTimeout(connection)
+        connection.pool = None
+        return connection
+
+    def put(self, connection):
+        key = (connection.host, connection.port)
+        connections = self._idle.setdefault(key, [])
+        if len(connections) >= self.maxIdle:
+            connection.close()
+            return
+        connections.append(connection)
+        connection.pool = self
+        if self.idleTimeout:
+            connection.idleCall = reactor.callLater(self.idleTimeout,
+                                                    self._expired, connection)
+
+    def remove(self, connection):
+        key = (connection.host, connection.port)
+        connections = self._idle.get(key)
+        if connections and connection in connections:
+            connections.remove(connection)
+            if not connections:
+                del self._idle[key]
+        self._cancelTimeout(connection)
+        connection.pool = None
+
+    def clear(self):
+        for connections in self._idle.values():
+            for connection in connections:
+                self._cancelTimeout(connection)
+                connection.pool = None
+                connection.close()
+        self._idle.clear()
+
+
+    ## Private Methods ##
+
+    def _cancelTimeout(self, connection):
+        if connection.idleCall is not None:
+            connection.idleCall.cancel()
+            connection.idleCall = None
+
+    def _expired(self, connection):
+        connection.idleCall = None
+        self.log("Closing idle connection to %s:%s",
+                 connection.host, connection.port)
+        self.remove(connection)
+        connection.close()
+
+
+class StreamConnection(http.HTTPClient, log.Loggable):
+    """
+    An HTTP connection retrieving the streams of L{StreamGetter} instances,
+    one after the other when the connection is kept alive.
+
+    The parsed response is forwarded to the attached getter.
+    """
+
+    logCategory = LOG_CATEGORY
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.getter = None
+        self.pool = None
+        self.idleCall = None
+
+    def attach(self, getter):
+        self.getter = getter
+        # Ready to parse a new response
+        self.firstLine = True
+        self.length = None
+        self._header = ""
+
+    def detach(self):
+        self.getter = None
+
+    def close(self):
+        self.getter = None
+        if self.transport is not None:
+            self.transport.loseConnection()
+
+    ### Overridden Methods ###
+
+    def connectionMade(self):
+        if self.getter is not None:
+            self.getter.connectionMade()
+
+    def connectionLost(self, reason):
+        if self.pool is not None:
+            self.pool.remove(self)
+        getter, self.getter = self.getter, None
+        if getter is not None:
+            getter.connectionLost(reason)
+
+    def lineReceived(self, line):
+        if self.getter is None:
+            # Nothing is expected on an idle connection
+            self.close()
+            return
+        http.HTTPClient.lineReceived(self, line)
+        if not self.line_mode and self.length == 0:
+            # HTTPClient waits for a body even when there is none
+            self.setLineMode()
+            self.handleResponseEnd()
+
+    def sendCommand(self, command, path):
+        # We want HTTP/1.1 for conditional GET and range requests
+        self.transport.write('%s %s HTTP/1.1\r\n' % (command, path))
+
+    def handleStatus(self, version, status, message):
+        if self.getter is not None:
+            self.getter.handleStatus(version, status, message)
+
+    def handleHeader(self, key, val):
+        if self.getter is not None:
+            self.getter.handleHeader(key, val)
+
+    def handleEndHeaders(self):
+        if self.getter is not None:
+            self.getter.handleEndHeaders()
+
+    def handleResponsePart(self, data):
+        if self.getter is not None:
+            self.getter.handleResponsePart(data)
+
+    def handleResponseEnd(self):
+        if self.getter is not None:
+            self.getter.handleResponseEnd()
 
-class StreamGetter(protocol.ClientFactory, http.HTTPClient, log.Loggable):
+
+class StreamConnector(protocol.ClientFactory):
+    """
+    Connects a new L{StreamConnection} for a L{StreamGetter}.
     """
-    Retrieves a stream using HTTP 1.0.
 
-    This class is at the same time a Factory and a Protocol,
-    this can be done because it's a client and in twisted
-    client factories only create on protocol.
+    def __init__(self, getter):
+        self.getter = getter
+
+    def buildProtocol(self, addr):
+        connection = StreamConnection(self.getter.host, self.getter.port)
+        self.getter.buildConnection(connection, addr)
+        return connection
+
+    def clientConnectionFailed(self, connector, reason):
+        self.getter.clientConnectionFailed(connector, reason)
+
+
+class StreamGetter(log.Loggable):
+    """
+    Retrieves a stream using HTTP 1.1.
 
     The outcome, the stream info and stream data is forwarded
     to a common.StreamConsumer instance given at creating time.
 
     It supports range requests and some conditional request types
     (ifModified and ifUnmodified).
+
+    When given a connection pool, an idle connection to the server
+    is reused if there is one, and the connection is given back
+    to the pool when the stream has been completely retrieved and
+    the server agreed to keep it alive. A request is never sent
+    on a connection before the previous response has been read.
     """
 
     logCategory = LOG_CATEGORY
@@ -162,11 +358,17 @@ class StreamGetter(protocol.ClientFactory, http.HTTPClient, log.Loggable):
         self.peer = None
         self.status = None
         self.info = None
+        self.connection = None
+        self.pool = None
+        self.reused = False
+        self.paused = False
 
         self._connected = False
         self._canceled = False
+        self._keepAlive = False
         self._remaining = None
         self._idlecheck = None
+        self._connTimeout = 0
 
         self.logName = common.log_id(self) # To be able to track the instance
 
@@ -175,74 +377,101 @@ class StreamGetter(protocol.ClientFactory, http.HTTPClient, log.Loggable):
 
     ### Public Methods ###
 
-    def connect(self, proxyAddress=None, proxyPort=None, timeout=0):
+    def connect(self, proxyAddress=None, proxyPort=None, timeout=0,
+                pool=None):
         assert not self._connected, "Already connected"
         self._connected = True
         url = self.url
         self.host = proxyAddress or url.hostname
         self.port = proxyPort or url.port
+        self.pool = pool
+        self._connTimeout = timeout
         if url.scheme != 'http':
             msg = "URL scheme %s not implemented" % url.scheme
             self._serverError(common.NOT_IMPLEMENTED, msg)
-        else:
-            self.log("Connecting to %s:%s for %s",
+            return
+        connection = pool and pool.get(self.host, self.port)
+        if connection:
+            self.log("Reusing connection to %s:%s for %s",
                      self.host, self.port, self.url)
-            reactor.connectTCP(self.host, self.port, self, timeout)
+            self.reused = True
+            self.peer = connection.transport.getPeer()
+            self._attach(connection)
+            self.connectionMade()
+        else:
+            self._connect()
 
     def pause(self):
-        if not self.paused and self.transport is not None:
-            self.pauseProducing()
+        if not self.paused and self.connection is not None:
+            self.paused = True
+            self.connection.pauseProducing()
             self.log("Request paused for %s", self.url)
 
     def resume(self):
-        if self.paused and self.transport is not None:
-            self.resumeProducing()
+        if self.paused and self.connection is not None:
+            self.paused = False
+            self.connection.resumeProducing()
             self.log("Request resumed for %s", self.url)
 
     def cancel(self):
-        if self._connected and self.transport is not None:
-            self.transport.loseConnection()
+        self._close()
         self._cancelIdleCheck()
         self.log("Request canceled for %s", self.url)
         self._canceled = True
 
-    ### Overridden Methods ###
+    ### Connection Callbacks ###
 
-    def buildProtocol(self, addr):
+    def buildConnection(self, connection, addr):
         assert self.peer is None, "Protocol already built"
         self.peer = addr
-        return self
+        self._attach(connection)
 
     def clientConnectionFailed(self, connector, reason):
         self._serverError(common.SERVER_UNAVAILABLE, reason.getErrorMessage())
 
     def connectionMade(self):
         self.log("Connection made for %s", self.url)
-        self.sendCommand(self.HTTP_METHOD, self.url.location)
-        self.sendHeader('Host', self.url.host)
-        self.sendHeader('User-Agent', USER_AGENT)
-        self.sendHeader('Connection', "close") # Pipeline not yet supported
+        connection = self.connection
+        connection.sendCommand(self.HTTP_METHOD, self.url.location)
+        connection.sendHeader('Host', self.url.host)
+        connection.sendHeader('User-Agent', USER_AGENT)
+        if self.pool is not None:
+            connection.sendHeader('Connection', "keep-alive")
+        else:
+            connection.sendHeader('Connection', "close")
 
         if self.ifModifiedSince:
             datestr = http.datetimeToString(self.ifModifiedSince)
-            self.sendHeader('If-Modified-Since', datestr)
+            connection.sendHeader('If-Modified-Since', datestr)
 
         if self.ifUnmodifiedSince:
             datestr = http.datetimeToString(self.ifUnmodifiedSince)
-            self.sendHeader('If-Unmodified-Since', datestr)
+            connection.sendHeader('If-Unmodified-Since', datestr)
 
         if self.start or self.size:
             start = self.start or 0
             end = (self.size and (start + self.size - 1)) or None
             rangeSpecs = "bytes=%s-%s" % (start, end or "")
-            self.sendHeader('Range', rangeSpecs)
+            connection.sendHeader('Range', rangeSpecs)
 
-        self.endHeaders()
+        connection.endHeaders()
 
         self._resetIdleCheck()
 
     def connectionLost(self, reason):
         self.log("Connection lost for %s", self.url)
+        self.connection = None
+        if (self.reused and self.status is None
+            and self.consumer and not self._canceled):
+            # The server closed the idle connection
+            # before receiving the request, try a new one
+            self.debug("Reused connection to %s:%s closed, reconnecting",
+                       self.host, self.port)
+            self.reused = False
+            self.peer = None
+            self._cancelIdleCheck()
+            self._connect()
+            return
         self.handleResponseEnd()
         if not self._canceled:
             self._serverError(common.SERVER_DISCONNECTED,
@@ -252,6 +481,7 @@ class StreamGetter(protocol.ClientFactory, http.HTTPClient, log.Loggable):
         self._keepActive()
         status = int(status_str)
         self.status = status
+        self._keepAlive = version == "HTTP/1.1"
 
         if status in (http.OK, http.NO_CONTENT, http.PARTIAL_CONTENT):
             return
@@ -281,6 +511,8 @@ class StreamGetter(protocol.ClientFactory, http.HTTPClient, log.Loggable):
     def handleHeader(self, key, val):
         self._keepActive()
         self.headers[key] = val
+        if key.lower() == "connection":
+            self._keepAlive = val.lower() == "keep-alive"
 
     def handleEndHeaders(self):
         self._keepActive()
@@ -312,7 +544,7 @@ class StreamGetter(protocol.ClientFactory, http.HTTPClient, log.Loggable):
             data = data[:self._remaining]
             self._remaining = 0
             self._onData(data)
-            self.cancel()
+            self._streamDone()
         else:
             self._remaining -= size
             self._onData(data)
@@ -324,6 +556,9 @@ class StreamGetter(protocol.ClientFactory, http.HTTPClient, log.Loggable):
                          "last modified on %s", self.info.size,
                          self.info.start, self.url.toString(),
                          ts2str(self.info.mtime))
+                # Give back the connection before the consumer
+                # may request something else to the same server
+                self._release()
                 self._streamDone()
                 return
         if self.info:
@@ -333,12 +568,36 @@ class StreamGetter(protocol.ClientFactory, http.HTTPClient, log.Loggable):
         else:
             self.log("Incomplete request %s", self.url.toString())
 
-    def sendCommand(self, command, path):
-        # We want HTTP/1.1 for conditional GET and range requests
-        self.transport.write('%s %s HTTP/1.1\r\n' % (command, path))
-
     ### Private Methods ###
 
+    def _connect(self):
+        self.log("Connecting to %s:%s for %s",
+                 self.host, self.port, self.url)
+        reactor.connectTCP(self.host, self.port,
+                           StreamConnector(self), self._connTimeout)
+
+    def _attach(self, connection):
+        self.connection = connection
+        connection.attach(self)
+
+    def _release(self):
+        connection, self.connection = self.connection, None
+        if connection is None:
+            return
+        connection.detach()
+        if (self.pool is not None and self._keepAlive
+            and connection.length == 0 and not self.paused):
+            self.log("Keeping connection to %s:%s alive",
+                     self.host, self.port)
+            self.pool.put(connection)
+        else:
+            connection.close()
+
+    def _close(self):
+        connection, self.connection = self.connection, None
+        if connection is not None:
+            connection.close()
+
     def _keepActive(self):
         self._updateCount += 1
 
@@ -366,8 +625,7 @@ class StreamGetter(protocol.ClientFactory, http.HTTPClient, log.Loggable):
     def _cancel(self):
         self._cancelIdleCheck()
         if self.consumer:
-            if self.transport:
-                self.transport.loseConnection()
+            self._close()
             self.consumer = None
 
     def _serverError(self, code, message):
@@ -26,16 +26,31 @@ LOG_CATEGORY = "request-manager"
 
 
 class RequestManager(log.Loggable):
+    """
+    Retrieves streams from the servers of a ServerSelector,
+    falling back to the next server when one fails.
+
+    The number of concurrent requests to each server can be limited;
+    the requests that can't be sent because all the servers are busy
+    wait for one of them to finish.
+    """
 
     logCategory = LOG_CATEGORY
 
-    def __init__(self, selector, client):
+    def __init__(self, selector, client, maxConnections=None, stats=None):
         """
         Selector: a ServerSelector
         Client: HttpClient (StreamRequester)
+        MaxConnections: maximum number of concurrent requests by server,
+                        None or 0 for no limit
+        Stats: a CacheStatistics to report upstream requests to
         """
         self.selector = selector
         self.client = client
+        self.maxConnections = maxConnections
+        self.stats = stats
+        self._connections = {} # {(IP, PORT): REQUEST_COUNT}
+        self._waiting = [] # [ConsumerManager] in arrival order
 
     def retrieve(self, consumer, url,
                  ifModifiedSince=None, ifUnmodifiedSince=None,
@@ -51,22 +66,82 @@ class RequestManager(log.Loggable):
         servers = self.selector.getServers()
         consumer_manager = ConsumerManager(consumer, url, start, size,
                                            ifModifiedSince, ifUnmodifiedSince,
-                                           servers, self.client)
+                                           servers, self)
         return consumer_manager.retrieve()
 
     def setup(self):
         return self.selector.setup()
 
     def cleanup(self):
+        self._waiting = []
+        self.client.cleanup()
         return self.selector.cleanup()
 
+    def getConnectionCount(self, server=None):
+        if server is None:
+            return sum(self._connections.values())
+        return self._connections.get((server.ip, server.port), 0)
+
+    def getWaitingCount(self):
+        return len(self._waiting)
+
+    def isAvailable(self, server):
+        if not self.maxConnections:
+            return True
+        return self.getConnectionCount(server) < self.maxConnections
+
+    def acquire(self, server):
+        key = (server.ip, server.port)
+        self._connections[key] = self._connections.get(key, 0) + 1
+        if self.stats is not None:
+            self.stats.onUpstreamRequest()
+        self._updateStats()
+
+    def release(self, server):
+        key = (server.ip, server.port)
+        count = self._connections.get(key, 0) - 1
+        if count > 0:
+            self._connections[key] = count
+        else:
+            self._connections.pop(key, None)
+        self._updateStats()
+        # Give the released connection to the oldest request waiting for it
+        for consumer_manager in self._waiting:
+            if consumer_manager.waitsFor(server):
+                self._waiting.remove(consumer_manager)
+                self._updateStats()
+                consumer_manager.retrieve()
+                break
+
+    def wait(self, consumer_manager):
+        self.debug("All servers busy, request for %s waiting "
+                   "(%d requests waiting)", consumer_manager.url,
+                   len(self._waiting) + 1)
+        self._waiting.append(consumer_manager)
+        if self.stats is not None:
+            self.stats.onUpstreamQueued()
+        self._updateStats()
+
+    def unwait(self, consumer_manager):
+        if consumer_manager in self._waiting:
+            self._waiting.remove(consumer_manager)
+            self._updateStats()
+
+
+    ## Private Methods ##
+
+    def _updateStats(self):
+        if self.stats is not None:
+            self.stats.onUpstreamUsage(self.getConnectionCount(),
+                                       len(self._waiting))
+
 
 class ConsumerManager(common.StreamConsumer, log.Loggable):
 
     logCategory = LOG_CATEGORY
 
     def __init__(self, consumer, url, start, size, ifModifiedSince,
-                 ifUnmodifiedSince, servers, client):
+                 ifUnmodifiedSince, servers, manager):
         self.consumer = consumer
         self.url = url
         self.start = start
@@ -74,11 +149,17 @@ class ConsumerManager(common.StreamConsumer, log.Loggable):
         self.ifModifiedSince = ifModifiedSince
         self.ifUnmodifiedSince = ifUnmodifiedSince
         self.servers = servers
-        self.client = client
+        self.manager = manager
+        self.client = manager.client
         self.current_server = None
         self.current_request = None
         self.last_error = None
         self.last_message = None
+        self.paused = False
+        self.waiting = False
+        self._busy = [] # Servers skipped because they were busy
+        self._waitingFor = [] # Busy servers we are waiting for
+        self._connected = None # The server we hold a connection to
 
         self.logName = common.log_id(self) # To be able to track the instance
 
@@ -94,53 +175,85 @@ class ConsumerManager(common.StreamConsumer, log.Loggable):
             return self.current_request.port
         return None
 
+    def waitsFor(self, server):
+        return server in self._waitingFor
+
     def retrieve(self):
+        self.waiting = False
         try:
             s = self.servers.next()
-            self.current_server = s
-            if self.size is None or self.start is None:
-                self.debug("Retrieving %s from %s:%s", self.url,
-                           self.current_server.ip, self.current_server.port)
-            else:
-                self.debug("Retrieving range %s-%s (%s B) of %s from %s:%s",
-                           self.start, self.start + self.size, self.size,
-                           self.url, self.current_server.ip,
-                           self.current_server.port)
-            proxy_address = s.ip
-            proxy_port = s.port
-            self.current_request =\
-                self.client.retrieve(self, self.url,
-                                     proxyAddress=proxy_address,
-                                     proxyPort=proxy_port,
-                                     ifModifiedSince=self.ifModifiedSince,
-                                     ifUnmodifiedSince=self.ifUnmodifiedSince,
-                                     start=self.start, size=self.size)
-            self.log("Retrieving data using %s", self.current_request.logName)
-            return self
+            while not self.manager.isAvailable(s):
+                self._busy.append(s)
+                s = self.servers.next()
         except StopIteration:
+            if self._busy:
+                # Wait for one of the busy servers to be released,
+                # then try them again in the same order
+                self._waitingFor = self._busy
+                self._busy = []
+                self.servers = iter(self._waitingFor)
+                self.waiting = True
+                self.manager.wait(self)
+                return self
             code = self.last_error or common.SERVER_UNAVAILABLE
             message = self.last_message or ""
             self.consumer.serverError(self, code, message)
             return self
+        self._busy = []
+        self._waitingFor = []
+        self.current_server = s
+        if self.size is None or self.start is None:
+            self.debug("Retrieving %s from %s:%s", self.url,
+                       self.current_server.ip, self.current_server.port)
+        else:
+            self.debug("Retrieving range %s-%s (%s B) of %s from %s:%s",
+                       self.start, self.start + self.size, self.size,
+                       self.url, self.current_server.ip,
+                       self.current_server.port)
+        self._connected = s
+        self.manager.acquire(s)
+        proxy_address = s.ip
+        proxy_port = s.port
+        self.current_request =\
+            self.client.retrieve(self, self.url,
+                                 proxyAddress=proxy_address,
+                                 proxyPort=proxy_port,
+                                 ifModifiedSince=self.ifModifiedSince,
+                                 ifUnmodifiedSince=self.ifUnmodifiedSince,
+                                 start=self.start, size=self.size)
+        self.log("Retrieving data using %s", self.current_request.logName)
+        if self.paused:
+            self.current_request.pause()
+        return self
 
     def pause(self):
         self.log("Pausing request %s", self.url)
-        self.current_request.pause()
+        self.paused = True
+        if self.current_request is not None:
+            self.current_request.pause()
 
     def resume(self):
         self.log("Resuming request %s", self.url)
-        self.current_request.resume()
+        self.paused = False
+        if self.current_request is not None:
+            self.current_request.resume()
 
     def cancel(self):
         self.debug("Canceling request %s", self.url)
-        self.current_request.cancel()
-        self.current_request = None
+        if self.waiting:
+            self.waiting = False
+            self.manager.unwait(self)
+        if self.current_request is not None:
+            self.current_request.cancel()
+            self.current_request = None
+        self._release()
 
     def serverError(self, getter, code, message):
         self.debug("Server Error %s (%s) for %s using %s:%s",
                    message, code, self.url, getter.host, getter.port)
         self.last_error = code
         self.last_message = message
+        self._release()
         if code in (common.SERVER_DISCONNECTED,
                     common.SERVER_TIMEOUT):
             # The connection was established
@@ -155,12 +268,14 @@ class ConsumerManager(common.StreamConsumer, log.Loggable):
             return
         self.log("Condition Error %s (%s) for %s",
                  message, code, self.url)
+        self._release()
         self.consumer.conditionFail(self, code, message)
 
     def streamNotAvailable(self, getter, code, message):
         if self.current_request is None:
             return
         self.log("Stream not available \"%s\" for %s", message, self.url)
+        self._release()
         self.consumer.streamNotAvailable(self, code, message)
 
     def onInfo(self, getter, info):
@@ -176,4 +291,14 @@ class ConsumerManager(common.StreamConsumer, log.Loggable):
     def streamDone(self, getter):
         if self.current_request is None:
             return
+        self._release()
         self.consumer.streamDone(self)
+
+
+    ## Private Methods ##
+
+    def _release(self):
+        # Give back the connection to the server, only once by request
+        server, self._connected = self._connected, None
+        if server is not None:
+            self.manager.release(server)
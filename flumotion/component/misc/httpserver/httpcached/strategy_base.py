@@ -68,6 +68,7 @@ class CachingStrategy(log.Loggable):
 
         self._identifiers = {} # {IDENTIFIER: CachingSession}
         self._etimes = {} # {IDENTIFIER: EXPIRATION_TIME}
+        self._blocks = {} # {(URL, MTIME): [BlockRequester]}
 
         self._cleanupCall = None
 
@@ -114,8 +115,55 @@ class CachingStrategy(log.Loggable):
         return d
 
     def requestData(self, url, offset=None, size=None, mtime=None):
-        requester = BlockRequester(self.reqmgr, url, mtime)
-        return requester.retrieve(offset, size)
+        """
+        Retrieves a block of data using range requests.
+
+        The parts of the block already being retrieved for another
+        request of the same resource are not requested again,
+        only the missing parts are.
+        """
+        if offset is None or size is None:
+            requester = BlockRequester(self.reqmgr, url, mtime)
+            return requester.retrieve(offset, size)
+
+        key = (str(url), mtime)
+        requesters = self._blocks.get(key, [])
+        pieces = [] # [(SIZE, DEFERRED)]
+        coalesced = False
+        pos, end = offset, offset + size
+        while pos < end:
+            requester = None
+            nextStart = end
+            for r in requesters:
+                if r.start <= pos < r.end:
+                    requester = r
+                    break
+                if pos < r.start < nextStart:
+                    nextStart = r.start
+            if requester is not None:
+                pieceEnd = min(end, requester.end)
+                pieces.append((pieceEnd - pos,
+                               requester.wait(pos, pieceEnd - pos)))
+                coalesced = True
+            else:
+                pieceEnd = nextStart
+                pieces.append((pieceEnd - pos,
+                               self._requestBlock(key, url, mtime,
+                                                  pos, pieceEnd - pos)))
+            pos = pieceEnd
+
+        if coalesced:
+            self.log("Coalesced request for %d bytes at %d of '%s' "
+                     "in %d pieces", size, offset, url, len(pieces))
+            self.cachemgr.stats.onRequestCoalesced()
+
+        if len(pieces) == 1:
+            return pieces[0][1]
+        d = defer.DeferredList([d for _, d in pieces],
+                               fireOnOneErrback=True, consumeErrors=True)
+        d.addCallbacks(self._joinPieces, self._pieceFailed,
+                       callbackArgs=([s for s, _ in pieces], ))
+        return d
 
     def getSessions(self):
         return self._identifiers.values()
@@ -133,6 +181,36 @@ class CachingStrategy(log.Loggable):
 
     ### Protected Methods ###
 
+    def _requestBlock(self, key, url, mtime, offset, size):
+        requester = BlockRequester(self.reqmgr, url, mtime)
+        self._blocks.setdefault(key, []).append(requester)
+        d = requester.retrieve(offset, size)
+        # The requester deferred is fired first, so it is forgotten
+        # before the coalesced requests get their data
+        d.addBoth(self._blockRetrieved, key, requester)
+        return d
+
+    def _blockRetrieved(self, result, key, requester):
+        requesters = self._blocks.get(key)
+        if requesters and requester in requesters:
+            requesters.remove(requester)
+            if not requesters:
+                del self._blocks[key]
+        return result
+
+    def _joinPieces(self, results, sizes):
+        data = []
+        for (_, piece), size in zip(results, sizes):
+            data.append(piece)
+            if len(piece) < size:
+                # End of file reached
+                break
+        return "".join(data)
+
+    def _pieceFailed(self, failure):
+        failure.trap(defer.FirstError)
+        return failure.value.subFailure
+
     def _startCleanupLoop(self):
         assert self._cleanupCall is None, "Already started"
         self._cleanupCall = reactor.callLater(EXP_TABLE_CLEANUP_PERIOD,
@@ -1017,19 +1095,25 @@ class BlockRequester(common.StreamConsumer, log.Loggable):
     fail if the requested file modification time changed.
 
     The data is returned as a block by triggering the deferred
-    returned by calling the retrieve method.
+    returned by calling the retrieve method. While retrieving,
+    parts of the block can be waited for by calling the wait method.
 
     It can recover request failures up to MAX_RESUME_COUNT times.
+
+    @ivar start: the offset of the block being retrieved
+    @ivar end:   the offset just after the block being retrieved
     """
 
     logCategory = "block-requester"
 
     def __init__(self, reqmgr, url, mtime=None):
         self.reqmgr = reqmgr
+        self.start = None
+        self.end = None
         self._url = url
         self._mtime = mtime
         self._data = None
-        self._deferred = None
+        self._waiters = None # [(OFFSET, SIZE, DEFERRED)]
         self._offset = None
         self._size = None
         self._resumes = MAX_RESUME_COUNT
@@ -1037,23 +1121,38 @@ class BlockRequester(common.StreamConsumer, log.Loggable):
         self.logName = common.log_id(self) # To be able to track the instance
 
     def retrieve(self, offset, size):
-        assert self._deferred is None, "Already retrieving"
-        self._deferred = defer.Deferred()
+        assert self._waiters is None, "Already retrieving"
+        self._waiters = []
         self._data = []
         self._offset = offset
         self._size = size
+        self.start = offset
+        self.end = offset + size
         self._curr = 0
 
+        d = self.wait(offset, size)
         self._retrieve()
 
-        return self._deferred
+        return d
+
+    def wait(self, offset, size):
+        """
+        Waits for a part of the block being retrieved.
+
+        @returns: a deferred fired with the data of the part,
+                  shorter than requested if the end of file is reached
+        """
+        assert self._waiters is not None, "Not retrieving anything"
+        assert self.start <= offset and offset + size <= self.end
+        d = defer.Deferred()
+        self._waiters.append((offset, size, d))
+        return d
 
     def serverError(self, getter, code, message):
-        assert self._deferred is not None, "Not retrieving anything"
+        assert self._waiters is not None, "Not retrieving anything"
         if code == common.RANGE_NOT_SATISFIABLE:
             # Simulate EOF
-            self._deferred.callback("")
-            self._cleanup()
+            self._succeed("")
             return
         if code in (common.SERVER_DISCONNECTED, common.SERVER_TIMEOUT):
             self.warning("Block request error: %s (%s)", message, code)
@@ -1067,19 +1166,15 @@ class BlockRequester(common.StreamConsumer, log.Loggable):
                 return
             self.debug("Too much resuming intents, stopping "
                        "after %d of %d", self._offset, self._size)
-        self._deferred.errback(fileprovider.FileError(message))
-        self._cleanup()
+        self._fail(fileprovider.FileError(message))
 
     def conditionFail(self, getter, code, message):
-        assert self._deferred is not None, "Not retrieving anything"
-        self._deferred.errback(fileprovider.FileOutOfDate(message))
-        self._cleanup()
+        assert self._waiters is not None, "Not retrieving anything"
+        self._fail(fileprovider.FileOutOfDate(message))
 
     def streamNotAvailable(self, getter, code, message):
-        assert self._deferred is not None, "Not retrieving anything"
-        error = fileprovider.FileOutOfDate(message)
-        self._deferred.errback(error)
-        self._cleanup()
+        assert self._waiters is not None, "Not retrieving anything"
+        self._fail(fileprovider.FileOutOfDate(message))
 
     def onData(self, getter, data):
         size = len(data)
@@ -1088,14 +1183,23 @@ class BlockRequester(common.StreamConsumer, log.Loggable):
         self._data.append(data)
 
     def streamDone(self, getter):
-        data = "".join(self._data)
-        self._deferred.callback(data)
-        self._cleanup()
+        self._succeed("".join(self._data))
 
     def _retrieve(self):
         self.reqmgr.retrieve(self, self._url, start=self._offset,
                              size=self._size, ifUnmodifiedSince=self._mtime)
 
+    def _succeed(self, data):
+        for offset, size, d in self._cleanup():
+            begin = offset - self.start
+            d.callback(data[begin:begin + size])
+
+    def _fail(self, error):
+        for _, _, d in self._cleanup():
+            d.errback(error)
+
     def _cleanup(self):
-        self._deferred = None
+        waiters = self._waiters
+        self._waiters = None
         self._data = None
+        return waiters
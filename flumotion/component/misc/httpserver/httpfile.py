@@ -15,6 +15,7 @@
 #
 # Headers in this file shall remain intact.
 
+import errno
 import string
 import time
 
@@ -28,14 +29,21 @@ except ImportError:
 
 from twisted.web import resource, server, http
 from twisted.web import error as weberror
-from twisted.internet import defer, reactor, abstract
+from twisted.internet import defer, reactor, abstract, tcp
 from twisted.python.failure import Failure
 
 from flumotion.configure import configure
 from flumotion.common import log
 from flumotion.component.component import moods
+from flumotion.component.consumers.disker.index import Index
 from flumotion.component.misc.httpserver import fileprovider
 
+# sendfile is a built module; without it files are always read and written
+try:
+    from flumotion.extern.sendfile import sendfile
+except ImportError:
+    sendfile = None
+
 # register serializables
 from flumotion.common import messages
 
@@ -43,6 +51,9 @@ __version__ = "$Rev$"
 
 LOG_CATEGORY = "httpserver"
 
+# How many keyframe indexes of recordings are kept loaded
+INDEX_CACHE_SIZE = 32
+
 try:
     resource.ErrorPage
     errorpage = resource
@@ -101,10 +112,15 @@ class File(resource.Resource, log.Loggable):
                  mimeToResource=None,
                  rateController=None,
                  requestModifiers=None,
-                 metadataProvider=None):
+                 metadataProvider=None,
+                 parentPath=None,
+                 name=None):
         resource.Resource.__init__(self)
 
         self._path = path
+        # the directory of the file and its name in it, when known
+        self._parentPath = parentPath
+        self._name = name
         self._httpauth = httpauth
         # mapping of mime type -> File subclass
         self._mimeToResource = mimeToResource or {}
@@ -131,7 +147,7 @@ class File(resource.Resource, log.Loggable):
         except fileprovider.InsecureError:
             return self.badRequest
 
-        return self._factory.create(child)
+        return self._factory.create(child, self._path, path)
 
     def render(self, request):
         """
@@ -389,7 +405,10 @@ class File(resource.Resource, log.Loggable):
             # Set the provider first, because for very small file
             # the transfer could terminate right away.
             request._provider = provider
-            transfer = FileTransfer(provider, last + 1, consumer)
+            if SendfileTransfer.canSend(request, consumer, provider):
+                transfer = SendfileTransfer(provider, last + 1, request)
+            else:
+                transfer = FileTransfer(provider, last + 1, consumer)
             request._transfer = transfer
 
             # The important NOT_DONE_YET was already returned by the render()
@@ -440,10 +459,15 @@ class MimedFileFactory(log.Loggable):
         self._requestModifiers = requestModifiers
         self._metadataProvider = metadataProvider
 
-    def create(self, path):
+    def create(self, path, parentPath=None, name=None):
         """
         Creates and returns an instance of a File subclass based
         on the mime type of the given path.
+
+        @param parentPath: the directory of the file
+        @type  parentPath: L{fileprovider.FilePath}
+        @param name:       the name of the file in its directory
+        @type  name:       str
         """
         mimeType = path.mimeType or self.defaultType
         self.debug("Create %s file for %s", mimeType, path)
@@ -452,7 +476,8 @@ class MimedFileFactory(log.Loggable):
                      mimeToResource=self._mimeToResource,
                      rateController=self._rateController,
                      requestModifiers=self._requestModifiers,
-                     metadataProvider=self._metadataProvider)
+                     metadataProvider=self._metadataProvider,
+                     parentPath=parentPath, name=name)
 
 
 class FLVFile(File):
@@ -561,6 +586,212 @@ class MP4File(File):
         return d
 
 
+class RecordingIndexes(log.Loggable):
+    """
+    I keep the keyframe indexes of the recordings being served, loaded
+    from the index files the disker writes next to them.
+
+    The index of a recording still being written is updated with the
+    entries appended to its file since it was read, instead of being
+    loaded again.
+    """
+
+    logCategory = LOG_CATEGORY
+
+    def __init__(self, size=INDEX_CACHE_SIZE):
+        self._size = size
+        self._indexes = {} # {key: (index, parsed size of the file)}
+        self._order = [] # keys, least recently used first
+        self._loading = {} # {key: [deferreds waiting for the index]}
+
+    def getIndex(self, path):
+        """
+        @param path: the path of an index file
+        @type  path: L{fileprovider.FilePath}
+
+        @returns: a deferred fired with the index, or with None if the
+                  index file does not exist or is not valid
+        @rtype:   L{defer.Deferred}
+        """
+        key = str(path)
+        d = defer.Deferred()
+        if key in self._loading:
+            self._loading[key].append(d)
+            return d
+        self._loading[key] = [d]
+        load = defer.maybeDeferred(path.open)
+        load.addCallback(self._gotIndexFile, key)
+        load.addErrback(self._indexFileFailure, path)
+        load.addBoth(self._indexLoaded, key)
+        return d
+
+    def clear(self):
+        self._indexes.clear()
+        del self._order[:]
+
+
+    ## Private Methods ##
+
+    def _gotIndexFile(self, provider, key):
+        cached = self._indexes.get(key)
+        size = provider.getsize()
+        if cached is not None and cached[1] == size:
+            provider.close()
+            return cached[0]
+        if cached is not None and cached[1] > size:
+            # the index file was written again
+            cached = None
+        offset = cached and cached[1] or 0
+        provider.seek(offset)
+        d = provider.read(size - offset)
+        d.addCallback(self._parseIndex, key, cached, provider)
+
+        def closeProvider(result):
+            provider.close()
+            return result
+        d.addBoth(closeProvider)
+        return d
+
+    def _parseIndex(self, data, key, cached, provider):
+        if cached is None:
+            index = Index()
+            parsed = index.loadIndexData(data, True)
+            if parsed is None:
+                self._forget(key)
+                return None
+        else:
+            index, offset = cached
+            parsed = index.appendIndexData(data)
+            if parsed is None:
+                # the index file was replaced, load it again
+                self._forget(key)
+                provider.seek(0)
+                d = provider.read(provider.getsize())
+                d.addCallback(self._parseIndex, key, None, provider)
+                return d
+            parsed += offset
+        self.debug("Loaded %d entries of index %s", len(index), key)
+        self._store(key, index, parsed)
+        return index
+
+    def _indexFileFailure(self, failure, path):
+        failure.trap(fileprovider.FileError)
+        self.debug("No index loaded from %s: %s", path,
+                   log.getFailureMessage(failure))
+        return None
+
+    def _indexLoaded(self, result, key):
+        for d in self._loading.pop(key):
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def _store(self, key, index, parsed):
+        if key in self._indexes:
+            self._order.remove(key)
+        self._indexes[key] = (index, parsed)
+        self._order.append(key)
+        while len(self._order) > self._size:
+            del self._indexes[self._order.pop(0)]
+
+    def _forget(self, key):
+        if key in self._indexes:
+            del self._indexes[key]
+            self._order.remove(key)
+
+
+class IndexedFile(File):
+    """
+    I am a File resource for recordings with a keyframe index next to
+    them, like the MPEG-TS, WebM and Ogg files written by the disker.
+    I can handle requests with a 'start' GET parameter using the index.
+    Without an index, I ignore this parameter.
+    The 'start' parameter is either a UNIX time, or a time offset from the
+    beginning of the recording, in seconds. If it is non-zero, I will seek
+    to the last keyframe before that time, and prepend the content with the
+    headers of the recording, to make the output playable. The media is
+    not parsed.
+    """
+
+    indexes = RecordingIndexes()
+
+    def do_prepareBody(self, request, provider, first, last):
+        self.log('do_prepareBody for indexed file')
+        length = last - first + 1
+
+        try:
+            start = float(request.args.get('start', ['0'])[0])
+        except ValueError:
+            start = 0
+        indexPath = self._getIndexPath()
+        # range request takes precedence over our start parsing
+        if request.getHeader('range') is None and start and indexPath:
+            self.debug('Start %f passed, seeking', start)
+            d = self.indexes.getIndex(indexPath)
+            d.addCallback(self._seek, request, provider, start, last)
+
+            def seekingFailed(failure):
+                # swallow the failure and serve the file from the beginning
+                self.warning("Seeking in indexed file %s failed: %s",
+                             provider, log.getFailureMessage(failure))
+                provider.seek(0)
+                request.setHeader('Content-Length', str(length))
+                return ''
+
+            d.addErrback(seekingFailed)
+            return d
+        else:
+            request.setHeader('Content-Length', str(length))
+            return defer.succeed('')
+
+
+    ## Private Methods ##
+
+    def _getIndexPath(self):
+        if self._parentPath is None:
+            return None
+        try:
+            return self._parentPath.child(
+                '.'.join([self._name, Index.INDEX_EXTENSION]))
+        except fileprovider.FileError:
+            return None
+
+    def _seek(self, index, request, provider, start, last):
+        entry = None
+        if index is not None:
+            firstTDT = index.getFirstTDT()
+            if firstTDT > 0 and start >= firstTDT:
+                entry = index.seekTDT(start)
+            else:
+                # the timestamps of the index are in nanoseconds
+                entry = index.seekTimestamp(index.getFirstTimestamp() +
+                                            long(start * 1000000000))
+        headers = index and index.getHeaders()
+        headersSize = headers and headers['length'] or 0
+        if entry is None or not headersSize < entry['offset'] <= last:
+            self.debug("Could not seek to %f in the index of %s, serving "
+                       "it from the beginning", start, provider)
+            request.setHeader('Content-Length', str(last + 1))
+            return ''
+        offset = entry['offset']
+        self.debug("Seeking to the keyframe at offset %d of %s",
+                   offset, provider)
+
+        def seekAndSetContentLength(header):
+            provider.seek(offset)
+            request.setHeader('Content-Length',
+                              str(last - offset + 1 + len(header)))
+            return header
+
+        if not headersSize:
+            return seekAndSetContentLength('')
+        provider.seek(0)
+        d = provider.read(headersSize)
+        d.addCallback(seekAndSetContentLength)
+        return d
+
+
 class FileTransfer(log.Loggable):
     """
     A class to represent the transfer of a file over the network.
@@ -684,3 +915,113 @@ class FileTransfer(log.Loggable):
             self.consumer.finish()
             self.consumer = None
             self._finished = True
+
+
+class SendfileTransfer(FileTransfer):
+    """
+    I transfer a local file with sendfile(2), so that the data goes from
+    the page cache to the client's socket without being copied through
+    python strings.
+
+    I can only be used when the request writes straight to its TCP
+    connection. If sendfile does not work for the file, I fall back to
+    reading it like L{FileTransfer}.
+    """
+
+    # most bytes to send in one go before going back to the reactor
+    chunkSize = 1024 * 1024
+
+    def canSend(cls, request, consumer, provider):
+        """
+        @returns: whether the body of the request can be sent with me
+        @rtype:   bool
+        """
+        if sendfile is None or consumer is not request:
+            # no rate control proxy may sit between us and the request
+            return False
+        if not hasattr(request, 'dataSent'):
+            return False
+        transport = request.transport
+        if not isinstance(transport, tcp.Connection):
+            return False
+        if getattr(transport, 'TLS', False):
+            return False
+        getFileDescriptor = getattr(provider, 'getFileDescriptor', None)
+        return getFileDescriptor is not None and \
+            getFileDescriptor() is not None
+    canSend = classmethod(canSend)
+
+    def __init__(self, provider, size, request):
+        """
+        @param provider: a file provider giving access to a file descriptor
+        @type  provider: L{fileprovider.File}
+        @param size: file position to which file should be sent
+        @type  size: int
+        @param request: the request to send the file to
+        @type  request: L{flumotion.component.misc.httpserver.httpserver.
+                          CancellableRequest}
+        """
+        self._fd = provider.getFileDescriptor()
+        self._sendfile = True
+        FileTransfer.__init__(self, provider, size, request)
+
+    def _produce(self):
+        if not self._sendfile:
+            FileTransfer._produce(self)
+            return
+
+        request = self.consumer
+        transport = request.transport
+        if not request.startedWriting:
+            # let the request write the status line and headers
+            request.write('')
+            if getattr(request, 'chunked', False):
+                # without a Content-Length the body has to be framed
+                self._sendfile = False
+                FileTransfer._produce(self)
+                return
+        if transport._tempDataBuffer or \
+           len(transport.dataBuffer) > transport.offset:
+            # Headers or a body prefix are still buffered; the transport
+            # asks us to resume once it has written them all.
+            return
+
+        count = min(self.chunkSize, self.size - self.written)
+        try:
+            sent = sendfile.sendfile(transport.fileno(), self._fd,
+                                     self.written, count)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                transport.startWriting()
+                return
+            if e.errno in (errno.EINVAL, errno.ENOSYS):
+                self.debug("Cannot use sendfile for %s, reading it "
+                           "instead: %s", self.provider, str(e))
+                self._sendfile = False
+                self.provider.seek(self.written)
+                FileTransfer._produce(self)
+                return
+            self.debug("Failure sending file %s: %s", self.provider, str(e))
+            self._terminate()
+            return
+
+        if not sent:
+            self.warning("File %s is shorter than expected, %d of %d "
+                         "bytes sent", self.provider, self.written, self.size)
+            self._terminate()
+            return
+
+        self.written += sent
+        self.bytesWritten += sent
+        request.sentLength += sent
+        request.dataSent(sent)
+        self.provider.onBytesSent(sent)
+
+        if self.written >= self.size:
+            self.debug('Sent entire file of %d bytes from %s',
+                       self.size, self.provider)
+            self._terminate()
+        else:
+            # With its buffers empty, the transport asks us to resume as
+            # soon as the socket is writable again.
+            transport.startWriting()
@@ -26,6 +26,7 @@ from twisted.cred import credentials
 from zope.interface import implements
 
 from flumotion.common import log, messages, errors, netutils, interfaces
+from flumotion.common import timerwheel
 from flumotion.common.i18n import N_, gettexter
 from flumotion.component import component
 from flumotion.component.base import http as httpbase
@@ -34,7 +35,7 @@ from flumotion.component.misc.httpserver import httpfile, \
         localprovider, localpath
 from flumotion.component.misc.httpserver import serverstats
 from flumotion.component.misc.porter import porterclient
-from flumotion.twisted import fdserver
+from flumotion.twisted import fdserver, flavors
 
 __version__ = "$Rev$"
 T_ = gettexter()
@@ -78,7 +79,13 @@ class CancellableRequest(server.Request):
 
     def write(self, data):
         server.Request.write(self, data)
-        size = len(data)
+        self.dataSent(len(data))
+
+    def dataSent(self, size):
+        """
+        Account for body data sent to the client, either through L{write}
+        or directly on the transport's socket.
+        """
         self._bytesWritten += size
         self.lastTimeWritten = time.time()
         # Update statistics
@@ -141,18 +148,14 @@ class Site(server.Site):
         self.component = component
 
 
-class StatisticsUpdater(object):
+class StatisticsUpdater(flavors.StatePublisher):
     """
     I wrap a statistics ui state entry, to allow updates.
+    The updates are only published while the ui state is observed.
     """
 
     def __init__(self, state, key):
-        self._state = state
-        self._key = key
-
-    def update(self, name, value):
-        if value != self._state.get(self._key).get(name, None):
-            self._state.setitem(self._key, name, value)
+        flavors.StatePublisher.__init__(self, state, key)
 
 
 class HTTPFileMedium(component.BaseComponentMedium):
@@ -220,6 +223,7 @@ class HTTPFileStreamer(component.BaseComponent, log.Loggable):
         self.stats = None
         self._rateControlPlug = None
         self._fileProviderPlug = None
+        self._defaultFileProviderPlug = False
         self._metadataProviderPlug = None
         self._loggers = []
         self._requestModifiers = []
@@ -227,6 +231,8 @@ class HTTPFileStreamer(component.BaseComponent, log.Loggable):
         self.httpauth = None
         self._startTime = time.time()
         self._uptimeCallId = None
+        self._statsUpdaters = []
+        self._authCacheUpdater = None
         self._allowBrowsing = False
 
         self._description = 'On-Demand Flumotion Stream'
@@ -238,7 +244,8 @@ class HTTPFileStreamer(component.BaseComponent, log.Loggable):
         self._pbclient = None
 
         self._twistedPort = None
-        self._timeoutRequestsCallLater = None
+        self._requestTimers = {} # fd -> Timer timing out the idle request
+        self._timerWheel = timerwheel.getTimerWheel()
 
         self._pendingDisconnects = {}
         self._rootResource = None
@@ -248,6 +255,11 @@ class HTTPFileStreamer(component.BaseComponent, log.Loggable):
         self._mimeToResource = {
             'video/x-flv': httpfile.FLVFile,
             'video/mp4': httpfile.MP4File,
+            'video/MP2T': httpfile.IndexedFile,
+            'video/webm': httpfile.IndexedFile,
+            'video/ogg': httpfile.IndexedFile,
+            'audio/ogg': httpfile.IndexedFile,
+            'application/ogg': httpfile.IndexedFile,
         }
 
         self.uiState.addKey('stream-url', None)
@@ -256,6 +268,7 @@ class HTTPFileStreamer(component.BaseComponent, log.Loggable):
         self.uiState.addKey('allow-browsing', False)
         self.uiState.addDictKey('request-statistics')
         self.uiState.addDictKey('provider-statistics')
+        self.uiState.addDictKey('auth-cache-statistics')
 
     def do_check(self):
         props = self.config['properties']
@@ -337,6 +350,11 @@ class HTTPFileStreamer(component.BaseComponent, log.Loggable):
 
         if 'allow-default' in props:
             self.httpauth.setAllowDefault(props['allow-default'])
+        if 'auth-cache-ttl' in props:
+            self.httpauth.enableCache(float(props['auth-cache-ttl']),
+                                      props.get('auth-cache-size', None),
+                                      props.get('auth-cache-negative-ttl',
+                                                None))
         if 'ip-filter' in props:
             logFilter = http.LogFilter()
             for f in props['ip-filter']:
@@ -359,6 +377,8 @@ class HTTPFileStreamer(component.BaseComponent, log.Loggable):
             plugProps = {"properties": {"path": props.get('path', None)}}
             self._fileProviderPlug = localprovider.FileProviderLocalPlug(
                 plugProps)
+            # not a configured plug, so we start and stop it ourselves
+            self._defaultFileProviderPlug = True
 
         socket = ('flumotion.component.misc.httpserver'
                  '.metadataprovider.MetadataProviderPlug')
@@ -382,15 +402,21 @@ class HTTPFileStreamer(component.BaseComponent, log.Loggable):
                 "a resource or path property must be set")
 
         site = Site(root, self)
-        self._timeoutRequestsCallLater = reactor.callLater(
-            self.REQUEST_TIMEOUT, self._timeoutRequests)
 
         # Create statistics handler and start updating ui state
         self.stats = serverstats.ServerStatistics()
         updater = StatisticsUpdater(self.uiState, "request-statistics")
+        self._statsUpdaters.append(updater)
         self.stats.startUpdates(updater)
         updater = StatisticsUpdater(self.uiState, "provider-statistics")
+        self._statsUpdaters.append(updater)
         self._fileProviderPlug.startStatsUpdates(updater)
+        self._authCacheUpdater = StatisticsUpdater(self.uiState,
+                                                   "auth-cache-statistics")
+        self._statsUpdaters.append(self._authCacheUpdater)
+        self._fileProviderPlug.setServerStatistics(self.stats)
+        if self._defaultFileProviderPlug:
+            self._fileProviderPlug.start(self)
         self._updateUptime()
 
         d = defer.Deferred()
@@ -447,11 +473,18 @@ class HTTPFileStreamer(component.BaseComponent, log.Loggable):
             self.stats.stopUpdates()
         if self._fileProviderPlug:
             self._fileProviderPlug.stopStatsUpdates()
+            if self._defaultFileProviderPlug:
+                self._fileProviderPlug.stop(self)
+        for updater in self._statsUpdaters:
+            updater.stop()
+        self._statsUpdaters = []
+        self._authCacheUpdater = None
         if self.httpauth:
             self.httpauth.stopKeepAlive()
-        if self._timeoutRequestsCallLater:
-            self._timeoutRequestsCallLater.cancel()
-            self._timeoutRequestsCallLater = None
+            self.httpauth.logCacheStats()
+        for timer in self._requestTimers.values():
+            timer.cancel()
+        self._requestTimers.clear()
         if self._uptimeCallId:
             self._uptimeCallId.cancel()
             self._uptimeCallId = None
@@ -503,27 +536,26 @@ class HTTPFileStreamer(component.BaseComponent, log.Loggable):
         reactor.connectWith(fdserver.FDConnector, self._porterPath,
                             self._pbclient, 10, checkPID=False)
 
-    def _timeoutRequests(self):
-        self._timeoutRequestsCallLater = None
-
-        now = time.time()
-        for request in self._connected_clients.values():
-            if now - request.lastTimeWritten > self.REQUEST_TIMEOUT:
-                self.debug("Timing out connection on request for [fd %5d]",
-                    request.fd)
-                # Apparently this is private API. However, calling
-                # loseConnection is not sufficient - it won't drop the
-                # connection until the send queue is empty, which might never
-                # happen for an uncooperative client
-                request.channel.transport.connectionLost(
-                    errors.TimeoutException())
-
-        # FIXME: ideally, we shouldn't create another callLater if the
-        # component is shutting down, to leave the environment clean
-        # and tidy (right now, let's hope the process will be stopped
-        # eventually anyway)
-        self._timeoutRequestsCallLater = reactor.callLater(
-            self.REQUEST_TIMEOUT, self._timeoutRequests)
+    def _timeoutRequest(self, fd):
+        # Requests are not rescheduled every time they write, only when
+        # their timer runs out before they've been idle long enough
+        request = self._connected_clients.get(fd, None)
+        if request is None:
+            del self._requestTimers[fd]
+            return
+        idle = time.time() - request.lastTimeWritten
+        if idle < self.REQUEST_TIMEOUT:
+            self._requestTimers[fd].reset(self.REQUEST_TIMEOUT - idle)
+            return
+        del self._requestTimers[fd]
+        self.debug("Timing out connection on request for [fd %5d]",
+            request.fd)
+        # Apparently this is private API. However, calling
+        # loseConnection is not sufficient - it won't drop the
+        # connection until the send queue is empty, which might never
+        # happen for an uncooperative client
+        request.channel.transport.connectionLost(
+            errors.TimeoutException())
 
     def _getDefaultRootResource(self):
         node = self._fileProviderPlug.getRootPath()
@@ -591,6 +623,11 @@ class HTTPFileStreamer(component.BaseComponent, log.Loggable):
         # request does not yet have proto and uri
         fd = request.transport.fileno() # ugly!
         self._connected_clients[fd] = request
+        if fd in self._requestTimers:
+            self._requestTimers[fd].reset(self.REQUEST_TIMEOUT)
+        else:
+            self._requestTimers[fd] = self._timerWheel.schedule(
+                self.REQUEST_TIMEOUT, self._timeoutRequest, fd)
         self.debug("[fd %5d] (ts %f) request %r started",
                    fd, time.time(), request)
 
@@ -615,6 +652,9 @@ class HTTPFileStreamer(component.BaseComponent, log.Loggable):
             d = defer.succeed(None)
 
         del self._connected_clients[fd]
+        timer = self._requestTimers.pop(fd, None)
+        if timer is not None:
+            timer.cancel()
 
         self._total_bytes_written += bytesWritten
 
@@ -714,5 +754,9 @@ class HTTPFileStreamer(component.BaseComponent, log.Loggable):
     def _updateUptime(self):
         uptime = time.time() - self._startTime
         self.uiState.set("server-uptime", uptime)
+        stats = self.httpauth and self.httpauth.getCacheStats()
+        if stats and self._authCacheUpdater:
+            for key, value in stats.items():
+                self._authCacheUpdater.update(key, value)
         self._uptimeCallId = reactor.callLater(UPTIME_UPDATE_INTERVAL,
                                                self._updateUptime)
@@ -0,0 +1,146 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_component_providers -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+import time
+
+from twisted.internet import defer, reactor
+from twisted.python import failure, threadpool
+
+from flumotion.common import log
+
+LOG_CATEGORY = "ioexecutor"
+
+
+class IOExecutor(log.Loggable):
+    """
+    I run blocking file operations in a bounded pool of threads, so that
+    slow disks don't stall the reactor.
+
+    Operations are submitted for a key, usually the file they work on.
+    Operations for the same key run one after the other in the order they
+    were submitted; operations for different keys run concurrently.
+
+    When I'm not started, or after I've been stopped, operations run
+    synchronously in the reactor thread.
+
+    @ivar pendingCount: the number of submitted operations not yet finished
+    @type pendingCount: int
+    """
+
+    logCategory = LOG_CATEGORY
+
+    def __init__(self, threads, stats=None):
+        """
+        @param threads: the maximum number of threads to run operations in
+        @type  threads: int
+        @param stats:   an object to report the time operations waited
+                        before running to, through onIOWaited(seconds)
+        """
+        self.threads = threads
+        self.pendingCount = 0
+        self._stats = stats
+        self._pool = None
+        self._shutdownTrigger = None
+        # key -> list of (submitTime, deferred, function, args) waiting
+        # for the running operation of that key to finish
+        self._queues = {}
+
+    def setStatistics(self, stats):
+        self._stats = stats
+
+    def start(self):
+        if self._pool is not None:
+            return
+        self.debug("Starting I/O thread pool with up to %d threads",
+                   self.threads)
+        self._pool = threadpool.ThreadPool(0, self.threads, 'ioexecutor')
+        self._pool.start()
+        self._shutdownTrigger = reactor.addSystemEventTrigger(
+            'during', 'shutdown', self._shutdown)
+
+    def stop(self):
+        if self._pool is None:
+            return
+        self.debug("Stopping I/O thread pool")
+        pool, self._pool = self._pool, None
+        if self._shutdownTrigger is not None:
+            reactor.removeSystemEventTrigger(self._shutdownTrigger)
+            self._shutdownTrigger = None
+        # operations already handed to the threads still complete
+        pool.stop()
+
+    def submit(self, key, function, *args):
+        """
+        Run a blocking function after the operations already submitted
+        for the same key.
+
+        @returns: a deferred fired with the result of the function
+        @rtype:   L{defer.Deferred}
+        """
+        d = defer.Deferred()
+        operation = (time.time(), d, function, args)
+        self.pendingCount += 1
+        queue = self._queues.get(key)
+        if queue is not None:
+            queue.append(operation)
+        else:
+            self._queues[key] = []
+            self._run(key, operation)
+        return d
+
+
+    ## Private Methods ##
+
+    def _shutdown(self):
+        # a firing trigger can't be removed
+        self._shutdownTrigger = None
+        self.stop()
+
+    def _run(self, key, operation):
+        submitTime, d, function, args = operation
+        if self._pool is None:
+            try:
+                result = function(*args)
+            except:
+                result = failure.Failure()
+            self._done(key, d, time.time() - submitTime, result)
+            return
+        self._pool.callInThread(self._work, key, operation)
+
+    def _work(self, key, operation):
+        # Called in a thread of the pool
+        submitTime, d, function, args = operation
+        waited = time.time() - submitTime
+        try:
+            result = function(*args)
+        except:
+            result = failure.Failure()
+        reactor.callFromThread(self._done, key, d, waited, result)
+
+    def _done(self, key, d, waited, result):
+        self.pendingCount -= 1
+        if self._stats is not None:
+            self._stats.onIOWaited(waited)
+        queue = self._queues[key]
+        if queue:
+            self._run(key, queue.pop(0))
+        else:
+            del self._queues[key]
+        if isinstance(result, failure.Failure):
+            d.errback(result)
+        else:
+            d.callback(result)
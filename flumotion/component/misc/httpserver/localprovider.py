@@ -23,6 +23,7 @@ from twisted.internet import defer
 
 from flumotion.common import log
 from flumotion.component.misc.httpserver import fileprovider, localpath
+from flumotion.component.misc.httpserver import ioexecutor
 from flumotion.component.misc.httpserver.fileprovider import FileError
 from flumotion.component.misc.httpserver.fileprovider import FileClosedError
 
@@ -31,11 +32,15 @@ SEEK_SET = 0
 
 LOG_CATEGORY = "fileprovider-local"
 
+# Default number of threads reading files
+DEFAULT_IO_THREADS = 4
+
 
 class FileProviderLocalPlug(fileprovider.FileProviderPlug, log.Loggable):
     """
-    I am a plug that provide local files directly,
-    faking the file access is asynchronous.
+    I am a plug that provide local files directly.
+    File reads run in a bounded pool of threads, unless the io-threads
+    property is 0; then they block the reactor thread.
     """
 
     logcategory = LOG_CATEGORY
@@ -43,6 +48,22 @@ class FileProviderLocalPlug(fileprovider.FileProviderPlug, log.Loggable):
     def __init__(self, args):
         props = args['properties']
         self._path = props.get('path', None)
+        threads = props.get('io-threads', DEFAULT_IO_THREADS)
+        self._executor = None
+        if threads > 0:
+            self._executor = ioexecutor.IOExecutor(threads)
+
+    def start(self, component):
+        if self._executor is not None:
+            self._executor.start()
+
+    def stop(self, component):
+        if self._executor is not None:
+            self._executor.stop()
+
+    def setServerStatistics(self, stats):
+        if self._executor is not None:
+            self._executor.setStatistics(stats)
 
     def startStatsUpdates(self, updater):
         # No statistics for local file provider
@@ -54,20 +75,37 @@ class FileProviderLocalPlug(fileprovider.FileProviderPlug, log.Loggable):
     def getRootPath(self):
         if self._path is None:
             return None
-        return LocalPath(self._path)
+        return LocalPath(self._path, self._executor)
 
 
 class LocalPath(localpath.LocalPath):
 
+    def __init__(self, path, executor=None):
+        localpath.LocalPath.__init__(self, path)
+        self._executor = executor
+
+    def child(self, name):
+        childpath = self._getChildPath(name)
+        return LocalPath(childpath, self._executor)
+
     def open(self):
-        return LocalFile(self._path, self.mimeType)
+        return LocalFile(self._path, self.mimeType, self._executor)
+
+
+def _readAt(f, position, size):
+    # Called in an I/O thread
+    f.seek(position, SEEK_SET)
+    return f.read(size)
 
 
 class LocalFile(fileprovider.File, log.Loggable):
     """
-    I offer a fake asynchronous wrapper around a synchronous file.
-    I'm not thread-safe, I should only be used to read small blocks
-    from a local file system and I don't support cloning.
+    I offer an asynchronous wrapper around a synchronous file.
+
+    With an L{ioexecutor.IOExecutor}, I read in its threads and read the
+    next block ahead while the current one is being sent. Without one,
+    I read in the calling thread, so I should only be used to read small
+    blocks from a local file system. I don't support cloning.
     """
 
     logCategory = LOG_CATEGORY
@@ -83,10 +121,14 @@ class LocalFile(fileprovider.File, log.Loggable):
     # Default values
     _file = None
     _info = None
+    _readAhead = None
 
-    def __init__(self, path, mimeType):
+    def __init__(self, path, mimeType, executor=None):
         self._path = path
         self.mimeType = mimeType
+        self._executor = executor
+        # the read position, when reads happen in I/O threads
+        self._position = 0
         try:
             self._file = open(path, 'rb')
             self.debug("%s opened [fd %5d]", self, self._file.fileno())
@@ -117,6 +159,8 @@ class LocalFile(fileprovider.File, log.Loggable):
     def tell(self):
         if self._file is None:
             raise FileClosedError("File closed")
+        if self._executor is not None:
+            return self._position
         try:
             return self._file.tell()
         except IOError, e:
@@ -127,6 +171,9 @@ class LocalFile(fileprovider.File, log.Loggable):
     def seek(self, offset):
         if self._file is None:
             raise FileClosedError("File closed")
+        if self._executor is not None:
+            self._position = offset
+            return
         try:
             self._file.seek(offset, SEEK_SET)
         except IOError, e:
@@ -137,6 +184,8 @@ class LocalFile(fileprovider.File, log.Loggable):
     def read(self, size):
         if self._file is None:
             raise FileClosedError("File closed")
+        if self._executor is not None:
+            return self._readInThread(size)
         try:
             data = self._file.read(size)
             return defer.succeed(data)
@@ -148,6 +197,14 @@ class LocalFile(fileprovider.File, log.Loggable):
             return defer.fail()
 
     def close(self):
+        if self._file is not None and self._executor is not None:
+            self._dropReadAhead()
+            f, self._file = self._file, None
+            self._info = None
+            # close after the reads still running in the I/O threads
+            d = self._executor.submit(self, f.close)
+            d.addErrback(self._ebCloseFailed)
+            return
         if self._file is not None:
             try:
                 try:
@@ -163,5 +220,56 @@ class LocalFile(fileprovider.File, log.Loggable):
     def __del__(self):
         self.close()
 
+    def getFileDescriptor(self):
+        if self._file is None:
+            raise FileClosedError("File closed")
+        return self._file.fileno()
+
     def getLogFields(self):
         return {}
+
+
+    ## Private Methods ##
+
+    def _readInThread(self, size):
+        position = self._position
+        self._position = position + size
+        ahead = self._readAhead
+        if ahead is not None and ahead[:2] == (position, size):
+            self._readAhead = None
+            d = ahead[2]
+        else:
+            self._dropReadAhead()
+            d = self._executor.submit(self, _readAt, self._file,
+                                      position, size)
+        d.addCallbacks(self._cbRead, self._ebRead,
+                       callbackArgs=(position, size))
+        return d
+
+    def _cbRead(self, data, position, size):
+        if self._file is None:
+            return data
+        if self._position == position + size:
+            # no seek since this read was started
+            self._position = position + len(data)
+            if len(data) == size and self._readAhead is None:
+                d = self._executor.submit(self, _readAt, self._file,
+                                          self._position, size)
+                self._readAhead = (self._position, size, d)
+        return data
+
+    def _ebRead(self, failure):
+        failure.trap(IOError)
+        e = failure.value
+        cls = self._errorLookup.get(e[0], FileError)
+        raise cls("Failed to read data from %s: %s" % (self._path, str(e)))
+
+    def _dropReadAhead(self):
+        if self._readAhead is not None:
+            # nobody will wait for the data; swallow errors too
+            self._readAhead[2].addErrback(lambda _: None)
+            self._readAhead = None
+
+    def _ebCloseFailed(self, failure):
+        self.warning("Failed to close file '%s': %s", self._path,
+                     log.getFailureMessage(failure))
@@ -0,0 +1,158 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_component_providers -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+from flumotion.common import log
+
+LOG_CATEGORY = "memory-cache"
+
+
+class _Entry(object):
+
+    __slots__ = ("path", "mtime", "data", "prev", "next")
+
+    def __init__(self, path, mtime, data):
+        self.path = path
+        self.mtime = mtime
+        self.data = data
+        self.prev = self
+        self.next = self
+
+
+class MemoryCache(log.Loggable):
+    """
+    I keep the content of small files in memory, up to a total size,
+    evicting the least recently used files when I'm full.
+
+    Entries are keyed by the source path and validated against the
+    modification time and size of the source file, the same way the
+    disk cache validates its files.
+
+    @ivar usage: the number of bytes held in memory
+    @type usage: int
+    """
+
+    logCategory = LOG_CATEGORY
+
+    def __init__(self, stats, maxSize, maxFileSize):
+        """
+        @param stats:       the L{cachestats.CacheStatistics} to update
+        @param maxSize:     the maximum number of bytes to keep in memory
+        @type  maxSize:     int
+        @param maxFileSize: the size of the biggest file to keep in memory
+        @type  maxFileSize: int
+        """
+        self.stats = stats
+        self.maxSize = maxSize
+        self.maxFileSize = min(maxFileSize, maxSize)
+        self.usage = 0
+        self._entries = {} # {path: _Entry}
+        # Circular list, the most recently used entry is _head.next
+        self._head = _Entry(None, None, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def accepts(self, size):
+        """
+        @returns: whether a file of the given size can be kept in memory
+        @rtype:   bool
+        """
+        return size <= self.maxFileSize
+
+    def get(self, path, mtime, size):
+        """
+        Look up the content of a file.
+        An entry that doesn't match the given modification time and size
+        is outdated and dropped.
+
+        @returns: the content of the file, or None
+        @rtype:   str or None
+        """
+        entry = self._entries.get(path)
+        if entry is None:
+            return None
+        if entry.mtime != mtime or len(entry.data) != size:
+            self.debug("Memory cached file '%s' out-of-date", path)
+            self._remove(entry)
+            self._updateUsage()
+            return None
+        self._unlink(entry)
+        self._link(entry)
+        return entry.data
+
+    def put(self, path, mtime, data):
+        """
+        Keep the content of a file, evicting least recently used files
+        if needed.
+
+        @returns: whether the content has been kept
+        @rtype:   bool
+        """
+        size = len(data)
+        if not self.accepts(size):
+            return False
+        old = self._entries.get(path)
+        if old is not None:
+            self._remove(old)
+        head = self._head
+        while self.usage + size > self.maxSize:
+            victim = head.prev
+            self.log("Evicting '%s' from memory", victim.path)
+            self._remove(victim)
+            self.stats.onMemoryEviction()
+        entry = _Entry(path, mtime, data)
+        self._entries[path] = entry
+        self._link(entry)
+        self.usage += size
+        self._updateUsage()
+        return True
+
+    def remove(self, path):
+        entry = self._entries.get(path)
+        if entry is not None:
+            self._remove(entry)
+            self._updateUsage()
+
+    def clear(self):
+        self._entries.clear()
+        self._head.prev = self._head.next = self._head
+        self.usage = 0
+        self._updateUsage()
+
+
+    ## Private Methods ##
+
+    def _link(self, entry):
+        head = self._head
+        entry.prev = head
+        entry.next = head.next
+        head.next.prev = entry
+        head.next = entry
+
+    def _unlink(self, entry):
+        entry.prev.next = entry.next
+        entry.next.prev = entry.prev
+        entry.prev = entry.next = entry
+
+    def _remove(self, entry):
+        self._unlink(entry)
+        del self._entries[entry.path]
+        self.usage -= len(entry.data)
+
+    def _updateUsage(self):
+        self.stats.onMemoryUsage(self.usage, self.maxSize,
+                                 len(self._entries))
@@ -1,4 +1,4 @@
-# -*- Mode: Python; test-case-name: -*-
+# -*- Mode: Python; test-case-name: flumotion.test.test_ratecontrol -*-
 # vi:si:et:sw=4:sts=4:ts=4
 
 # Flumotion - a streaming media server
@@ -17,7 +17,7 @@
 
 __version__ = "$Rev$"
 
-import time
+from collections import deque
 
 from flumotion.common import log
 
@@ -25,6 +25,15 @@ from twisted.internet import reactor
 
 from flumotion.component.plugs import base as plugbase
 
+# NOTE: Performance is strongly correlated with this value.
+# Low values (e.g. 0.2) give a 'smooth' transfer, but very high cpu usage
+# if you have several hundred clients.
+# Higher values (e.g. 1.0 or more) give bursty transfer, but nicely lower
+# cpu usage.
+DRIP_INTERVAL = 1.0 # If we need to wait for more bits in our bucket, wait
+                    # at least this long, to avoid overly frequent small
+                    # writes
+
 
 class RateControllerPlug(plugbase.ComponentPlug):
 
@@ -39,6 +48,7 @@ class RateControllerPlug(plugbase.ComponentPlug):
 class RateControllerFixedPlug(RateControllerPlug):
 
     def __init__(self, args):
+        RateControllerPlug.__init__(self, args)
         props = args['properties']
         self._rateBytesPerSec = int(props.get('rate', 128000) / 8)
         # Peak level is 10 seconds of data; this is chosen
@@ -47,9 +57,181 @@ class RateControllerFixedPlug(RateControllerPlug):
             self._rateBytesPerSec * 8 * 10) / 8)
         self._initialLevel = int(props.get('initial-level', 0) / 8)
 
+        # The rate of all the transfers together, with a peak level
+        # of a second of data by default
+        aggregateRate = props.get('aggregate-rate', None)
+        aggregateLevel = None
+        if aggregateRate is not None:
+            aggregateRate = int(aggregateRate / 8)
+            aggregateLevel = int(props.get('aggregate-max-level',
+                aggregateRate * 8) / 8)
+        self._scheduler = TokenBucketScheduler(rate=aggregateRate,
+                                               maxLevel=aggregateLevel)
+
+    def stop(self, component):
+        stats = self._scheduler.getStats()
+        self.debug("Clients spent %.1f seconds throttled",
+                   stats['throttled-time'])
+        self._scheduler.stop()
+
+    def getStats(self):
+        """
+        @returns: the throttling statistics of the transfers
+        @rtype:   dict
+        """
+        return self._scheduler.getStats()
+
     def createProducerConsumerProxy(self, consumer, request):
         return TokenBucketConsumer(consumer, self._maxLevel,
-            self._rateBytesPerSec, self._initialLevel)
+            self._rateBytesPerSec, self._initialLevel, self._scheduler)
+
+
+class TokenBucketScheduler(log.Loggable):
+    """
+    I refill the token buckets of the throttled transfers on a single
+    periodic tick, instead of a delayed call per transfer.
+
+    I can also have a bucket of my own, capping the rate of all the
+    transfers together: a transfer writes only what both its bucket and
+    mine allow. When my bucket runs dry, the transfers are served in
+    turns, starting with a different one every tick.
+    """
+
+    logCategory = 'token-bucket'
+
+    def __init__(self, interval=DRIP_INTERVAL, rate=None, maxLevel=None,
+                 clock=reactor):
+        """
+        @param interval: seconds between the refills of the buckets
+        @type  interval: float
+        @param rate:     rate of all the transfers together, in bytes per
+                         second, or None for no limit
+        @type  rate:     int
+        @param maxLevel: maximum level of my bucket, in bytes; defaults
+                         to a second of data
+        @type  maxLevel: int
+        @param clock:    the provider of the time and delayed calls
+        @type  clock:    L{twisted.internet.interfaces.IReactorTime}
+        """
+        self.interval = interval
+        self.rate = rate
+        self.maxLevel = maxLevel or rate
+        self.level = self.maxLevel
+        self._clock = clock
+        self._lastFill = clock.seconds()
+        self._waiting = {} # throttled TokenBucketConsumer -> None
+        self._call = None
+        self._turn = 0
+        # seconds spent throttled, added up for all the transfers
+        self._throttledTime = 0.0
+        self._lastAccount = clock.seconds()
+
+    def seconds(self):
+        return self._clock.seconds()
+
+    def allowance(self, level):
+        """
+        @param level: the level of the bucket of a transfer
+        @returns:     how many bytes the transfer can write now
+        @rtype:       int
+        """
+        if self.rate is None:
+            return level
+        self._fill()
+        return min(level, int(self.level))
+
+    def consume(self, size):
+        """
+        Take the tokens of size bytes written by a transfer.
+        """
+        if self.rate is not None:
+            self.level -= size
+
+    def wait(self, consumer):
+        """
+        Refill the bucket of a transfer on the next tick.
+
+        @type consumer: L{TokenBucketConsumer}
+        """
+        self._account()
+        self._waiting[consumer] = None
+        if self._call is None:
+            self._call = self._clock.callLater(self.interval, self._tick)
+
+    def cancel(self, consumer):
+        """
+        Stop refilling the bucket of a transfer.
+
+        @type consumer: L{TokenBucketConsumer}
+        """
+        self._account()
+        self._waiting.pop(consumer, None)
+        if not self._waiting and self._call is not None:
+            self._call.cancel()
+            self._call = None
+
+    def getStats(self):
+        """
+        @returns: the number of transfers throttled now, and the seconds
+                  spent throttled by all the transfers
+        @rtype:   dict
+        """
+        self._account()
+        return {'throttled-clients': len(self._waiting),
+                'throttled-time': self._throttledTime}
+
+    def stop(self):
+        self._account()
+        self._waiting.clear()
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+
+
+    ## Private Methods ##
+
+    def _fill(self):
+        now = self._clock.seconds()
+        self.level = min(self.level + self.rate * (now - self._lastFill),
+                         self.maxLevel)
+        self._lastFill = now
+
+    def _account(self):
+        now = self._clock.seconds()
+        self._throttledTime += (now - self._lastAccount) * len(self._waiting)
+        self._lastAccount = now
+
+    def _tick(self):
+        self._call = None
+        self._account()
+        now = self._clock.seconds()
+        consumers = self._waiting.keys()
+        self._waiting.clear()
+        if self.rate is not None and consumers:
+            start = self._turn % len(consumers)
+            consumers = consumers[start:] + consumers[:start]
+            self._turn += 1
+        # the transfers still throttled wait for the next tick again
+        for consumer in consumers:
+            try:
+                consumer._dripAndTryWrite(now)
+            except Exception, e:
+                self.warning("Failed to refill %r: %s", consumer,
+                             log.getExceptionMessage(e))
+
+
+_scheduler = None
+
+
+def getScheduler():
+    """
+    @returns: the scheduler of the transfers created without one
+    @rtype:   L{TokenBucketScheduler}
+    """
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = TokenBucketScheduler()
+    return _scheduler
 
 
 class TokenBucketConsumer(log.Loggable):
@@ -61,6 +243,9 @@ class TokenBucketConsumer(log.Loggable):
     permitted.  The initial level can be set to a non-zero value, this is
     useful to implement burst-on-connect behaviour.
 
+    The bucket is refilled by a L{TokenBucketScheduler} while data is
+    waiting for tokens.
+
     TODO: This almost certainly only works with producers that work like
     FileTransfer - i.e. they produce data directly in resumeProducing, and
     ignore pauseProducing. This is sufficient for our needs right now.
@@ -68,21 +253,17 @@ class TokenBucketConsumer(log.Loggable):
 
     logCategory = 'token-bucket'
 
-    # NOTE: Performance is strongly correlated with this value.
-    # Low values (e.g. 0.2) give a 'smooth' transfer, but very high cpu usage
-    # if you have several hundred clients.
-    # Higher values (e.g. 1.0 or more) give bursty transfer, but nicely lower
-    # cpu usage.
-    _dripInterval = 1.0 # If we need to wait for more bits in our bucket, wait
-                        # at least this long, to avoid overly frequent small
-                        # writes
-
-    def __init__(self, consumer, maxLevel, fillRate, fillLevel=0):
+    def __init__(self, consumer, maxLevel, fillRate, fillLevel=0,
+                 scheduler=None):
         self.maxLevel = maxLevel # in bytes
         self.fillRate = fillRate # in bytes per second
         self.fillLevel = fillLevel # in bytes
 
-        self._buffers = [] # List of (offset, buffer) tuples
+        if scheduler is None:
+            scheduler = getScheduler()
+        self._scheduler = scheduler
+
+        self._buffers = deque() # (offset, buffer) tuples
         self._buffersSize = 0
 
         self._finishing = False # If true, we'll stop once the current buffer
@@ -91,8 +272,8 @@ class TokenBucketConsumer(log.Loggable):
         self._unregister = False # If true, we'll unregister from the consumer
                                  # once the data has been sent.
 
-        self._lastDrip = time.time()
-        self._dripDC = None
+        self._lastDrip = scheduler.seconds()
+        self._waiting = False # If true, the scheduler will drip for us
         self._paused = True
 
         self.producer = None # we get this in registerProducer.
@@ -110,15 +291,14 @@ class TokenBucketConsumer(log.Loggable):
                   "initial level %d, maximum level %d",
                   fillRate, fillLevel, maxLevel)
 
-    def _dripAndTryWrite(self):
+    def _dripAndTryWrite(self, now):
         """
         Re-fill our token bucket based on how long it has been since we last
         refilled it.
         Then attempt to write some data.
         """
-        self._dripDC = None
+        self._waiting = False
 
-        now = time.time()
         elapsed = now - self._lastDrip
         self._lastDrip = now
 
@@ -134,28 +314,47 @@ class TokenBucketConsumer(log.Loggable):
         if not self.consumer:
             return
 
-        while self.fillLevel > 0 and self._buffersSize > 0:
-            # If we're permitted to write at the moment, do so.
-            offset, buf = self._buffers[0]
-            sendbuf = buf[offset:offset+self.fillLevel]
-            sendBytes = len(sendbuf)
-
-            if sendBytes + offset == len(buf):
-                self._buffers.pop(0)
-            else:
-                self._buffers[0] = (offset + sendBytes, buf)
+        allowed = 0
+        if self.fillLevel > 0 and self._buffersSize > 0:
+            allowed = self._scheduler.allowance(self.fillLevel)
+        if allowed > 0:
+            # If we're permitted to write at the moment, do so, in a
+            # single write; only the buffer sent partially is sliced.
+            chunks = []
+            remaining = allowed
+            while remaining > 0 and self._buffers:
+                offset, buf = self._buffers[0]
+                size = len(buf) - offset
+                if size <= remaining:
+                    self._buffers.popleft()
+                    if offset:
+                        buf = buf[offset:]
+                    chunks.append(buf)
+                    remaining -= size
+                else:
+                    chunks.append(buf[offset:offset+remaining])
+                    self._buffers[0] = (offset + remaining, buf)
+                    remaining = 0
+            sendBytes = allowed - remaining
             self._buffersSize -= sendBytes
-
-            self.consumer.write(sendbuf)
             self.fillLevel -= sendBytes
+            self._scheduler.consume(sendBytes)
+
+            if len(chunks) == 1:
+                self.consumer.write(chunks[0])
+            else:
+                self.consumer.write(''.join(chunks))
+            if not self.consumer:
+                # stopped while writing
+                return
 
         if self._buffersSize > 0:
             # If we have data (and we're not already waiting for our next drip
             # interval), wait... this is what actually performs the data
             # throttling.
-            if not (self._dripDC or self._paused):
-                self._dripDC = reactor.callLater(self._dripInterval,
-                    self._dripAndTryWrite)
+            if not (self._waiting or self._paused):
+                self._waiting = True
+                self._scheduler.wait(self)
         else:
             # No buffer remaining; ask for more data or finish
             if self._finishing:
@@ -167,6 +366,10 @@ class TokenBucketConsumer(log.Loggable):
             elif self._unregister:
                 self._doUnregister()
 
+    def _cancelWait(self):
+        self._scheduler.cancel(self)
+        self._waiting = False
+
     def _doUnregister(self):
         self.consumer.unregisterProducer()
         self._unregister = False
@@ -181,10 +384,9 @@ class TokenBucketConsumer(log.Loggable):
         if self.producer is not None:
             self.producer.stopProducing()
 
-        if self._dripDC:
+        if self._waiting:
             # don't produce after stopProducing()!
-            self._dripDC.cancel()
-            self._dripDC = None
+            self._cancelWait()
 
             # ...and then, we still may have pending things to do
             if self._unregister:
@@ -196,7 +398,7 @@ class TokenBucketConsumer(log.Loggable):
 
         if self._buffersSize > 0:
             # make sure we release all the buffers, just in case
-            self._buffers = []
+            self._buffers.clear()
             self._buffersSize = 0
 
         self.consumer = None
@@ -217,10 +419,10 @@ class TokenBucketConsumer(log.Loggable):
         #
         # The producer might be None at this point if the following happened:
         # 1) we resumeProducing()
-        # 2) we find out we're not permitted to write more, so we set up the
-        #    callLater to write after self._dripInterval
+        # 2) we find out we're not permitted to write more, so we wait for
+        #    the next tick of the scheduler
         # 3) the producer goes avay, unregisterProducer() gets called
-        # 4) the callLater fires and we _dripAndTryWrite()
+        # 4) the scheduler ticks and we _dripAndTryWrite()
         # 5) we try to push some data to the consumer
         # 6) but the consumer is not reading fast enough, Twisted calls
         #    pauseProducing() on us
@@ -231,9 +433,8 @@ class TokenBucketConsumer(log.Loggable):
 
         # We have to stop dripping, otherwise we will keep on filling
         # the buffers and eventually run out of memory.
-        if self._dripDC:
-            self._dripDC.cancel()
-            self._dripDC = None
+        if self._waiting:
+            self._cancelWait()
 
     def resumeProducing(self):
         self._paused = False
@@ -248,14 +449,15 @@ class TokenBucketConsumer(log.Loggable):
 
         self._tryWrite()
 
-        if self._buffers and not self.fillLevel and self.producer:
+        # data left means our bucket or the one of the scheduler ran dry
+        if self._buffers and self.producer:
             # FIXME: That's not completely correct. See the comment in
             # self.pauseProducing() about not calling pauseProducing
             # on 'pull' producers.
             self.producer.pauseProducing()
 
     def finish(self):
-        if self._dripDC:
+        if self._waiting:
             self._finishing = True
         elif self.consumer:
             self._doFinish()
@@ -271,7 +473,7 @@ class TokenBucketConsumer(log.Loggable):
         if self.producer is not None:
             self.producer = None
 
-            if not self._dripDC:
+            if not self._waiting:
                 self._doUnregister()
             else:
                 # we need to wait until we've written the data
@@ -26,6 +26,17 @@ from flumotion.common import log
 MIN_REQUEST_SIZE = 64 * 1024 + 1
 # Statistics update period
 STATS_UPDATE_PERIOD = 10
+# Minimum interval in seconds between two publications
+# of the statistics updated for each request
+PUBLISH_INTERVAL = 1
+# Minimum relative change for the periodic statistics to be published
+PUBLISH_CHANGE = 0.01
+
+REQUEST_KEYS = ("current-request-count", "total-request-count",
+                "mean-file-read-ratio")
+PERIODIC_KEYS = ("mean-request-count", "current-request-rate",
+                 "mean-request-rate", "current-bitrate", "mean-bitrate",
+                 "current-io-wait", "mean-io-wait", "total-bytes-sent")
 
 
 class RequestStatistics(object):
@@ -69,16 +80,35 @@ class ServerStatistics(object):
         self.bitratePeak = 0
         self.bitratePeakTime = now
 
+        # Time file operations waited for an I/O thread
+        self.totalIOCount = 0
+        self.meanIOWait = 0.0
+        self.currentIOWait = 0.0
+        self.ioWaitPeak = 0.0
+        self.ioWaitPeakTime = now
+
         self._fileReadRatios = 0.0
+        self._ioWaits = 0.0
+        self._lastIOCount = 0
+        self._lastIOWaits = 0.0
         self._lastUpdateTime = now
         self._lastRequestCount = 0
         self._lastBytesSent = 0L
 
     def startUpdates(self, updater):
+        """
+        @param updater: the L{flavors.StatePublisher} to publish
+                        the statistics with
+        """
         self._updater = updater
+        for key in REQUEST_KEYS:
+            updater.setPolicy(key, minInterval=PUBLISH_INTERVAL)
+        for key in PERIODIC_KEYS:
+            updater.setPolicy(key, minChange=PUBLISH_CHANGE)
         self._set("bitrate-peak-time", self.bitratePeakTime)
         self._set("request-rate-peak-time", self.requestRatePeakTime)
         self._set("request-count-peak-time", self.requestCountPeakTime)
+        self._set("io-wait-peak-time", self.ioWaitPeakTime)
         if self._callId is None:
             self._callId = reactor.callLater(STATS_UPDATE_PERIOD, self._update)
 
@@ -88,6 +118,20 @@ class ServerStatistics(object):
             self._callId.cancel()
             self._callId = None
 
+    def onIOWaited(self, seconds):
+        """
+        Called when a file operation starts after waiting for an I/O
+        thread for the given time.
+        """
+        self.totalIOCount += 1
+        self._ioWaits += seconds
+        if seconds > self.ioWaitPeak:
+            now = time.time()
+            self.ioWaitPeak = seconds
+            self.ioWaitPeakTime = now
+            self._set("io-wait-peak", seconds)
+            self._set("io-wait-peak-time", now)
+
     def getMeanFileReadRatio(self):
         if self.finishedRequestCount > 0:
             return self._fileReadRatios / self.finishedRequestCount
@@ -113,12 +157,22 @@ class ServerStatistics(object):
         # calculate average bitrate
         meanBitrate = self._updateAverage(self._lastUpdateTime, now,
                                           self.currentBitrate, newBitrate)
+        # Calculate the mean time file operations waited since last update
+        ioCountDiff = self.totalIOCount - self._lastIOCount
+        newIOWait = 0.0
+        if ioCountDiff > 0:
+            newIOWait = (self._ioWaits - self._lastIOWaits) / ioCountDiff
+        meanIOWait = 0.0
+        if self.totalIOCount > 0:
+            meanIOWait = self._ioWaits / self.totalIOCount
         # Update Values
         self.meanRequestCount = meanReqCount
         self.currentRequestRate = newReqRate
         self.meanRequestRate = meanReqRate
         self.currentBitrate = newBitrate
         self.meanBitrate = meanBitrate
+        self.currentIOWait = newIOWait
+        self.meanIOWait = meanIOWait
 
         # Update the statistics keys with the new values
         self._set("mean-request-count", meanReqCount)
@@ -126,6 +180,8 @@ class ServerStatistics(object):
         self._set("mean-request-rate", meanReqRate)
         self._set("current-bitrate", newBitrate)
         self._set("mean-bitrate", meanBitrate)
+        self._set("current-io-wait", newIOWait)
+        self._set("mean-io-wait", meanIOWait)
 
         # Update request rate peak
         if newReqRate > self.requestRatePeak:
@@ -148,6 +204,8 @@ class ServerStatistics(object):
 
         self._lastRequestCount = self.totalRequestCount
         self._lastBytesSent = self.totalBytesSent
+        self._lastIOCount = self.totalIOCount
+        self._lastIOWaits = self._ioWaits
         self._lastUpdateTime = now
         # Log the stats
         self._logStatsLine()
@@ -202,11 +260,12 @@ class ServerStatistics(object):
             FRR: File Read Ratio
             MBR: Mean Bitrate
             CBR: Current Bitrate
+            CIW: Current I/O Wait
         """
         log.debug("stats-http-server",
                   "TRC: %s; CRC: %d; CRR: %.2f; MRR: %.2f; "
-                  "FRR: %.4f; MBR: %d; CBR: %d",
+                  "FRR: %.4f; MBR: %d; CBR: %d; CIW: %.4f",
                   self.totalRequestCount, self.currentRequestCount,
                   self.currentRequestRate, self.meanRequestRate,
                   self.meanFileReadRatio, self.meanBitrate,
-                  self.currentBitrate)
+                  self.currentBitrate, self.currentIOWait)
@@ -0,0 +1,301 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_porter -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+"""
+accept workers for the porter
+
+A porter configured with accept workers forks processes that listen on the
+same public port, using SO_REUSEPORT so that the kernel spreads incoming
+connections among them. Each worker parses request lines itself and passes
+the connections straight to the streamers, which log in to every worker
+on its own UNIX socket. The path and prefix table lives in the porter and
+is pushed to the workers over the porter's PB socket.
+"""
+
+import os
+import signal
+
+from twisted.cred import portal, credentials
+from twisted.internet import reactor, defer, error, process
+from twisted.spread import pb
+from zope.interface import implements
+
+from flumotion.common import log, pathtree
+from flumotion.common.poller import Poller
+from flumotion.twisted import fdserver, checkers
+
+__version__ = "$Rev$"
+
+# How often the handoff statistics are sent to the porter
+HANDOFF_REPORT_INTERVAL = 5
+
+
+class _UnreachableAvatar(object):
+    """
+    Stands in for a streamer that has a registered path but is not connected
+    to this worker, so that its clients get a 503 rather than a 404.
+    """
+
+    def __init__(self, avatarId):
+        self.avatarId = avatarId
+
+    def isAttached(self):
+        return True
+
+    def queueFileDescriptor(self, fileno, data):
+        return defer.fail(error.ConnectionRefusedError(
+            "%s is not connected to this accept worker" % self.avatarId))
+
+    def cancelFileDescriptor(self, fileno):
+        pass
+
+
+class AcceptWorkerAvatar(pb.Avatar, log.Loggable):
+    """
+    An avatar in an accept worker representing a streamer.
+    """
+
+    def __init__(self, avatarId, worker, mind):
+        self.avatarId = avatarId
+        self.worker = worker
+        self.mind = mind
+        if mind is not None:
+            mind.broker.transport.maxPendingFDs = worker.handoffQueueSize
+
+    def isAttached(self):
+        return self.mind is not None
+
+    def queueFileDescriptor(self, fileno, data):
+        return self.mind.broker.transport.queueFileDescriptor(fileno, data)
+
+    def cancelFileDescriptor(self, fileno):
+        if self.mind is not None:
+            self.mind.broker.transport.cancelFileDescriptor(fileno)
+
+    def logout(self):
+        self.debug("porter client %s logging out of accept worker",
+                   self.avatarId)
+        self.mind = None
+        self.worker.avatarDetached(self)
+
+    def perspective_enableFDBatching(self):
+        if self.mind is not None:
+            self.mind.broker.transport.maxFDBatch = \
+                self.worker.handoffBatchSize
+
+    def perspective_getPort(self):
+        return self.worker.porter._iptablesPort
+
+
+class AcceptWorkerRealm(log.Loggable):
+    implements(portal.IRealm)
+
+    def __init__(self, worker):
+        self.worker = worker
+
+    def requestAvatar(self, avatarId, mind, *interfaces):
+        if pb.IPerspective in interfaces:
+            avatar = AcceptWorkerAvatar(avatarId, self.worker, mind)
+            self.worker.avatarAttached(avatar)
+            return pb.IPerspective, avatar, avatar.logout
+        else:
+            raise NotImplementedError("no interface")
+
+
+class AcceptWorker(pb.Referenceable, log.Loggable):
+    """
+    I run in a process forked from the porter, accepting connections on
+    the porter's public port and passing them to streamers.
+
+    @ivar index:      the number of this worker, starting at 0
+    @type index:      int
+    @ivar socketPath: the UNIX socket streamers connect to
+    @type socketPath: str
+    """
+    logCategory = 'porter-worker'
+
+    def __init__(self, porter, index, secret=None):
+        """
+        @param secret: the secret I register with, telling me from the
+                       streamers logging in to the porter
+        @type  secret: str
+        """
+        self.porter = porter
+        self.index = index
+        self._secret = secret
+        self.logName = '%s-worker-%d' % (porter.name, index)
+        self.socketPath = porter.getAcceptWorkerSocketPath(index)
+        self.handoffQueueSize = porter._handoffQueueSize
+        self.handoffBatchSize = porter._handoffBatchSize
+
+        # path -> avatarId and prefix -> avatarId, as pushed by the porter
+        self._mappings = {}
+        self._prefixes = pathtree.PathTree()
+        # avatarId -> AcceptWorkerAvatar
+        self._avatars = {}
+        self._porterPerspective = None
+
+        # handoffs not reported to the porter yet
+        self._handoffCount = 0
+        self._handoffLatency = 0.0
+        self._handoffLatencyPeak = 0.0
+        self._handoffRejected = 0
+        self._handoffStatsPoller = None
+
+    def start(self):
+        """
+        Take over this freshly forked process: drop everything inherited
+        from the porter and start serving.
+        """
+        # the porter process is the one talking to the job and manager
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        for call in reactor.getDelayedCalls():
+            call.cancel()
+        # the other accept workers are not our children
+        process.reapProcessHandlers.clear()
+        for selectable in reactor.removeAll():
+            # Close our copies of the porter's sockets, through the socket
+            # objects so they won't close reused descriptors later on.
+            sock = getattr(selectable, 'socket', None)
+            if sock is not None:
+                sock.close()
+
+        self._listenStreamers()
+        self._listenClients()
+        self._connectPorter()
+
+    def _listenStreamers(self):
+        porter = self.porter
+        checker = checkers.FlexibleCredentialsChecker()
+        checker.addUser(porter._username, porter._password)
+        if not porter._requirePassword:
+            checker.allowPasswordless(True)
+        p = portal.Portal(AcceptWorkerRealm(self), [checker])
+        try:
+            os.unlink(self.socketPath)
+        except OSError:
+            pass
+        reactor.listenWith(fdserver.FDPort, self.socketPath,
+                           pb.PBServerFactory(p), mode=porter._socketMode)
+        self.debug("Listening for streamers on %s", self.socketPath)
+
+    def _listenClients(self):
+        from flumotion.component.misc.porter import porter
+        factory = porter.PorterProtocolFactory(self,
+            self.porter.getPorterProtocolClass())
+        reactor.listenWith(fdserver.ReusablePassableServerPort,
+                           self.porter._port, factory,
+                           interface=self.porter._interface)
+        self.debug("Accepting connections on port %d", self.porter._port)
+
+    def _connectPorter(self):
+        factory = pb.PBClientFactory()
+        reactor.connectUNIX(self.porter._socketPath, factory)
+        creds = credentials.UsernamePassword(self.porter._username,
+                                             self.porter._password)
+        d = factory.login(creds)
+        d.addCallback(self._porterConnected)
+        d.addErrback(self._porterLost)
+
+        def disconnected(connector, reason):
+            self._porterLost(reason)
+        factory.clientConnectionLost = disconnected
+
+    def _porterConnected(self, perspective):
+        # the porter logs us out as soon as we drop our reference
+        self._porterPerspective = perspective
+        self._handoffStatsPoller = Poller(self._sendHandoffStats,
+                                          HANDOFF_REPORT_INTERVAL)
+        return perspective.callRemote('registerAcceptWorker', self,
+                                      self.socketPath, self._secret)
+
+    def _sendHandoffStats(self):
+        if self._porterPerspective is None:
+            return
+        if not self._handoffCount and not self._handoffRejected:
+            return
+        stats = (self._handoffCount, self._handoffLatency,
+                 self._handoffLatencyPeak, self._handoffRejected)
+        self._handoffCount = 0
+        self._handoffLatency = 0.0
+        self._handoffLatencyPeak = 0.0
+        self._handoffRejected = 0
+        d = self._porterPerspective.callRemote('addHandoffStats', *stats)
+        d.addErrback(lambda failure: self.debug(
+            "Could not send handoff statistics: %s",
+            log.getFailureMessage(failure)))
+
+    def _porterLost(self, failure):
+        # Without the porter, our routing table goes stale and nobody will
+        # stop us; just go away.
+        self.warning("Lost connection to the porter: %s",
+                     log.getFailureMessage(failure))
+        try:
+            os.unlink(self.socketPath)
+        except OSError:
+            pass
+        os._exit(0)
+
+    ### methods used by the avatars and PorterProtocol
+
+    def avatarAttached(self, avatar):
+        self.debug("Streamer %s connected", avatar.avatarId)
+        self._avatars[avatar.avatarId] = avatar
+
+    def avatarDetached(self, avatar):
+        if self._avatars.get(avatar.avatarId) is avatar:
+            del self._avatars[avatar.avatarId]
+
+    def findDestination(self, path):
+        avatarId = self._mappings.get(path)
+        if avatarId is None:
+            avatarId = self._prefixes.longestPrefixValue(path)
+            if avatarId is None:
+                return None
+        avatar = self._avatars.get(avatarId)
+        if avatar is None:
+            self.debug("%s is not connected to us", avatarId)
+            return _UnreachableAvatar(avatarId)
+        return avatar
+
+    def handoffCompleted(self, latency):
+        self._handoffCount += 1
+        self._handoffLatency += latency
+        self._handoffLatencyPeak = max(self._handoffLatencyPeak, latency)
+
+    def handoffRejected(self):
+        self._handoffRejected += 1
+
+    ### remote methods called by the porter
+
+    def remote_setTable(self, mappings, prefixes):
+        self._mappings = mappings
+        self._prefixes = pathtree.PathTree(prefixes.items())
+
+    def remote_registerPath(self, path, avatarId):
+        self._mappings[path] = avatarId
+
+    def remote_deregisterPath(self, path):
+        self._mappings.pop(path, None)
+
+    def remote_registerPrefix(self, prefix, avatarId):
+        self._prefixes[prefix] = avatarId
+
+    def remote_deregisterPrefix(self, prefix):
+        if prefix in self._prefixes:
+            del self._prefixes[prefix]
@@ -15,20 +15,23 @@
 #
 # Headers in this file shall remain intact.
 
+import errno
 import os
 import random
+import signal
 import socket
 import string
 import time
 from urllib2 import urlparse
 
 from twisted.cred import portal
-from twisted.internet import protocol, reactor, error, defer
+from twisted.internet import protocol, reactor, error, defer, process
 from twisted.spread import pb
 from zope.interface import implements
 
-from flumotion.common import medium, log, messages, errors
+from flumotion.common import medium, log, messages, errors, pathtree
 from flumotion.common.i18n import N_, gettexter
+from flumotion.common.poller import Poller
 from flumotion.component import component
 from flumotion.component.component import moods
 from flumotion.twisted import fdserver, checkers
@@ -37,6 +40,13 @@ from flumotion.twisted import reflect
 __version__ = "$Rev$"
 T_ = gettexter()
 
+# How often the FD handoff statistics in the UI state are updated
+HANDOFF_STATS_INTERVAL = 10
+# How long to wait before restarting an accept worker that died
+ACCEPT_WORKER_RESTART_DELAY = 1
+# How long stopping accept workers may take before they are killed
+ACCEPT_WORKER_STOP_TIMEOUT = 5
+
 
 class PorterAvatar(pb.Avatar, log.Loggable):
     """
@@ -50,10 +60,28 @@ class PorterAvatar(pb.Avatar, log.Loggable):
         # The underlying transport is now accessible as
         # self.mind.broker.transport, on which we can call sendFileDescriptor
         self.mind = mind
+        if mind is not None:
+            mind.broker.transport.maxPendingFDs = porter._handoffQueueSize
 
     def isAttached(self):
         return self.mind != None
 
+    def queueFileDescriptor(self, fileno, data):
+        """
+        Queue a file descriptor to be passed to the streamer.
+        See L{fdserver.FDServer.queueFileDescriptor}.
+        """
+        return self.mind.broker.transport.queueFileDescriptor(fileno, data)
+
+    def cancelFileDescriptor(self, fileno):
+        if self.mind is not None:
+            self.mind.broker.transport.cancelFileDescriptor(fileno)
+
+    def getPendingFileDescriptorCount(self):
+        if self.mind is None:
+            return 0
+        return self.mind.broker.transport.getPendingFileDescriptorCount()
+
     def logout(self):
         self.debug("porter client %s logging out", self.avatarId)
         self.mind = None
@@ -77,6 +105,84 @@ class PorterAvatar(pb.Avatar, log.Loggable):
     def perspective_getPort(self):
         return self.porter._iptablesPort
 
+    def perspective_registerAcceptWorker(self, worker, socketPath, secret):
+        """
+        Called by an accept worker of this porter, after logging in.
+
+        @param worker:     the worker, to push path registrations to
+        @type  worker:     L{twisted.spread.pb.RemoteReference}
+        @param socketPath: the socket streamers should connect to
+        @type  socketPath: str
+        @param secret:     the secret the worker was forked with, telling
+                           it from the streamers logging in
+        @type  secret:     str
+        """
+        self.porter.registerAcceptWorker(self, worker, socketPath, secret)
+
+    def perspective_addHandoffStats(self, count, latency, peak, rejected):
+        """
+        Called by an accept worker of this porter with the connections it
+        handed off since its last call.
+        """
+        self.porter.addHandoffStats(self, count, latency, peak, rejected)
+
+    def perspective_enableFDBatching(self):
+        # The client can receive several FDs in a single message
+        self.debug("porter client %s accepts batched FDs", self.avatarId)
+        if self.mind is not None:
+            self.mind.broker.transport.maxFDBatch = \
+                self.porter._handoffBatchSize
+
+
+class AcceptWorkerProcess(log.Loggable):
+    """
+    I am an accept worker process forked by the porter. The reactor reaps
+    me when I exit, and tells the porter.
+
+    @ivar index:  the number of the worker
+    @type index:  int
+    @ivar pid:    the pid of the worker process
+    @type pid:    int
+    @ivar secret: the secret the worker registers with
+    @type secret: str
+    """
+    logCategory = 'porter'
+
+    def __init__(self, porter, index, pid, secret):
+        self.porter = porter
+        self.index = index
+        self.pid = pid
+        self.secret = secret
+
+    def watch(self):
+        """
+        Start waiting for the process to exit.
+        """
+        process.registerReapProcessHandler(self.pid, self)
+
+    def signal(self, signum):
+        try:
+            os.kill(self.pid, signum)
+        except OSError, e:
+            self.debug("Accept worker %d: %s", self.pid,
+                       log.getExceptionMessage(e))
+
+    # called by the reactor on SIGCHLD
+
+    def reapProcess(self):
+        try:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+        except OSError, e:
+            if e.errno != errno.ECHILD:
+                raise
+            pid, status = self.pid, None
+        if pid:
+            process.unregisterReapProcessHandler(self.pid, self)
+            self.processEnded(status)
+
+    def processEnded(self, status):
+        self.porter.acceptWorkerEnded(self, status)
+
 
 class PorterRealm(log.Loggable):
     """
@@ -97,7 +203,12 @@ class PorterRealm(log.Loggable):
                  avatarId, mind, interfaces)
         if pb.IPerspective in interfaces:
             avatar = PorterAvatar(avatarId, self.porter, mind)
-            return pb.IPerspective, avatar, avatar.logout
+            self.porter.avatarLoggedIn(avatar)
+
+            def logout():
+                avatar.logout()
+                self.porter.avatarLoggedOut(avatar)
+            return pb.IPerspective, avatar, logout
         else:
             raise NotImplementedError("no interface")
 
@@ -127,11 +238,14 @@ class Porter(component.BaseComponent, log.Loggable):
 
     def init(self):
         # We maintain a map of path -> avatar (the underlying transport is
-        # accessible from the avatar, we need this for FD-passing)
+        # accessible from the avatar, we need this for FD-passing).
+        # Prefixes are kept in a radix tree so that finding the longest
+        # matching prefix does not depend on how many are registered.
         self._mappings = {}
-        self._prefixes = {}
+        self._prefixes = pathtree.PathTree()
 
         self._socketlistener = None
+        self._clientListener = None
 
         self._socketPath = None
         self._username = None
@@ -143,6 +257,34 @@ class Porter(component.BaseComponent, log.Loggable):
         self._interface = ''
         self._external_interface = ''
 
+        # avatars of logged in streamers and accept workers
+        self._avatars = set()
+        # avatar -> (worker remote reference, socket path)
+        self._acceptWorkers = {}
+        self._acceptWorkerCount = 0
+        # index -> AcceptWorkerProcess
+        self._acceptWorkerProcesses = {}
+        # index -> DelayedCall restarting it
+        self._acceptWorkerRestarts = {}
+        self._acceptWorkersStopped = None
+
+        self._handoffQueueSize = 64
+        self._handoffBatchSize = 16
+        self._handoffCount = 0
+        self._handoffLatency = 0.0
+        self._handoffLatencyPeak = 0.0
+        self._handoffRejected = 0
+        self._handoffStatsPoller = Poller(self._updateHandoffStats,
+                                          HANDOFF_STATS_INTERVAL,
+                                          start=False)
+
+        self.uiState.addKey('fd-handoff-pending', 0)
+        self.uiState.addKey('fd-handoff-latency', 0.0)
+        self.uiState.addKey('fd-handoff-latency-peak', 0.0)
+        self.uiState.addKey('fd-handoff-total', 0)
+        self.uiState.addKey('fd-handoff-rejected', 0)
+        self.uiState.addDictKey('fd-handoff-queues')
+
     def registerPath(self, path, avatar):
         """
         Register a path as being served by a streamer represented by this
@@ -159,6 +301,7 @@ class Porter(component.BaseComponent, log.Loggable):
             self.warning("Replacing existing mapping for path \"%s\"" % path)
 
         self._mappings[path] = avatar
+        self._pushToAcceptWorkers('registerPath', path, avatar.avatarId)
 
     def deregisterPath(self, path, avatar):
         """
@@ -174,6 +317,7 @@ class Porter(component.BaseComponent, log.Loggable):
             if self._mappings[path] == avatar:
                 self.debug("Removing porter mapping for \"%s\"" % path)
                 del self._mappings[path]
+                self._pushToAcceptWorkers('deregisterPath', path)
             else:
                 self.warning(
                     "Mapping not removed: refers to a different avatar")
@@ -195,6 +339,7 @@ class Porter(component.BaseComponent, log.Loggable):
             self.warning("Overwriting prefix")
 
         self._prefixes[prefix] = avatar
+        self._pushToAcceptWorkers('registerPrefix', prefix, avatar.avatarId)
 
     def deregisterPrefix(self, prefix, avatar):
         """
@@ -212,22 +357,17 @@ class Porter(component.BaseComponent, log.Loggable):
         if self._prefixes[prefix] == avatar:
             self.debug("Removing prefix destination from porter")
             del self._prefixes[prefix]
+            self._pushToAcceptWorkers('deregisterPrefix', prefix)
         else:
             self.warning(
                 "Not removing prefix destination: expected avatar not found")
 
     def findPrefixMatch(self, path):
-        found = None
-        # TODO: Horribly inefficient. Replace with pathtree code.
-        for prefix in self._prefixes.keys():
-            self.log("Checking: %r, %r" % (prefix, path))
-            if (path.startswith(prefix) and
-                (not found or len(found) < len(prefix))):
-                found = prefix
-        if found:
-            return self._prefixes[found]
-        else:
-            return None
+        """
+        Find the avatar registered for the longest prefix of this path.
+        @returns: The Avatar for this prefix, or None.
+        """
+        return self._prefixes.longestPrefixValue(path)
 
     def findDestination(self, path):
         """
@@ -240,6 +380,228 @@ class Porter(component.BaseComponent, log.Loggable):
         else:
             return self.findPrefixMatch(path)
 
+    def avatarLoggedIn(self, avatar):
+        self._avatars.add(avatar)
+        # tell streamers where they can also receive connections from
+        for worker, socketPath in self._acceptWorkers.values():
+            self._connectToAcceptWorker(avatar, socketPath)
+
+    def avatarLoggedOut(self, avatar):
+        self._avatars.discard(avatar)
+        if avatar in self._acceptWorkers:
+            worker, socketPath = self._acceptWorkers.pop(avatar)
+            self.warning("Accept worker at %s went away", socketPath)
+
+    def registerAcceptWorker(self, avatar, worker, socketPath, secret):
+        """
+        Register an accept worker that logged in as the given avatar. The
+        worker gets the current path and prefix table, and all logged in
+        streamers are told to connect to it.
+
+        @raises errors.NotAuthenticatedError: if the secret is not the one
+                                              of a worker forked by me
+        """
+        secrets = [proc.secret
+                   for proc in self._acceptWorkerProcesses.values()]
+        if secret not in secrets:
+            self.warning("Porter client %s tried to register as an accept "
+                         "worker", avatar.avatarId)
+            raise errors.NotAuthenticatedError(
+                "%s is not an accept worker" % avatar.avatarId)
+        self.info("Accept worker listening at %s", socketPath)
+        self._acceptWorkers[avatar] = (worker, socketPath)
+
+        mappings = dict([(path, a.avatarId)
+                         for path, a in self._mappings.items()])
+        prefixes = dict([(prefix, a.avatarId)
+                         for prefix, a in self._prefixes.iteritems()])
+        d = worker.callRemote('setTable', mappings, prefixes)
+        d.addErrback(self._acceptWorkerErrback, socketPath)
+
+        for streamer in self._avatars:
+            if streamer is not avatar:
+                self._connectToAcceptWorker(streamer, socketPath)
+
+    def _connectToAcceptWorker(self, avatar, socketPath):
+        if not avatar.isAttached():
+            return
+
+        def errback(failure):
+            self.warning("Porter client %s can not connect to accept "
+                         "workers, its connections from them will fail: %s",
+                         avatar.avatarId, log.getFailureMessage(failure))
+        d = avatar.mind.callRemote('connectAcceptWorker', socketPath)
+        d.addErrback(errback)
+
+    def _pushToAcceptWorkers(self, method, *args):
+        for worker, socketPath in self._acceptWorkers.values():
+            d = worker.callRemote(method, *args)
+            d.addErrback(self._acceptWorkerErrback, socketPath)
+
+    def _acceptWorkerErrback(self, failure, socketPath):
+        self.warning("Failed to update accept worker at %s: %s",
+                     socketPath, log.getFailureMessage(failure))
+
+    def getAcceptWorkerSocketPath(self, index):
+        return '%s.worker-%d' % (self._socketPath, index)
+
+    def _startAcceptWorkers(self):
+        for index in range(self._acceptWorkerCount):
+            if not self._startAcceptWorker(index):
+                # We're a worker now; never return to the porter's code.
+                return
+
+    def _startAcceptWorker(self, index):
+        """
+        Fork an accept worker.
+
+        @returns: whether this is still the porter process
+        @rtype:   bool
+        """
+        from flumotion.component.misc.porter import acceptworker
+        self._acceptWorkerRestarts.pop(index, None)
+        secret = os.urandom(16).encode('hex')
+        worker = acceptworker.AcceptWorker(self, index, secret)
+        pid = os.fork()
+        if pid:
+            self.debug("Forked accept worker %d with pid %d", index, pid)
+            proc = AcceptWorkerProcess(self, index, pid, secret)
+            self._acceptWorkerProcesses[index] = proc
+            proc.watch()
+            return True
+
+        try:
+            worker.start()
+        except Exception, e:
+            self.warning("Accept worker %d failed to start: %s",
+                         index, log.getExceptionMessage(e))
+            os._exit(1)
+        return False
+
+    def acceptWorkerEnded(self, proc, status):
+        """
+        Called when an accept worker process was reaped. Unless I am
+        stopping, it is started again.
+        """
+        if self._acceptWorkerProcesses.get(proc.index) is not proc:
+            return
+        del self._acceptWorkerProcesses[proc.index]
+        if self._acceptWorkersStopped is not None:
+            self.debug("Accept worker %d stopped", proc.index)
+            if not self._acceptWorkerProcesses:
+                d, self._acceptWorkersStopped = \
+                    self._acceptWorkersStopped, None
+                d.callback(None)
+            return
+        self.warning("Accept worker %d with pid %d exited with status "
+                     "%r, restarting it", proc.index, proc.pid, status)
+        self._acceptWorkerRestarts[proc.index] = reactor.callLater(
+            ACCEPT_WORKER_RESTART_DELAY, self._startAcceptWorker, proc.index)
+
+    def _stopAcceptWorkers(self):
+        """
+        Stop the accept workers.
+
+        @returns: a deferred fired once they were all reaped
+        """
+        for call in self._acceptWorkerRestarts.values():
+            if call.active():
+                call.cancel()
+        self._acceptWorkerRestarts.clear()
+        if not self._acceptWorkerProcesses:
+            return defer.succeed(None)
+        d = self._acceptWorkersStopped = defer.Deferred()
+        for proc in self._acceptWorkerProcesses.values():
+            proc.signal(signal.SIGTERM)
+        kill = reactor.callLater(ACCEPT_WORKER_STOP_TIMEOUT,
+                                 self._killAcceptWorkers)
+
+        def cancelKill(result):
+            if kill.active():
+                kill.cancel()
+            return result
+        d.addCallback(cancelKill)
+        return d
+
+    def _killAcceptWorkers(self):
+        for proc in self._acceptWorkerProcesses.values():
+            self.warning("Accept worker %d did not stop, killing it",
+                         proc.index)
+            proc.signal(signal.SIGKILL)
+
+    def handoffCompleted(self, latency):
+        """
+        Called when a connection was passed to a streamer.
+
+        @param latency: how many seconds the FD waited to be sent
+        @type  latency: float
+        """
+        self._handoffCount += 1
+        self._handoffLatency += latency
+        self._handoffLatencyPeak = max(self._handoffLatencyPeak, latency)
+
+    def handoffRejected(self):
+        """
+        Called when a connection could not be passed to a streamer.
+        """
+        self._handoffRejected += 1
+
+    def addHandoffStats(self, avatar, count, latency, peak, rejected):
+        """
+        Add the handoffs done by the accept worker logged in as the given
+        avatar.
+
+        @param count:    how many connections were passed to streamers
+        @type  count:    int
+        @param latency:  how many seconds their FDs waited to be sent,
+                         in total
+        @type  latency:  float
+        @param peak:     the longest time an FD waited to be sent
+        @type  peak:     float
+        @param rejected: how many connections could not be passed
+        @type  rejected: int
+        """
+        if avatar not in self._acceptWorkers:
+            self.warning("Handoff statistics from %s, which is not an "
+                         "accept worker", avatar.avatarId)
+            return
+        self._handoffCount += count
+        self._handoffLatency += latency
+        self._handoffLatencyPeak = max(self._handoffLatencyPeak, peak)
+        self._handoffRejected += rejected
+
+    def _updateHandoffStats(self):
+        avatars = set(self._mappings.values())
+        avatars.update([a for p, a in self._prefixes.iteritems()])
+        queues = {}
+        for avatar in avatars:
+            queues[avatar.avatarId] = avatar.getPendingFileDescriptorCount()
+
+        current = self.uiState.get('fd-handoff-queues')
+        for avatarId in current.keys():
+            if avatarId not in queues:
+                self.uiState.delitem('fd-handoff-queues', avatarId)
+        for avatarId, pending in queues.items():
+            if current.get(avatarId) != pending:
+                self.uiState.setitem('fd-handoff-queues', avatarId, pending)
+
+        total = self.uiState.get('fd-handoff-total')
+        count = self._handoffCount - total
+        if count:
+            latency = self._handoffLatency / count
+        else:
+            latency = 0.0
+        # like the average, the peak covers the last interval only
+        peak = self._handoffLatencyPeak
+        self._handoffLatency = 0.0
+        self._handoffLatencyPeak = 0.0
+
+        self.uiState.set('fd-handoff-pending', sum(queues.values()))
+        self.uiState.set('fd-handoff-latency', latency)
+        self.uiState.set('fd-handoff-latency-peak', peak)
+        self.uiState.set('fd-handoff-total', self._handoffCount)
+        self.uiState.set('fd-handoff-rejected', self._handoffRejected)
+
     def generateSocketPath(self):
         """
         Generate a socket pathname in an appropriate location
@@ -292,15 +654,37 @@ class Porter(component.BaseComponent, log.Loggable):
         # interface
         self._external_interface = props.get('external-interface',
             self._interface)
+        self._handoffQueueSize = props.get('handoff-queue-size',
+                                           self._handoffQueueSize)
+        self._handoffBatchSize = props.get('handoff-batch-size',
+                                           self._handoffBatchSize)
+        self._acceptWorkerCount = props.get('accept-workers', 0)
+
+    def getPorterProtocolClass(self):
+        """
+        Get the class that deals with the specific protocol we're proxying.
+        """
+        try:
+            proto = reflect.namedAny(self._porterProtocol)
+            self.debug("Created proto %r" % proto)
+        except (ImportError, AttributeError):
+            self.warning("Failed to import protocol '%s', defaulting to HTTP" %
+                self._porterProtocol)
+            proto = HTTPPorterProtocol
+        return proto
 
     def do_stop(self):
-        d = None
+        self._handoffStatsPoller.stop()
+        l = [self._stopAcceptWorkers()]
         if self._socketlistener:
             # stopListening() calls (via a callLater) connectionLost(), which
             # will unlink our socket, so we don't need to explicitly delete it.
-            d = self._socketlistener.stopListening()
+            l.append(defer.maybeDeferred(self._socketlistener.stopListening))
         self._socketlistener = None
-        return d
+        if self._clientListener:
+            l.append(defer.maybeDeferred(self._clientListener.stopListening))
+        self._clientListener = None
+        return defer.DeferredList(l)
 
     def do_setup(self):
         # Create our combined PB-server/fd-passing channel
@@ -336,25 +720,25 @@ class Porter(component.BaseComponent, log.Loggable):
             self.setMood(moods.sad)
             return defer.fail(errors.ComponentSetupHandledError())
 
-        # Create the class that deals with the specific protocol we're proxying
-        # in this porter.
-        try:
-            proto = reflect.namedAny(self._porterProtocol)
-            self.debug("Created proto %r" % proto)
-        except (ImportError, AttributeError):
-            self.warning("Failed to import protocol '%s', defaulting to HTTP" %
-                self._porterProtocol)
-            proto = HTTPPorterProtocol
+        proto = self.getPorterProtocolClass()
 
         # And of course we also want to listen for incoming requests in the
         # appropriate protocol (HTTP, RTSP, etc.)
         factory = PorterProtocolFactory(self, proto)
+        if self._acceptWorkerCount:
+            # the accept workers will listen on the same port
+            portClass = fdserver.ReusablePassableServerPort
+        else:
+            portClass = fdserver.PassableServerPort
         try:
-            reactor.listenWith(
-                fdserver.PassableServerPort, self._port, factory,
-                    interface=self._interface)
+            self._clientListener = reactor.listenWith(
+                portClass, self._port, factory, interface=self._interface)
             self.info("Now listening on interface %r on port %d",
                       self._interface, self._port)
+            self._handoffStatsPoller.start()
+            if self._acceptWorkerCount:
+                # fork from a clean stack, not in the middle of setup
+                reactor.callLater(0, self._startAcceptWorkers)
         except error.CannotListenError:
             self.warning("Failed to listen on interface %r on port %d",
                          self._interface, self._port)
@@ -409,6 +793,8 @@ class PorterProtocol(protocol.Protocol, log.Loggable):
         self._buffer = ''
         self._porter = porter
         self.requestId = None # a string that should identify the request
+        # the avatar and fd of a handoff waiting in the avatar's queue
+        self._handoff = None
 
         self._timeoutDC = reactor.callLater(self.PORTER_CLIENT_TIMEOUT,
             self._timeout)
@@ -432,6 +818,12 @@ class PorterProtocol(protocol.Protocol, log.Loggable):
         if self._timeoutDC:
             self._timeoutDC.cancel()
             self._timeoutDC = None
+        if self._handoff:
+            avatar, fileno = self._handoff
+            self._handoff = None
+            self.debug("[fd %5d] connection lost while waiting to be sent",
+                       fileno)
+            avatar.cancelFileDescriptor(fileno)
 
     def dataReceived(self, data):
         self._buffer = self._buffer + data
@@ -515,21 +907,25 @@ class PorterProtocol(protocol.Protocol, log.Loggable):
                    self.transport.fileno(), time.time(), self.requestId,
                    destinationAvatar.avatarId)
 
-        # TODO: Check out blocking characteristics of sendFileDescriptor, fix
-        # if it blocks.
-        try:
-            destinationAvatar.mind.broker.transport.sendFileDescriptor(
-                self.transport.fileno(), self._buffer)
-        except OSError, e:
-            self.warning("[fd %5d] failed to send FD: %s",
-                         self.transport.fileno(), log.getExceptionMessage(e))
-            self.writeServiceUnavailableResponse()
-            return self.transport.loseConnection()
+        # The FD is queued on the avatar's connection and sent when that is
+        # writable, so a busy streamer doesn't hold up the porter. Don't
+        # read anything else from the client in the meantime; it all has to
+        # go to the streamer.
+        fileno = self.transport.fileno()
+        self.transport.stopReading()
+        self._handoff = (destinationAvatar, fileno)
+        d = destinationAvatar.queueFileDescriptor(fileno, self._buffer)
+        d.addCallbacks(self._fileDescriptorSent, self._fileDescriptorFailed,
+                       callbackArgs=(destinationAvatar, fileno),
+                       errbackArgs=(fileno, ))
+
+    def _fileDescriptorSent(self, latency, avatar, fileno):
+        self._handoff = None
+        self._porter.handoffCompleted(latency)
 
         # PROBE: sent fd; see no destination and fdserver.py
         self.debug("[fd %5d] (ts %f) (request-id %r) sent fd to avatarId %s",
-                   self.transport.fileno(), time.time(), self.requestId,
-                   destinationAvatar.avatarId)
+                   fileno, time.time(), self.requestId, avatar.avatarId)
 
         # After this, we don't want to do anything with the FD, other than
         # close our reference to it - but not close the actual TCP connection.
@@ -538,6 +934,14 @@ class PorterProtocol(protocol.Protocol, log.Loggable):
         self.transport.keepSocketAlive = True
         self.transport.loseConnection()
 
+    def _fileDescriptorFailed(self, failure, fileno):
+        self._handoff = None
+        self._porter.handoffRejected()
+        self.warning("[fd %5d] failed to send FD: %s",
+                     fileno, log.getFailureMessage(failure))
+        self.writeServiceUnavailableResponse()
+        self.transport.loseConnection()
+
     def parseLine(self, line):
         """
         Parse the initial line of the request. Return an object that can be
@@ -71,7 +71,18 @@ class PorterMedium(medium.BaseMedium):
     A medium we use to talk to the porter.
     Mostly, we use this to say what mountpoints (or perhaps, later,
     (hostname, mountpoint) pairs?) we expect to receive requests for.
+
+    @ivar factory: the client factory using me
+    @type factory: L{PorterClientFactory}
     """
+    factory = None
+
+    def remote_connectAcceptWorker(self, path):
+        """
+        The porter has an accept worker listening at the given socket path,
+        which will pass us connections too.
+        """
+        self.factory.connectAcceptWorker(path)
 
     def registerPath(self, path):
         return self.callRemote("registerPath", path)
@@ -95,6 +106,15 @@ class PorterMedium(medium.BaseMedium):
         d.addErrback(handle_error)
         return d
 
+    def enableFDBatching(self):
+
+        def handle_error(failure):
+            self.debug('Old porter does not batch FDs: %r', failure)
+
+        d = self.callRemote("enableFDBatching")
+        d.addErrback(handle_error)
+        return d
+
 
 class PorterClientFactory(fpb.ReconnectingPBClientFactory):
     """
@@ -111,15 +131,35 @@ class PorterClientFactory(fpb.ReconnectingPBClientFactory):
         fpb.ReconnectingPBClientFactory.__init__(self)
 
         self.medium = PorterMedium()
+        self.medium.factory = self
 
         self.protocol = fdserver.FDPassingBroker
         self._childFactory = childFactory
+        # socket path -> AcceptWorkerClientFactory
+        self._acceptWorkers = {}
 
     def buildProtocol(self, addr):
         p = self.protocol(self._childFactory, FDPorterServer)
         p.factory = self
         return p
 
+    def connectAcceptWorker(self, path):
+        if path in self._acceptWorkers:
+            return
+        self.debug("Connecting to porter accept worker at %s", path)
+        factory = AcceptWorkerClientFactory(self._childFactory)
+        factory.startLogin(self._credentials, factory.medium)
+        self._acceptWorkers[path] = factory
+        reactor.connectWith(fdserver.FDConnector, path, factory, 10,
+                            checkPID=False)
+
+    def stopTrying(self):
+        fpb.ReconnectingPBClientFactory.stopTrying(self)
+        workers, self._acceptWorkers = self._acceptWorkers, {}
+        for factory in workers.values():
+            factory.stopTrying()
+            factory.disconnect()
+
     def registerPath(self, path):
         return self.medium.registerPath(path)
 
@@ -139,6 +179,19 @@ class PorterClientFactory(fpb.ReconnectingPBClientFactory):
         return self.medium.deregisterPrefix("/")
 
 
+class AcceptWorkerClientFactory(PorterClientFactory):
+    """
+    A client factory logging into one of a porter's accept workers; the
+    paths are registered with the porter itself.
+    """
+    # the worker goes away for good if the porter is stopped
+    maxRetries = 10
+
+    def gotDeferredLogin(self, deferred):
+        deferred.addCallback(self.medium.setRemoteReference)
+        deferred.addCallback(lambda r: self.medium.enableFDBatching())
+
+
 class HTTPPorterClientFactory(PorterClientFactory):
 
     def __init__(self, childFactory, mountPoints, do_start_deferred,
@@ -171,6 +224,8 @@ class HTTPPorterClientFactory(PorterClientFactory):
         deferred.addCallback(self.medium.setRemoteReference)
         deferred.addCallback(lambda r: self.medium.getPort())
         deferred.addCallback(self._setRemotePort)
+        # our FDClient transport understands several FDs per message
+        deferred.addCallback(lambda r: self.medium.enableFDBatching())
         for mount in self._mountPoints:
             self.debug("Registering mount point %s with porter", mount)
             deferred.addCallback(lambda r, m: self.registerPath(m), mount)
@@ -15,13 +15,45 @@
 #
 # Headers in this file shall remain intact.
 
+import Queue
+import calendar
+import os
+import socket
+import struct
+import threading
 import time
 
-from flumotion.common import errors
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        json = None
+
+from twisted.internet import reactor
+
+from flumotion.common import errors, log
 from flumotion.component.plugs import base
 
 __version__ = "$Rev$"
 
+# Defaults of the buffered logging mode:
+# how many lines can wait to be written before new ones are dropped
+DEFAULT_BUFFER_SIZE = 10000
+# the lines are written when this many bytes are waiting
+DEFAULT_FLUSH_SIZE = 64 * 1024
+# or at least this often (in seconds)
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+# Defaults of the aggregate logger: the length of the intervals (in
+# seconds), how many mount points and client IP prefixes are kept per
+# interval and the length of the prefixes (in bits)
+DEFAULT_AGGREGATE_INTERVAL = 1
+DEFAULT_TOP_COUNT = 10
+DEFAULT_IP_PREFIX_LENGTH = 24
+AGGREGATE_FORMATS = ('json', 'binary')
+
 
 class RequestLoggerPlug(base.ComponentPlug):
     """
@@ -48,11 +80,22 @@ class RequestLoggerPlug(base.ComponentPlug):
         pass
 
 
+# (time, formatted date) of the last formatted date; most of the
+# requests of a busy server complete within the same second
+_lastDate = [None, None]
+
+
+def _formatDate(t):
+    if t != _lastDate[0]:
+        _lastDate[:] = [t, time.strftime('%d/%b/%Y:%H:%M:%S +0000', t)]
+    return _lastDate[1]
+
+
 def _http_session_completed_to_apache_log(args):
     # ident is something that should in theory come from identd but in
     # practice is never there
     ident = '-'
-    date = time.strftime('%d/%b/%Y:%H:%M:%S +0000', args['time'])
+    date = _formatDate(args['time'])
 
     return ("%s %s %s [%s] \"%s %s %s\" %d %d %s \"%s\" %d\n"
             % (args['ip'], ident, args['username'], date,
@@ -61,28 +104,600 @@ def _http_session_completed_to_apache_log(args):
                args['user-agent'], args['time-connected']))
 
 
+class _BufferedLogWriter(threading.Thread, log.Loggable):
+    """
+    I write the lines of a log file from a thread, in batches.
+
+    The lines are collected in the reactor thread and handed to the
+    writer thread one batch at a time, when the batch is big enough or
+    when the flush interval expires. When the lines waiting to be written
+    reach the size of the buffer, new lines are dropped and counted.
+    When the file is rotated, the lines logged before are still written
+    to the previous file.
+
+    @ivar written: the number of lines written
+    @type written: int
+    @ivar dropped: the number of lines dropped because the buffer was full
+    @type dropped: int
+    @ivar failed:  the number of lines that could not be written
+    @type failed:  int
+    """
+
+    logCategory = "request-logger"
+
+    def __init__(self, file, filename, bufferSize=DEFAULT_BUFFER_SIZE,
+                 flushSize=DEFAULT_FLUSH_SIZE,
+                 flushInterval=DEFAULT_FLUSH_INTERVAL):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self._file = file
+        self._filename = filename
+        self._bufferSize = bufferSize
+        self._flushSize = flushSize
+        self._flushInterval = flushInterval
+        self._batch = [] # lines not handed to the writer thread yet
+        self._batchBytes = 0
+        self._queue = Queue.Queue() # (operation, lines)
+        self._lock = threading.Lock() # protects _queued
+        self._queued = 0 # lines handed to the writer thread, not written
+        self._reportedDrops = 0
+        self._flushCall = None
+
+    def start(self):
+        threading.Thread.start(self)
+        self._flushCall = reactor.callLater(self._flushInterval,
+                                            self._flushPeriodically)
+
+    def write(self, line):
+        # Lines are only handed to the writer thread in batches,
+        # so that the lock is not taken for every line
+        if self._queued + len(self._batch) >= self._bufferSize:
+            self.dropped += 1
+            return
+        self._batch.append(line)
+        self._batchBytes += len(line)
+        if self._batchBytes >= self._flushSize:
+            self.flush()
+
+    def flush(self):
+        """
+        Hand the lines logged so far to the writer thread.
+        """
+        if not self._batch:
+            return
+        batch = self._batch
+        self._batch = []
+        self._batchBytes = 0
+        self._lock.acquire()
+        try:
+            self._queued += len(batch)
+        finally:
+            self._lock.release()
+        self._queue.put(('write', batch))
+
+    def rotate(self):
+        self.flush()
+        self._queue.put(('rotate', None))
+
+    def stop(self):
+        """
+        Write the waiting lines, close the file and wait for the thread
+        to finish.
+        """
+        if self._flushCall is not None:
+            self._flushCall.cancel()
+            self._flushCall = None
+        self.flush()
+        self._queue.put(('stop', None))
+        self.join()
+        self._reportDrops()
+
+    def run(self):
+        while True:
+            operation, lines = self._queue.get()
+            if operation == 'write':
+                self._write(lines)
+            elif operation == 'rotate':
+                self._reopen()
+            else:
+                break
+        self._close()
+
+
+    ## Private Methods ##
+
+    def _flushPeriodically(self):
+        self.flush()
+        self._reportDrops()
+        self._flushCall = reactor.callLater(self._flushInterval,
+                                            self._flushPeriodically)
+
+    def _reportDrops(self):
+        dropped = self.dropped
+        if dropped != self._reportedDrops:
+            self.warning("%d lines dropped from log file %s, it can't be "
+                         "written fast enough", dropped - self._reportedDrops,
+                         self._filename)
+            self._reportedDrops = dropped
+
+    def _write(self, lines):
+        # Called in the writer thread
+        try:
+            if self._file is None:
+                self.failed += len(lines)
+                return
+            try:
+                self._file.write(''.join(lines))
+                self._file.flush()
+                self.written += len(lines)
+            except IOError, e:
+                self.failed += len(lines)
+                self.warning("Could not write to log file %s: %s",
+                             self._filename, log.getExceptionMessage(e))
+        finally:
+            self._lock.acquire()
+            try:
+                self._queued -= len(lines)
+            finally:
+                self._lock.release()
+
+    def _reopen(self):
+        self._close()
+        try:
+            self._file = open(self._filename, 'a')
+        except IOError, e:
+            self.warning("Could not reopen log file %s: %s",
+                         self._filename, log.getExceptionMessage(e))
+
+    def _close(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            except IOError, e:
+                self.warning("Could not close log file %s: %s",
+                             self._filename, log.getExceptionMessage(e))
+            self._file = None
+
+
 class RequestLoggerFilePlug(RequestLoggerPlug):
+    """
+    I log the requests to a file in the Apache combined log format.
+
+    In buffered mode, the lines are written in batches from a thread,
+    so that writing the log file doesn't stall the reactor.
+    """
     filename = None
     file = None
+    writer = None
 
     def start(self, component=None):
-        self.filename = self.args['properties']['logfile']
+        props = self.args['properties']
+        self.filename = props['logfile']
         try:
             self.file = open(self.filename, 'a')
         except IOError, data:
             raise errors.PropertyError('could not open log file %s '
                                          'for writing (%s)'
                                          % (self.filename, data[1]))
+        if props.get('buffered', False):
+            self.writer = _BufferedLogWriter(self.file, self.filename,
+                props.get('buffer-size', DEFAULT_BUFFER_SIZE),
+                props.get('flush-size', DEFAULT_FLUSH_SIZE),
+                props.get('flush-interval', DEFAULT_FLUSH_INTERVAL))
+            # the file now belongs to the writer thread
+            self.file = None
+            self.writer.start()
 
     def stop(self, component=None):
+        if self.writer:
+            self.writer.stop()
+            self.writer = None
         if self.file:
             self.file.close()
             self.file = None
 
     def event_http_session_completed(self, args):
-        self.file.write(_http_session_completed_to_apache_log(args))
+        line = _http_session_completed_to_apache_log(args)
+        if self.writer:
+            self.writer.write(line)
+            return
+        self.file.write(line)
         self.file.flush()
 
     def rotate(self):
+        if self.writer:
+            self.writer.rotate()
+            return
         self.stop()
         self.start()
+
+
+# (time, UNIX time) of the last converted time, like _lastDate
+_lastTimestamp = [None, None]
+
+
+def _timestamp(t):
+    if t != _lastTimestamp[0]:
+        _lastTimestamp[:] = [t, calendar.timegm(t)]
+    return _lastTimestamp[1]
+
+
+def _mountPoint(uri):
+    # the first component of the path of the request, '/live' for
+    # '/live/stream-1.ts?token=x'
+    path = uri.split('?', 1)[0]
+    end = path.find('/', 1)
+    if end == -1:
+        return path
+    return path[:end]
+
+
+def _decode(s):
+    # the request strings are whatever bytes the client sent
+    if isinstance(s, str):
+        return s.decode('utf-8', 'replace')
+    return s
+
+
+def _ipPrefix(ip, length):
+    if ip.startswith('::ffff:') and '.' in ip:
+        ip = ip[7:]
+    elif ':' in ip:
+        # IPv6, the /64 network is kept whatever the length
+        try:
+            address = socket.inet_pton(socket.AF_INET6, ip)
+        except (socket.error, ValueError):
+            return ip
+        return socket.inet_ntop(socket.AF_INET6,
+                                address[:8] + '\0' * 8) + '/64'
+    try:
+        address, = struct.unpack('!I', socket.inet_aton(ip))
+    except (socket.error, struct.error):
+        return ip
+    mask = (0xffffffffL << (32 - length)) & 0xffffffffL
+    return '%s/%d' % (socket.inet_ntoa(struct.pack('!I', address & mask)),
+                      length)
+
+
+def _top(counts, count):
+    # the most frequent keys first, ties in key order
+    items = [(-n, key) for key, n in counts.iteritems()]
+    items.sort()
+    return [[key, -n] for n, key in items[:count]]
+
+
+class _RequestAggregate(object):
+    """
+    I hold the statistics of the requests completed during an interval.
+
+    @ivar start:     UNIX time of the beginning of the interval
+    @type start:     int
+    @ivar responses: number of requests per response code
+    @type responses: dict of int -> int
+    @ivar mounts:    number of requests per mount point
+    @type mounts:    dict of str -> int
+    @ivar clients:   number of requests per client IP
+    @type clients:   dict of str -> int
+    @ivar samples:   records of the sampled requests
+    @type samples:   list of dict
+    """
+
+    def __init__(self, start, interval):
+        self.start = start
+        self.interval = interval
+        self.requests = 0
+        self.bytes = 0
+        self.responses = {}
+        self.mounts = {}
+        self.clients = {}
+        self.samples = []
+
+    def add(self, response, bytes, mount, ip):
+        self.requests += 1
+        self.bytes += bytes
+        self.responses[response] = self.responses.get(response, 0) + 1
+        self.mounts[mount] = self.mounts.get(mount, 0) + 1
+        self.clients[ip] = self.clients.get(ip, 0) + 1
+
+    def getRecord(self, topCount, prefixLength):
+        """
+        @returns: the record of the interval, keeping only the topCount
+                  most requested mount points and client IP prefixes
+        @rtype:   dict
+        """
+        responses = {}
+        for code, n in self.responses.iteritems():
+            responses[str(code)] = n
+        # the prefixes are only computed once per client and interval
+        prefixes = {}
+        for ip, n in self.clients.iteritems():
+            prefix = _ipPrefix(ip, prefixLength)
+            prefixes[prefix] = prefixes.get(prefix, 0) + n
+        return {'type': 'aggregate',
+                'time': self.start,
+                'interval': self.interval,
+                'requests': self.requests,
+                'bytes': self.bytes,
+                'responses': responses,
+                'mounts': _top(self.mounts, topCount),
+                'prefixes': _top(prefixes, topCount)}
+
+
+# Binary aggregate log format: a header, then one record per interval or
+# sampled request, made of a type byte, the size of the payload and the
+# payload. The columns of the aggregate records (response codes, mount
+# points, prefixes) are stored as a count, the keys and then the values.
+# Strings are stored as their size and UTF-8 bytes, None as size 0xffff.
+# All numbers are little endian.
+BINARY_LOG_HEADER = 'FLUREQ1\n'
+RECORD_AGGREGATE = 1
+RECORD_REQUEST = 2
+
+_RECORD_HEADER = '<BI'
+_AGGREGATE = '<qIIQ' # time, interval, requests, bytes
+_REQUEST = '<qHQI' # time, response, bytes, time-connected
+_NONE_SIZE = 0xffff
+_REQUEST_STRINGS = ('ip', 'method', 'uri', 'referer', 'user-agent')
+
+
+def _unpack(format, data, offset):
+    end = offset + struct.calcsize(format)
+    return struct.unpack(format, data[offset:end]), end
+
+
+def _packString(s):
+    if s is None:
+        return struct.pack('<H', _NONE_SIZE)
+    if isinstance(s, unicode):
+        s = s.encode('utf-8')
+    s = s[:_NONE_SIZE - 1]
+    return struct.pack('<H', len(s)) + s
+
+
+def _unpackString(data, offset):
+    (size, ), offset = _unpack('<H', data, offset)
+    if size == _NONE_SIZE:
+        return None, offset
+    return data[offset:offset + size], offset + size
+
+
+def _packColumns(pairs, keyFormat):
+    # pairs of [key, count]
+    n = len(pairs)
+    keys = [key for key, count in pairs]
+    if keyFormat is None:
+        packed = ''.join([_packString(key) for key in keys])
+    else:
+        packed = struct.pack('<%d%s' % (n, keyFormat), *keys)
+    return (struct.pack('<H', n) + packed +
+            struct.pack('<%dI' % n, *[count for key, count in pairs]))
+
+
+def _unpackColumns(data, offset, keyFormat):
+    (n, ), offset = _unpack('<H', data, offset)
+    if keyFormat is None:
+        keys = []
+        for i in range(n):
+            key, offset = _unpackString(data, offset)
+            keys.append(key)
+    else:
+        keys, offset = _unpack('<%d%s' % (n, keyFormat), data, offset)
+    counts, offset = _unpack('<%dI' % n, data, offset)
+    return [[key, count] for key, count in zip(keys, counts)], offset
+
+
+def _packRecord(record):
+    if record['type'] == 'aggregate':
+        responses = [[int(code), n]
+                     for code, n in record['responses'].iteritems()]
+        responses.sort()
+        payload = (struct.pack(_AGGREGATE, record['time'], record['interval'],
+                               record['requests'], record['bytes']) +
+                   _packColumns(responses, 'H') +
+                   _packColumns(record['mounts'], None) +
+                   _packColumns(record['prefixes'], None))
+        recordType = RECORD_AGGREGATE
+    else:
+        payload = struct.pack(_REQUEST, record['time'], record['response'],
+                              record['bytes'], int(record['time-connected']))
+        payload += ''.join([_packString(record[key])
+                            for key in _REQUEST_STRINGS])
+        recordType = RECORD_REQUEST
+    return struct.pack(_RECORD_HEADER, recordType, len(payload)) + payload
+
+
+def _unpackRecord(recordType, data):
+    if recordType == RECORD_AGGREGATE:
+        (start, interval, requests, bytes), offset = _unpack(
+            _AGGREGATE, data, 0)
+        responses, offset = _unpackColumns(data, offset, 'H')
+        mounts, offset = _unpackColumns(data, offset, None)
+        prefixes, offset = _unpackColumns(data, offset, None)
+        return {'type': 'aggregate', 'time': start, 'interval': interval,
+                'requests': requests, 'bytes': bytes,
+                'responses': dict([(str(code), n)
+                                   for code, n in responses]),
+                'mounts': mounts, 'prefixes': prefixes}
+    (t, response, bytes, connected), offset = _unpack(_REQUEST, data, 0)
+    record = {'type': 'request', 'time': t, 'response': response,
+              'bytes': bytes, 'time-connected': connected}
+    for key in _REQUEST_STRINGS:
+        record[key], offset = _unpackString(data, offset)
+    return record
+
+
+def readBinaryLog(data):
+    """
+    Decode the contents of a binary aggregate log file.
+
+    @param data: the contents of the file
+    @type  data: str
+
+    @returns: the records of the file, like the lines of a JSON log
+    @rtype:   list of dict
+    """
+    if not data.startswith(BINARY_LOG_HEADER):
+        raise ValueError("not a binary request log")
+    records = []
+    offset = len(BINARY_LOG_HEADER)
+    headerSize = struct.calcsize(_RECORD_HEADER)
+    while offset + headerSize <= len(data):
+        (recordType, size), offset = _unpack(_RECORD_HEADER, data, offset)
+        if offset + size > len(data):
+            break # truncated record
+        if recordType in (RECORD_AGGREGATE, RECORD_REQUEST):
+            records.append(_unpackRecord(recordType,
+                                         data[offset:offset + size]))
+        offset += size
+    return records
+
+
+class RequestLoggerAggregatePlug(RequestLoggerPlug):
+    """
+    I aggregate the requests into fixed time intervals and log one record
+    per interval, with the number of requests, the bytes sent, the number
+    of requests per response code and the most requested mount points and
+    client IP prefixes.
+
+    The records are written either as JSON, one per line, or in a compact
+    binary format that can be read with L{readBinaryLog}. A fraction of
+    the requests can also be logged one by one, as sample records.
+
+    The intervals are those of the time the requests completed. The
+    records are written once their interval is over; a request logged
+    late for an interval already written gets a record of its own for the
+    same interval.
+    """
+    filename = None
+    file = None
+    _writeCall = None
+
+    def start(self, component=None):
+        props = self.args['properties']
+        self.filename = props['logfile']
+        self._interval = props.get('interval', DEFAULT_AGGREGATE_INTERVAL)
+        self._topCount = props.get('top-count', DEFAULT_TOP_COUNT)
+        self._prefixLength = props.get('ip-prefix-length',
+                                       DEFAULT_IP_PREFIX_LENGTH)
+        sampleRate = props.get('sample-rate', 0.0)
+        self._format = props.get('format', 'json')
+        if self._interval < 1:
+            raise errors.PropertyError('interval must be at least 1 second')
+        if not 0 <= self._prefixLength <= 32:
+            raise errors.PropertyError('ip-prefix-length must be between '
+                                       '0 and 32')
+        if not 0.0 <= sampleRate <= 1.0:
+            raise errors.PropertyError('sample-rate must be between 0 and 1')
+        if self._format not in AGGREGATE_FORMATS:
+            raise errors.PropertyError('unknown log format %s, should be '
+                                       'one of %s' % (self._format,
+                                       ', '.join(AGGREGATE_FORMATS)))
+        if self._format == 'json' and json is None:
+            raise errors.PropertyError('the json log format needs the json '
+                                       'or simplejson module')
+        # every n-th request is sampled, which is cheaper than
+        # drawing random numbers and spreads the samples evenly
+        self._sampleEvery = 0
+        if sampleRate:
+            self._sampleEvery = max(int(round(1 / sampleRate)), 1)
+        self._sampleCount = 0
+        self._buckets = {} # interval start -> _RequestAggregate
+        self._open()
+        self._writeCall = reactor.callLater(self._interval,
+                                            self._writePeriodically)
+
+    def stop(self, component=None):
+        if self._writeCall is not None:
+            self._writeCall.cancel()
+            self._writeCall = None
+        self._writeBuckets(None)
+        self._close()
+
+    def event_http_session_completed(self, args):
+        t = _timestamp(args['time'])
+        start = t - t % self._interval
+        bucket = self._buckets.get(start, None)
+        if bucket is None:
+            bucket = _RequestAggregate(start, self._interval)
+            self._buckets[start] = bucket
+        uri = _decode(args['uri'])
+        bucket.add(args['response'], args['bytes-sent'],
+                   _mountPoint(uri), args['ip'])
+        if self._sampleEvery:
+            self._sampleCount += 1
+            if self._sampleCount >= self._sampleEvery:
+                self._sampleCount = 0
+                bucket.samples.append({
+                    'type': 'request', 'time': t, 'ip': args['ip'],
+                    'method': _decode(args['method']), 'uri': uri,
+                    'response': args['response'],
+                    'bytes': args['bytes-sent'],
+                    'time-connected': args['time-connected'],
+                    'referer': _decode(args['referer']),
+                    'user-agent': _decode(args['user-agent'])})
+
+    def rotate(self):
+        self._close()
+        self._open()
+
+
+    ## Private Methods ##
+
+    def _open(self):
+        try:
+            self.file = open(self.filename, 'ab')
+        except IOError, data:
+            raise errors.PropertyError('could not open log file %s '
+                                         'for writing (%s)'
+                                         % (self.filename, data[1]))
+        if self._format == 'binary' and not os.stat(self.filename).st_size:
+            self.file.write(BINARY_LOG_HEADER)
+            self.file.flush()
+
+    def _close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def _writePeriodically(self):
+        try:
+            self._writeBuckets(time.time())
+        finally:
+            self._writeCall = reactor.callLater(self._interval,
+                                                self._writePeriodically)
+
+    def _writeBuckets(self, now):
+        # write the buckets of the intervals over at the given time,
+        # all of them if it's None
+        starts = [start for start in self._buckets
+                  if now is None or start + self._interval <= now]
+        if not starts or not self.file:
+            return
+        starts.sort()
+        records = []
+        for start in starts:
+            bucket = self._buckets.pop(start)
+            records.append(bucket.getRecord(self._topCount,
+                                            self._prefixLength))
+            records.extend(bucket.samples)
+        lines = []
+        for record in records:
+            try:
+                if self._format == 'json':
+                    lines.append(json.dumps(record, sort_keys=True,
+                                            separators=(',', ':')) + '\n')
+                else:
+                    lines.append(_packRecord(record))
+            except (UnicodeError, ValueError, TypeError, struct.error), e:
+                self.warning("Could not encode log record %r: %s",
+                             record, log.getExceptionMessage(e))
+        data = ''.join(lines)
+        try:
+            self.file.write(data)
+            self.file.flush()
+        except IOError, e:
+            self.warning("Could not write to log file %s: %s",
+                         self.filename, log.getExceptionMessage(e))
@@ -34,6 +34,7 @@
 
 #include <Python.h>
 
+#include <string.h>
 #include <sys/types.h>
 #include <sys/socket.h>
 
@@ -47,7 +48,7 @@ readfds(PyObject *self, PyObject *args)
   struct msghdr msg;
   struct iovec iov[1];
   struct cmsghdr *msgptr;
-  int n;
+  int n, i, numfds;
 
   if (!PyArg_ParseTuple (args, "ii", &sockfd, &size))
     return NULL;
@@ -85,7 +86,7 @@ readfds(PyObject *self, PyObject *args)
 
   msgptr = CMSG_FIRSTHDR (&msg);
   while (msgptr != NULL) {
-    if (msgptr->cmsg_len != CMSG_LEN (sizeof (int)) ||
+    if (msgptr->cmsg_len < CMSG_LEN (sizeof (int)) ||
         msgptr->cmsg_level != SOL_SOCKET ||
         msgptr->cmsg_type != SCM_RIGHTS)
     {
@@ -94,11 +95,15 @@ readfds(PyObject *self, PyObject *args)
       goto done;
     }
 
-    fd = *((int *) CMSG_DATA (msgptr));
+    /* A single control message can carry several fds */
+    numfds = (msgptr->cmsg_len - CMSG_LEN (0)) / sizeof (int);
+    for (i = 0; i < numfds; i++) {
+      fd = ((int *) CMSG_DATA (msgptr))[i];
 
-    fdobj = PyInt_FromLong ((long)fd);
-    PyList_Append (list, fdobj);
-    Py_DECREF (fdobj);
+      fdobj = PyInt_FromLong ((long)fd);
+      PyList_Append (list, fdobj);
+      Py_DECREF (fdobj);
+    }
 
     msgptr = CMSG_NXTHDR (&msg, msgptr);
   }
@@ -147,22 +152,29 @@ writefds(PyObject *self, PyObject *args)
     PyObject *fdobj;
     int fd, i;
 
+    if (numfds < 1 || numfds > MAX_RECEIVED_FDS) {
+      PyErr_SetString(PyExc_ValueError, "Invalid number of fds");
+      return NULL;
+    }
+
     msg.msg_controllen = CMSG_SPACE (sizeof (int) * numfds);
     msg.msg_control = malloc (msg.msg_controllen);
     if (msg.msg_control == NULL) {
       return PyErr_NoMemory();
     }
+    memset (msg.msg_control, 0, msg.msg_controllen);
 
+    /* All the fds go in a single control message */
     msgptr = CMSG_FIRSTHDR (&msg);
+    msgptr->cmsg_len = CMSG_LEN (sizeof (int) * numfds);
+    msgptr->cmsg_level = SOL_SOCKET;
+    /* The control message type for FD-passing is called SCM_RIGHTS for some
+     * reason */
+    msgptr->cmsg_type = SCM_RIGHTS;
+
     for (i = 0; i < numfds; i++)
     {
-      msgptr->cmsg_len = CMSG_LEN (sizeof(int));
-      msgptr->cmsg_level = SOL_SOCKET;
-      /* The control message type for FD-passing is called SCM_RIGHTS for some
-       * reason */
-      msgptr->cmsg_type = SCM_RIGHTS;
-
-      /* And the actual data: a single int, our passed fd. Convert from python
+      /* And the actual data: an int per passed fd. Convert from python
        * first, checking that it's valid.
        */
       fdobj = PyList_GetItem (list, i);
@@ -174,9 +186,7 @@ writefds(PyObject *self, PyObject *args)
       }
       fd = (int) PyInt_AsLong (fdobj);
 
-      *((int *) CMSG_DATA (msgptr)) = fd;
-
-      msgptr = CMSG_NXTHDR (&msg, msgptr);
+      ((int *) CMSG_DATA (msgptr))[i] = fd;
     }
 
     /* These are used for sending control messages on unconnected sockets; we
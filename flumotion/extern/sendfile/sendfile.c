@@ -0,0 +1,76 @@
+/*
+ * Flumotion - a streaming media server
+ * Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+ * Copyright (C) 2010,2011 Flumotion Services, S.A.
+ * All rights reserved.
+ *
+ * This file may be distributed and/or modified under the terms of
+ * the GNU Lesser General Public License version 2.1 as published by
+ * the Free Software Foundation.
+ * This file is distributed without any warranty; without even the implied
+ * warranty of merchantability or fitness for a particular purpose.
+ * See "LICENSE.LGPL" in the source distribution for more information.
+ *
+ * Headers in this file shall remain intact.
+ */
+
+/* sendfile.c:
+ *
+ * Simple python extension module to wrap sendfile(), which copies data from
+ * a file to a socket inside the kernel, without going through user space.
+ *
+ * Send up to 'count' bytes of the file open on fd 'in', starting at byte
+ * 'offset', to the socket 'out'. The file position of 'in' is left alone.
+ * Returns the number of bytes sent, which is less than 'count' if the
+ * socket is non-blocking and its buffer filled up.
+ * sent = sendfile.sendfile(out, in, offset, count)
+ */
+
+#include <Python.h>
+
+#include <sys/types.h>
+#include <sys/sendfile.h>
+
+static PyObject *
+pysendfile(PyObject *self, PyObject *args)
+{
+  int outfd, infd;
+  PY_LONG_LONG offset;
+  Py_ssize_t count;
+  off_t off;
+  ssize_t ret;
+
+  if (!PyArg_ParseTuple (args, "iiLn", &outfd, &infd, &offset, &count))
+    return NULL;
+
+  if (offset < 0 || count < 0) {
+    PyErr_SetString(PyExc_ValueError, "Negative offset or count");
+    return NULL;
+  }
+
+  off = (off_t) offset;
+
+  Py_BEGIN_ALLOW_THREADS
+  ret = sendfile (outfd, infd, &off, (size_t) count);
+  Py_END_ALLOW_THREADS
+
+  if (ret < 0) {
+    /* Failure. Throw an appropriate Python exception */
+    return PyErr_SetFromErrno(PyExc_OSError);
+  }
+
+  return PyInt_FromSsize_t(ret);
+}
+
+static PyMethodDef methods[] =
+{
+    {"sendfile", pysendfile, METH_VARARGS,
+        "Send part of a file over a socket without copying it"},
+    {NULL, NULL, 0, NULL},
+};
+
+PyMODINIT_FUNC
+initsendfile(void)
+{
+  Py_InitModule ("sendfile", methods);
+}
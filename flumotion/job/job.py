@@ -123,6 +123,16 @@ class JobMedium(medium.BaseMedium):
     def remote_getPid(self):
         return os.getpid()
 
+    def remote_preload(self):
+        """
+        I am called on by the worker's JobAvatar when this job is started
+        in advance, to import the libraries needed by the components, so
+        that creating one later does not have to wait for them.
+        """
+        self.debug('preloading component libraries')
+        from flumotion.component import feedcomponent
+        feedcomponent # pyflakes
+
     def remote_runFunction(self, moduleName, methodName, *args, **kwargs):
         """
         I am called on by the worker's JobAvatar to run a function,
@@ -149,7 +149,8 @@ class ManagerAvatar(fpb.PingableAvatar, log.Loggable):
         @type  moduleName: str or list of str
         @param moduleName: the name of the module requested for import
 
-        @rtype: list of (str, str) tuples of (bundleName, md5sum)
+        @rtype: L{twisted.internet.defer.Deferred} firing a list of
+                (str, str) tuples of (bundleName, md5sum)
         """
         bundleNames = []
         fileNames = []
@@ -200,16 +201,21 @@ class ManagerAvatar(fpb.PingableAvatar, log.Loggable):
             self.debug('dependencies of %s: %r' % (bundleName, thisdeps[1:]))
             deps.extend(thisdeps)
 
-        sums = []
+        found = []
         for dep in deps:
             bundler = basket.getBundlerByName(dep)
             if not bundler:
                 self.warning('Did not find bundle with name %s' % dep)
             else:
-                sums.append((dep, bundler.bundle().md5sum))
-
-        self.debug('requested bundles: %r' % [x[0] for x in sums])
-        return sums
+                found.append(dep)
+
+        def gotBundles(bundles):
+            sums = [(dep, bundles[dep].md5sum) for dep in found]
+            self.debug('requested bundles: %r' % [x[0] for x in sums])
+            return sums
+        d = basket.getBundles(found)
+        d.addCallback(gotBundles)
+        return d
 
     def perspective_getBundleSumsByFile(self, filename):
         """
@@ -220,7 +226,8 @@ class ManagerAvatar(fpb.PingableAvatar, log.Loggable):
         @type  filename: str
 
         @returns: list of (bundleName, md5sum) tuples
-        @rtype:   list of (str, str) tuples
+        @rtype:   L{twisted.internet.defer.Deferred} firing a list of
+                  (str, str) tuples
         """
         self.debug('asked to get bundle sums for file %s' % filename)
         basket = self.vishnu.getBundlerBasket()
@@ -239,17 +246,24 @@ class ManagerAvatar(fpb.PingableAvatar, log.Loggable):
         @type  bundles: list of str
 
         @returns: dictionary of bundleName -> zipdata
-        @rtype:   dict of str -> str
+        @rtype:   L{twisted.internet.defer.Deferred} firing a dict of
+                  str -> str
         """
         basket = self.vishnu.getBundlerBasket()
-        zips = {}
         for name in bundles:
             bundler = basket.getBundlerByName(name)
             if not bundler:
                 raise errors.NoBundleError(
                     'The bundle named "%s" was not found' % (name, ))
-            zips[name] = bundler.bundle().getZip()
-        return zips
+
+        def gotBundles(bundles):
+            zips = {}
+            for name, bundle in bundles.items():
+                zips[name] = bundle.getZip()
+            return zips
+        d = basket.getBundles(bundles)
+        d.addCallback(gotBundles)
+        return d
 
     def perspective_authenticate(self, bouncerName, keycard):
         """
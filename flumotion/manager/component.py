@@ -563,74 +563,128 @@ class dictlist(dict):
 
 
 class FeedMap(object, log.Loggable):
+    """
+    I map the feeds provided by the attached components to the eaters
+    of the attached components.
+
+    I am updated as components attach and detach, touching only the
+    feeds they provide and eat from.
+
+    @ivar feeds:            full feed id -> list of (feederAvatar,
+                            feedName) providing it, in attaching order;
+                            eaters eat from the first one
+    @ivar feedersForEaters: eater full feed id -> (eaterAlias,
+                            feederAvatar, feedName)
+    @ivar eatersForFeeders: feeder full feed id -> list of (feedName,
+                            eaterAvatar, eaterAlias)
+    @ivar feedDeps:         feederAvatar -> list of (eaterAvatar, full
+                            feed id) of the eaters it feeds
+    """
     logName = 'feed-map'
 
     def __init__(self):
-        #FIXME: Use twisted.python.util.OrderedDict instead
         self.avatars = {}
-        self._ordered_avatars = []
-        self._dirty = True
-        self._recalc()
+        self.feeds = dictlist()
+        self.feedersForEaters = {}
+        self.eatersForFeeders = dictlist()
+        self.feedDeps = dictlist()
+        # full feed id -> list of (eaterAvatar, eaterAlias, feedId) of
+        # all the eaters of a feed, provided or not
+        self._eaters = dictlist()
+        # avatarId -> (feeds, eaters) the avatar was attached with
+        self._attached = {}
+        # (avatarId, feeder name or eater alias) -> full feed id, recorded
+        # on attach as the avatar cannot tell them any more once detached
+        self._fullFeedIds = {}
 
     def componentAttached(self, avatar):
         assert avatar.avatarId not in self.avatars
         self.avatars[avatar.avatarId] = avatar
-        self._ordered_avatars.append(avatar)
-        self._dirty = True
+
+        for name in avatar.getFeeders():
+            self._fullFeedIds[(avatar.avatarId, name)] = \
+                avatar.getFullFeedId(name)
+        feeds = [(avatar.getFullFeedId(feederName), (avatar, feederName))
+                 for feederName in avatar.getFeeders()]
+        feeds.extend(avatar.getVirtualFeeds().items())
+        flowName = avatar.getParentName()
+        eaters = []
+        for pairs in avatar.getEaters().values():
+            for feedId, eName in pairs:
+                compName, feedName = common.parseFeedId(feedId)
+                ffid = common.fullFeedId(flowName, compName, feedName)
+                eaters.append((ffid, (avatar, eName, feedId)))
+                self._fullFeedIds[(avatar.avatarId, eName)] = \
+                    avatar.getFullFeedId(eName)
+        self._attached[avatar.avatarId] = (feeds, eaters)
+
+        for ffid, pair in feeds:
+            self.feeds.add(ffid, pair)
+            if len(self.feeds[ffid]) == 1:
+                # the eaters that were waiting for this feed
+                for eater in self._eaters.get(ffid, []):
+                    self._connect(ffid, eater)
+        for ffid, eater in eaters:
+            self._eaters.add(ffid, eater)
+            if ffid in self.feeds:
+                self._connect(ffid, eater)
+            else:
+                self.debug('eater %s waiting for feed %s to log in',
+                           avatar.getFeedId(eater[1]), eater[2])
 
     def componentDetached(self, avatar):
         # returns the a list of other components that will need to be
         # reconnected
         del self.avatars[avatar.avatarId]
-        self._ordered_avatars.remove(avatar)
-        self._dirty = True
-        # NB, feedDeps is dirty. Scrub it of avatars that have logged
-        # out
-        return [(a, f) for a, f in self.feedDeps.pop(avatar, [])
-                if a.avatarId in self.avatars]
-
-    def _getFeederAvatar(self, eater, feedId):
-        # FIXME: 'get' part is confusing - this methods _modifies_ structures!
-        flowName = eater.getParentName()
-        compName, feedName = common.parseFeedId(feedId)
-        ffid = common.fullFeedId(flowName, compName, feedName)
-        feeder = None
-        if ffid in self.feeds:
-            feeder, feedName = self.feeds[ffid][0]
-            self.feedDeps.add(feeder, (eater, ffid))
-            if feeder.getFeedId(feedName) != feedId:
-                self.debug('chose %s for feed %s',
-                           feeder.getFeedId(feedName), feedId)
-        return feeder, feedName
-
-    def _recalc(self):
-        if not self._dirty:
-            return
-        self.feedersForEaters = ffe = {}
-        self.eatersForFeeders = eff = dictlist()
-        self.feeds = dictlist()
-        self.feedDeps = dictlist()
+        feeds, eaters = self._attached.pop(avatar.avatarId)
 
-        for comp in self._ordered_avatars:
-            for feederName in comp.getFeeders():
-                self.feeds.add(comp.getFullFeedId(feederName),
-                               (comp, feederName))
-            for ffid, pair in comp.getVirtualFeeds().items():
-                self.feeds.add(ffid, pair)
-
-        for eater in self.avatars.values():
-            for pairs in eater.getEaters().values():
-                for feedId, eName in pairs:
-                    feeder, fName = self._getFeederAvatar(eater, feedId)
-                    if feeder:
-                        ffe[eater.getFullFeedId(eName)] = (
-                            eName, feeder, fName)
-                        eff.add(feeder.getFullFeedId(fName),
-                                (fName, eater, eName))
-                    else:
-                        self.debug('eater %s waiting for feed %s to log in',
-                                   eater.getFeedId(eName), feedId)
-        self._dirty = False
+        for ffid, eater in eaters:
+            self._eaters.remove(ffid, eater)
+            if ffid in self.feeds:
+                self._disconnect(ffid, eater, self.feeds[ffid][0])
+
+        provided = []
+        for ffid, pair in feeds:
+            if self.feeds[ffid][0] == pair:
+                provided.append((ffid, pair))
+            self.feeds.remove(ffid, pair)
+
+        ret = []
+        for ffid, pair in provided:
+            # the eaters of the feed eat from the next provider, if any
+            for eater in self._eaters.get(ffid, []):
+                self._disconnect(ffid, eater, pair)
+                if ffid in self.feeds:
+                    self._connect(ffid, eater)
+                ret.append((eater[0], ffid))
+
+        for key in self._fullFeedIds.keys():
+            if key[0] == avatar.avatarId:
+                del self._fullFeedIds[key]
+        return ret
+
+    def _connect(self, ffid, (eater, eName, feedId)):
+        feeder, feedName = self.feeds[ffid][0]
+        if feeder.getFeedId(feedName) != feedId:
+            self.debug('chose %s for feed %s',
+                       feeder.getFeedId(feedName), feedId)
+        self.feedersForEaters[self._getFullFeedId(eater, eName)] = (
+            eName, feeder, feedName)
+        self.eatersForFeeders.add(self._getFullFeedId(feeder, feedName),
+                                  (feedName, eater, eName))
+        self.feedDeps.add(feeder, (eater, ffid))
+
+    def _disconnect(self, ffid, (eater, eName, feedId), (feeder, feedName)):
+        eaterFfid = self._getFullFeedId(eater, eName)
+        if self.feedersForEaters.get(eaterFfid, None) == (eName, feeder,
+                                                         feedName):
+            del self.feedersForEaters[eaterFfid]
+        self.eatersForFeeders.remove(self._getFullFeedId(feeder, feedName),
+                                     (feedName, eater, eName))
+        self.feedDeps.remove(feeder, (eater, ffid))
+
+    def _getFullFeedId(self, avatar, name):
+        return self._fullFeedIds[(avatar.avatarId, name)]
 
     def getFeedersForEaters(self, avatar):
         """Get the set of feeds that this component is eating from,
@@ -639,7 +693,6 @@ class FeedMap(object, log.Loggable):
         @return: a list of (eaterAlias, feederAvatar, feedName) tuples
         @rtype:  list of (str, ComponentAvatar, str)
         """
-        self._recalc()
         ret = []
         for tups in avatar.getEaters().values():
             for feedId, alias in tups:
@@ -659,7 +712,6 @@ class FeedMap(object, log.Loggable):
         @return: a list of (eaterAlias, feederAvatar, feedName) tuples
         @rtype:  list of (str, L{ComponentAvatar}, str)
         """
-        self._recalc()
         ret = []
         for feeder, feedName in self.feeds.get(ffid, []):
             rffid = feeder.getFullFeedId(feedName)
@@ -676,7 +728,6 @@ class FeedMap(object, log.Loggable):
         @return: a list of (feederName, eaterAvatar, eaterAlias) tuples
         @rtype:  list of (str, ComponentAvatar, str)
         """
-        self._recalc()
         ret = []
         for feedName in avatar.getFeeders():
             ffid = avatar.getFullFeedId(feedName)
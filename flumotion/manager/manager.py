@@ -243,6 +243,7 @@ class Vishnu(log.Loggable):
         @returns: A deferred that will fire when the manager has shut
         down.
         """
+        self.bundlerBasket.stopWatching()
         if self.bouncer:
             return self.bouncer.stop()
         else:
@@ -270,9 +271,11 @@ class Vishnu(log.Loggable):
         if registry.getRegistry().rebuildNeeded():
             self.info("Registry changed, rebuilding")
             registry.getRegistry().verify(force=True)
+            self.bundlerBasket.stopWatching()
             self.bundlerBasket = registry.getRegistry().makeBundlerBasket()
         elif not self.bundlerBasket.isUptodate(registry.getRegistry().mtime):
             self.info("BundlerBasket is older than the Registry, rebuilding")
+            self.bundlerBasket.stopWatching()
             self.bundlerBasket = registry.getRegistry().makeBundlerBasket()
         return self.bundlerBasket
 
@@ -56,13 +56,16 @@ from flumotion.common import boot
 boot.init_gobject()
 boot.init_gst()
 
-# fdpass is a built module,  so it lives in builddir, while the package
-# __init__ is in srcdir.  Append to its __path__ to make the tests work
+# fdpass and sendfile are built modules,  so they live in builddir, while
+# the package __init__ is in srcdir.  Append to their __path__ to make the
+# tests work
 i = os.getcwd().find('_build')
 if i > -1:
     top_builddir = os.path.join(os.getcwd()[:i], '_build')
-    from flumotion.extern import fdpass
+    from flumotion.extern import fdpass, sendfile
     fdpass.__path__.append(os.path.join(top_builddir, 'flumotion', 'extern',
         'fdpass'))
+    sendfile.__path__.append(os.path.join(top_builddir, 'flumotion', 'extern',
+        'sendfile'))
 
 del boot, flumotion, i, log, useGtk2Reactor
@@ -260,6 +260,29 @@ class TestIPBouncer(bouncertest.BouncerTestHelper):
         d.addCallback(lambda _: self.check_auth(keycard, bouncer, True))
         return self.stop_bouncer(bouncer, d)
 
+    def test_ipv6_subnet_allow_and_deny(self):
+        bouncer = self.get_bouncer({'deny': ['2001:db8:1::/48'],
+                                     'allow': ['2001:db8::/32',
+                                               '62.121.66.0/24']})
+        keycard = keycards.KeycardGeneric()
+        keycard.username = 'user'
+        keycard.password = 'test'
+        keycard.address = '2001:db8::1'
+        d = self.check_auth(keycard, bouncer, True)
+
+        keycard = keycards.KeycardGeneric()
+        keycard.username = 'user'
+        keycard.password = 'test'
+        keycard.address = '2001:db8:1::1'
+        d.addCallback(lambda _: self.check_auth(keycard, bouncer, False))
+
+        keycard = keycards.KeycardGeneric()
+        keycard.username = 'user'
+        keycard.password = 'test'
+        keycard.address = '::ffff:62.121.66.134'
+        d.addCallback(lambda _: self.check_auth(keycard, bouncer, True))
+        return self.stop_bouncer(bouncer, d)
+
     def test_no_ip(self):
         bouncer = self.get_bouncer({'deny': ['62.121.66.134/32']})
         keycard = keycards.KeycardGeneric()
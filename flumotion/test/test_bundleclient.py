@@ -0,0 +1,146 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_bundleclient -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+import os
+import shutil
+import tempfile
+
+from twisted.internet import defer, task
+
+from flumotion.common import bundle, bundleclient, errors, testsuite
+from flumotion.configure import configure
+
+
+class FakeManager:
+    # serves the sums and zips of bundles like the manager's avatars
+
+    def __init__(self, bundles):
+        self.bundles = bundles
+        self.calls = []
+        self.pending = None
+
+    def callRemote(self, methodName, *args, **kwargs):
+        self.calls.append(methodName)
+        if methodName == 'getBundleSums':
+            result = [(b.name, b.md5sum) for b in self.bundles]
+        else:
+            result = {}
+            for b in self.bundles:
+                if b.name in args[0] and b.zip is not None:
+                    result[b.name] = b.getZip()
+        if self.pending is None:
+            return defer.succeed(result)
+        d = defer.Deferred()
+        self.pending.append((d, result))
+        return d
+
+    def firePending(self):
+        pending, self.pending = self.pending, []
+        for d, result in pending:
+            d.callback(result)
+
+
+class TestBundleLoader(testsuite.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.tempdir, 'cache')
+        self.patch(configure, 'cachedir', self.cachedir)
+
+        bundles = []
+        for name in 'high', 'low':
+            path = os.path.join(self.tempdir, name + '.py')
+            handle = open(path, 'w')
+            handle.write('# %s\n' % name)
+            handle.close()
+            bundler = bundle.Bundler(name)
+            bundler.add(path, name + '.py')
+            bundles.append(bundler.bundle())
+        self.manager = FakeManager(bundles)
+        self.clock = task.Clock()
+        self.loader = self.makeLoader()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def makeLoader(self, sumsTTL=0):
+        return bundleclient.BundleLoader(self.manager.callRemote,
+                                         sumsTTL=sumsTTL, clock=self.clock)
+
+    def assertBundles(self, result):
+        self.assertEquals([name for name, path in result], ['low', 'high'])
+        for name, path in result:
+            self.failUnless(os.path.exists(os.path.join(path, name + '.py')))
+
+    def testGetBundles(self):
+        d = self.loader.getBundles(moduleName='high')
+        d.addCallback(self.assertBundles)
+        d.addCallback(lambda _: self.assertEquals(
+            self.manager.calls, ['getBundleSums', 'getBundleZips']))
+        return d
+
+    def testUnpackedBundlesNotFetched(self):
+        d = self.loader.getBundles(moduleName='high')
+
+        def getAgain(_):
+            # as another process on the same host would
+            self.manager.calls = []
+            return self.makeLoader().getBundles(moduleName='high')
+        d.addCallback(getAgain)
+        d.addCallback(self.assertBundles)
+        d.addCallback(lambda _: self.assertEquals(
+            self.manager.calls, ['getBundleSums']))
+        return d
+
+    def testSumsReused(self):
+        self.loader = self.makeLoader(sumsTTL=30)
+        d = self.loader.getBundles(moduleName=['high'])
+        d.addCallback(lambda _: self.loader.getBundles(moduleName=['high']))
+        d.addCallback(self.assertBundles)
+
+        def expire(_):
+            self.assertEquals(self.manager.calls,
+                              ['getBundleSums', 'getBundleZips'])
+            self.clock.advance(31)
+            return self.loader.getBundles(moduleName=['high'])
+        d.addCallback(expire)
+        d.addCallback(lambda _: self.assertEquals(self.manager.calls,
+            ['getBundleSums', 'getBundleZips', 'getBundleSums']))
+        return d
+
+    def testConcurrent(self):
+        self.manager.pending = []
+        d = defer.DeferredList(
+            [self.loader.getBundles(moduleName='high') for i in range(3)],
+            fireOnOneErrback=True)
+        self.assertEquals(self.manager.calls, ['getBundleSums'])
+        self.manager.firePending()
+        self.assertEquals(self.manager.calls,
+                          ['getBundleSums', 'getBundleZips'])
+        self.manager.firePending()
+
+        def check(results):
+            for success, result in results:
+                self.assertBundles(result)
+        d.addCallback(check)
+        return d
+
+    def testMissingBundle(self):
+        self.manager.bundles.append(bundle.Bundle('missing'))
+        self.manager.bundles[-1].md5sum = 'deadbeef'
+        d = self.loader.getBundles(moduleName='high')
+        return self.failUnlessFailure(d, errors.NoBundleError)
@@ -24,16 +24,17 @@ import time
 
 from twisted.internet import defer, threads, reactor
 from twisted.trial import unittest
-
 import twisted.copyright
+
+from flumotion.common import testsuite, errors
+from flumotion.component.misc.httpserver import cachemanager, fileprovider
+from flumotion.component.misc.httpserver import cacheindex
+
 if twisted.copyright.version == 'SVN-Trunk':
     SKIP_MSG = "Twisted 2.0.1 thread pool is broken for tests"
 else:
     SKIP_MSG = None
 
-from flumotion.common import testsuite, errors
-from flumotion.component.misc.httpserver import cachemanager, fileprovider
-
 attr = testsuite.attr
 
 CACHE_SIZE = 1 * 1024 * 1024
@@ -427,3 +428,147 @@ class TestCacheManager(testsuite.TestCase):
         dl.append(d)
 
         return defer.DeferredList(dl)
+
+
+class TestCacheIndex(testsuite.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(suffix=".flumotion.test")
+        self.indexes = []
+
+    def tearDown(self):
+        for index in self.indexes:
+            index.close()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def newIndex(self):
+        index = cacheindex.CacheIndex(self.path, ".tmp")
+        index.load()
+        self.indexes.append(index)
+        return index
+
+    def createFile(self, name, size, atime):
+        path = os.path.join(self.path, name)
+        f = open(path, "wb")
+        f.truncate(size)
+        f.close()
+        os.utime(path, (atime, atime))
+
+    def testScan(self):
+        self.createFile("a", 10, 1000)
+        self.createFile("b", 20, 2000)
+        self.createFile("c.tmp", 40, 1000)
+        index = self.newIndex()
+        self.assertEqual(len(index), 2)
+        self.assertEqual(index.usage, 30)
+        self.assertEqual(index.popOldest(), ("a", 10))
+
+    def testReload(self):
+        index = self.newIndex()
+        index.add("a", 10, 1000)
+        index.add("b", 20, 2000)
+        index.touch("a", 10, 3000)
+        index.remove("b")
+        index.add("c", 40, 2500)
+        other = self.newIndex()
+        self.assertEqual(other.usage, 50)
+        self.assertEqual(other.popOldest(), ("c", 40))
+        self.assertEqual(other.popOldest(), ("a", 10))
+        self.assertEqual(other.popOldest(), None)
+
+    def testTouchResolution(self):
+        index = self.newIndex()
+        index.add("a", 10, 1000)
+        index.add("b", 20, 1010)
+        index.touch("a", 10, 1000 + cacheindex.TOUCH_RESOLUTION - 1)
+        self.assertEqual(index.popOldest(), ("a", 10))
+
+    def testTouchUnknown(self):
+        index = self.newIndex()
+        index.touch("a", 10, 1000)
+        self.assertEqual(index.usage, 10)
+        index.touch("a", 15, 1000)
+        self.assertEqual(index.usage, 15)
+
+    def testShared(self):
+        index = self.newIndex()
+        other = self.newIndex()
+        index.add("a", 10, 1000)
+        other.add("b", 20, 2000)
+        index.sync()
+        other.sync()
+        self.assertEqual(index.usage, 30)
+        self.assertEqual(other.usage, 30)
+        other.remove("a")
+        index.sync()
+        self.assertEqual(index.usage, 20)
+
+    def testCompact(self):
+        index = self.newIndex()
+        other = self.newIndex()
+        for i in range(100):
+            index.add(str(i), 1, 1000 + i)
+        for i in range(90):
+            index.remove(str(i))
+        index.compact()
+        path = os.path.join(self.path, cacheindex.JOURNAL_NAME)
+        self.assertEqual(len(open(path).readlines()), 10)
+        # the other process notices the journal has been replaced
+        other.add("x", 5, 500)
+        index.sync()
+        other.sync()
+        self.assertEqual(index.usage, 15)
+        self.assertEqual(other.usage, 15)
+        self.assertEqual(other.popOldest(), ("x", 5))
+
+    def testJournalRemoved(self):
+        index = self.newIndex()
+        index.add("a", 10, 1000)
+        os.unlink(os.path.join(self.path, cacheindex.JOURNAL_NAME))
+        index.add("b", 20, 2000)
+        other = self.newIndex()
+        self.assertEqual(other.usage, 30)
+
+    def testEvict(self):
+        index = self.newIndex()
+        index.add("a", 10, 1000)
+        index.add("b", 20, 3000)
+        index.add("c", 40, 2000)
+        index.touch("a", 10, 4000)
+        self.assertEqual(index.evict(25), ["c", "b"])
+        self.assertEqual(index.usage, 10)
+        other = self.newIndex()
+        self.assertEqual(other.usage, 10)
+
+    def testLargeJournal(self):
+        index = self.newIndex()
+        synced = self.newIndex()
+        appended = self.newIndex()
+        for i in range(5000):
+            index.add("file-%05d" % i, 1000, 1000 + i)
+        path = os.path.join(self.path, cacheindex.JOURNAL_NAME)
+        self.failUnless(os.path.getsize(path) > cacheindex.READ_BUFFER_SIZE)
+        loaded = self.newIndex()
+        self.assertEqual(len(loaded), 5000)
+        self.assertEqual(loaded.usage, 5000000)
+        synced.sync()
+        self.assertEqual(len(synced), 5000)
+        self.assertEqual(synced.usage, 5000000)
+        appended.add("last", 1000, 500)
+        self.assertEqual(len(appended), 5001)
+        self.assertEqual(appended.usage, 5001000)
+
+    def testEvictSynced(self):
+        index = self.newIndex()
+        other = self.newIndex()
+        index.add("a", 10, 1000)
+        other.add("b", 20, 2000)
+        index.add("c", 40, 3000)
+        index.sync()
+        index.sync()
+        self.assertEqual(index.usage, 70)
+        self.assertEqual(index._records, 3)
+        self.assertEqual(index.evict(40), ["a", "b"])
+        self.assertEqual(index.usage, 40)
+        self.assertEqual(index.evict(0), ["c"])
+        self.assertEqual(index.evict(0), [])
@@ -15,12 +15,14 @@
 #
 # Headers in this file shall remain intact.
 
+from twisted.internet import defer, reactor
 from twisted.trial import unittest
 
 from flumotion.common import testsuite
 
-from flumotion.common import bundle, python
+from flumotion.common import bundle, errors, python
 
+import fcntl
 import tempfile
 import os
 import StringIO
@@ -172,6 +174,85 @@ class TestUnbundler(testsuite.TestCase):
         two = open(newfile, "r").read()
         self.assertEquals(one, two)
 
+    def testUnbundlerAtomic(self):
+        bundler = bundle.Bundler("test")
+        bundler.add(self.filename, 'test.py')
+        b = bundler.bundle()
+        unbundler = bundle.Unbundler(self.tempdir)
+        self.failIf(unbundler.isUnbundled('test', b.md5sum))
+
+        dir = unbundler.unbundle(b)
+        self.failUnless(unbundler.isUnbundled('test', b.md5sum))
+        # nothing is left from unpacking
+        self.assertEquals(os.listdir(os.path.dirname(dir)), [b.md5sum])
+        # a bundle already unpacked is not unpacked again
+        os.unlink(os.path.join(dir, 'test.py'))
+        self.assertEquals(unbundler.unbundle(b), dir)
+        self.assertEquals(os.listdir(dir), [bundle.UNBUNDLED_NAME])
+
+    def testUnbundlerIncomplete(self):
+        bundler = bundle.Bundler("test")
+        bundler.add(self.filename, 'test.py')
+        b = bundler.bundle()
+        unbundler = bundle.Unbundler(self.tempdir)
+        # as left by an interrupted unpacking of older versions
+        os.makedirs(unbundler.unbundlePath(b))
+        self.failIf(unbundler.isUnbundled('test', b.md5sum))
+
+        dir = unbundler.unbundle(b)
+        self.failUnless(os.path.exists(os.path.join(dir, 'test.py')))
+        entries = os.listdir(os.path.dirname(dir))
+        self.assertEquals(len(entries), 2)
+        self.failUnless([e for e in entries
+                         if e.startswith(bundle.TEMP_PREFIX)])
+
+    def testUnbundlerLeased(self):
+        unbundler = bundle.Unbundler(self.tempdir)
+        old = time.time() - 2 * bundle.STALE_AGE
+        for md5sum in 'ours', 'theirs', 'recent':
+            path = unbundler.unbundlePathByInfo('test', md5sum)
+            os.makedirs(path)
+            open(os.path.join(path, bundle.UNBUNDLED_NAME), 'w').close()
+            if md5sum != 'recent':
+                os.utime(path, (old, old))
+        self.failUnless(unbundler.lease('test', 'ours'))
+        self.failIf(unbundler.lease('test', 'missing'))
+        # as another process would
+        handle = open(os.path.join(unbundler.unbundlePathByInfo(
+            'test', 'theirs'), bundle.UNBUNDLED_NAME))
+        fcntl.flock(handle.fileno(), fcntl.LOCK_SH)
+
+        removed = unbundler.cleanup(['test'], keep=1)
+        handle.close()
+        self.assertEquals(removed,
+            [unbundler.unbundlePathByInfo('test', 'ours')])
+        remaining = os.listdir(os.path.join(self.tempdir, 'test'))
+        remaining.sort()
+        self.assertEquals(remaining, ['recent', 'theirs'])
+
+    def testUnbundlerCleanup(self):
+        unbundler = bundle.Unbundler(self.tempdir)
+        now = time.time()
+        for age, md5sum in [(4, 'reused'), (3, 'old'), (2, 'running'),
+                            (1, 'unused'), (0, 'recent'),
+                            (1, bundle.TEMP_PREFIX + 'x')]:
+            path = unbundler.unbundlePathByInfo('test', md5sum)
+            os.makedirs(path)
+            mtime = now - age * bundle.STALE_AGE - 1
+            os.utime(path, (mtime, mtime))
+        unbundler.markUsed('test', 'reused')
+
+        removed = unbundler.cleanup(['test', 'unknown'], keep=1,
+            exclude=[unbundler.unbundlePathByInfo('test', 'running')])
+        removed.sort()
+        self.assertEquals(removed, [
+            unbundler.unbundlePathByInfo('test', bundle.TEMP_PREFIX + 'x'),
+            unbundler.unbundlePathByInfo('test', 'old'),
+            unbundler.unbundlePathByInfo('test', 'unused')])
+        remaining = os.listdir(os.path.join(self.tempdir, 'test'))
+        remaining.sort()
+        self.assertEquals(remaining, ['recent', 'reused', 'running'])
+
 
 class TestBundlerBasket(testsuite.TestCase):
     # everything we need to set up the test environment
@@ -271,6 +352,108 @@ class TestBundlerBasket(testsuite.TestCase):
         list.sort()
         self.assertEquals(list, deps)
 
+    def waitFor(self, condition, timeout=5):
+        d = defer.Deferred()
+        start = time.time()
+
+        def check():
+            if condition() or time.time() - start > timeout:
+                d.callback(None)
+            else:
+                reactor.callLater(0.01, check)
+        check()
+        return d
+
+    def modify(self, path):
+        handle = open(path, 'w')
+        handle.write("print 'I am another bit of python'")
+        handle.close()
+
+    def testGetBundles(self):
+        basket = bundle.BundlerBasket()
+        self.addCleanup(basket.stopWatching)
+        basket.add('test', self.pythonfile, "test.py")
+        basket.add('text', self.textfile, "text")
+        bundles = []
+
+        d = basket.getBundles(['test', 'text', 'test'])
+        d.addCallback(bundles.append)
+        d.addCallback(lambda _: basket.getBundles(['test']))
+        d.addCallback(bundles.append)
+
+        def check(_):
+            names = bundles[0].keys()
+            names.sort()
+            self.assertEquals(names, ['test', 'text'])
+            self.assertEquals(bundles[0]['test'].md5sum,
+                basket.getBundlerByName('test').bundle().md5sum)
+            # cached
+            self.assertIdentical(bundles[0]['test'], bundles[1]['test'])
+        d.addCallback(check)
+        return d
+
+    def testGetBundlesUnknown(self):
+        basket = bundle.BundlerBasket()
+        self.addCleanup(basket.stopWatching)
+        basket.add('test', self.pythonfile, "test.py")
+        d = basket.getBundles(['test', 'notexist'])
+        return self.assertFailure(d, errors.NoBundleError)
+
+    def testGetBundlesConcurrent(self):
+        basket = bundle.BundlerBasket()
+        self.addCleanup(basket.stopWatching)
+        basket.add('test', self.pythonfile, "test.py")
+        builds = []
+        build = basket._build
+
+        def countingBuild(bundler):
+            builds.append(bundler)
+            return build(bundler)
+        basket._build = countingBuild
+        d = defer.gatherResults([basket.getBundles(['test']),
+                                 basket.getBundles(['test'])])
+
+        def check(results):
+            self.assertEquals(len(builds), 1)
+            self.assertIdentical(results[0]['test'], results[1]['test'])
+        d.addCallback(check)
+        return d
+
+    def assertChangeNoticed(self, basket):
+        sums = []
+        basket.add('test', self.pythonfile, "test.py")
+        d = basket.getBundles(['test'])
+        d.addCallback(lambda b: sums.append(b['test'].md5sum))
+        d.addCallback(lambda _: self.modify(self.pythonfile))
+        d.addCallback(lambda _: self.waitFor(
+            lambda: 'test' not in basket._bundles))
+        d.addCallback(lambda _: basket.getBundles(['test']))
+        d.addCallback(lambda b: sums.append(b['test'].md5sum))
+
+        def check(_):
+            self.assertNotEquals(sums[0], sums[1])
+            self.assertEquals(sums[1],
+                basket.getBundlerByName('test').bundle().md5sum)
+        d.addCallback(check)
+        return d
+
+    def testINotify(self):
+        basket = bundle.BundlerBasket()
+        self.addCleanup(basket.stopWatching)
+        basket.startWatching()
+        if basket._notifier is None:
+            raise unittest.SkipTest("inotify is not available")
+        return self.assertChangeNoticed(basket)
+
+    def testPolling(self):
+        basket = bundle.BundlerBasket()
+        self.addCleanup(basket.stopWatching)
+        self.patch(bundle, 'inotify', None)
+        basket.startWatching(pollInterval=0.01)
+        self.assertEquals(basket._notifier, None)
+        # the size of the file changes, even if its mtime may not
+        return self.assertChangeNoticed(basket)
+
     def tearDown(self):
         os.unlink(self.packagefile)
         os.rmdir(self.packagedir)
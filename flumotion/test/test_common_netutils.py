@@ -21,6 +21,7 @@ from twisted.internet import address
 
 from flumotion.common import testsuite
 from flumotion.common.netutils import ipv4StringToInt, ipv4IntToString
+from flumotion.common.netutils import ipv6StringToInt, ipv6IntToString
 from flumotion.common.netutils import RoutingTable
 from flumotion.common.netutils import addressGetHost, addressGetPort
 
@@ -56,6 +57,20 @@ class TestIpv4Parse(testsuite.TestCase):
         self.assertParseFails('1.1.1.-3')
 
 
+class TestIpv6Parse(testsuite.TestCase):
+
+    def testIpv6Parse(self):
+        self.assertEquals(ipv6StringToInt('::1'), 1)
+        self.assertEquals(ipv6StringToInt('1::'), 1L << 112)
+        self.assertEquals(ipv6StringToInt('::ffff:192.168.1.1'),
+                          (0xffff << 32) | ipv4StringToInt('192.168.1.1'))
+        for s in ['::1', '2001:db8::', '2001:db8::ff00:42:8329']:
+            self.assertEquals(ipv6IntToString(ipv6StringToInt(s)), s)
+
+        self.assertRaises(ValueError, ipv6StringToInt, '1::1::1')
+        self.assertRaises(ValueError, ipv6StringToInt, '2001:db8::g')
+
+
 class TestRoutingTable(testsuite.TestCase):
 
     def testAddRemove(self):
@@ -141,6 +156,49 @@ class TestRoutingTable(testsuite.TestCase):
         ar('192.168.1.1', 'bar')
         ar('192.168.2.1', 'baz')
 
+    def testIpv6Routing(self):
+        net = RoutingTable()
+
+        def ar(ip, route):
+            self.assertEquals(net.route(ip), route)
+
+        net.addSubnet('foo', '2001:db8::', 32)
+        net.addSubnet('bar', '2001:db8:1::', 48)
+        net.addSubnet('baz', '192.168.1.0', 24)
+        self.assertEquals(len(net), 3)
+        self.assertRaises(ValueError, net.addSubnet, 'foo', '2001:db8::', 129)
+        self.assertRaises(ValueError, net.addSubnet, 'foo', '2001:db8::', 16)
+
+        ar('2001:db8::1', 'foo')
+        ar('2001:db8:1::1', 'bar')
+        ar('2001:db9::1', None)
+        # the IPv6 routes are not used for IPv4 addresses, and the IPv4
+        # routes are used for IPv4-mapped IPv6 addresses
+        ar('0.0.0.1', None)
+        ar('::ffff:192.168.1.1', 'baz')
+        ar('::c0a8:101', None)
+        self.assertEquals(list(net.route_iter('2001:db8:1::1')),
+                          ['bar', 'foo', None])
+
+        self.assertEquals(list(net.iterHumanReadable()),
+                          [('baz', '192.168.1.0', 24),
+                           ('bar', '2001:db8:1::', 48),
+                           ('foo', '2001:db8::', 32)])
+
+        net.removeSubnet('bar', '2001:db8:1::', 48)
+        ar('2001:db8:1::1', 'foo')
+
+    def testSameSubnet(self):
+        net = RoutingTable()
+        net.addSubnet('foo', '192.168.1.0', 24)
+        net.addSubnet('bar', '192.168.1.0', 24)
+        # ties are broken the way the routes are iterated
+        self.assertEquals(net.route('192.168.1.1'), 'foo')
+        self.assertEquals(list(net.route_iter('192.168.1.1')),
+                          ['foo', 'bar', None])
+        net.removeSubnet('foo', '192.168.1.0', 24)
+        self.assertEquals(net.route('192.168.1.1'), 'bar')
+
     def assertParseFailure(self, string, **kwargs):
         f = StringIO.StringIO(string)
         self.assertRaises(ValueError, RoutingTable.fromFile, f,
@@ -194,6 +252,11 @@ class TestRoutingTable(testsuite.TestCase):
                                '0.0.0.0/0 general',
                                [('foo', '192.168.1.1', 32),
                                 ('general', '0.0.0.0', 0)])
+        self.assertParseEquals('2001:db8::/32 foo\n'
+                               '::ffff:192.168.1.0/120 bar',
+                               [('foo', '2001:db8::', 32),
+                                ('bar', '::ffff:192.168.1.0', 120)])
+        self.assertParseFailure('2001:db8::/129 foo')
 
     def assertRouteNamesOrder(self, string, routeNames):
         f = StringIO.StringIO(string)
@@ -0,0 +1,108 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_common_pathtree -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+import random
+
+from flumotion.common import pathtree
+from flumotion.common import testsuite
+
+
+class TestPathTree(testsuite.TestCase):
+
+    def testEmpty(self):
+        t = pathtree.PathTree()
+        self.assertEquals(len(t), 0)
+        self.failIf('/foo' in t)
+        self.assertRaises(KeyError, t.__getitem__, '/foo')
+        self.assertRaises(KeyError, t.__delitem__, '/foo')
+        self.assertEquals(t.longestPrefix('/foo'), None)
+        self.assertEquals(t.longestPrefixValue('/foo', 'x'), 'x')
+
+    def testDictInterface(self):
+        t = pathtree.PathTree()
+        t['/foo'] = 1
+        t['/foobar'] = 2
+        t['/fo'] = 3
+        self.assertEquals(len(t), 3)
+        self.assertEquals(t['/foo'], 1)
+        self.assertEquals(t['/foobar'], 2)
+        self.assertEquals(t['/fo'], 3)
+        self.failIf('/f' in t)
+        self.failIf('/foob' in t)
+        self.assertEquals(sorted(t.keys()), ['/fo', '/foo', '/foobar'])
+
+        t['/foo'] = 4
+        self.assertEquals(len(t), 3)
+        self.assertEquals(t['/foo'], 4)
+
+        del t['/foo']
+        self.assertEquals(len(t), 2)
+        self.failIf('/foo' in t)
+        self.assertEquals(t['/foobar'], 2)
+        self.assertEquals(t['/fo'], 3)
+        self.assertEquals(t.get('/foo'), None)
+
+    def testLongestPrefix(self):
+        t = pathtree.PathTree([('/', 'root'),
+                               ('/live/', 'live'),
+                               ('/live/sports', 'sports')])
+        self.assertEquals(t.longestPrefix('/index.html'), ('/', 'root'))
+        self.assertEquals(t.longestPrefix('/live/news'), ('/live/', 'live'))
+        self.assertEquals(t.longestPrefix('/live/sports2'),
+                          ('/live/sports', 'sports'))
+        self.assertEquals(t.longestPrefixValue('/live'), 'root')
+        self.assertEquals(t.longestPrefix('nothing'), None)
+
+        del t['/live/']
+        self.assertEquals(t.longestPrefixValue('/live/news'), 'root')
+        self.assertEquals(t.longestPrefixValue('/live/sports/a'), 'sports')
+
+    def testEmptyKey(self):
+        t = pathtree.PathTree()
+        t[''] = 'default'
+        self.assertEquals(t.longestPrefix('/anything'), ('', 'default'))
+        del t['']
+        self.assertEquals(t.longestPrefix('/anything'), None)
+
+    def testRandomAgainstLinearScan(self):
+        alphabet = '/ab'
+        keys = set()
+        for i in range(300):
+            keys.add(''.join([random.choice(alphabet)
+                              for j in range(random.randint(1, 6))]))
+        keys = list(keys)
+        t = pathtree.PathTree()
+        d = {}
+        for k in keys:
+            t[k] = d[k] = k.upper()
+        # remove half of them again, exercising node merging
+        for k in keys[::2]:
+            del t[k]
+            del d[k]
+        self.assertEquals(len(t), len(d))
+        self.assertEquals(sorted(t.items()), sorted(d.items()))
+
+        for i in range(300):
+            path = ''.join([random.choice(alphabet)
+                            for j in range(random.randint(0, 8))])
+            matching = [k for k in d if path.startswith(k)]
+            if matching:
+                best = max(matching, key=len)
+                expected = (best, d[best])
+            else:
+                expected = None
+            self.assertEquals(t.longestPrefix(path), expected)
@@ -0,0 +1,147 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_common_timerwheel -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+from twisted.internet import task
+
+from flumotion.common import testsuite
+from flumotion.common import timerwheel
+
+
+class TestTimerWheel(testsuite.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.wheel = timerwheel.TimerWheel(resolution=1.0, size=8,
+                                           clock=self.clock)
+        self.calls = []
+
+    def call(self, *args):
+        self.calls.append((self.clock.seconds(), args))
+
+    def advance(self, seconds):
+        for i in range(int(seconds * 10)):
+            self.clock.advance(0.1)
+
+    def testSchedule(self):
+        self.wheel.schedule(2.5, self.call, 'a')
+        self.wheel.schedule(1, self.call, 'b')
+        self.assertEquals(len(self.wheel), 2)
+        self.advance(2)
+        self.assertEquals([args for t, args in self.calls], [('b', )])
+        self.advance(2)
+        self.assertEquals([args for t, args in self.calls],
+                          [('b', ), ('a', )])
+        # called at the first tick after the deadline
+        self.assertApproximates(self.calls[1][0], 3.0, 0.01)
+        self.assertEquals(len(self.wheel), 0)
+
+    def testIdle(self):
+        # no delayed call is left when there are no timers
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+        timer = self.wheel.schedule(5, self.call)
+        self.assertEquals(len(self.clock.getDelayedCalls()), 1)
+        timer.cancel()
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+        self.wheel.schedule(1, self.call)
+        self.advance(2)
+        self.assertEquals(len(self.calls), 1)
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+    def testCancel(self):
+        timer = self.wheel.schedule(1, self.call, 'a')
+        self.wheel.schedule(1, self.call, 'b')
+        self.failUnless(timer.active())
+        timer.cancel()
+        self.failIf(timer.active())
+        timer.cancel()
+        self.advance(2)
+        self.assertEquals([args for t, args in self.calls], [('b', )])
+
+    def testReset(self):
+        timer = self.wheel.schedule(2, self.call)
+        self.advance(1.5)
+        timer.reset(2)
+        self.advance(1.5)
+        self.assertEquals(self.calls, [])
+        self.advance(1.5)
+        self.assertEquals(len(self.calls), 1)
+        self.failIf(timer.active())
+        # a called timer can be reset to be called again
+        timer.reset(1)
+        self.advance(2)
+        self.assertEquals(len(self.calls), 2)
+
+    def testResetSooner(self):
+        timer = self.wheel.schedule(10, self.call)
+        timer.reset(1)
+        self.advance(2)
+        self.assertEquals(len(self.calls), 1)
+        self.assertEquals(len(self.wheel), 0)
+
+    def testSeveralRevolutions(self):
+        # 8 slots of 1 second, the timer stays through two revolutions
+        self.wheel.schedule(20, self.call)
+        self.advance(19.5)
+        self.assertEquals(self.calls, [])
+        self.advance(1)
+        self.assertEquals(len(self.calls), 1)
+
+    def testStall(self):
+        self.wheel.schedule(3, self.call, 'a')
+        self.wheel.schedule(30, self.call, 'b')
+        # the reactor doesn't run for longer than a revolution
+        self.clock.advance(12)
+        self.assertEquals([args for t, args in self.calls], [('a', )])
+        self.advance(20)
+        self.assertEquals([args for t, args in self.calls],
+                          [('a', ), ('b', )])
+
+    def testCancelFromCall(self):
+        timers = []
+
+        def cancelOther(other):
+            self.call()
+            timers[other].cancel()
+        timers.append(self.wheel.schedule(1, cancelOther, 1))
+        timers.append(self.wheel.schedule(1, cancelOther, 0))
+        # whichever is called first, the other is not called
+        self.advance(3)
+        self.assertEquals(len(self.calls), 1)
+
+    def testFailingCall(self):
+
+        def fail():
+            raise ValueError('failing timer')
+        self.wheel.schedule(1, fail)
+        self.wheel.schedule(1, self.call)
+        self.advance(2)
+        self.assertEquals(len(self.calls), 1)
+
+    def testScheduleFromCall(self):
+
+        def again():
+            self.call()
+            if len(self.calls) < 3:
+                self.wheel.schedule(1, again)
+        self.wheel.schedule(1, again)
+        self.advance(8)
+        self.assertEquals(len(self.calls), 3)
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+    def testShared(self):
+        self.assertIdentical(timerwheel.getTimerWheel(),
+                             timerwheel.getTimerWheel())
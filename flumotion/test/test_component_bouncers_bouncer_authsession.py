@@ -20,7 +20,8 @@ from flumotion.common import testsuite
 
 from flumotion.component.bouncers import component
 
-from flumotion.common import keycards
+from flumotion.common import keycards, timerwheel
+from twisted.internet import task
 from twisted.spread import pb
 
 
@@ -38,6 +39,8 @@ class AuthSessionBouncerTestCase(testsuite.TestCase):
                   'plugs': {},
                   'properties': {}}
         self.bouncer = DummyBouncer(config)
+        self.clock = task.Clock()
+        self.bouncer._timerWheel = timerwheel.TimerWheel(clock=self.clock)
 
     def tearDown(self):
         self.bouncer.stop()
@@ -141,7 +144,7 @@ class AuthSessionBouncerTestCase(testsuite.TestCase):
         self.assertEqual(answer, self.bouncer.getAuthSessionInfo(answer))
 
         # Then the session expire
-        self.bouncer._expire()
+        self.clock.advance(11)
 
         self.failIf(self.bouncer.hasKeycard(answer))
         self.failIf(self.bouncer.hasAuthSession(answer))
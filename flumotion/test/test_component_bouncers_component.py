@@ -17,9 +17,9 @@
 
 from flumotion.common import testsuite
 
-from twisted.internet import defer, reactor
+from twisted.internet import defer, task
 
-from flumotion.common import keycards
+from flumotion.common import keycards, timerwheel
 from flumotion.component.bouncers import base, component
 
 
@@ -67,54 +67,25 @@ class TrivialBouncerTest(testsuite.TestCase):
         d.addCallback(self.assertAttr, 'state', keycards.AUTHENTICATED)
         return d
 
-    def setKeycardExpireInterval(self, interval):
-        # can be overridden
-        self.obj._expirer.timeout = interval
+    def useClock(self):
+        clock = task.Clock()
+        self.obj._timerWheel = timerwheel.TimerWheel(clock=clock)
+        return clock
 
     def testTimeoutAlgorithm(self):
-        # the plan: make a keycard that expires in 0.75 seconds, and
-        # set up the component such that it checks for expired keycards
-        # every half second. this test will check the keycard's
-        # ttl value at 0.25 seconds and 0.75 seconds, and will
-        # make sure that at 1.25 seconds that the keycard is out of the
-        # bouncer.
-
-        # check for expired keycards every half a second
-        self.setKeycardExpireInterval(0.5)
-
-        def checkTimeout(k):
-
-            def check(expected, inBouncer, furtherChecks):
-                if k.ttl != expected:
-                    d.errback(AssertionError('ttl %r != expected %r'
-                                             % (k.ttl, expected)))
-                    return
-                if inBouncer:
-                    if not self.obj.hasKeycard(k):
-                        d.errback(AssertionError('comp missing keycard'))
-                        return
-                else:
-                    if self.obj.hasKeycard(k):
-                        d.errback(AssertionError(
-                            'comp unexpectedly has keycard'))
-                        return
-
-                if furtherChecks:
-                    args = furtherChecks.pop(0)
-                    args += (furtherChecks, )
-                    reactor.callLater(*args)
-                else:
-                    d.callback('success')
-            reactor.callLater(0.25, check, 0.75, True,
-                              [(0.5, check, 0.25, True),
-                               (0.5, check, -0.25, False)])
-            d = defer.Deferred()
-            return d
-
-        def checkCalls(res):
+        # a keycard with a ttl of 0.75 seconds is out of the bouncer at
+        # the first tick of the timer wheel after its ttl
+        clock = self.useClock()
+
+        def checkTimeout(_):
+            clock.advance(0.5)
+            self.failUnless(self.obj.hasKeycard(k))
+            self.assertEquals(self.medium.calls, [])
+            clock.advance(0.5)
+            self.failIf(self.obj.hasKeycard(k))
             self.assertEquals(self.medium.calls,
                               [('expireKeycard', (k.requesterId, k.id), {})])
-            return res
+            self.assertEquals(len(self.obj._timerWheel), 0)
 
         k = keycards.KeycardGeneric()
         k.ttl = 0.75
@@ -123,10 +94,25 @@ class TrivialBouncerTest(testsuite.TestCase):
         d.addCallback(self.assertAttr, 'state', keycards.AUTHENTICATED)
         d.addCallback(self.assertAttr, 'ttl', 0.75)
         d.addCallback(checkTimeout)
-        d.addCallback(checkCalls)
+        return d
+
+    def testRemoveCancelsTimeout(self):
+        clock = self.useClock()
+
+        def remove(_):
+            self.assertEquals(len(self.obj._timerWheel), 1)
+            self.obj.removeKeycardId(k.id)
+            self.assertEquals(len(self.obj._timerWheel), 0)
+            self.assertEquals(clock.getDelayedCalls(), [])
+
+        k = keycards.KeycardGeneric()
+        k.ttl = 10
+        d = self.obj.authenticate(k)
+        d.addCallback(remove)
         return d
 
     def testKeepAlive(self):
+        clock = self.useClock()
 
         def adjustTTL(_):
             self.assertEquals(k.ttl, 0.75)
@@ -134,6 +120,11 @@ class TrivialBouncerTest(testsuite.TestCase):
             self.assertEquals(k.ttl, 0.75)
             self.obj.keepAlive('foo', 10)
             self.assertEquals(k.ttl, 10)
+            # the keycard is now expired 10 seconds later
+            clock.advance(5)
+            self.failUnless(self.obj.hasKeycard(k))
+            clock.advance(6)
+            self.failIf(self.obj.hasKeycard(k))
 
         k = keycards.KeycardGeneric()
         k.ttl = 0.75
@@ -159,3 +150,47 @@ class TrivialBouncerTest(testsuite.TestCase):
         d = self.obj.authenticate(k)
         d.addCallback(authenticated)
         return d
+
+    def addKeycards(self, count, requesterId):
+        added = []
+        for i in range(count):
+            k = keycards.KeycardGeneric()
+            k.requesterId = requesterId
+            self.obj.authenticate(k)
+            added.append(k)
+        return added
+
+    def testHasKeycard(self):
+        k, = self.addKeycards(1, 'streamer')
+        self.failUnless(self.obj.hasKeycard(k))
+        # a copy of the keycard is not the keycard of the bouncer
+        copy = keycards.KeycardGeneric()
+        copy.id = k.id
+        self.failIf(self.obj.hasKeycard(copy))
+        self.failIf(self.obj.hasKeycard(keycards.KeycardGeneric()))
+
+    def testExpireAllKeycards(self):
+
+        def expired(total):
+            self.failIf(self.obj._keycards)
+            self.failIf(self.obj._requesterKeycards)
+            # the keycards of a requester are expired in blocks of
+            # EXPIRE_BLOCK_SIZE with a remote call each
+            calls = [(args[0], len(args[1]))
+                     for method, args, kwargs in self.medium.calls]
+            calls.sort()
+            self.assertEquals(calls, [('a', 50), ('a', 100),
+                                      ('b', 50), ('b', 100)])
+
+        self.addKeycards(150, 'a')
+        self.addKeycards(150, 'b')
+        d = self.obj.expireAllKeycards()
+        d.addCallback(expired)
+        return d
+
+    def testExpireAllKeycardsWithoutMedium(self):
+        self.obj.medium = None
+        self.addKeycards(250, 'a')
+        d = self.obj.expireAllKeycards()
+        d.addCallback(lambda _: self.failIf(self.obj._keycards))
+        return d
@@ -22,6 +22,7 @@ from flumotion.common import testsuite
 from flumotion.common import log
 from flumotion.common.planet import moods
 from flumotion.component.consumers.disker import disker
+from flumotion.component.consumers.disker.index import INDEX_FLUSH_ENTRIES
 
 from flumotion.test import comptest
 
@@ -334,6 +335,23 @@ CHK POS LEN TS DUR KF %s TDUR
         file.close()
         os.remove(path)
 
+    def testSavePartial(self):
+        self.fillIndex()
+        self.index.setHeadersSize(10)
+        fd, path = tempfile.mkstemp(suffix='.index')
+        os.close(fd)
+        self.index.setLocation(path)
+        self.assertEquals(self.index.save(20, 30), True)
+        lines = open(path, 'r').readlines()
+        self.assertEquals(lines[2:],
+            ['0 10 1 20 10 1 120 10\n',
+            '1 11 -1 30 -1 1 130 -1\n'])
+        loaded = disker.Index()
+        self.failUnless(loaded.loadIndexFile(path))
+        self.assertEquals(loaded.getHeaders()['length'], 10)
+        self.checkEntry(loaded._index[0], 10, 20)
+        os.remove(path)
+
     def testSaveVoidIndex(self):
         fd, path = tempfile.mkstemp()
         self.index.setLocation(path)
@@ -458,3 +476,93 @@ CHK POS LEN TS DUR KF %s TDUR
         # test all outside highest boundary
         entries = self.index.clipTimestamp(1001, 1100)
         self.assertEquals(entries, None)
+
+    def testClipTDT(self):
+        self.fillIndex()
+        entries = self.index.clipTDT(115, 125)
+        self.assertEquals([e['tdt'] for e in entries], [110, 120])
+        self.assertEquals(self.index.clipTDT(130, 140), None)
+
+    def testSeek(self):
+        self.fillIndex()
+        self.assertEquals(self.index.seekTimestamp(25)['offset'], 1)
+        self.assertEquals(self.index.seekTimestamp(5)['offset'], 0)
+        # the last entry has no duration yet
+        self.assertEquals(self.index.seekTimestamp(100)['offset'], 2)
+        self.assertEquals(self.index.seekTDT(120)['offset'], 1)
+        self.index.addEntry(3, 40, 0, 140)
+        self.index.addEntry(4, 50, 1, 150)
+        # seek to the last keyframe, and not after the end
+        self.assertEquals(self.index.seekTimestamp(45)['offset'], 2)
+        self.index = disker.Index()
+        self.assertEquals(self.index.seekTimestamp(10), None)
+
+    def testLoadPartialData(self):
+        data = self.INDEX % ('FLUIDX1 #Flumotion', 'TDT', ' 120')
+        # the last line is still being written
+        parsed = self.index.loadIndexData(data, True)
+        self.assertEquals(parsed, data.rfind('\n') + 1)
+        self.assertEquals(len(self.index), 2)
+        self.assertEquals(self.index.appendIndexData(data[parsed:]), 0)
+        self.assertEquals(self.index.appendIndexData(data[parsed:] + '\n'),
+                          len(data) - parsed + 1)
+        self.assertEquals(len(self.index), 3)
+        self.checkEntry(self.index.seekTDT(135), 2, 30)
+
+    def testAppendBinaryData(self):
+        fd, path = tempfile.mkstemp(suffix='.index')
+        self.index = disker.Index(location=path, binary=True)
+        self.index.save()
+        self.fillBigIndex()
+        self.index.flush()
+        data = open(path, 'rb').read()
+        os.remove(path)
+
+        index = disker.Index()
+        cut = len(data) - 10 * index.BINARY_ENTRY_SIZE - 3
+        parsed = index.loadIndexData(data[:cut], True)
+        self.assertEquals(len(index), 88)
+        self.assertEquals(index.appendIndexData(data[parsed:]),
+                          len(data) - parsed)
+        self.assertEquals(index._index[:98], self.index._index[:98])
+        self.checkEntry(index._index[98], 98, 980)
+
+    def testBufferedWrites(self):
+        fd, path = tempfile.mkstemp()
+        self.index.setLocation(path)
+        self.index.save()
+        self.fillIndex()
+        # the entries are written in batches
+        self.assertEquals(len(open(path, 'r').readlines()), 2)
+        self.index.flush()
+        self.assertEquals(open(path, 'r').readlines()[2:],
+            ['0 0 1 10 10 1 110 10\n',
+             '1 1 1 20 10 1 120 10\n'])
+        os.remove(path)
+
+    def testFlushWhenFull(self):
+        fd, path = tempfile.mkstemp()
+        self.index.setLocation(path)
+        self.index.save()
+        for i in range(INDEX_FLUSH_ENTRIES + 1):
+            self.index.addEntry(i, i * 10, 1, 0)
+        lines = open(path, 'r').readlines()
+        self.assertEquals(len(lines), INDEX_FLUSH_ENTRIES + 2)
+        os.remove(path)
+
+    def testBinaryIndex(self):
+        fd, path = tempfile.mkstemp(suffix='.index')
+        self.index = disker.Index(location=path, binary=True)
+        self.index.save()
+        self.fillBigIndex()
+        self.index.flush()
+        data = open(path, 'rb').read()
+        self.failUnless(data.startswith(disker.Index.BINARY_INDEX_HEADER))
+
+        index = disker.Index()
+        self.failUnless(index.loadIndexFile(path))
+        # the last entry has no length yet, it's not written
+        self.assertEquals(len(index), 99)
+        self.assertEquals(index._index[:98], self.index._index[:98])
+        self.checkEntry(index._index[98], 98, 980)
+        os.remove(path)
@@ -20,7 +20,7 @@ import shutil
 import tempfile
 from StringIO import StringIO
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 from twisted.trial import unittest
 from twisted.web import client, server, http, error
 from twisted.web.resource import Resource
@@ -28,6 +28,7 @@ from twisted.web.static import Data
 
 from flumotion.common import log
 from flumotion.common import testsuite
+from flumotion.component.consumers.disker.index import Index
 from flumotion.component.misc.httpserver import httpfile, httpserver
 from flumotion.component.misc.httpserver import localprovider
 from flumotion.component.plugs.base import ComponentPlug
@@ -175,6 +176,114 @@ class MountTest(testsuite.TestCase):
         d3.addErrback(lambda f: f.trap(error.Error))
         return defer.DeferredList([d1, d2, d3], fireOnOneErrback=True)
 
+    def testAuthCacheStatistics(self):
+        properties = {
+            u'mount-point': '/ondemand',
+            u'path': os.path.join(self.path, 'A'),
+            u'port': 0,
+            u'auth-cache-ttl': 60,
+        }
+        self.makeComponent(properties)
+        uiState = self.component.uiState
+        observer = FakeObserver()
+        uiState.getStateToCacheAndObserveFor(None, observer)
+        # published once the observer got the state
+        d = defer.Deferred()
+        reactor.callLater(0, d.callback, None)
+
+        def check(_):
+            self.assertEquals(uiState.get('auth-cache-statistics'),
+                              {'hits': 0, 'misses': 0, 'hit-ratio': 0.0,
+                               'size': 0})
+            uiState.stoppedObserving(None, observer)
+        d.addCallback(check)
+        return d
+
+
+class SendfileTest(testsuite.TestCase):
+    """
+    Checks that files are sent right with sendfile over real connections.
+    """
+
+    slow = True
+
+    def setUp(self):
+        if httpfile.sendfile is None:
+            raise unittest.SkipTest("sendfile module not built")
+        self.path = tempfile.mkdtemp(suffix=".flumotion.test")
+        # spread the file over many small sendfile calls
+        self.data = ''.join([chr(i % 251) for i in range(100000)])
+        open(os.path.join(self.path, 'A'), "w").write(self.data)
+        self.transfers = []
+        transfers = self.transfers
+        SendfileTransfer = httpfile.SendfileTransfer
+
+        class RecordingTransfer(SendfileTransfer):
+            chunkSize = 4096
+
+            def __init__(self, *args):
+                transfers.append(self)
+                SendfileTransfer.__init__(self, *args)
+        self.patch(httpfile, 'SendfileTransfer', RecordingTransfer)
+        config = {
+            'feed': [],
+            'name': 'http-server',
+            'parent': 'default',
+            'avatarId': '/default/http-server',
+            'clock-master': None,
+            'type': 'http-server',
+            'plugs': {},
+            'properties': {u'mount-point': '/', u'path': self.path,
+                           u'port': 0},
+        }
+        self.component = httpserver.HTTPFileStreamer(config)
+
+    def tearDown(self):
+        self.component.stop()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def getPage(self, headers=None):
+        url = 'http://localhost:%d/A' % self.component.port
+        factory = client.HTTPClientFactory(url, headers=headers)
+        reactor.connectTCP('localhost', self.component.port, factory)
+        return factory
+
+    def checkSent(self, data, factory, status, body):
+        self.assertEquals(factory.status, status)
+        self.assertEquals(data, body)
+        self.assertEquals(factory.response_headers['content-length'],
+                          [str(len(body))])
+        self.assertEquals(len(self.transfers), 1)
+        transfer = self.transfers[0]
+        # every byte went through sendfile, none was read
+        self.failUnless(transfer._sendfile)
+        self.assertEquals(transfer.bytesWritten, len(body))
+
+    def testFull(self):
+        factory = self.getPage()
+        factory.deferred.addCallback(self.checkSent, factory, '200',
+                                     self.data)
+        return factory.deferred
+
+    def testRange(self):
+        factory = self.getPage({'Range': 'bytes=1000-70000'})
+
+        # the page getter fails on anything but 200, 201 and 202
+        def checkRange(failure):
+            failure.trap(error.Error)
+            self.checkSent(failure.value.response, factory, '206',
+                           self.data[1000:70001])
+            self.assertEquals(factory.response_headers['content-range'],
+                              ['bytes 1000-70000/100000'])
+        factory.deferred.addCallbacks(self.fail, checkRange)
+        return factory.deferred
+
+
+class FakeObserver:
+
+    def callRemote(self, name, *args):
+        return defer.succeed(None)
+
 
 class _Resource(Resource):
 
@@ -810,5 +919,102 @@ class TestDirectory(testsuite.TestCase):
         return fr.finishDeferred
 
 
+class TestIndexedFile(testsuite.TestCase):
+
+    HEADERS = 'HEAD'
+    CHUNKS = ['AAAAAA', 'BBBBBB', 'CCCCCC', 'DDDD']
+    TDT = 1300000000
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        h = open(os.path.join(self.path, 'rec.ts'), 'w')
+        h.write(self.HEADERS + ''.join(self.CHUNKS))
+        h.close()
+        self.index = Index(location=os.path.join(self.path, 'rec.ts.index'))
+        self.index.setHeadersSize(len(self.HEADERS))
+        self.index.save()
+        # one keyframe every 2 seconds
+        offset = len(self.HEADERS)
+        for i, chunk in enumerate(self.CHUNKS):
+            self.index.addEntry(offset, i * 2000000000, True,
+                                self.TDT + i * 2)
+            offset += len(chunk)
+        self.index.flush()
+        httpfile.IndexedFile.indexes.clear()
+
+        self.component = FakeComponent(self.path)
+        self.resource = httpfile.File(self.component.getRoot(), self.component,
+            {'video/MP2T': httpfile.IndexedFile})
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def request(self, expected, **kwargs):
+        fr = FakeRequest(**kwargs)
+        self.assertEquals(self.resource.getChild('rec.ts', fr).render(fr),
+            server.NOT_DONE_YET)
+
+        def finish(result):
+            self.assertEquals(fr.getHeader('content-type'), 'video/MP2T')
+            self.assertEquals(fr.data, expected)
+            self.assertEquals(fr.getHeader('Content-Length'),
+                              str(len(expected)))
+        fr.finishDeferred.addCallback(finish)
+        return fr.finishDeferred
+
+    def testGetChild(self):
+        fr = FakeRequest()
+        r = self.resource.getChild('rec.ts', fr)
+        self.assertEquals(r.__class__, httpfile.IndexedFile)
+
+    def testFull(self):
+        return self.request(self.HEADERS + 'AAAAAABBBBBBCCCCCCDDDD')
+
+    def testStartSeconds(self):
+        return self.request(self.HEADERS + 'BBBBBBCCCCCCDDDD',
+                            args={'start': ['3']})
+
+    def testStartTDT(self):
+        return self.request(self.HEADERS + 'CCCCCCDDDD',
+                            args={'start': [str(self.TDT + 5)]})
+
+    def testStartFirstKeyframe(self):
+        return self.request(self.HEADERS + 'AAAAAABBBBBBCCCCCCDDDD',
+                            args={'start': ['1']})
+
+    def testStartWithoutHeaders(self):
+        h = open(os.path.join(self.path, 'rec.ts'), 'w')
+        h.write(''.join(self.CHUNKS))
+        h.close()
+        self.index.setHeadersSize(0)
+        self.index.save()
+        return self.request('BBBBBBCCCCCCDDDD', args={'start': ['2.5']})
+
+    def testStartWithoutIndex(self):
+        os.unlink(self.index.location)
+        return self.request(self.HEADERS + 'AAAAAABBBBBBCCCCCCDDDD',
+                            args={'start': ['3']})
+
+    def testStartMalformed(self):
+        return self.request(self.HEADERS + 'AAAAAABBBBBBCCCCCCDDDD',
+                            args={'start': ['w00t']})
+
+    def testRangeStart(self):
+        # range should take precedence over start parameter
+        return self.request('AAAA', headers={'range': 'bytes=4-7'},
+                            args={'start': ['3']})
+
+    def testIndexGrowing(self):
+        d = self.request(self.HEADERS + 'CCCCCCDDDD', args={'start': ['9']})
+
+        def addEntry(_):
+            # the last chunk is complete and is now in the index file
+            self.index.addEntry(26, 8000000000, True, self.TDT + 8)
+            self.index.flush()
+            return self.request('HEADDDDD', args={'start': ['9']})
+        d.addCallback(addEntry)
+        return d
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,215 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_common -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+import os
+import shutil
+import tempfile
+
+from twisted.internet import defer, reactor
+from twisted.web import server, static
+
+from flumotion.common.testsuite import TestCase
+from flumotion.component.misc.httpserver.httpcached import common
+from flumotion.component.misc.httpserver.httpcached import http_client
+from flumotion.component.misc.httpserver.httpcached import http_utils
+
+
+class TestStreamRequester(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(suffix=".src")
+        self.data = os.urandom(100000)
+        self._createFile("a", self.data)
+        self._createFile("b", "content of b")
+        self._createFile("empty", "")
+
+        self.site = DummySite(static.File(self.path))
+        self.port = reactor.listenTCP(0, self.site, interface="127.0.0.1")
+        self.stats = DummyStatistics()
+        self.client = http_client.StreamRequester(2, 5, 2, self.stats)
+
+    def tearDown(self):
+        self.client.cleanup()
+        shutil.rmtree(self.path, ignore_errors=True)
+        d = defer.maybeDeferred(self.port.stopListening)
+        # Let the closed connections be cleaned up
+        d.addCallback(wait, 0.05)
+        return d
+
+    def testReuse(self):
+        d = self._retrieve("/a")
+        d.addCallback(self.assertEqual, self.data)
+        d.addCallback(lambda _: self._retrieve("/b"))
+        d.addCallback(self.assertEqual, "content of b")
+        d.addCallback(lambda _: self._retrieve("/a", 1000, 2000))
+        d.addCallback(self.assertEqual, self.data[1000:3000])
+        d.addCallback(lambda _: self._retrieve("/empty"))
+        d.addCallback(self.assertEqual, "")
+        d.addCallback(lambda _: self._retrieve("/a"))
+        d.addCallback(self.assertEqual, self.data)
+        d.addCallback(lambda _: self.assertEqual(self.stats.connections,
+                                                 [False] + [True] * 4))
+        return d
+
+    def testConcurrent(self):
+        d = defer.gatherResults([self._retrieve("/a"), self._retrieve("/b"),
+                                 self._retrieve("/a", 10, 10)])
+        d.addCallback(self.assertEqual,
+                      [self.data, "content of b", self.data[10:20]])
+        d.addCallback(lambda _: self.assertEqual(len(self.client.pool), 2))
+        d.addCallback(lambda _: self._retrieve("/b"))
+        d.addCallback(lambda _: self.assertEqual(self.stats.connections,
+                                                 [False] * 3 + [True]))
+        return d
+
+    def testNotFound(self):
+        d = self._retrieve("/a")
+        d.addCallback(lambda _: self._retrieve("/missing"))
+        d.addCallbacks(lambda _: self.fail("Should have failed"),
+                       lambda f: f.trap(StreamError))
+        # The connection of a failed request is not reused
+        d.addCallback(lambda _: self.assertEqual(len(self.client.pool), 0))
+        d.addCallback(lambda _: self._retrieve("/b"))
+        d.addCallback(self.assertEqual, "content of b")
+        d.addCallback(lambda _: self.assertEqual(self.stats.connections,
+                                                 [False, True, False]))
+        return d
+
+    def testClosedByServer(self):
+        # An idle connection closed by the server is not reused
+        d = self._retrieve("/b")
+        d.addCallback(lambda _: self._closeServerConnections())
+        d.addCallback(wait, 0.05)
+        d.addCallback(lambda _: self._retrieve("/a"))
+        d.addCallback(self.assertEqual, self.data)
+        d.addCallback(lambda _: self.assertEqual(self.stats.connections,
+                                                 [False, False]))
+        return d
+
+    def testClosedWhileReused(self):
+        # A reused connection closed by the server before it got
+        # the request is replaced by a new one
+        d = self._retrieve("/b")
+        d.addCallback(lambda _: self._closeServerConnections())
+        d.addCallback(lambda _: self._retrieve("/a"))
+        d.addCallback(self.assertEqual, self.data)
+        d.addCallback(lambda _: self.assertEqual(self.stats.connections,
+                                                 [False, True]))
+        d.addCallback(lambda _: self.assertEqual(len(self.site.channels), 2))
+        return d
+
+    def testIdleTimeout(self):
+        self.client.pool.idleTimeout = 0.05
+        d = self._retrieve("/b")
+        d.addCallback(lambda _: self.assertEqual(len(self.client.pool), 1))
+        d.addCallback(wait, 0.1)
+        d.addCallback(lambda _: self.assertEqual(len(self.client.pool), 0))
+        d.addCallback(lambda _: self._retrieve("/b"))
+        d.addCallback(lambda _: self.assertEqual(self.stats.connections,
+                                                 [False, False]))
+        return d
+
+    def testNoKeepAlive(self):
+        self.client = http_client.StreamRequester(2, 5, 0, self.stats)
+        d = self._retrieve("/b")
+        d.addCallback(lambda _: self._retrieve("/b"))
+        d.addCallback(self.assertEqual, "content of b")
+        d.addCallback(lambda _: self.assertEqual(self.stats.connections,
+                                                 [False, False]))
+        return d
+
+    def _createFile(self, name, data):
+        f = open(os.path.join(self.path, name), "w")
+        f.write(data)
+        f.close()
+
+    def _retrieve(self, path, start=None, size=None):
+        url = http_utils.Url.fromString("http://localhost" + path)
+        consumer = DummyConsumer()
+        self.client.retrieve(consumer, url, "127.0.0.1",
+                             self.port.getHost().port,
+                             start=start, size=size)
+        return consumer.deferred
+
+    def _closeServerConnections(self):
+        for connections in self.client.pool._idle.values():
+            for connection in connections:
+                port = connection.transport.getHost().port
+                for channel in self.site.channels:
+                    if channel.transport.getPeer().port == port:
+                        channel.transport.loseConnection()
+
+
+######################################################################
+##### Utility Functions and Dummy Classes
+######################################################################
+
+
+def wait(result, timeout):
+    d = defer.Deferred()
+    reactor.callLater(timeout, d.callback, result)
+    return d
+
+
+class StreamError(Exception):
+    pass
+
+
+class DummySite(server.Site):
+
+    def __init__(self, resource):
+        server.Site.__init__(self, resource)
+        self.channels = []
+
+    def buildProtocol(self, addr):
+        channel = server.Site.buildProtocol(self, addr)
+        self.channels.append(channel)
+        return channel
+
+
+class DummyStatistics(object):
+
+    def __init__(self):
+        self.connections = []
+
+    def onUpstreamConnection(self, reused):
+        self.connections.append(reused)
+
+
+class DummyConsumer(common.StreamConsumer):
+
+    def __init__(self):
+        self.deferred = defer.Deferred()
+        self.data = []
+
+    def serverError(self, getter, code, message):
+        self.deferred.errback(StreamError(code, message))
+
+    def conditionFail(self, getter, code, message):
+        self.deferred.errback(StreamError(code, message))
+
+    def streamNotAvailable(self, getter, code, message):
+        self.deferred.errback(StreamError(code, message))
+
+    def onInfo(self, getter, info):
+        pass
+
+    def onData(self, getter, data):
+        self.data.append(data)
+
+    def streamDone(self, getter):
+        self.deferred.callback("".join(self.data))
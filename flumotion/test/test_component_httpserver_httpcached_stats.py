@@ -46,6 +46,9 @@ class DummyStats(object):
     def __init__(self):
         self.stats = {}
 
+    def setPolicy(self, key, minInterval=0, minChange=0):
+        pass
+
     def update(self, key, val):
         self.stats[key] = val
 
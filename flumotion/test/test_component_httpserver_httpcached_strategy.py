@@ -30,6 +30,8 @@ from flumotion.common.testsuite import attr, TestCase
 from flumotion.component.misc.httpserver import fileprovider
 from flumotion.component.misc.httpserver.httpcached import common
 from flumotion.component.misc.httpserver.httpcached import http_utils
+from flumotion.component.misc.httpserver.httpcached import request_manager
+from flumotion.component.misc.httpserver.httpcached import server_selection
 from flumotion.component.misc.httpserver.httpcached import strategy_base
 from flumotion.component.misc.httpserver.httpcached import strategy_basic
 
@@ -1474,6 +1476,157 @@ class TestBasicCachingStrategy(TestCase):
         return result
 
 
+class TestRequestCoalescing(TestCase):
+
+    def setUp(self):
+        self.data = os.urandom(BLOCK_SIZE)
+        self.cachemgr = DummyCacheMgr()
+        self.reqmgr = DummyReqMgr(ResDef("/dummy", self.data, 42))
+        self.stgy = strategy_base.CachingStrategy(self.cachemgr,
+                                                  self.reqmgr, DEFAULT_TTL)
+        self.url = http_utils.Url.fromString("http://www.flumotion.com/dummy")
+
+    def tearDown(self):
+        self.reqmgr.final_reset()
+
+    def _request(self, offset, size):
+        d = self.stgy.requestData(self.url, offset, size, 42)
+        d.addCallback(self.assertEqual, self.data[offset:offset+size])
+        return d
+
+    def _checkRequests(self, _, ranges, coalesced):
+        self.assertEqual(self.reqmgr.ranges, ranges)
+        self.assertEqual(self.cachemgr.stats.coalesced, coalesced)
+        self.assertEqual(self.stgy._blocks, {})
+
+    def testContained(self):
+        d = defer.gatherResults([self._request(0, 4096),
+                                 self._request(1000, 1000),
+                                 self._request(0, 4096)])
+        d.addCallback(self._checkRequests, [(0, 4096)], 2)
+        return d
+
+    def testOverlapping(self):
+        d = defer.gatherResults([self._request(1000, 1000),
+                                 self._request(3000, 1000),
+                                 self._request(0, 5000)])
+        d.addCallback(self._checkRequests,
+                      [(1000, 1000), (3000, 1000),
+                       (0, 1000), (2000, 1000), (4000, 1000)], 1)
+        return d
+
+    def testEndOfFile(self):
+        d = defer.gatherResults([self._request(BLOCK_SIZE - 100, 1000),
+                                 self._request(BLOCK_SIZE - 200, 2000),
+                                 self._request(BLOCK_SIZE + 10, 10)])
+        d.addCallback(self._checkRequests,
+                      [(BLOCK_SIZE - 100, 1000), (BLOCK_SIZE - 200, 100),
+                       (BLOCK_SIZE + 900, 900)], 2)
+        return d
+
+    def testSequential(self):
+        d = self._request(0, 1000)
+        d.addCallback(lambda _: self._request(0, 1000))
+        d.addCallback(self._checkRequests, [(0, 1000), (0, 1000)], 0)
+        return d
+
+    def testError(self):
+        self.reqmgr.available = False
+        d1 = self.stgy.requestData(self.url, 0, 1000, 42)
+        d2 = self.stgy.requestData(self.url, 500, 1000, 42)
+        d = defer.DeferredList([d1, d2], consumeErrors=True)
+
+        def check(results):
+            for success, result in results:
+                self.failIf(success)
+                result.trap(fileprovider.FileError)
+
+        d.addCallback(check)
+        # The missing part of the second request may not have failed yet
+        d.addCallback(wait, 0.05)
+        d.addCallback(lambda _: self.assertEqual(self.stgy._blocks, {}))
+        return d
+
+
+class TestRequestManager(TestCase):
+
+    def setUp(self):
+        self.servers = [server_selection.Server("10.0.0.1", 3128, 1),
+                        server_selection.Server("10.0.0.2", 3128, 2)]
+        self.client = DummyClient()
+        self.stats = DummyUpstreamStatistics()
+        self.reqmgr = request_manager.RequestManager(
+            DummySelector(self.servers), self.client, 1, self.stats)
+
+    def _retrieve(self, path):
+        consumer = DummyConsumer()
+        url = http_utils.Url.fromString("http://www.flumotion.com" + path)
+        return consumer, self.reqmgr.retrieve(consumer, url)
+
+    def _proxies(self):
+        return [(r.proxyAddress, r.url.path) for r in self.client.requests]
+
+    def testLimit(self):
+        c1, m1 = self._retrieve("/a")
+        c2, m2 = self._retrieve("/b")
+        c3, m3 = self._retrieve("/c")
+        self.assertEqual(self._proxies(), [("10.0.0.1", "/a"),
+                                           ("10.0.0.2", "/b")])
+        self.failUnless(m3.waiting)
+        self.assertEqual(self.reqmgr.getWaitingCount(), 1)
+        self.assertEqual(self.stats.usage, (2, 1))
+
+        m2.streamDone(self.client.requests[1])
+        self.assertEqual(c2.done, True)
+        self.failIf(m3.waiting)
+        self.assertEqual(self._proxies()[-1], ("10.0.0.2", "/c"))
+        self.assertEqual(self.stats.usage, (2, 0))
+        self.assertEqual(self.stats.requests, 3)
+        self.assertEqual(self.stats.queued, 1)
+
+        m1.streamDone(self.client.requests[0])
+        m3.streamDone(self.client.requests[2])
+        self.assertEqual(self.stats.usage, (0, 0))
+
+    def testPriority(self):
+        # A waiting request takes the first released server
+        c1, m1 = self._retrieve("/a")
+        c2, m2 = self._retrieve("/b")
+        c3, m3 = self._retrieve("/c")
+        c4, m4 = self._retrieve("/d")
+        m1.streamDone(self.client.requests[0])
+        self.assertEqual(self._proxies()[2:], [("10.0.0.1", "/c")])
+        self.failUnless(m4.waiting)
+        m3.conditionFail(self.client.requests[2],
+                         common.STREAM_MODIFIED, "Modified")
+        self.assertEqual(self._proxies()[3:], [("10.0.0.1", "/d")])
+        self.assertEqual(c3.errors, [common.STREAM_MODIFIED])
+
+    def testCancelWaiting(self):
+        c1, m1 = self._retrieve("/a")
+        c2, m2 = self._retrieve("/b")
+        c3, m3 = self._retrieve("/c")
+        m3.cancel()
+        self.assertEqual(self.reqmgr.getWaitingCount(), 0)
+        m1.cancel()
+        self.assertEqual(len(self.client.requests), 2)
+        self.assertEqual(self.reqmgr.getConnectionCount(), 1)
+
+    def testServerError(self):
+        # The connection is released before falling back
+        c1, m1 = self._retrieve("/a")
+        c2, m2 = self._retrieve("/b")
+        m1.serverError(self.client.requests[0],
+                       common.SERVER_UNAVAILABLE, "Unavailable")
+        self.failUnless(m1.waiting)
+        m2.streamDone(self.client.requests[1])
+        self.assertEqual(self._proxies()[2:], [("10.0.0.2", "/a")])
+        m1.serverError(self.client.requests[2],
+                       common.SERVER_UNAVAILABLE, "Unavailable")
+        self.assertEqual(c1.errors, [common.SERVER_UNAVAILABLE])
+        self.assertEqual(self.reqmgr.getConnectionCount(), 0)
+
+
 ######################################################################
 ##### Utility Functions and Dummy Classes
 ######################################################################
@@ -1602,7 +1755,10 @@ class DummyRequestStatistics(object):
 class DummyStatistics:
 
     def __init__(self):
-        pass
+        self.coalesced = 0
+
+    def onRequestCoalesced(self):
+        self.coalesced += 1
 
     def onCopyStarted(self):
         pass
@@ -1746,10 +1902,12 @@ class DummyReqMgr(object):
     def __init__(self, *resources):
         self.defs = dict([(r.path, r) for r in resources])
         self.resources = []
+        self.ranges = []
         self.calls = {}
 
     def reset(self):
         self.resources = []
+        self.ranges = []
         for _key, dc in self.calls.items():
             dc.cancel()
         self.calls = {}
@@ -1763,6 +1921,7 @@ class DummyReqMgr(object):
         if self.calls is None:
             return
 
+        self.ranges.append((start, size))
         req = DummyReq(self)
 
         if self.error_reset_countdown is not None:
@@ -1903,3 +2062,78 @@ class DummyReqMgr(object):
 
     def cleanup(self):
         pass
+
+
+class DummyUpstreamStatistics(object):
+
+    def __init__(self):
+        self.requests = 0
+        self.queued = 0
+        self.usage = (0, 0)
+
+    def onUpstreamRequest(self):
+        self.requests += 1
+
+    def onUpstreamQueued(self):
+        self.queued += 1
+
+    def onUpstreamUsage(self, connections, waiting):
+        self.usage = (connections, waiting)
+
+
+class DummySelector(object):
+
+    def __init__(self, servers):
+        self.servers = servers
+
+    def getServers(self):
+        return iter(self.servers)
+
+
+class DummyClientRequest(object):
+
+    def __init__(self, url, proxyAddress, proxyPort):
+        self.url = url
+        self.proxyAddress = proxyAddress
+        self.host = proxyAddress
+        self.port = proxyPort
+        self.canceled = False
+        self.logName = "DummyClientRequest"
+
+    def cancel(self):
+        self.canceled = True
+
+
+class DummyClient(object):
+
+    def __init__(self):
+        self.requests = []
+
+    def retrieve(self, consumer, url, proxyAddress=None, proxyPort=None,
+                 ifModifiedSince=None, ifUnmodifiedSince=None,
+                 start=None, size=None):
+        request = DummyClientRequest(url, proxyAddress, proxyPort)
+        self.requests.append(request)
+        return request
+
+    def cleanup(self):
+        pass
+
+
+class DummyConsumer(common.StreamConsumer):
+
+    def __init__(self):
+        self.done = False
+        self.errors = []
+
+    def serverError(self, getter, code, message):
+        self.errors.append(code)
+
+    def conditionFail(self, getter, code, message):
+        self.errors.append(code)
+
+    def streamNotAvailable(self, getter, code, message):
+        self.errors.append(code)
+
+    def streamDone(self, getter):
+        self.done = True
@@ -0,0 +1,230 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+import os
+import shutil
+import tempfile
+import time
+
+from flumotion.common import testsuite
+from flumotion.component.plugs import request
+
+
+def sessionArgs(uri='/a', t=None):
+    return {'ip': '10.0.0.1', 'time': t or time.gmtime(0),
+            'method': 'GET', 'uri': uri, 'username': '-',
+            'clientproto': 'HTTP/1.1', 'response': 200,
+            'bytes-sent': 1000, 'referer': None,
+            'user-agent': 'agent', 'time-connected': 2}
+
+
+class TestRequestLoggerFilePlug(testsuite.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.logfile = os.path.join(self.path, 'access.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def createPlug(self, **properties):
+        properties['logfile'] = self.logfile
+        plug = request.RequestLoggerFilePlug({'properties': properties})
+        plug.start()
+        return plug
+
+    def readLines(self, path=None):
+        return open(path or self.logfile).readlines()
+
+    def testApacheLine(self):
+        plug = self.createPlug()
+        plug.event('http_session_completed', sessionArgs())
+        self.assertEquals(self.readLines(),
+            ['10.0.0.1 - - [01/Jan/1970:00:00:00 +0000] "GET /a HTTP/1.1" '
+             '200 1000 None "agent" 2\n'])
+        plug.stop()
+
+    def testDateCache(self):
+        date = request._formatDate(time.gmtime(0))
+        self.assertEquals(date, '01/Jan/1970:00:00:00 +0000')
+        self.assertIdentical(request._formatDate(time.gmtime(0)), date)
+        self.assertEquals(request._formatDate(time.gmtime(1)),
+                          '01/Jan/1970:00:00:01 +0000')
+
+    def testBuffered(self):
+        plug = self.createPlug(buffered=True)
+        for i in range(100):
+            plug.event('http_session_completed', sessionArgs('/%d' % i))
+        writer = plug.writer
+        plug.stop()
+        lines = self.readLines()
+        self.assertEquals(len(lines), 100)
+        self.failUnless(lines[-1].startswith('10.0.0.1 - - ['))
+        self.failUnless('"GET /99 HTTP/1.1"' in lines[-1])
+        self.assertEquals(writer.written, 100)
+        self.assertEquals(writer.dropped, 0)
+
+    def testBufferedFlushSize(self):
+        plug = self.createPlug(buffered=True, **{'flush-size': 1,
+                                                 'flush-interval': 60.0})
+        plug.event('http_session_completed', sessionArgs())
+        # the line is written without waiting for the flush interval
+        for i in range(100):
+            if plug.writer.written:
+                break
+            time.sleep(0.01)
+        self.assertEquals(len(self.readLines()), 1)
+        plug.stop()
+
+    def testBufferedRotate(self):
+        plug = self.createPlug(buffered=True, **{'flush-interval': 60.0})
+        plug.event('http_session_completed', sessionArgs('/before'))
+        rotated = self.logfile + '.1'
+        os.rename(self.logfile, rotated)
+        plug.rotate()
+        plug.event('http_session_completed', sessionArgs('/after'))
+        plug.stop()
+        # the lines logged before rotating go to the previous file
+        lines = self.readLines(rotated)
+        self.assertEquals(len(lines), 1)
+        self.failUnless('/before' in lines[0])
+        lines = self.readLines()
+        self.assertEquals(len(lines), 1)
+        self.failUnless('/after' in lines[0])
+
+    def testBufferFull(self):
+        writer = request._BufferedLogWriter(open(self.logfile, 'a'),
+                                            self.logfile, bufferSize=2)
+        for i in range(5):
+            writer.write('line %d\n' % i)
+        self.assertEquals(writer.dropped, 3)
+        writer.start()
+        writer.stop()
+        self.assertEquals(writer.written, 2)
+        self.assertEquals(self.readLines(), ['line 0\n', 'line 1\n'])
+
+
+class TestRequestLoggerAggregatePlug(testsuite.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.logfile = os.path.join(self.path, 'access.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def createPlug(self, **properties):
+        properties['logfile'] = self.logfile
+        plug = request.RequestLoggerAggregatePlug({'properties': properties})
+        plug.start()
+        return plug
+
+    def logRequests(self, plug):
+        for i in range(10):
+            args = sessionArgs('/live/%d.ts?token=x' % i, time.gmtime(i / 4))
+            args['ip'] = '10.0.%d.%d' % (i % 2, i)
+            args['response'] = i == 9 and 404 or 200
+            plug.event('http_session_completed', args)
+        plug.event('http_session_completed', sessionArgs('/other'))
+
+    def readRecords(self):
+        return [request.json.loads(line)
+                for line in open(self.logfile).readlines()]
+
+    def testAggregate(self):
+        plug = self.createPlug(interval=2, **{'top-count': 1})
+        self.logRequests(plug)
+        plug.stop()
+        records = self.readRecords()
+        self.assertEquals(len(records), 2)
+        self.assertEquals(records[0],
+            {'type': 'aggregate', 'time': 0, 'interval': 2,
+             'requests': 9, 'bytes': 9000, 'responses': {'200': 9},
+             'mounts': [['/live', 8]], 'prefixes': [['10.0.0.0/24', 5]]})
+        self.assertEquals(records[1]['time'], 2)
+        self.assertEquals(records[1]['requests'], 2)
+        self.assertEquals(records[1]['responses'], {'200': 1, '404': 1})
+    if request.json is None:
+        testAggregate.skip = "json module not available"
+
+    def testSamples(self):
+        plug = self.createPlug(**{'sample-rate': 0.25})
+        self.logRequests(plug)
+        plug.stop()
+        samples = [record for record in self.readRecords()
+                   if record['type'] == 'request']
+        self.assertEquals([sample['uri'] for sample in samples],
+                          ['/live/3.ts?token=x', '/live/7.ts?token=x'])
+        self.assertEquals(samples[0]['ip'], '10.0.1.3')
+        self.assertEquals(samples[0]['time'], 0)
+        self.assertEquals(samples[0]['referer'], None)
+    if request.json is None:
+        testSamples.skip = "json module not available"
+
+    def testBinary(self):
+        plug = self.createPlug(format='binary', **{'sample-rate': 0.5})
+        self.logRequests(plug)
+        plug.stop()
+        # a rotated or restarted log file doesn't get a second header
+        plug.start()
+        plug.event('http_session_completed', sessionArgs(t=time.gmtime(9)))
+        plug.stop()
+        records = request.readBinaryLog(open(self.logfile, 'rb').read())
+        aggregates = [r for r in records if r['type'] == 'aggregate']
+        self.assertEquals([r['time'] for r in aggregates], [0, 1, 2, 9])
+        self.assertEquals(aggregates[2],
+            {'type': 'aggregate', 'time': 2, 'interval': 1,
+             'requests': 2, 'bytes': 2000,
+             'responses': {'200': 1, '404': 1}, 'mounts': [['/live', 2]],
+             'prefixes': [['10.0.0.0/24', 1], ['10.0.1.0/24', 1]]})
+        samples = [r for r in records if r['type'] == 'request']
+        self.assertEquals(len(samples), 5)
+        self.assertEquals(samples[0],
+            {'type': 'request', 'time': 0, 'ip': '10.0.1.1',
+             'method': 'GET', 'uri': '/live/1.ts?token=x', 'response': 200,
+             'bytes': 1000, 'time-connected': 2, 'referer': None,
+             'user-agent': 'agent'})
+
+    def testNonUTF8(self):
+        plug = self.createPlug(**{'sample-rate': 1.0})
+        args = sessionArgs('/\xe9t\xe9/a.ts')
+        args['user-agent'] = 'agent \xff'
+        plug.event('http_session_completed', args)
+        plug.event('http_session_completed', sessionArgs())
+        plug.stop()
+        records = self.readRecords()
+        self.assertEquals(records[0]['requests'], 2)
+        self.assertEquals(sorted(records[0]['mounts']),
+                          [[u'/a', 1], [u'/\ufffdt\ufffd', 1]])
+        self.assertEquals(records[1]['uri'], u'/\ufffdt\ufffd/a.ts')
+        self.assertEquals(records[1]['user-agent'], u'agent \ufffd')
+    if request.json is None:
+        testNonUTF8.skip = "json module not available"
+
+    def testIPPrefix(self):
+        self.assertEquals(request._ipPrefix('192.168.1.20', 16),
+                          '192.168.0.0/16')
+        self.assertEquals(request._ipPrefix('::ffff:192.168.1.20', 24),
+                          '192.168.1.0/24')
+        self.assertEquals(request._ipPrefix('2001:db8:1:2:3::1', 24),
+                          '2001:db8:1:2::/64')
+        self.assertEquals(request._ipPrefix('unknown', 24), 'unknown')
+
+    def testMountPoint(self):
+        self.assertEquals(request._mountPoint('/live/a/b.ts?x=/y'), '/live')
+        self.assertEquals(request._mountPoint('/stream.ogg'), '/stream.ogg')
+        self.assertEquals(request._mountPoint('/'), '/')
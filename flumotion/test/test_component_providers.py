@@ -17,23 +17,33 @@
 
 import os
 import shutil
+import socket
 import tempfile
+import threading
 
 from twisted.internet import defer, reactor
 from twisted.trial import unittest
-
 import twisted.copyright
-if twisted.copyright.version == "SVN-Trunk":
-    SKIP_MSG = "Twisted 2.0.1 thread pool is broken for tests"
-else:
-    SKIP_MSG = None
 
 from flumotion.common import testsuite
 from flumotion.component.misc.httpserver import localpath
 from flumotion.component.misc.httpserver import localprovider
 from flumotion.component.misc.httpserver import cachedprovider
+from flumotion.component.misc.httpserver import cachestats
+from flumotion.component.misc.httpserver import ioexecutor
+from flumotion.component.misc.httpserver import memorycache
 from flumotion.component.misc.httpserver.fileprovider \
-    import InsecureError, NotFoundError, CannotOpenError
+    import InsecureError, NotFoundError, CannotOpenError, FileClosedError
+
+try:
+    from flumotion.extern.sendfile import sendfile
+except ImportError:
+    sendfile = None
+
+if twisted.copyright.version == "SVN-Trunk":
+    SKIP_MSG = "Twisted 2.0.1 thread pool is broken for tests"
+else:
+    SKIP_MSG = None
 
 attr = testsuite.attr
 
@@ -238,6 +248,197 @@ class LocalPathLocalProvider(testsuite.TestCase):
         child = self.local.child('foo').child('bar')
         self.assertRaises(NotFoundError, child.open)
 
+    def testFileDescriptor(self):
+        f = self.local.child('a').open()
+        fd = f.getFileDescriptor()
+        self.assertEquals(os.fstat(fd).st_size, len('test file a'))
+        f.close()
+        self.assertRaises(FileClosedError, f.getFileDescriptor)
+
+    def testSendfile(self):
+        if sendfile is None:
+            raise unittest.SkipTest("sendfile module not built")
+        f = self.local.child('a').open()
+        a, b = socket.socketpair()
+        try:
+            sent = sendfile.sendfile(a.fileno(), f.getFileDescriptor(), 5, 100)
+            self.assertEquals(sent, len('file a'))
+            self.assertEquals(b.recv(100), 'file a')
+            # the file position is left alone
+            self.assertEquals(f.tell(), 0)
+        finally:
+            a.close()
+            b.close()
+            f.close()
+
+
+class FakeStats:
+
+    def __init__(self):
+        self.waits = []
+
+    def onIOWaited(self, seconds):
+        self.waits.append(seconds)
+
+
+class IOExecutorTest(testsuite.TestCase):
+
+    def setUp(self):
+        self.stats = FakeStats()
+        self.executor = ioexecutor.IOExecutor(2, self.stats)
+        self.executor.start()
+
+    def tearDown(self):
+        self.executor.stop()
+
+    def testOrderPerKey(self):
+        done = []
+        lock = threading.Lock()
+
+        def operation(key, i):
+            lock.acquire()
+            try:
+                done.append((key, i))
+            finally:
+                lock.release()
+            return i
+
+        dl = []
+        for i in range(10):
+            for key in ('a', 'b'):
+                dl.append(self.executor.submit(key, operation, key, i))
+        self.assertEquals(self.executor.pendingCount, 20)
+
+        def check(results):
+            self.assertEquals([r for s, r in results],
+                              [i for i in range(10) for key in 'ab'])
+            for key in 'ab':
+                self.assertEquals([i for k, i in done if k == key],
+                                  range(10))
+            self.assertEquals(self.executor.pendingCount, 0)
+            self.assertEquals(len(self.stats.waits), 20)
+        d = defer.DeferredList(dl)
+        d.addCallback(check)
+        return d
+
+    def testFailure(self):
+        d = self.executor.submit('a', int, 'not a number')
+        return self.failUnlessFailure(d, ValueError)
+
+    def testStopped(self):
+        # operations run synchronously when the pool is not running
+        self.executor.stop()
+        results = []
+        d = self.executor.submit('a', len, 'abc')
+        d.addCallback(results.append)
+        self.assertEquals(results, [3])
+
+
+class LocalFileIOExecutorTest(testsuite.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(suffix=".flumotion.test")
+        self.data = ''.join([chr(i % 256) for i in range(100000)])
+        open(os.path.join(self.path, 'a'), "w").write(self.data)
+        self.executor = ioexecutor.IOExecutor(2)
+        self.executor.start()
+        self.local = localprovider.LocalPath(self.path, self.executor)
+
+    def tearDown(self):
+        self.executor.stop()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def readAll(self, f, size):
+        chunks = []
+        d = defer.Deferred()
+
+        def gotData(data):
+            chunks.append(data)
+            if data:
+                f.read(size).addCallbacks(gotData, d.errback)
+            else:
+                d.callback(''.join(chunks))
+        f.read(size).addCallbacks(gotData, d.errback)
+        return d
+
+    def testRead(self):
+        f = self.local.child('a').open()
+        d = self.readAll(f, 4096)
+
+        def check(data):
+            self.assertEquals(data, self.data)
+            self.assertEquals(f.tell(), len(self.data))
+            f.close()
+        d.addCallback(check)
+        return d
+
+    def testSeek(self):
+        f = self.local.child('a').open()
+        d = f.read(1000)
+
+        def seekAndRead(data):
+            self.assertEquals(data, self.data[:1000])
+            # throws away the data read ahead
+            f.seek(50000)
+            self.assertEquals(f.tell(), 50000)
+            return f.read(1000)
+
+        def check(data):
+            self.assertEquals(data, self.data[50000:51000])
+            self.assertEquals(f.tell(), 51000)
+            f.close()
+            self.assertRaises(FileClosedError, f.tell)
+        d.addCallback(seekAndRead)
+        d.addCallback(check)
+        return d
+
+
+class MemoryCacheTest(testsuite.TestCase):
+
+    def setUp(self):
+        self.stats = cachestats.CacheStatistics()
+        self.memory = memorycache.MemoryCache(self.stats, 10, 4)
+
+    def testGet(self):
+        self.failUnless(self.memory.put('a', 1, 'foo'))
+        self.assertEqual(self.memory.get('a', 1, 3), 'foo')
+        self.assertEqual(self.memory.get('b', 1, 3), None)
+        self.assertEqual(self.memory.usage, 3)
+
+    def testOutdated(self):
+        self.memory.put('a', 1, 'foo')
+        self.assertEqual(self.memory.get('a', 2, 3), None)
+        # outdated entries are dropped
+        self.assertEqual(self.memory.get('a', 1, 3), None)
+        self.assertEqual(self.memory.usage, 0)
+
+    def testTooBig(self):
+        self.failIf(self.memory.put('a', 1, 'fooba'))
+        self.assertEqual(len(self.memory), 0)
+
+    def testEvictLeastRecentlyUsed(self):
+        self.memory.put('a', 1, 'aaaa')
+        self.memory.put('b', 1, 'bbbb')
+        self.memory.get('a', 1, 4)
+        self.memory.put('c', 1, 'cccc')
+        self.assertEqual(self.memory.get('b', 1, 4), None)
+        self.assertEqual(self.memory.get('a', 1, 4), 'aaaa')
+        self.assertEqual(self.memory.get('c', 1, 4), 'cccc')
+        self.assertEqual(self.memory.usage, 8)
+        self.assertEqual(self.stats.memoryEvictionCount, 1)
+
+    def testReplace(self):
+        self.memory.put('a', 1, 'aaaa')
+        self.memory.put('a', 2, 'aa')
+        self.assertEqual(self.memory.get('a', 2, 2), 'aa')
+        self.assertEqual(self.memory.usage, 2)
+
+    def testClear(self):
+        self.memory.put('a', 1, 'aaaa')
+        self.memory.clear()
+        self.assertEqual(self.memory.get('a', 1, 4), None)
+        self.assertEqual(self.memory.usage, 0)
+
 
 class CachedProviderFileTest(testsuite.TestCase):
 
@@ -319,6 +520,93 @@ class CachedProviderFileTest(testsuite.TestCase):
                           self.failUnlessEqual(self.data, data))
         return d
 
+    def testFileDescriptorWhileCaching(self):
+        # the temporary file is still being written, it can't be sent
+        d = self.openFile('a')
+        d.addCallback(lambda f: f.getFileDescriptor())
+        d.addCallback(pass_through, self.close)
+
+        d.addCallback(self.assertIdentical, None)
+        return d
+
+    @attr('slow')
+    def testMemoryCache(self):
+        self.fileProviderPlug.memory = memorycache.MemoryCache(
+            self.fileProviderPlug.stats, 1000, 100)
+        statuses = []
+
+        def readAgain(_):
+            d = self.openFile('a')
+            d.addCallback(lambda f: statuses.append(
+                f.getLogFields()['cache-status']))
+            d.addCallback(self.readFile, self.dataSize)
+            d.addCallback(pass_through, self.close)
+            return d
+
+        d = readAgain(None)
+        # wait for the file to be copied to the disk cache
+        d.addCallback(delay, 1)
+        d.addCallback(readAgain)
+        d.addCallback(readAgain)
+
+        def check(data):
+            self.assertEqual(data, self.data)
+            self.assertEqual(statuses,
+                             ['cache-miss', 'cache-hit', 'memory-hit'])
+            self.assertEqual(self.fileProviderPlug.stats.memoryHitCount, 1)
+            self.assertEqual(self.fileProviderPlug.stats.memoryMissCount, 2)
+        d.addCallback(check)
+        return d
+
+    def testMemoryCacheModifySrc(self):
+        self.fileProviderPlug.memory = memorycache.MemoryCache(
+            self.fileProviderPlug.stats, 1000, 100)
+        self.fileProviderPlug.memory.put(self.testFileName, 1, self.data)
+        newData = "bar foo"
+        self.createFile('a', newData)
+
+        d = self.openFile('a')
+        d.addCallback(self.readFile, self.dataSize)
+        d.addCallback(pass_through, self.close)
+
+        d.addCallback(self.assertEqual, newData)
+        return d
+
+    def testMemoryCacheTouch(self):
+        self.fileProviderPlug.memory = memorycache.MemoryCache(
+            self.fileProviderPlug.stats, 1000, 100)
+        self.fileProviderPlug.memory.put(self.testFileName, 1, self.data)
+        cache = self.fileProviderPlug.cache
+        name = cache.getIdentifier(self.testFileName)
+        cache._index.add(name, self.dataSize, 1000)
+
+        d = self.openFile('a')
+        d.addCallback(self.readFile, self.dataSize)
+        d.addCallback(pass_through, self.close)
+
+        def check(data):
+            self.assertEqual(data, self.data)
+            self.failUnless(cache._index._atimes[name] > 1000)
+        d.addCallback(check)
+        return d
+
+    def testMemoryCacheTouchEvicted(self):
+        self.fileProviderPlug.memory = memorycache.MemoryCache(
+            self.fileProviderPlug.stats, 1000, 100)
+        self.fileProviderPlug.memory.put(self.testFileName, 1, self.data)
+        cache = self.fileProviderPlug.cache
+        name = cache.getIdentifier(self.testFileName)
+
+        d = self.openFile('a')
+        d.addCallback(self.readFile, self.dataSize)
+        d.addCallback(pass_through, self.close)
+
+        def check(data):
+            self.assertEqual(data, self.data)
+            self.failIf(name in cache._index)
+        d.addCallback(check)
+        return d
+
     def getCachePath(self, path):
         return self.fileProviderPlug.cache.getCachePath(path)
 
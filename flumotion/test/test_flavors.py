@@ -81,6 +81,16 @@ class TestRoot(testsuite.TestManagerRoot):
     def remote_haveAdopted(self, name):
         return self.state.remove('children', name)
 
+    def remote_familyReunion(self):
+        self.state.beginBatch()
+        self.state.set('name', 'clark')
+        self.state.append('children', 'robin')
+        self.state.setitem('nationalities', 'clark', 'krypton')
+        self.state.append('children', 'batman')
+        self.state.remove('children', 'robin')
+        self.state.set('name', 'superman')
+        return self.state.commitBatch()
+
 
 class StateTest(testsuite.TestCase):
 
@@ -118,6 +128,14 @@ class StateTest(testsuite.TestCase):
         d = self.sport.stopListening()
         return d
 
+    def listen(self, state):
+
+        def event(type):
+            return lambda *x: self.changes.append((type, ) + x)
+        state.addListener(self, set_=event('set'), append=event('append'),
+                          remove=event('remove'), setitem=event('setitem'),
+                          delitem=event('delitem'))
+
 
 class TestStateSet(StateTest):
 
@@ -187,14 +205,6 @@ class TestStateSet(StateTest):
         d.addCallback(got_state_and_stop)
         return d
 
-    def listen(self, state):
-
-        def event(type):
-            return lambda *x: self.changes.append((type, ) + x)
-        state.addListener(self, set_=event('set'), append=event('append'),
-                          remove=event('remove'), setitem=event('setitem'),
-                          delitem=event('delitem'))
-
     # listener tests
 
     def testStateSetListener(self):
@@ -383,6 +393,231 @@ class TestFullListener(StateTest):
         return d
 
 
+class TestStateBatch(StateTest):
+
+    def testBatch(self):
+        d = self.runClient()
+        d.addCallback(lambda _: self.perspective.callRemote('getState'))
+
+        def add_listener_and_reunite(state):
+            d.state = state # monkeypatch
+            self.listen(state)
+            return self.perspective.callRemote('familyReunion')
+
+        def check_results(_):
+            self.assertEquals(d.state.get('name'), 'superman')
+            self.assertEquals(d.state.get('children'), ['batman'])
+            self.assertEquals(d.state.get('nationalities'),
+                              {'clark': 'krypton'})
+            # only the last set of a key is sent, in its place
+            self.assertEquals(self.changes, [
+                ('append', d.state, 'children', 'robin'),
+                ('setitem', d.state, 'nationalities', 'clark', 'krypton'),
+                ('append', d.state, 'children', 'batman'),
+                ('remove', d.state, 'children', 'robin'),
+                ('set', d.state, 'name', 'superman')])
+            return self.stopClient()
+
+        d.addCallback(add_listener_and_reunite)
+        d.addCallback(check_results)
+        return d
+
+
+class TestStateProxy(flavors.StateCacheable, flavors.StateRemoteCache):
+    pass
+
+
+class FakeObserver:
+
+    def __init__(self):
+        self.calls = []
+
+    def callRemote(self, name, *args):
+        self.calls.append((name, ) + args)
+        return defer.succeed(None)
+
+
+class TestStateBatchLocal(testsuite.TestCase):
+
+    def setUp(self):
+        self.state = flavors.StateCacheable()
+        self.state.addKey('name')
+        self.state.addListKey('children')
+        self.observer = FakeObserver()
+        self.state.getStateToCacheAndObserveFor(None, self.observer)
+
+    def testUnbatched(self):
+        self.state.set('name', 'lois')
+        self.state.set('name', 'clark')
+        self.assertEquals(self.observer.calls, [('set', 'name', 'lois'),
+                                                ('set', 'name', 'clark')])
+
+    def testNested(self):
+        fired = []
+        self.state.beginBatch()
+        self.state.set('name', 'lois')
+        self.state.beginBatch()
+        self.state.append('children', 'robin')
+        self.state.commitBatch().addCallback(fired.append)
+        self.assertEquals(self.observer.calls, [])
+        self.assertEquals(fired, [])
+        self.state.commitBatch()
+        self.assertEquals(self.observer.calls, [
+            ('batch', [('set', 'name', 'lois'),
+                       ('append', 'children', 'robin')])])
+        self.assertEquals(len(fired), 1)
+
+    def testSingleChange(self):
+        batch = self.state.batch()
+        batch.__enter__()
+        self.state.set('name', 'lois')
+        self.state.set('name', 'clark')
+        batch.__exit__(None, None, None)
+        self.assertEquals(self.observer.calls, [('set', 'name', 'clark')])
+
+    def testSetAroundChanges(self):
+        # a set followed by other changes of its key is still sent
+        self.state.addKey('sidekicks')
+        cache = TestStateRemoteCache()
+        cache._dict = {'sidekicks': None}
+        self.state.beginBatch()
+        self.state.set('sidekicks', [])
+        self.state.append('sidekicks', 'robin')
+        self.state.set('sidekicks', ['batgirl'])
+        self.state.commitBatch()
+        changes = [('set', 'sidekicks', []),
+                   ('append', 'sidekicks', 'robin'),
+                   ('set', 'sidekicks', ['batgirl'])]
+        self.assertEquals(self.observer.calls, [('batch', changes)])
+        cache.observe_batch(changes)
+        self.assertEquals(cache.get('sidekicks'), ['batgirl'])
+
+    def testNewObserver(self):
+        self.state.beginBatch()
+        self.state.set('name', 'lois')
+        observer = FakeObserver()
+        self.state.getStateToCacheAndObserveFor(None, observer)
+        self.state.set('name', 'clark')
+        self.state.commitBatch()
+        self.assertEquals(self.observer.calls, [('set', 'name', 'lois'),
+                                                ('set', 'name', 'clark')])
+        self.assertEquals(observer.calls, [('set', 'name', 'clark')])
+
+    def testBatchUpdates(self):
+        self.state.batchUpdates = True
+        self.state.set('name', 'lois')
+        d = self.state.append('children', 'robin')
+        self.assertEquals(self.observer.calls, [])
+
+        def check(_):
+            self.assertEquals(self.observer.calls, [
+                ('batch', [('set', 'name', 'lois'),
+                           ('append', 'children', 'robin')])])
+        d.addCallback(check)
+        return d
+
+    def testProxy(self):
+        proxy = TestStateProxy()
+        proxy._dict = {'name': None, 'children': []}
+        observer = FakeObserver()
+        proxy.getStateToCacheAndObserveFor(None, observer)
+        changes = [('set', 'name', 'lois'), ('append', 'children', 'robin')]
+        proxy.observe_batch(changes)
+        self.assertEquals(proxy.get('children'), ['robin'])
+        self.assertEquals(observer.calls, [('batch', changes)])
+
+    def testUnknownChange(self):
+        cache = TestStateRemoteCache()
+        cache._dict = {'name': None}
+        self.assertRaises(ValueError, cache.observe_batch,
+                          [('set', 'name', 'lois'), ('explode', 'name')])
+
+
+class TestStatePublisher(testsuite.TestCase):
+
+    def setUp(self):
+        self.state = flavors.StateCacheable()
+        self.state.addKey('name')
+        self.state.addKey('bitrate', 0)
+        self.state.addDictKey('stats')
+        self.observer = FakeObserver()
+        self.publisher = flavors.StatePublisher(self.state)
+
+    def tearDown(self):
+        self.publisher.stop()
+
+    def observe(self):
+        self.state.getStateToCacheAndObserveFor(None, self.observer)
+
+    def wait(self, timeout):
+        d = defer.Deferred()
+        reactor.callLater(timeout, d.callback, None)
+        return d
+
+    def testUnobserved(self):
+        self.publisher.update('name', 'lois')
+        self.publisher.update('bitrate', 1000)
+        self.assertEquals(self.state.get('name'), None)
+        self.observe()
+        # published once the observer got the state
+        self.assertEquals(self.observer.calls, [])
+        d = self.wait(0)
+
+        def check(_):
+            self.assertEquals(self.state.get('name'), 'lois')
+            self.assertEquals(self.state.get('bitrate'), 1000)
+            self.assertEquals(len(self.observer.calls), 1)
+            self.assertEquals(self.observer.calls[0][0], 'batch')
+        d.addCallback(check)
+        return d
+
+    def testUnchanged(self):
+        self.observe()
+        self.publisher.update('name', 'lois')
+        self.publisher.update('name', 'lois')
+        self.assertEquals(self.observer.calls, [('set', 'name', 'lois')])
+
+    def testMinChange(self):
+        self.publisher.setPolicy('bitrate', minChange=0.1)
+        self.publisher.setPolicy('name', minChange=0.1)
+        self.observe()
+        self.publisher.update('bitrate', 1000)
+        self.publisher.update('bitrate', 1050)
+        self.publisher.update('bitrate', 1100)
+        self.publisher.update('name', 'lois')
+        self.publisher.update('name', 'clark')
+        self.assertEquals(self.observer.calls, [('set', 'bitrate', 1000),
+                                                ('set', 'bitrate', 1100),
+                                                ('set', 'name', 'lois'),
+                                                ('set', 'name', 'clark')])
+
+    def testMinInterval(self):
+        self.publisher.setPolicy('bitrate', minInterval=0.05)
+        self.observe()
+        self.publisher.update('bitrate', 1)
+        self.publisher.update('bitrate', 2)
+        self.publisher.update('bitrate', 3)
+        self.assertEquals(self.observer.calls, [('set', 'bitrate', 1)])
+        self.assertEquals(self.state.get('bitrate'), 1)
+        d = self.wait(0.1)
+
+        def check(_):
+            # the latest value is published when the interval is over
+            self.assertEquals(self.observer.calls, [('set', 'bitrate', 1),
+                                                    ('set', 'bitrate', 3)])
+        d.addCallback(check)
+        return d
+
+    def testDictKey(self):
+        self.publisher.stop()
+        self.publisher = flavors.StatePublisher(self.state, 'stats')
+        self.observe()
+        self.publisher.update('hits', 1)
+        self.assertEquals(self.state.get('stats'), {'hits': 1})
+        self.assertEquals(self.observer.calls,
+                          [('setitem', 'stats', 'hits', 1)])
+
+
 class TestState(testsuite.TestCase):
 
     def testStateAddKey(self):
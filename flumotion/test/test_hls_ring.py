@@ -120,6 +120,50 @@ http://localhost:8000/fragment-5.webm?GKID=%s
         self.assertEqual(self.ring._renderStreamPlaylist(args),
                 self.STREAM_WITH_GKID_PLAYLIST % tuple(5*[ID]))
 
+    def testPlaylistUpdated(self):
+        self.ring._hostname = 'http://localhost:8000/'
+        self.ring.title = 'Title'
+        for i in range(5):
+            self.ring.addFragment('', i, 2)
+        first = self.ring.renderPlaylist('stream.m3u8', {})
+        self.assertEqual(self.ring.renderPlaylist('stream.m3u8', {}), first)
+        self.ring.addFragment('', 5, 2)
+        self.assertEqual(self.ring.renderPlaylist('stream.m3u8', {}),
+                self.STREAM_PLAYLIST)
+        self.ring.setAllowCache(False)
+        self.assertEqual(self.ring.renderPlaylist('stream.m3u8', {}),
+                self.STREAM_PLAYLIST.replace('CACHE:YES', 'CACHE:NO'))
+
+    def testPlaylistArgs(self):
+        self.ring._hostname = 'http://localhost:8000/'
+        self.ring.title = 'Title'
+        for i in range(6):
+            self.ring.addFragment('', i, 2)
+        for ID in ('1', '2'):
+            args = {'GKID': [ID], 'FLUREQID': ['3']}
+            self.assertEqual(self.ring.renderPlaylist('stream.m3u8', args),
+                    self.STREAM_WITH_GKID_PLAYLIST % tuple(5*[ID]))
+        self.assertEqual(self.ring.renderPlaylist('live.m3u8', {'a': ['b']}),
+                self.MAIN_PLAYLIST.replace('.m3u8', '.m3u8?a=b'))
+        self.assertRaises(hlsring.PlaylistNotFound,
+                self.ring.renderPlaylist, 'other.m3u8', {})
+
+    def testTargetDuration(self):
+        durations = [4, 3, 5, 3, 6, 7, 8, 9, 10]
+        for i, duration in enumerate(durations):
+            self.ring.addFragment('', i, duration)
+            window = durations[max(0, i - 4):i + 1]
+            self.assertEqual(self.ring._getTargetDuration(), min(window))
+
+    def testDiscontinuity(self):
+        self.ring._hostname = 'http://localhost:8000/'
+        self.ring.title = 'Title'
+        for i in (1, 2, 4):
+            self.ring.addFragment('', i, 2)
+        playlist = self.ring.renderPlaylist('stream.m3u8', {})
+        self.assert_('fragment-2.webm\n#EXT-X-DISCONTINUITY\n#EXTINF'
+                in playlist)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,238 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_http_authcache -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+from twisted.internet import defer, task
+
+from flumotion.common import errors, keycards, timerwheel
+from flumotion.common import testsuite
+from flumotion.component.base import http
+
+
+class FakeTransport:
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def fileno(self):
+        return self.fd
+
+
+class FakeRequest:
+    method = 'GET'
+
+    def __init__(self, fd, user='fakeuser', passwd='fakepasswd',
+                 ip='10.0.0.1', path='/'):
+        self.transport = FakeTransport(fd)
+        self.user = user
+        self.passwd = passwd
+        self.ip = ip
+        self.path = path
+        self.args = {}
+
+    def getUser(self):
+        return self.user
+
+    def getPassword(self):
+        return self.passwd
+
+    def getClientIP(self):
+        return self.ip
+
+
+class FakeMedium:
+    # this medium allows HTTP auth with fakeuser/fakepasswd
+
+    def __init__(self):
+        self.calls = 0
+
+    def authenticate(self, bouncerName, keycard):
+        self.calls += 1
+        if keycard.username == 'fakeuser' and keycard.password == 'fakepasswd':
+            keycard.id = 'keycard-%d' % self.calls
+            keycard.state = keycards.AUTHENTICATED
+            return defer.succeed(keycard)
+        return defer.succeed(None)
+
+    def removeKeycardId(self, bouncerName, keycardId):
+        self.removed.append(keycardId)
+        return defer.succeed(None)
+
+
+class FakeComponent:
+
+    def __init__(self):
+        self.medium = FakeMedium()
+        self.medium.removed = []
+        self.plugs = {}
+        self.removed = []
+
+    def getName(self):
+        return 'fake'
+
+    def remove_client(self, fd):
+        self.removed.append(fd)
+
+
+class TestAuthenticationCache(testsuite.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cache = http.AuthenticationCache(10, size=3, negativeTTL=2,
+                                              clock=self.clock)
+
+    def keycard(self, id):
+        keycard = keycards.KeycardGeneric()
+        keycard.id = id
+        return keycard
+
+    def testLookup(self):
+        self.assertEquals(self.cache.lookup('a'), (False, None))
+        keycard = self.keycard('ka')
+        self.cache.store('a', keycard)
+        self.cache.store('b', None)
+        self.assertEquals(self.cache.lookup('a'), (True, keycard))
+        self.assertEquals(self.cache.lookup('b'), (True, None))
+        self.clock.advance(3)
+        # refusals are remembered for less time
+        self.assertEquals(self.cache.lookup('a'), (True, keycard))
+        self.assertEquals(self.cache.lookup('b'), (False, None))
+        self.clock.advance(8)
+        self.assertEquals(self.cache.lookup('a'), (False, None))
+        self.assertEquals(len(self.cache), 0)
+
+        stats = self.cache.getStats()
+        self.assertEquals(stats['hits'], 3)
+        self.assertEquals(stats['misses'], 3)
+        self.assertEquals(stats['hit-ratio'], 0.5)
+
+    def testSize(self):
+        for key in 'abcd':
+            self.cache.store(key, self.keycard('k' + key))
+        self.assertEquals(len(self.cache), 3)
+        self.assertEquals(self.cache.lookup('a'), (False, None))
+        # storing again makes an entry the newest
+        self.cache.store('b', self.keycard('kb'))
+        self.cache.store('e', None)
+        self.assertEquals(self.cache.lookup('c')[0], False)
+        self.assertEquals(self.cache.lookup('b')[0], True)
+
+    def testInvalidate(self):
+        self.cache.store('a', self.keycard('ka'))
+        self.failIf(self.cache.invalidate('kb'))
+        self.failUnless(self.cache.invalidate('ka'))
+        self.assertEquals(self.cache.lookup('a'), (False, None))
+        self.failIf(self.cache.invalidate('ka'))
+
+
+class TestHTTPAuthenticationCache(testsuite.TestCase):
+
+    def setUp(self):
+        self.component = FakeComponent()
+        self.httpauth = http.HTTPAuthentication(self.component)
+        self.httpauth.setBouncerName('fakebouncer')
+        self.clock = task.Clock()
+        self.httpauth.enableCache(60, clock=self.clock)
+        self.httpauth._timerWheel = timerwheel.TimerWheel(clock=self.clock)
+
+    def authenticate(self, request):
+        result = []
+        d = self.httpauth.authenticate(request)
+        d.addCallback(result.append)
+        self.httpauth._authenticatedCallback(result[0], request)
+        return result[0]
+
+    def testCached(self):
+        first = self.authenticate(FakeRequest(10))
+        second = self.authenticate(FakeRequest(11, path='/fragment-2.ts'))
+        self.assertEquals(self.component.medium.calls, 1)
+        self.assertEquals(second.state, keycards.AUTHENTICATED)
+        self.assertEquals(second.path, '/fragment-2.ts')
+        self.assertNotEquals(second.id, first.id)
+
+        self.assertEquals(self.authenticate(
+            FakeRequest(12, ip='10.0.0.2')).id, 'keycard-2')
+        self.assertEquals(self.component.medium.calls, 2)
+        stats = self.httpauth.getCacheStats()
+        self.assertEquals((stats['hits'], stats['misses']), (1, 2))
+
+        # the bouncer is only asked to remove the keycards it knows, once
+        # they can't be copied anymore
+        self.httpauth.cleanupAuth(11)
+        self.httpauth.cleanupAuth(10)
+        self.assertEquals(self.component.medium.removed, [])
+        self.clock.advance(60)
+        self.assertEquals(self.component.medium.removed, [first.id])
+
+    def testNegative(self):
+        request = FakeRequest(10, passwd='wrong')
+        self.assertRaises(errors.NotAuthenticatedError, self.authenticate,
+                          request)
+        self.assertRaises(errors.NotAuthenticatedError, self.authenticate,
+                          request)
+        self.assertEquals(self.component.medium.calls, 1)
+
+    def testExpire(self):
+        first = self.authenticate(FakeRequest(10))
+        self.authenticate(FakeRequest(11))
+        self.authenticate(FakeRequest(12))
+        # the client authorized by the bouncer left
+        self.httpauth.cleanupAuth(10)
+        self.assertEquals(self.httpauth.expireKeycards([first.id]), 2)
+        self.component.removed.sort()
+        self.assertEquals(self.component.removed, [11, 12])
+
+        self.authenticate(FakeRequest(13))
+        self.assertEquals(self.component.medium.calls, 2)
+
+    def testKeptForCopies(self):
+        first = self.authenticate(FakeRequest(10))
+        self.authenticate(FakeRequest(11))
+        self.httpauth.cleanupAuth(10)
+        self.clock.advance(60)
+        # a client copied from it is still connected
+        self.assertEquals(self.component.medium.removed, [])
+        self.httpauth.cleanupAuth(11)
+        self.assertEquals(self.component.medium.removed, [first.id])
+        self.authenticate(FakeRequest(12))
+        self.assertEquals(self.component.medium.calls, 2)
+
+    def testExpiredAfterClientLeft(self):
+        first = self.authenticate(FakeRequest(10))
+        self.authenticate(FakeRequest(11))
+        self.httpauth.cleanupAuth(10)
+        # the bouncer still knows the keycard, and can expire its copies
+        self.assertEquals(self.httpauth.expireKeycards([first.id]), 1)
+        self.assertEquals(self.component.removed, [11])
+        self.clock.advance(60)
+        self.assertEquals(self.component.medium.removed, [])
+
+    def testRemainingDuration(self):
+        medium = self.component.medium
+        authenticate = medium.authenticate
+
+        def limited(bouncerName, keycard):
+            d = authenticate(bouncerName, keycard)
+            keycard.duration = 30
+            return d
+        medium.authenticate = limited
+        self.authenticate(FakeRequest(10))
+        self.clock.advance(20)
+        self.assertEquals(self.authenticate(FakeRequest(11)).duration, 10)
+        self.clock.advance(10)
+        # the authorization ran out, the bouncer is asked again
+        self.assertEquals(self.authenticate(FakeRequest(12)).duration, 30)
+        self.assertEquals(medium.calls, 2)
@@ -41,6 +41,23 @@ class TestLogFilter(testsuite.TestCase):
         self.failIf(filter.isInRange("192.168.0.200"))
         self.failIf(filter.isInRange("127.0.0.2"))
 
+    def testIPv6Filter(self):
+        filter = http.LogFilter()
+        filter.addIPFilter("2001:db8::/32")
+        filter.addIPFilter("192.168.1.0/24")
+
+        self.failUnless(filter.isInRange("2001:db8::1"))
+        self.failUnless(filter.isInRange("::ffff:192.168.1.1"))
+        self.failIf(filter.isInRange("2001:db9::1"))
+        self.failIf(filter.isInRange("::1"))
+
+    def testUnmaskedFilter(self):
+        filter = http.LogFilter()
+        filter.addIPFilter("192.168.1.1/24")
+        filter.addIPFilter("192.168.1.0/24")
+
+        self.failUnless(filter.isInRange("192.168.1.200"))
+
     def testParseFailure(self):
         filter = http.LogFilter()
         self.assertRaises(errors.ConfigError, filter.addIPFilter, "192.12")
@@ -48,3 +65,7 @@ class TestLogFilter(testsuite.TestCase):
             "192.168.0.0/33")
         self.assertRaises(errors.ConfigError, filter.addIPFilter,
             "192.168.0.0/30/1")
+        self.assertRaises(errors.ConfigError, filter.addIPFilter,
+            "2001:db8::/129")
+        self.assertRaises(errors.ConfigError, filter.addIPFilter,
+            "2001:db8::g")
@@ -16,6 +16,7 @@
 # Headers in this file shall remain intact.
 
 
+import random
 from StringIO import StringIO
 from twisted.internet import defer
 
@@ -646,3 +647,90 @@ class TestComponentHeaven(testsuite.TestCase):
                             (cA, [('default-prime', '/a/comp9:default',
                                    '127.0.0.1', 1032)], [])], *without(c9, cA))
         self.resetEatFeed(c9, cA)
+
+
+class TestFeedMap(testsuite.TestCase):
+
+    def makeComponents(self):
+        # producers, some of them also providing virtual feeds, and
+        # eaters of real and virtual feeds, in two flows
+        comps = []
+        for flow in 'a', 'b':
+            for i in range(4):
+                vfeeds = []
+                if i % 2:
+                    vfeeds = [('vcomp', 'vfeed', 'default')]
+                comps.append(fca(flow, 'prod%d' % i, vfeeds=vfeeds))
+            for i in range(6):
+                eaters = {'default': [('prod%d:default' % (i % 4),
+                                       'default-prime')],
+                          'virtual': [('vcomp:vfeed', 'virtual-prime')]}
+                comps.append(fca(flow, 'eat%d' % i, eaters=eaters))
+        return comps
+
+    def rebuild(self, attached):
+        # map all the feeds from scratch, in attaching order
+        feeds = {}
+        for comp in attached:
+            for feederName in comp.getFeeders():
+                feeds.setdefault(comp.getFullFeedId(feederName), []).append(
+                    (comp, feederName))
+            for ffid, pair in comp.getVirtualFeeds().items():
+                feeds.setdefault(ffid, []).append(pair)
+        ffe = {}
+        eff = []
+        deps = []
+        for eater in attached:
+            for pairs in eater.getEaters().values():
+                for feedId, eName in pairs:
+                    compName, feedName = common.parseFeedId(feedId)
+                    ffid = common.fullFeedId(eater.getParentName(),
+                                             compName, feedName)
+                    if ffid in feeds:
+                        feeder, fName = feeds[ffid][0]
+                        ffe[eater.getFullFeedId(eName)] = (eName, feeder,
+                                                           fName)
+                        eff.append((feeder.getFullFeedId(fName),
+                                    (fName, eater, eName)))
+                        deps.append((feeder, (eater, ffid)))
+        return ffe, self.sorted(eff), self.sorted(deps)
+
+    def sorted(self, items):
+        items = list(items)
+        items.sort(key=repr)
+        return items
+
+    def flatten(self, dictlist):
+        return self.sorted([(key, value)
+                            for key, values in dictlist.items()
+                            for value in values])
+
+    def assertMapped(self, feedMap, attached):
+        ffe, eff, deps = self.rebuild(attached)
+        self.assertEquals(feedMap.feedersForEaters, ffe)
+        self.assertEquals(self.flatten(feedMap.eatersForFeeders), eff)
+        self.assertEquals(self.flatten(feedMap.feedDeps), deps)
+
+    def testIncremental(self):
+        rand = random.Random(0)
+        comps = self.makeComponents()
+        feedMap = component.FeedMap()
+        attached = []
+        for i in range(200):
+            comp = rand.choice(comps)
+            if comp in attached:
+                # the other eaters the component fed
+                fed = [dep for feeder, dep in self.rebuild(attached)[2]
+                       if feeder is comp and dep[0] is not comp]
+                attached.remove(comp)
+                ret = feedMap.componentDetached(comp)
+                self.assertEquals(self.sorted(ret), fed)
+            else:
+                feedMap.componentAttached(comp)
+                attached.append(comp)
+            self.assertMapped(feedMap, attached)
+        for comp in attached[:]:
+            feedMap.componentDetached(comp)
+            attached.remove(comp)
+        self.assertMapped(feedMap, [])
+        self.assertEquals(feedMap.feeds, {})
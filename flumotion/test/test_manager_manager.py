@@ -659,6 +659,49 @@ class TestVishnu(testsuite.TestCase):
         d.addCallback(verifyMappersIsZero)
         return d
 
+    def testFeedMapLogout(self):
+        # components logging out are removed from the feed map, even
+        # though their avatars no longer know their flow by then
+        producerId = '/testflow/producer-video-test'
+        converterId = '/testflow/converter-ogg-theora'
+        __thisdir = os.path.dirname(os.path.abspath(__file__))
+        file = os.path.join(__thisdir, 'test.xml')
+
+        def loadConfig(workerAvatar):
+            d = self.vishnu.loadComponentConfigurationXML(
+                file, manager.LOCAL_IDENTITY)
+            d.addCallback(
+                lambda _: workerAvatar.mind.waitForComponentsCreate())
+            d.addCallback(lambda _: self._verifyConfigAndOneWorker())
+            d.addCallback(lambda _: workerAvatar)
+            return d
+
+        def logoutComponents(workerAvatar):
+            feedMap = self.vishnu.componentHeaven.feedMap
+            producer = self._components[producerId]
+            converter = self._components[converterId]
+            feeders = [feeder for alias, feeder, feedName
+                       in feedMap.getFeedersForEaters(converter)]
+            self.assertEquals(feeders, [producer])
+
+            self._logoutAvatar(producer)
+            self.failIf(producerId in feedMap.avatars)
+            self.assertEquals(feedMap.feedersForEaters, {})
+            self.assertEquals(feedMap.eatersForFeeders, {})
+            self.assertEquals(feedMap.feedDeps, {})
+
+            self._logoutAvatar(converter)
+            self.assertEquals(feedMap.avatars, {})
+            self.assertEquals(feedMap.feeds, {})
+
+            self._logoutAvatar(workerAvatar)
+
+        d = self._loginWorker('worker')
+        d.addCallback(loadConfig)
+        d.addCallback(logoutComponents)
+        d.addCallback(lambda _: self.vishnu.emptyPlanet())
+        return d
+
     def _verifyConfigAndOneWorker(self):
         self.debug('verifying after having loaded config and started worker')
         mappers = self.vishnu._componentMappers
@@ -17,30 +17,56 @@
 
 import cgi
 import errno
+import os
+import signal
+import socket
 import string
+import struct
 from urllib2 import urlparse
 
-from flumotion.common import testsuite
-from flumotion.component.misc.porter import porter
+from twisted.internet import defer, error, protocol, reactor
+from twisted.python import failure
+
+from flumotion.common import errors, testsuite
+from flumotion.component.misc.porter import acceptworker, porter
+from flumotion.extern.fdpass import fdpass
+from flumotion.twisted import fdserver
 
 
 class FakeTransport:
     connected = True
+    reading = True
+    keepSocketAlive = False
     _fileno = 5
 
     def __init__(self, protocol, overloaded=False):
         self.written = ''
         self.protocol = protocol
         self.overloaded = overloaded
+        self.queued = {}
 
     def loseConnection(self):
         self.connected = False
         self.protocol.connectionLost(None)
 
+    def stopReading(self):
+        self.reading = False
+
     def sendFileDescriptor(self, fd, data):
         if self.overloaded:
             raise OSError(errno.EAGAIN, 'Resource temporarily unavailable')
 
+    def queueFileDescriptor(self, fd, data):
+        if self.overloaded:
+            return defer.fail(fdserver.FDQueueFullError())
+        if self.protocol.delayed:
+            self.queued[fd] = defer.Deferred()
+            return self.queued[fd]
+        return defer.succeed(0.0)
+
+    def cancelFileDescriptor(self, fd):
+        del self.queued[fd]
+
     def write(self, data):
         self.written += data
 
@@ -50,6 +76,11 @@ class FakeTransport:
 
 class FakePorter:
     foundDestination = False
+    handoffs = 0
+    rejected = 0
+
+    def __init__(self):
+        self.delayedAvatar = FakeAvatar(delayed=True)
 
     def findDestination(self, path):
         self.foundDestination = True
@@ -57,31 +88,46 @@ class FakePorter:
             return FakeAvatar(overloaded=False)
         elif path == '/overloaded':
             return FakeAvatar(overloaded=True)
+        elif path == '/busy':
+            return self.delayedAvatar
 
         return None
 
+    def handoffCompleted(self, latency):
+        self.handoffs += 1
+
+    def handoffRejected(self):
+        self.rejected += 1
+
 
 class FakeBroker:
 
-    def __init__(self, overloaded=False):
+    def __init__(self, overloaded=False, delayed=False):
+        self.delayed = delayed
         self.transport = FakeTransport(self, overloaded)
 
 
 class FakeMind:
 
-    def __init__(self, overloaded=False):
-        self.broker = FakeBroker(overloaded)
+    def __init__(self, overloaded=False, delayed=False):
+        self.broker = FakeBroker(overloaded, delayed)
 
 
 class FakeAvatar:
     avatarId = 'testAvatar'
 
-    def __init__(self, overloaded=False):
-        self.mind = FakeMind(overloaded)
+    def __init__(self, overloaded=False, delayed=False):
+        self.mind = FakeMind(overloaded, delayed)
 
     def isAttached(self):
         return True
 
+    def queueFileDescriptor(self, fileno, data):
+        return self.mind.broker.transport.queueFileDescriptor(fileno, data)
+
+    def cancelFileDescriptor(self, fileno):
+        self.mind.broker.transport.cancelFileDescriptor(fileno)
+
 
 class TestPorterProtocol(testsuite.TestCase):
 
@@ -143,6 +189,33 @@ class TestHTTPPorterProtocol(testsuite.TestCase):
         self.failIf(self.t.connected)
         self.failUnless(self.p.foundDestination)
         self.failIf(self.t.written)
+        self.failUnless(self.t.keepSocketAlive)
+        self.assertEquals(self.p.handoffs, 1)
+
+    def testHandoffQueued(self):
+        self.pp.dataReceived('GET /busy HTTP/1.1\r\n')
+        # waiting in the avatar's queue; the client stays connected, but
+        # nothing more is read from it
+        self.failUnless(self.t.connected)
+        self.failIf(self.t.reading)
+        self.assertEquals(self.p.handoffs, 0)
+
+        avatarTransport = self.p.delayedAvatar.mind.broker.transport
+        avatarTransport.queued[self.t.fileno()].callback(0.5)
+        self.failIf(self.t.connected)
+        self.failIf(self.t.written)
+        self.failUnless(self.t.keepSocketAlive)
+        self.assertEquals(self.p.handoffs, 1)
+
+    def testHandoffCancelledOnTimeout(self):
+        self.pp.dataReceived('GET /busy HTTP/1.1\r\n')
+        avatarTransport = self.p.delayedAvatar.mind.broker.transport
+        self.failUnless(self.t.fileno() in avatarTransport.queued)
+        self.pp._timeoutDC.cancel()
+        self.pp._timeout()
+        self.failIf(self.t.connected)
+        self.failIf(self.t.keepSocketAlive)
+        self.failIf(avatarTransport.queued)
 
     def testErrorSendingFileDescriptors(self):
         self.pp.dataReceived('GET ')
@@ -153,6 +226,7 @@ class TestHTTPPorterProtocol(testsuite.TestCase):
         self.failUnless(self.p.foundDestination)
         self.failUnless(self.t.written)
         self.failIf(self.t.written.find('503') < 0)
+        self.assertEquals(self.p.rejected, 1)
 
 
 class TestHTTPPorterProtocolParser(testsuite.TestCase):
@@ -266,3 +340,278 @@ class TestHTTPPorterProtocolParser(testsuite.TestCase):
             unparsed = self.pp.unparseLine(injected)
             self.containsSameInfo(line, unparsed,
                                   {self.pp.requestIdParameter: ['ID']})
+
+
+class FakeFDProtocol:
+
+    def __init__(self):
+        self.data = ''
+        self.fds = []
+
+    def dataReceived(self, data):
+        self.data += data
+
+    def fileDescriptorsReceived(self, fds, message):
+        self.fds.append((fds, message))
+
+
+class FakeServerPort:
+    _realPortNumber = None
+
+
+class TestFDPassing(testsuite.TestCase):
+
+    def setUp(self):
+        self.sock, self.peer = socket.socketpair(socket.AF_UNIX,
+                                                 socket.SOCK_STREAM)
+        self.server = fdserver.FDServer(self.sock, protocol.Protocol(),
+                                        None, FakeServerPort(), 0, reactor)
+        self.files = []
+
+    def tearDown(self):
+        self.server.connectionLost(failure.Failure(error.ConnectionDone()))
+        self.peer.close()
+        for f in self.files:
+            f.close()
+
+    def openFile(self):
+        f = open(__file__)
+        self.files.append(f)
+        return f.fileno()
+
+    def parse(self, fds, message):
+        # feed a received message through FDClient's message parsing
+        client = fdserver.FDClient.__new__(fdserver.FDClient)
+        client.protocol = FakeFDProtocol()
+        client._fdsPending = list(fds)
+        client._fdData = message
+        client._fdMessagesReceived()
+        return client
+
+    def testSend(self):
+        results = []
+        d = self.server.queueFileDescriptor(self.openFile(), 'data')
+        d.addCallback(results.append)
+        self.assertEquals(len(results), 1)
+
+        fds, message = fdpass.readfds(self.peer.fileno(), 64 * 1024)
+        self.assertEquals(len(fds), 1)
+        client = self.parse(fds, message)
+        self.assertEquals(client.protocol.fds, [(fds, 'data')])
+        os.close(fds[0])
+
+    def testBatch(self):
+        self.server.maxFDBatch = 3
+        # FDs wait while normal data is buffered
+        self.server.write('pb')
+        results = []
+        for data in ('first', 'second', ''):
+            d = self.server.queueFileDescriptor(self.openFile(), data)
+            d.addCallback(results.append)
+        self.assertEquals(len(results), 0)
+        self.assertEquals(self.server.getPendingFileDescriptorCount(), 3)
+
+        self.server.doWrite()
+        self.assertEquals(len(results), 3)
+        self.assertEquals(self.server.getPendingFileDescriptorCount(), 0)
+
+        data = ''
+        fds = []
+        while not fds:
+            fds, message = fdpass.readfds(self.peer.fileno(), 64 * 1024)
+            data += message
+        self.assertEquals(len(fds), 3)
+        self.failUnless(data.startswith('pb'))
+        client = self.parse(fds, data[2:])
+        self.assertEquals([m for f, m in client.protocol.fds],
+                          ['first', 'second', ''])
+        self.assertEquals(client.protocol.data, '')
+        for fd in fds:
+            os.close(fd)
+
+    def testQueueFull(self):
+        self.server.maxPendingFDs = 0
+        d = self.server.queueFileDescriptor(self.openFile(), 'data')
+        return self.failUnlessFailure(d, fdserver.FDQueueFullError)
+
+    def testSplitMessage(self):
+        header = struct.pack("@16sI", fdserver.MAGIC_SIGNATURE, 4)
+        message = header + 'abcd' + header + 'efgh' + 'pbdata'
+        client = self.parse([10, 11], message[:30])
+        self.assertEquals(client.protocol.fds, [([10], 'abcd')])
+        client._fdData += message[30:]
+        client._fdMessagesReceived()
+        self.assertEquals(client.protocol.fds,
+                          [([10], 'abcd'), ([11], 'efgh')])
+        self.assertEquals(client.protocol.data, 'pbdata')
+
+
+class FakeWorkerPorter:
+    name = 'porter'
+    _handoffQueueSize = 64
+    _handoffBatchSize = 16
+
+    def getAcceptWorkerSocketPath(self, index):
+        return '/tmp/porter.worker-%d' % index
+
+
+class TestAcceptWorker(testsuite.TestCase):
+
+    def setUp(self):
+        self.worker = acceptworker.AcceptWorker(FakeWorkerPorter(), 0)
+        self.avatar = acceptworker.AcceptWorkerAvatar(
+            'streamer', self.worker, FakeMind())
+        self.worker.avatarAttached(self.avatar)
+
+    def testRouting(self):
+        self.worker.remote_setTable({'/exact': 'streamer'},
+                                    {'/live/': 'streamer'})
+        self.assertIdentical(self.worker.findDestination('/exact'),
+                             self.avatar)
+        self.assertIdentical(self.worker.findDestination('/live/a'),
+                             self.avatar)
+        self.assertIdentical(self.worker.findDestination('/other'), None)
+
+        self.worker.remote_deregisterPrefix('/live/')
+        self.worker.remote_registerPath('/other', 'streamer')
+        self.assertIdentical(self.worker.findDestination('/live/a'), None)
+        self.assertIdentical(self.worker.findDestination('/other'),
+                             self.avatar)
+
+        # still routed, but no longer to the logged out avatar
+        self.avatar.logout()
+        destination = self.worker.findDestination('/exact')
+        self.failIf(destination is None)
+        self.failIf(destination is self.avatar)
+
+    def testUnreachableStreamer(self):
+        self.worker.remote_registerPrefix('/', 'elsewhere')
+        pp = porter.HTTPPorterProtocol(self.worker)
+        t = FakeTransport(pp)
+        pp.transport = t
+        pp.dataReceived('GET /stream HTTP/1.0\r\n')
+        self.failIf(t.connected)
+        self.failIf(t.written.find('503') < 0)
+
+    def testHandoffStats(self):
+        calls = []
+
+        class FakePerspective:
+
+            def callRemote(self, methodName, *args):
+                calls.append((methodName, ) + args)
+                return defer.succeed(None)
+        self.worker._porterPerspective = FakePerspective()
+        self.worker._sendHandoffStats()
+        self.assertEquals(calls, [])
+
+        self.worker.handoffCompleted(0.5)
+        self.worker.handoffCompleted(1.5)
+        self.worker.handoffRejected()
+        self.worker._sendHandoffStats()
+        self.assertEquals(calls, [('addHandoffStats', 2, 2.0, 1.5, 1)])
+        # only the new handoffs are sent
+        self.worker.handoffCompleted(0.25)
+        self.worker._sendHandoffStats()
+        self.assertEquals(calls[1], ('addHandoffStats', 1, 0.25, 0.25, 0))
+
+
+class FakeWorkerMind:
+
+    def callRemote(self, methodName, *args):
+        return defer.succeed(None)
+
+
+class TestPorterAcceptWorkers(testsuite.TestCase):
+
+    def setUp(self):
+        config = {
+            'feed': [],
+            'name': 'porter',
+            'parent': 'default',
+            'avatarId': '/default/porter',
+            'clock-master': None,
+            'type': 'porter',
+            'plugs': {},
+            'properties': {'port': 0},
+        }
+        self.porter = porter.Porter(config)
+        self.started = []
+        self.porter._startAcceptWorker = self.started.append
+
+    def tearDown(self):
+        return self.porter.stop()
+
+    def fork(self, exitCode=None):
+        pid = os.fork()
+        if not pid:
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                if exitCode is None:
+                    signal.pause()
+            finally:
+                os._exit(exitCode or 0)
+        index = len(self.porter._acceptWorkerProcesses)
+        proc = porter.AcceptWorkerProcess(self.porter, index, pid, 'secret')
+        self.porter._acceptWorkerProcesses[proc.index] = proc
+        proc.watch()
+        return proc
+
+    def testRegisterStreamer(self):
+        self.fork()
+        streamer = porter.PorterAvatar('streamer', self.porter, None)
+        self.assertRaises(errors.NotAuthenticatedError,
+                          streamer.perspective_registerAcceptWorker,
+                          FakeWorkerMind(), '/tmp/porter.worker-0', 'wrong')
+        self.failIf(streamer in self.porter._acceptWorkers)
+        streamer.perspective_addHandoffStats(1, 0.5, 0.5, 0)
+        self.assertEquals(self.porter._handoffCount, 0)
+
+        worker = porter.PorterAvatar('worker', self.porter, None)
+        worker.perspective_registerAcceptWorker(
+            FakeWorkerMind(), '/tmp/porter.worker-0', 'secret')
+        worker.perspective_addHandoffStats(1, 0.5, 0.5, 0)
+        self.assertEquals(self.porter._handoffCount, 1)
+
+    def testRestartDied(self):
+        self.patch(porter, 'ACCEPT_WORKER_RESTART_DELAY', 0)
+        proc = self.fork(exitCode=1)
+        d = defer.Deferred()
+
+        def restarted(index):
+            self.started.append(index)
+            d.callback(index)
+        self.porter._startAcceptWorker = restarted
+        d.addCallback(self.assertEquals, proc.index)
+        d.addCallback(lambda _: self.failIf(
+            proc.index in self.porter._acceptWorkerProcesses))
+        return d
+
+    def testStop(self):
+        procs = [self.fork(), self.fork()]
+        d = self.porter._stopAcceptWorkers()
+
+        def stopped(_):
+            self.assertEquals(self.porter._acceptWorkerProcesses, {})
+            self.assertEquals(self.started, [])
+            for proc in procs:
+                self.assertRaises(OSError, os.waitpid, proc.pid,
+                                  os.WNOHANG)
+        d.addCallback(stopped)
+        return d
+
+    def testHandoffLatencyPeak(self):
+        self.porter.handoffCompleted(2.0)
+        self.porter.handoffCompleted(1.0)
+        self.porter._updateHandoffStats()
+        self.assertEquals(self.porter.uiState.get('fd-handoff-latency'), 1.5)
+        self.assertEquals(
+            self.porter.uiState.get('fd-handoff-latency-peak'), 2.0)
+        # the peak of a quiet interval is not the old one
+        self.porter._updateHandoffStats()
+        self.assertEquals(
+            self.porter.uiState.get('fd-handoff-latency-peak'), 0.0)
+        self.porter.handoffCompleted(0.5)
+        self.porter._updateHandoffStats()
+        self.assertEquals(
+            self.porter.uiState.get('fd-handoff-latency-peak'), 0.5)
@@ -0,0 +1,157 @@
+# -*- Mode: Python; test-case-name: flumotion.test.test_ratecontrol -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+from twisted.internet import task
+
+from flumotion.common import testsuite
+from flumotion.component.misc.httpserver import ratecontrol
+
+
+class FakeConsumer(object):
+
+    def __init__(self):
+        self.data = []
+        self.finished = False
+        self.producer = None
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def write(self, data):
+        self.data.append(data)
+
+    def finish(self):
+        self.finished = True
+
+    def written(self):
+        return sum([len(d) for d in self.data])
+
+
+class FakeProducer(object):
+    """
+    I write a chunk every time I'm resumed, like FileTransfer.
+    """
+
+    def __init__(self, proxy, chunks):
+        self.proxy = proxy
+        self.chunks = chunks
+
+    def resumeProducing(self):
+        if self.chunks:
+            self.proxy.write(self.chunks.pop(0))
+        elif self.proxy.producer is self:
+            self.proxy.unregisterProducer()
+            self.proxy.finish()
+
+    def pauseProducing(self):
+        pass
+
+    def stopProducing(self):
+        self.chunks = []
+
+
+class TestTokenBucket(testsuite.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+
+    def transfer(self, scheduler, chunks, rate=100, maxLevel=1000,
+                 fillLevel=0):
+        consumer = FakeConsumer()
+        proxy = ratecontrol.TokenBucketConsumer(consumer, maxLevel, rate,
+                                                fillLevel, scheduler)
+        proxy.resumeProducing()
+        proxy.registerProducer(FakeProducer(proxy, chunks), True)
+        return consumer, proxy
+
+    def testRate(self):
+        scheduler = ratecontrol.TokenBucketScheduler(clock=self.clock)
+        consumer, proxy = self.transfer(scheduler, ['x' * 250] * 2,
+                                        fillLevel=50)
+        self.assertEquals(consumer.data, ['x' * 50])
+        self.clock.advance(1)
+        self.assertEquals(consumer.written(), 150)
+        self.clock.advance(1)
+        # the rest of the first chunk and the start of the second one
+        # are written together
+        self.assertEquals(consumer.data[-1], 'x' * 100)
+        self.assertEquals(consumer.written(), 250)
+        self.clock.advance(3)
+        self.assertEquals(consumer.written(), 500)
+        self.failUnless(consumer.finished)
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+    def testSharedTick(self):
+        scheduler = ratecontrol.TokenBucketScheduler(clock=self.clock)
+        transfers = [self.transfer(scheduler, ['x' * 1000])
+                     for i in range(10)]
+        self.assertEquals(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(1)
+        self.assertEquals([c.written() for c, p in transfers], [100] * 10)
+        self.assertEquals(scheduler.getStats()['throttled-clients'], 10)
+        self.assertEquals(scheduler.getStats()['throttled-time'], 10.0)
+
+    def testAggregateRate(self):
+        scheduler = ratecontrol.TokenBucketScheduler(rate=150, maxLevel=150,
+                                                     clock=self.clock)
+        first, firstProxy = self.transfer(scheduler, ['x' * 1000],
+                                          fillLevel=100)
+        second, secondProxy = self.transfer(scheduler, ['x' * 1000],
+                                            fillLevel=100)
+        # the first burst takes most of the aggregate bucket
+        self.assertEquals((first.written(), second.written()), (100, 50))
+        for i in range(10):
+            self.clock.advance(1)
+        total = first.written() + second.written()
+        self.assertEquals(total, 150 * 11)
+        # both transfers got their turns
+        self.failUnless(first.written() > 500)
+        self.failUnless(second.written() > 500)
+
+    def testStop(self):
+        scheduler = ratecontrol.TokenBucketScheduler(clock=self.clock)
+        consumer, proxy = self.transfer(scheduler, ['x' * 1000])
+        self.clock.advance(1)
+        proxy.stopProducing()
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+        self.assertEquals(scheduler.getStats()['throttled-clients'], 0)
+
+    def testPause(self):
+        scheduler = ratecontrol.TokenBucketScheduler(clock=self.clock)
+        consumer, proxy = self.transfer(scheduler, ['x' * 1000])
+        proxy.pauseProducing()
+        self.clock.advance(2)
+        self.assertEquals(consumer.written(), 0)
+        proxy.resumeProducing()
+        self.assertEquals(consumer.written(), 0)
+        # the next tick refills the bucket for the time paused too
+        self.clock.advance(1)
+        self.assertEquals(consumer.written(), 300)
+
+
+class TestRateControllerFixedPlug(testsuite.TestCase):
+
+    def testProperties(self):
+        plug = ratecontrol.RateControllerFixedPlug(
+            {'properties': {'rate': 8000, 'aggregate-rate': 80000}})
+        self.assertEquals(plug._scheduler.rate, 10000)
+        self.assertEquals(plug._scheduler.maxLevel, 10000)
+        plug.stop(None)
+        self.assertEquals(plug.getStats()['throttled-clients'], 0)
@@ -19,7 +19,7 @@ from twisted.trial import unittest
 from twisted.internet import reactor, defer
 
 from flumotion.common import testsuite
-from flumotion.worker import worker
+from flumotion.worker import job, worker
 
 
 class FakeOptions:
@@ -28,6 +28,8 @@ class FakeOptions:
         self.name = 'fakeworker'
         self.feederports = []
         self.randomFeederports = False
+        self.jobPoolSize = 0
+        self.jobPoolRefillDelay = 5
 
 
 class TestCheckJobHeaven(testsuite.TestCase):
@@ -42,3 +44,128 @@ class TestCheckJobHeaven(testsuite.TestCase):
 
     def testInit(self):
         pass
+
+
+class FakeBrain:
+    workerName = 'fakeworker'
+
+
+class FakeProtocol:
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.avatarId = None
+
+    def setAvatarId(self, avatarId):
+        self.avatarId = avatarId
+
+
+class FakeAvatar:
+
+    def __init__(self, avatarId, pid):
+        self.avatarId = self.logName = avatarId
+        self.pid = pid
+        self.created = []
+
+    def mindCallRemote(self, methodName, *args):
+        return defer.succeed(None)
+
+    def createComponent(self, jobInfo):
+        self.created.append(jobInfo)
+
+
+class PoolJobHeaven(job.ComponentJobHeaven):
+    # spawns no processes, remembering what it would have spawned
+
+    def __init__(self, poolSize):
+        job.ComponentJobHeaven.__init__(self, FakeBrain(), poolSize)
+        self.spawned = []
+
+    def _spawnJob(self, avatarId):
+        pid = len(self.spawned) + 1000
+        if avatarId.startswith(job.POOL_PREFIX):
+            self._pooled[avatarId] = FakeProtocol(pid)
+        self.spawned.append(avatarId)
+        return pid
+
+    def login(self, avatarId):
+        # as the job's avatar does once it knows its pid
+        avatar = FakeAvatar(avatarId, self.spawned.index(avatarId) + 1000)
+        self.avatars[avatarId] = avatar
+        return self.jobPooled(avatar)
+
+
+class TestComponentJobHeaven(testsuite.TestCase):
+
+    def tearDown(self):
+        if self.heaven._refillDC is not None:
+            self.heaven._refillDC.cancel()
+
+    def spawn(self, avatarId):
+        return self.heaven.spawn(avatarId, 'videotest', 'module', 'method',
+                                 0, [], {})
+
+    def testNoPool(self):
+        self.heaven = PoolJobHeaven(0)
+        self.heaven._fillPool()
+        self.spawn('/default/producer')
+        self.assertEquals(self.heaven.spawned, ['/default/producer'])
+        self.assertEquals(self.heaven._refillDC, None)
+
+    def testPool(self):
+        heaven = self.heaven = PoolJobHeaven(2)
+        heaven._fillPool()
+        # one job is started at a time
+        self.assertEquals(heaven.spawned, ['job-pool-0'])
+        heaven.login('job-pool-0')
+        self.assertEquals(heaven.spawned, ['job-pool-0', 'job-pool-1'])
+        heaven.login('job-pool-1')
+        heaven._fillPool()
+        self.assertEquals(len(heaven.spawned), 2)
+        self.assertEquals(heaven.getJobInfos(), [])
+
+        d = self.spawn('/default/producer')
+        self.assertEquals(len(heaven.spawned), 2)
+        self.failIf('job-pool-0' in heaven.avatars)
+        avatar = heaven.avatars['/default/producer']
+        self.assertEquals(avatar.avatarId, '/default/producer')
+        self.assertEquals([jobInfo.avatarId for jobInfo in avatar.created],
+                          ['/default/producer'])
+        self.assertEquals([jobInfo.avatarId
+                           for jobInfo in heaven.getJobInfos()],
+                          ['/default/producer'])
+        self.failUnless(heaven._refillDC.active())
+
+        heaven._startSet.createSuccess('/default/producer')
+        return d
+
+    def testPooledJobLost(self):
+        heaven = self.heaven = PoolJobHeaven(1)
+        heaven._fillPool()
+        heaven.login('job-pool-0')
+        heaven.removeAvatar('job-pool-0')
+        self.failIf(heaven.isPooled('job-pool-0'))
+        self.failUnless(heaven._refillDC.active())
+        # the next component gets a new job
+        self.spawn('/default/producer')
+        self.assertEquals(heaven.spawned, ['job-pool-0', '/default/producer'])
+
+    def testPooledJobStoppedBeforeLogout(self):
+        heaven = self.heaven = PoolJobHeaven(1)
+        heaven._fillPool()
+        heaven.login('job-pool-0')
+        heaven.jobStopped(1000)
+        self.failIf(heaven.isPooled('job-pool-0'))
+        self.failUnless(heaven._refillDC.active())
+        heaven.removeAvatar('job-pool-0')
+        self.failUnless(heaven._refillDC.active())
+
+    def testSpawnAfterPooledJobStopped(self):
+        heaven = self.heaven = PoolJobHeaven(1)
+        heaven._fillPool()
+        heaven.login('job-pool-0')
+        heaven.jobStopped(1000)
+        d = self.spawn('/default/producer')
+        self.assertEquals(heaven.spawned, ['job-pool-0', '/default/producer'])
+        heaven._startSet.createSuccess('/default/producer')
+        return d
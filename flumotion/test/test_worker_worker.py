@@ -28,6 +28,8 @@ class FakeOptions:
         self.feederports = [9998]
         self.randomFeederports = False
         self.name = 'fakeworker'
+        self.jobPoolSize = 0
+        self.jobPoolRefillDelay = 5
 
 
 class TestBrain(testsuite.TestCase):
@@ -89,3 +89,18 @@ class TestConfig(testsuite.TestCase):
         s = ('<worker><authentication><invalid-name/>'
              '</authentication></worker>')
         self.assertRaises(config.ConfigError, parse, s)
+
+    def testParseJobPool(self):
+        conf = parse('<worker></worker>')
+        self.assertEquals(conf.jobPoolSize, None)
+        self.assertEquals(conf.jobPoolRefillDelay, None)
+        conf = parse('<worker><job-pool size="3" refill-delay="2.5"/>'
+                     '</worker>')
+        self.assertEquals(conf.jobPoolSize, 3)
+        self.assertEquals(conf.jobPoolRefillDelay, 2.5)
+
+    def testParseJobPoolError(self):
+        self.assertRaises(config.ConfigError, parse,
+                          '<worker><job-pool size="many"/></worker>')
+        self.assertRaises(config.ConfigError, parse,
+                          '<worker><job-pool size="-1"/></worker>')
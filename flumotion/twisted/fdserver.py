@@ -18,7 +18,7 @@
 from flumotion.common import log
 from flumotion.extern.fdpass import fdpass
 
-from twisted.internet import unix, main, address, tcp
+from twisted.internet import unix, main, address, tcp, defer
 from twisted.spread import pb
 
 import errno
@@ -46,13 +46,145 @@ __version__ = "$Rev$"
 MAGIC_SIGNATURE = ''.join(map(chr, [253, 252, 142, 127, 7, 71, 185, 234,
                                     161, 117, 238, 216, 220, 54, 200, 163]))
 
+# fdpass can't receive more FDs than this in a single message
+MAX_FD_BATCH = 32
+
+
+class FDQueueFullError(Exception):
+    """
+    Too many file descriptors are already waiting to be passed over a
+    connection.
+    """
+
 
 class FDServer(unix.Server):
+    """
+    A UNIX socket server connection that can pass file descriptors to the
+    other side.
+
+    Besides sending FDs right away with L{sendFileDescriptor}, FDs can be
+    queued with L{queueFileDescriptor}; queued FDs are sent when the socket
+    is writable, several at a time if the peer accepts it.
+
+    @ivar maxPendingFDs:  how many FDs can be waiting in the queue
+    @type maxPendingFDs:  int
+    @ivar maxFDBatch:     how many queued FDs can be sent in a single
+                          message; only raise this above 1 if the peer
+                          is known to understand batched messages
+    @type maxFDBatch:     int
+    @ivar maxFDBatchSize: how many bytes of data can go in a single batched
+                          message
+    @type maxFDBatchSize: int
+    """
+    maxPendingFDs = 64
+    maxFDBatch = 1
+    # The receiving FDClient reads at most 64KiB at a time
+    maxFDBatchSize = 32 * 1024
+
+    def __init__(self, *args, **kwargs):
+        unix.Server.__init__(self, *args, **kwargs)
+        # list of (fileno, data, queue time, deferred)
+        self._pendingFDs = []
 
     def sendFileDescriptor(self, fileno, data=""):
         message = struct.pack("@16sI", MAGIC_SIGNATURE, len(data)) + data
         return fdpass.writefds(self.fileno(), [fileno], message)
 
+    def queueFileDescriptor(self, fileno, data=""):
+        """
+        Queue a file descriptor to be passed to the other side along with
+        some data. The file descriptor must be kept open until the
+        returned deferred fires.
+
+        @returns: a deferred firing with the number of seconds the FD spent
+                  in the queue once it is sent, or failing with
+                  L{FDQueueFullError} if the queue is full.
+        @rtype:   L{twisted.internet.defer.Deferred}
+        """
+        if len(self._pendingFDs) >= self.maxPendingFDs:
+            return defer.fail(FDQueueFullError(
+                "%d FDs already pending" % len(self._pendingFDs)))
+        d = defer.Deferred()
+        self._pendingFDs.append((fileno, data, time.time(), d))
+        self._flushFileDescriptors()
+        return d
+
+    def cancelFileDescriptor(self, fileno):
+        """
+        Remove a queued file descriptor that was not sent yet.
+        The deferred returned when queueing it will never fire.
+
+        @returns: whether the FD was found in the queue
+        @rtype:   bool
+        """
+        for i, pending in enumerate(self._pendingFDs):
+            if pending[0] == fileno:
+                del self._pendingFDs[i]
+                return True
+        return False
+
+    def getPendingFileDescriptorCount(self):
+        return len(self._pendingFDs)
+
+    def _writeBufferEmpty(self):
+        return self.offset == len(self.dataBuffer) and not self._tempDataLen
+
+    def _flushFileDescriptors(self):
+        # Only send FDs when no normal data is buffered, otherwise the FD
+        # message could get in the middle of a partially written message.
+        while self._pendingFDs and self.connected and \
+              self._writeBufferEmpty():
+            count = 0
+            size = 0
+            chunks = []
+            batchSize = max(min(self.maxFDBatch, MAX_FD_BATCH), 1)
+            for fileno, data, queued, d in self._pendingFDs[:batchSize]:
+                if count and size + len(data) > self.maxFDBatchSize:
+                    break
+                chunks.append(struct.pack("@16sI", MAGIC_SIGNATURE,
+                                          len(data)))
+                chunks.append(data)
+                count += 1
+                size += len(data)
+            batch = self._pendingFDs[:count]
+            message = ''.join(chunks)
+
+            try:
+                sent = fdpass.writefds(self.fileno(),
+                                       [p[0] for p in batch], message)
+            except OSError, e:
+                if e.errno in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    # try again when the socket is writable
+                    self.startWriting()
+                    return
+                del self._pendingFDs[:count]
+                for fileno, data, queued, d in batch:
+                    d.errback(e)
+                continue
+
+            del self._pendingFDs[:count]
+            if sent < len(message):
+                # The FDs went along with the first byte; the rest of the
+                # message is just stream data now.
+                self.write(message[sent:])
+            now = time.time()
+            for fileno, data, queued, d in batch:
+                d.callback(now - queued)
+
+    def doWrite(self):
+        ret = unix.Server.doWrite(self)
+        if ret is None and self._pendingFDs:
+            self._flushFileDescriptors()
+            if self._pendingFDs:
+                self.startWriting()
+        return ret
+
+    def connectionLost(self, reason):
+        pending, self._pendingFDs = self._pendingFDs, []
+        for fileno, data, queued, d in pending:
+            d.errback(reason)
+        unix.Server.connectionLost(self, reason)
+
 
 class FDPort(unix.Port):
     transport = FDServer
@@ -60,6 +192,11 @@ class FDPort(unix.Port):
 
 class FDClient(unix.Client): #, log.Loggable):
 
+    # FDs received whose data did not completely arrive yet, and the data
+    # received for them so far
+    _fdsPending = ()
+    _fdData = ''
+
     def doRead(self):
         if not self.connected:
             return
@@ -74,7 +211,13 @@ class FDClient(unix.Client): #, log.Loggable):
             if not message:
                 return main.CONNECTION_DONE
 
-            if len(fds) > 0:
+            if self._fdsPending:
+                # Rest of the data for FDs received earlier, possibly with
+                # more FDs, whose data comes after.
+                self._fdsPending.extend(fds)
+                self._fdData += message
+                return self._fdMessagesReceived()
+            elif len(fds) > 0:
                 # Look for our magic cookie in (possibly) the midst of other
                 # data. Pass surrounding chunks, if any, onto dataReceived(),
                 # which (undocumentedly) must return None unless a failure
@@ -92,20 +235,44 @@ class FDClient(unix.Client): #, log.Loggable):
                     if ret:
                         return ret
 
-                msglen = struct.unpack("@I", message[offset+16:offset+20])[0]
-                offset += 20
-                ret = self.protocol.fileDescriptorsReceived(fds,
-                    message[offset:offset+msglen])
-                if ret:
-                    return ret
-
-                if offset+msglen < len(message):
-                    return self.protocol.dataReceived(message[offset+msglen:])
-                return ret
+                self._fdsPending = list(fds)
+                self._fdData = message[offset:]
+                return self._fdMessagesReceived()
             else:
               #  self.debug("No FDs, passing to dataReceived")
                 return self.protocol.dataReceived(message)
 
+    def _fdMessagesReceived(self):
+        # A message can carry several FDs, each with its own signed and
+        # length-prefixed chunk of data following in the same order. The
+        # data can be split across several reads.
+        ret = None
+        while self._fdsPending:
+            data = self._fdData
+            head = data[:16]
+            if head != MAGIC_SIGNATURE[:len(head)]:
+                # Not what we expected; don't leak the FDs
+                for fd in self._fdsPending:
+                    os.close(fd)
+                self._fdsPending = ()
+                break
+            if len(data) < 20:
+                return None
+            msglen = struct.unpack("@I", data[16:20])[0]
+            if len(data) < 20 + msglen:
+                return None
+            fd = self._fdsPending.pop(0)
+            self._fdData = data[20 + msglen:]
+            ret = self.protocol.fileDescriptorsReceived([fd],
+                data[20:20 + msglen])
+            if ret:
+                return ret
+
+        data, self._fdData = self._fdData, ''
+        if data:
+            return self.protocol.dataReceived(data)
+        return ret
+
 
 class FDConnector(unix.Connector):
 
@@ -202,3 +369,20 @@ class PassableServerConnection(_SocketMaybeCloser, tcp.Server):
 
 class PassableServerPort(tcp.Port):
     transport = PassableServerConnection
+
+
+# Not exposed by python 2's socket module; this is the Linux value.
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+
+class ReusablePassableServerPort(PassableServerPort):
+    """
+    A PassableServerPort that can listen on a port other sockets (usually in
+    other processes) listen on too; the kernel spreads incoming connections
+    among them.
+    """
+
+    def createInternetSocket(self):
+        s = PassableServerPort.createInternetSocket(self)
+        s.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        return s
@@ -21,9 +21,12 @@ Flumotion Twisted-like flavors
 Inspired by L{twisted.spread.flavors}
 """
 
-from twisted.internet import defer
+import copy
+import time
+
+from twisted.internet import defer, reactor
 from twisted.spread import pb
-from zope.interface import Interface
+from zope.interface import Interface, implements
 from flumotion.common import log
 
 __version__ = "$Rev$"
@@ -97,14 +100,44 @@ class IStateCacheableListener(Interface):
         """
 
 
+class _StateBatch:
+    """
+    I batch the changes of a state object for as long as I'm entered;
+    see L{StateCacheable.batch}.
+    """
+
+    def __init__(self, state):
+        self.state = state
+
+    def __enter__(self):
+        self.state.beginBatch()
+        return self.state
+
+    def __exit__(self, *exc_info):
+        self.state.commitBatch()
+        return False
+
+
 class StateCacheable(pb.Cacheable):
     """
     I am a cacheable state object.
 
     I cache key-value pairs, where values can be either single objects
     or list of objects.
+
+    Changes are sent to the observers one by one, unless they are made
+    in a batch; the changes of a batch are sent in a single
+    observe_batch message when the batch is committed. Consecutive sets
+    of the same key in a batch are coalesced, only the last value is
+    sent. Other changes are sent in the order they were made.
+
+    @cvar batchUpdates: whether the changes made during a reactor
+                        iteration are batched automatically
+    @type batchUpdates: bool
     """
 
+    batchUpdates = False
+
     def __init__(self):
         self._observers = []
         self._hooks = []
@@ -174,8 +207,7 @@ class StateCacheable(pb.Cacheable):
             raise KeyError('%s in %r' % (key, self))
 
         self._dict[key] = value
-        dList = [o.callRemote('set', key, value) for o in self._observers]
-        return defer.DeferredList(dList)
+        return self._notifyObservers('set', key, value)
 
     def append(self, key, value):
         """
@@ -186,8 +218,7 @@ class StateCacheable(pb.Cacheable):
             raise KeyError('%s in %r' % (key, self))
 
         self._dict[key].append(value)
-        dList = [o.callRemote('append', key, value) for o in self._observers]
-        return defer.DeferredList(dList)
+        return self._notifyObservers('append', key, value)
 
     def remove(self, key, value):
         """
@@ -202,9 +233,7 @@ class StateCacheable(pb.Cacheable):
         except ValueError:
             raise ValueError('value %r not in list %r for key %r' % (
                 value, self._dict[key], key))
-        dList = [o.callRemote('remove', key, value) for o in self._observers]
-        dl = defer.DeferredList(dList)
-        return dl
+        return self._notifyObservers('remove', key, value)
 
     def setitem(self, key, subkey, value):
         """
@@ -215,9 +244,7 @@ class StateCacheable(pb.Cacheable):
             raise KeyError('%s in %r' % (key, self))
 
         self._dict[key][subkey] = value
-        dList = [o.callRemote('setitem', key, subkey, value)
-                for o in self._observers]
-        return defer.DeferredList(dList)
+        return self._notifyObservers('setitem', key, subkey, value)
 
     def delitem(self, key, subkey):
         """
@@ -233,14 +260,53 @@ class StateCacheable(pb.Cacheable):
         except KeyError:
             raise KeyError('key %r not in dict %r for key %r' % (
                 subkey, self._dict[key], key))
-        dList = [o.callRemote('delitem', key, subkey, value) for o in
-                self._observers]
-        dl = defer.DeferredList(dList)
-        return dl
+        return self._notifyObservers('delitem', key, subkey, value)
+
+    def beginBatch(self):
+        """
+        Start batching the changes, until the matching call to
+        L{commitBatch}. Batches can be nested, the changes are sent
+        when the outermost batch is committed.
+        """
+        self._ensureBatch()
+        self._batchDepth += 1
+
+    def commitBatch(self):
+        """
+        Send the changes batched since the matching call to
+        L{beginBatch}.
+
+        @returns: a deferred fired when the observers got the changes
+        """
+        assert self._batchDepth > 0, "No batch to commit in %r" % self
+        self._batchDepth -= 1
+        if self._batchDepth == 0:
+            return self._flushBatch()
+        return self._waitBatch()
+
+    def hasObservers(self):
+        """
+        @returns: whether someone is observing me
+        @rtype:   bool
+        """
+        return len(self._observers) > 0
+
+    def batch(self):
+        """
+        Returns a context manager batching the changes made while in it::
+
+          with state.batch():
+              state.set('a', 1)
+              state.append('b', 2)
+        """
+        return _StateBatch(self)
 
     # pb.Cacheable methods
 
     def getStateToCacheAndObserveFor(self, perspective, observer):
+        # The new observer gets the current state, the pending changes
+        # are for the others
+        self._flushBatch()
         self._observers.append(observer)
         for hook in self._hooks:
             hook.observerAppend(observer, len(self._observers))
@@ -277,6 +343,234 @@ class StateCacheable(pb.Cacheable):
         """
         self._hooks.remove(hook)
 
+    def _ensureBatch(self):
+        # subclasses don't always call our constructor before
+        # changing the state, nor do the proxies created by unjellying
+        if not hasattr(self, '_batch'):
+            self._batch = [] # [(NAME, ARGS...) or None]
+            self._batchSets = {} # {KEY: INDEX OF THE LAST SET}
+            self._batchDepth = 0
+            self._batchWaiters = []
+            self._batchCall = None
+
+    def _notifyObservers(self, name, *args):
+        if not self._observers:
+            return defer.DeferredList([])
+        self._ensureBatch()
+        if not (self._batchDepth or self.batchUpdates):
+            return defer.DeferredList([o.callRemote(name, *args)
+                                       for o in self._observers])
+        if name == 'set':
+            # last write wins, over a set not followed by other changes
+            index = self._batchSets.get(args[0])
+            if index is not None:
+                self._batch[index] = None
+            self._batchSets[args[0]] = len(self._batch)
+            # the value is sent when the batch is committed, after the
+            # changes that may follow on the same list or dict
+            if isinstance(args[1], (list, dict)):
+                args = (args[0], copy.copy(args[1]))
+        else:
+            self._batchSets.pop(args[0], None)
+        self._batch.append((name, ) + args)
+        if not self._batchDepth and self._batchCall is None:
+            self._batchCall = reactor.callLater(0, self._flushBatch)
+        return self._waitBatch()
+
+    def _waitBatch(self):
+        d = defer.Deferred()
+        self._batchWaiters.append(d)
+        return d
+
+    def _flushBatch(self):
+        self._ensureBatch()
+        if self._batchCall is not None:
+            if self._batchCall.active():
+                self._batchCall.cancel()
+            self._batchCall = None
+        changes = [change for change in self._batch if change is not None]
+        waiters = self._batchWaiters
+        self._batch = []
+        self._batchSets = {}
+        self._batchWaiters = []
+
+        if not changes or not self._observers:
+            dl = defer.DeferredList([])
+        elif len(changes) == 1:
+            change = changes[0]
+            dl = defer.DeferredList([o.callRemote(*change)
+                                     for o in self._observers])
+        else:
+            dl = defer.DeferredList([o.callRemote('batch', changes)
+                                     for o in self._observers])
+
+        def fireWaiters(result):
+            for d in waiters:
+                d.callback(result)
+            return result
+        dl.addCallback(fireWaiters)
+        return dl
+
+
+class StatePublisher(object):
+    """
+    I publish values to the keys of a state object, or to the items of
+    one of its dict keys, for code updating them on timers.
+
+    While the state has no observers, I only remember the latest values
+    and publish them when an observer arrives. Unchanged values are not
+    published again. Keys can have a policy limiting how often they are
+    published, and for numeric values, the relative change from the
+    published value below which a new value is not worth publishing.
+    A value held back by the minimum interval is published when the
+    interval is over.
+    """
+
+    implements(IStateCacheableListener)
+
+    def __init__(self, state, dictKey=None):
+        """
+        @param state:   the state to publish to
+        @type  state:   L{StateCacheable}
+        @param dictKey: the dict key of the state to publish items of,
+                        or None to publish keys of the state
+        @type  dictKey: str
+        """
+        self.state = state
+        self._dictKey = dictKey
+        self._policies = {} # {KEY: (MIN INTERVAL, MIN RELATIVE CHANGE)}
+        self._published = {} # {KEY: (VALUE, TIME)}
+        self._pending = {} # {KEY: VALUE}
+        self._flushCall = None
+        state.addHook(self)
+
+    def setPolicy(self, key, minInterval=0, minChange=0):
+        """
+        @param minInterval: the minimum number of seconds between two
+                            publications of the key
+        @type  minInterval: float
+        @param minChange:   the minimum change of a numeric value,
+                            relative to the published value, for the new
+                            value to be published
+        @type  minChange:   float
+        """
+        self._policies[key] = (minInterval, minChange)
+
+    def isObserved(self):
+        """
+        @returns: whether the published values are observed; when not,
+                  computing them can be skipped
+        @rtype:   bool
+        """
+        return self.state.hasObservers()
+
+    def update(self, key, value):
+        if not self.state.hasObservers():
+            self._pending[key] = value
+            return
+        published = self._published.get(key)
+        if published is not None and published[0] == value:
+            self._pending.pop(key, None)
+            return
+        policy = self._policies.get(key)
+        if policy is None or published is None:
+            self._publish(key, value, time.time())
+            return
+        minInterval, minChange = policy
+        if minChange and not self._changed(published[0], value, minChange):
+            self._pending.pop(key, None)
+            return
+        now = time.time()
+        wait = published[1] + minInterval - now
+        if wait <= 0:
+            self._publish(key, value, now)
+            return
+        self._pending[key] = value
+        self._scheduleFlush(wait)
+
+    def flush(self):
+        """
+        Publish the values held back, regardless of the policies.
+        """
+        self._cancelFlush()
+        pending, self._pending = self._pending, {}
+        if not pending or not self.state.hasObservers():
+            self._pending.update(pending)
+            return
+        now = time.time()
+        self.state.beginBatch()
+        try:
+            for key, value in pending.iteritems():
+                self._publish(key, value, now)
+        finally:
+            self.state.commitBatch()
+
+    def stop(self):
+        """
+        Stop publishing to the state.
+        """
+        self._cancelFlush()
+        self._pending.clear()
+        try:
+            self.state.removeHook(self)
+        except ValueError:
+            pass
+
+    # IStateCacheableListener
+
+    def observerAppend(self, observer, num):
+        if num == 1:
+            # The values published until now are unknown to the observer
+            self._published.clear()
+        # The observer gets the state when we return; changes made
+        # before that would reach it before the state itself
+        if self._pending:
+            self._scheduleFlush(0)
+
+    def observerRemove(self, observer, num):
+        if num == 0:
+            self._cancelFlush()
+
+    ## Private Methods ##
+
+    def _changed(self, old, new, minChange):
+        numbers = (int, long, float)
+        if not (isinstance(old, numbers) and isinstance(new, numbers)):
+            return True
+        if old == 0:
+            return True
+        return abs(new - old) >= abs(old) * minChange
+
+    def _publish(self, key, value, now):
+        self._pending.pop(key, None)
+        self._published[key] = (value, now)
+        if self._dictKey is None:
+            self.state.set(key, value)
+        else:
+            self.state.setitem(self._dictKey, key, value)
+
+    def _scheduleFlush(self, delay):
+        if self._flushCall is not None:
+            if self._flushCall.getTime() <= time.time() + delay:
+                return
+            self._flushCall.cancel()
+        self._flushCall = reactor.callLater(delay, self._flushDue)
+
+    def _cancelFlush(self):
+        if self._flushCall is not None:
+            self._flushCall.cancel()
+            self._flushCall = None
+
+    def _flushDue(self):
+        self._flushCall = None
+        pending, self._pending = self._pending, {}
+        self.state.beginBatch()
+        try:
+            for key, value in pending.iteritems():
+                self.update(key, value)
+        finally:
+            self.state.commitBatch()
+
 
 # At some point, a StateRemoteCache will become invalid. The normal way
 # would be losing the connection to the RemoteCacheable, although
@@ -421,23 +715,65 @@ class StateRemoteCache(pb.RemoteCache):
                                 log.getExceptionMessage(e))
 
     def observe_set(self, key, value):
+        self._applySet(key, value)
+        self._notifyListeners(0, key, value)
+
+    def observe_append(self, key, value):
+        self._applyAppend(key, value)
+        self._notifyListeners(1, key, value)
+
+    def observe_remove(self, key, value):
+        self._applyRemove(key, value)
+        self._notifyListeners(2, key, value)
+
+    def observe_setitem(self, key, subkey, value):
+        self._applySetitem(key, subkey, value)
+        self._notifyListeners(3, key, subkey, value)
+
+    def observe_delitem(self, key, subkey, value):
+        self._applyDelitem(key, subkey, value)
+        self._notifyListeners(4, key, subkey, value)
+
+    def observe_batch(self, changes):
+        """
+        Apply a batch of changes sent by L{StateCacheable.commitBatch}.
+        All the changes are applied before the listeners are notified
+        of each of them, in order.
+        """
+        # if we also subclass from Cacheable, then we're a proxy,
+        # so proxy the changes in a batch too
+        proxy = hasattr(self, 'commitBatch')
+        if proxy:
+            StateCacheable.beginBatch(self)
+        notifications = []
+        try:
+            for change in changes:
+                name, args = change[0], change[1:]
+                if name not in self._batchHandlers:
+                    raise ValueError("unknown state change %r" % (name, ))
+                index, applyChange = self._batchHandlers[name]
+                applyChange(self, *args)
+                notifications.append((index, args))
+        finally:
+            if proxy:
+                StateCacheable.commitBatch(self)
+        for index, args in notifications:
+            self._notifyListeners(index, *args)
+
+    def _applySet(self, key, value):
         self._dict[key] = value
         # if we also subclass from Cacheable, then we're a proxy, so proxy
         if hasattr(self, 'set'):
             StateCacheable.set(self, key, value)
 
-        self._notifyListeners(0, key, value)
-
-    def observe_append(self, key, value):
+    def _applyAppend(self, key, value):
         # if we also subclass from Cacheable, then we're a proxy, so proxy
         if hasattr(self, 'append'):
             StateCacheable.append(self, key, value)
         else:
             self._dict[key].append(value)
 
-        self._notifyListeners(1, key, value)
-
-    def observe_remove(self, key, value):
+    def _applyRemove(self, key, value):
         # if we also subclass from Cacheable, then we're a proxy, so proxy
         if hasattr(self, 'remove'):
             StateCacheable.remove(self, key, value)
@@ -448,18 +784,14 @@ class StateRemoteCache(pb.RemoteCache):
                 raise ValueError("value %r not under key %r with values %r" %
                     (value, key, self._dict[key]))
 
-        self._notifyListeners(2, key, value)
-
-    def observe_setitem(self, key, subkey, value):
+    def _applySetitem(self, key, subkey, value):
         # if we also subclass from Cacheable, then we're a proxy, so proxy
         if hasattr(self, 'setitem'):
             StateCacheable.setitem(self, key, subkey, value)
         else:
             self._dict[key][subkey] = value
 
-        self._notifyListeners(3, key, subkey, value)
-
-    def observe_delitem(self, key, subkey, value):
+    def _applyDelitem(self, key, subkey, value):
         # if we also subclass from Cacheable, then we're a proxy, so proxy
         if hasattr(self, 'delitem'):
             StateCacheable.delitem(self, key, subkey)
@@ -470,7 +802,12 @@ class StateRemoteCache(pb.RemoteCache):
                 raise KeyError("key %r not in dict %r for state dict %r" %
                     (subkey, self._dict[key], self._dict))
 
-        self._notifyListeners(4, key, subkey, value)
+    # {CHANGE NAME: (LISTENER INDEX, APPLY METHOD)}
+    _batchHandlers = {'set': (0, _applySet),
+                      'append': (1, _applyAppend),
+                      'remove': (2, _applyRemove),
+                      'setitem': (3, _applySetitem),
+                      'delitem': (4, _applyDelitem)}
 
     def invalidate(self):
         """Invalidate this StateRemoteCache.
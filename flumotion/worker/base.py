@@ -95,6 +95,14 @@ class JobProcessProtocol(worker.ProcessProtocol):
                                         'component',
                                         heaven.getWorkerName())
 
+    def setAvatarId(self, avatarId):
+        """
+        Set the avatarId of the job, when a job started in advance is
+        given a component to run.
+        """
+        self.avatarId = avatarId
+        self._deferredStart = self._startSet.createRegistered(avatarId)
+
     def sendMessage(self, message):
         heaven = self.loggable
         heaven.brain.callRemote('componentAddMessage', self.avatarId,
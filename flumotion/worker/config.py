@@ -59,6 +59,8 @@ class WorkerConfigXML(log.Loggable):
         self.feederports = None
         self.fludebug = None
         self.randomFeederports = False
+        self.jobPoolSize = None
+        self.jobPoolRefillDelay = None
 
         try:
             if filename != None:
@@ -104,6 +106,9 @@ class WorkerConfigXML(log.Loggable):
             elif node.nodeName == 'feederports':
                 self.feederports, self.randomFeederports = \
                     self.parseFeederports(node)
+            elif node.nodeName == 'job-pool':
+                self.jobPoolSize, self.jobPoolRefillDelay = \
+                    self.parseJobPool(node)
             elif node.nodeName == 'debug':
                 self.fludebug = str(node.firstChild.nodeValue)
             else:
@@ -207,3 +212,25 @@ class WorkerConfigXML(log.Loggable):
                 if port not in ports:
                     ports.append(port)
         return (ports, random)
+
+    def parseJobPool(self, node):
+        """
+        Returns how many jobs to start in advance, and how many seconds to
+        wait after one was used before starting another.
+
+        @rtype: (int, float)
+        """
+        # <job-pool size="2" refill-delay="5"/>
+        size = None
+        refillDelay = None
+        try:
+            if node.hasAttribute('size'):
+                size = int(node.getAttribute('size'))
+            if node.hasAttribute('refill-delay'):
+                refillDelay = float(node.getAttribute('refill-delay'))
+        except ValueError, e:
+            raise ConfigError("<job-pool> has an invalid attribute: %s" % e)
+        if (size is not None and size < 0 or
+            refillDelay is not None and refillDelay < 0):
+            raise ConfigError("<job-pool> attributes must not be negative")
+        return (size, refillDelay)
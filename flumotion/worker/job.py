@@ -22,6 +22,7 @@ worker-side objects to handle worker clients
 import os
 import signal
 import sys
+import time
 
 from twisted.internet import defer, reactor
 
@@ -34,11 +35,35 @@ from flumotion.worker import base
 __version__ = "$Rev$"
 T_ = gettexter()
 
+# prefix of the avatarIds of the jobs started for the pool
+POOL_PREFIX = 'job-pool-'
+# how many jobs are started in advance, by default none
+JOB_POOL_SIZE = 0
+# seconds to wait after a job of the pool was used before starting another
+JOB_POOL_REFILL_DELAY = 5
+
 
 class ComponentJobAvatar(base.BaseJobAvatar):
 
     def haveMind(self):
 
+        def gotPid(pid):
+            self.pid = pid
+            if self._heaven.isPooled(self.avatarId):
+                return self._heaven.jobPooled(self)
+            return self.createComponent(self._heaven.getJobInfo(pid))
+        d = self.mindCallRemote("getPid")
+        d.addCallback(gotPid)
+        return d
+
+    def createComponent(self, job):
+        """
+        Tell the job to bootstrap and create its component.
+
+        @param job: the job info of the component to create
+        @type  job: L{ComponentJobInfo}
+        """
+
         def bootstrap(*args):
             return self.mindCallRemote('bootstrap', *args)
 
@@ -66,24 +91,18 @@ class ComponentJobAvatar(base.BaseJobAvatar):
             # FIXME: drills down too much?
             self._heaven._startSet.createFailed(job.avatarId, failure)
 
-        def gotPid(pid):
-            self.pid = pid
-            info = self._heaven.getManagerConnectionInfo()
-            if info.use_ssl:
-                transport = 'ssl'
-            else:
-                transport = 'tcp'
-            job = self._heaven.getJobInfo(pid)
-            workerName = self._heaven.getWorkerName()
-
-            d = bootstrap(workerName, info.host, info.port, transport,
-                          info.authenticator, job.bundles)
-            d.addCallback(create, job)
-            d.addCallback(success, job.avatarId)
-            d.addErrback(error, job)
-            return d
-        d = self.mindCallRemote("getPid")
-        d.addCallback(gotPid)
+        info = self._heaven.getManagerConnectionInfo()
+        if info.use_ssl:
+            transport = 'ssl'
+        else:
+            transport = 'tcp'
+        workerName = self._heaven.getWorkerName()
+
+        d = bootstrap(workerName, info.host, info.port, transport,
+                      info.authenticator, job.bundles)
+        d.addCallback(create, job)
+        d.addCallback(success, job.avatarId)
+        d.addErrback(error, job)
         return d
 
     def stop(self):
@@ -157,9 +176,108 @@ class ComponentJobInfo(base.JobInfo):
 
 
 class ComponentJobHeaven(base.BaseJobHeaven):
+    """
+    I spawn the jobs running the components of the worker.
+
+    I can keep a pool of jobs started in advance, logged in and with the
+    component libraries imported, so that creating a component only
+    needs to bootstrap and create it in one of them.
+    """
     avatarClass = ComponentJobAvatar
     logCategory = 'component-job-heaven'
 
+    _poolCount = 0
+
+    def __init__(self, brain, poolSize=0,
+                 refillDelay=JOB_POOL_REFILL_DELAY):
+        """
+        @param brain:       a reference to the worker brain
+        @type  brain:       L{worker.WorkerBrain}
+        @param poolSize:    how many jobs to start in advance
+        @type  poolSize:    int
+        @param refillDelay: seconds to wait after a job of the pool was
+                            given a component before starting another
+        @type  refillDelay: float
+        """
+        base.BaseJobHeaven.__init__(self, brain)
+        self._poolSize = poolSize
+        self._refillDelay = refillDelay
+        self._pool = [] # avatars of the jobs ready to create a component
+        self._pooled = {} # avatarId -> protocol of the jobs of the pool
+        self._poolStarting = None # avatarId of the job being started
+        self._refillDC = None
+
+    def listen(self):
+        base.BaseJobHeaven.listen(self)
+        self._fillPool()
+
+    def shutdown(self):
+        self._poolSize = 0
+        if self._refillDC is not None and self._refillDC.active():
+            self._refillDC.cancel()
+        self._refillDC = None
+        return base.BaseJobHeaven.shutdown(self)
+
+    def removeAvatar(self, avatarId):
+        base.BaseJobHeaven.removeAvatar(self, avatarId)
+        for avatar in self._pool:
+            if avatar.avatarId == avatarId:
+                self.debug('job %s of the pool logged out', avatarId)
+                self._pool.remove(avatar)
+                self._pooled.pop(avatarId, None)
+                self._scheduleRefill()
+                break
+
+    def jobStopped(self, pid):
+        # the process may end before its avatar logs out
+        for avatarId, protocol in self._pooled.items():
+            if protocol.pid == pid:
+                del self._pooled[avatarId]
+        for avatar in self._pool:
+            if avatar.pid == pid:
+                self.debug('job %s of the pool stopped', avatar.avatarId)
+                self._pool.remove(avatar)
+                self._scheduleRefill()
+                break
+        base.BaseJobHeaven.jobStopped(self, pid)
+
+    def getJobInfos(self):
+        # the jobs of the pool run no component yet
+        return [jobInfo for jobInfo in base.BaseJobHeaven.getJobInfos(self)
+                if jobInfo.avatarId not in self._pooled]
+
+    def isPooled(self, avatarId):
+        """
+        Returns whether the given job was started for the pool and was not
+        given a component yet.
+
+        @rtype: bool
+        """
+        return avatarId in self._pooled
+
+    def jobPooled(self, avatar):
+        """
+        Called when a job started for the pool logged in. Has it import
+        the component libraries, then adds it to the pool.
+
+        @type avatar: L{ComponentJobAvatar}
+        """
+
+        def preloaded(_):
+            self.debug('job %s of the pool is ready', avatar.avatarId)
+            self._pool.append(avatar)
+            self._startSet.createSuccess(avatar.avatarId)
+
+        def error(failure):
+            self.warning('job %s of the pool could not preload: %s',
+                         avatar.avatarId, log.getFailureMessage(failure))
+            self._startSet.createFailed(avatar.avatarId, failure)
+            avatar.stop()
+
+        d = avatar.mindCallRemote('preload')
+        d.addCallbacks(preloaded, error)
+        return d
+
     def getManagerConnectionInfo(self):
         """
         Gets the L{flumotion.common.connection.PBConnectionInfo}
@@ -175,9 +293,9 @@ class ComponentJobHeaven(base.BaseJobHeaven):
         Spawn a new job.
 
         This will spawn a new flumotion-job process, running under the
-        requested nice level. When the job logs in, it will be told to
-        load bundles and run a function, which is expected to return a
-        component.
+        requested nice level, or take one from the pool. When the job
+        logs in, it will be told to load bundles and run a function,
+        which is expected to return a component.
 
         @param avatarId:   avatarId the component should use to log in
         @type  avatarId:   str
@@ -196,7 +314,42 @@ class ComponentJobHeaven(base.BaseJobHeaven):
         @type  conf:       dict
         """
         d = self._startSet.createStart(avatarId)
+        started = time.time()
+
+        # a previous instance of the component may still be logged in
+        if (self._pool and avatarId not in self.avatars
+            and not self._valgrind(avatarId)):
+            avatar = self._pool.pop(0)
+            jobInfo = ComponentJobInfo(avatar.pid, avatarId, type,
+                                       moduleName, methodName, nice,
+                                       bundles, conf)
+            self._assignPooled(avatar, jobInfo)
+            how = 'in a job of the pool'
+        else:
+            pid = self._spawnJob(avatarId)
+            self.addJobInfo(pid, ComponentJobInfo(pid, avatarId, type,
+                                                  moduleName, methodName,
+                                                  nice, bundles, conf))
+            how = 'in a new job'
+
+        def created(result):
+            self.info('component %s created %s in %.3f seconds', avatarId,
+                      how, time.time() - started)
+            return result
+        d.addCallback(created)
+        return d
 
+
+    ## Private Methods ##
+
+    def _valgrind(self, avatarId):
+        # FLU_VALGRIND_JOB takes a comma-seperated list of full component
+        # avatar IDs.
+        if 'FLU_VALGRIND_JOB' in os.environ:
+            return avatarId in os.environ['FLU_VALGRIND_JOB'].split(',')
+        return False
+
+    def _spawnJob(self, avatarId):
         p = base.JobProcessProtocol(self, avatarId, self._startSet)
         executable = os.path.join(configure.bindir, 'flumotion-job')
         if not os.path.exists(executable):
@@ -208,18 +361,14 @@ class ComponentJobHeaven(base.BaseJobHeaven):
 
         # Run some jobs under valgrind, optionally. Would be nice to have the
         # arguments to run it with configurable, but this'll do for now.
-        # FLU_VALGRIND_JOB takes a comma-seperated list of full component
-        # avatar IDs.
-        if 'FLU_VALGRIND_JOB' in os.environ:
-            jobnames = os.environ['FLU_VALGRIND_JOB'].split(',')
-            if avatarId in jobnames:
-                realexecutable = 'valgrind'
-                # We can't just valgrind flumotion-job, we have to valgrind
-                # python running flumotion-job, otherwise we'd need
-                # --trace-children (not quite sure why), which we don't want
-                argv = ['valgrind', '--leak-check=full', '--num-callers=24',
-                    '--leak-resolution=high', '--show-reachable=yes',
-                    'python'] + argv
+        if self._valgrind(avatarId):
+            realexecutable = 'valgrind'
+            # We can't just valgrind flumotion-job, we have to valgrind
+            # python running flumotion-job, otherwise we'd need
+            # --trace-children (not quite sure why), which we don't want
+            argv = ['valgrind', '--leak-check=full', '--num-callers=24',
+                '--leak-resolution=high', '--show-reachable=yes',
+                'python'] + argv
 
         childFDs = {0: 0, 1: 1, 2: 2}
         env = {}
@@ -229,12 +378,61 @@ class ComponentJobHeaven(base.BaseJobHeaven):
             childFDs=childFDs)
 
         p.setPid(process.pid)
-
-        self.addJobInfo(process.pid,
-                        ComponentJobInfo(process.pid, avatarId, type,
-                                         moduleName, methodName, nice,
-                                         bundles, conf))
-        return d
+        if avatarId.startswith(POOL_PREFIX):
+            self._pooled[avatarId] = p
+        return process.pid
+
+    def _assignPooled(self, avatar, jobInfo):
+        poolId = avatar.avatarId
+        avatarId = jobInfo.avatarId
+        self.debug('giving job %s of the pool the component %s', poolId,
+                   avatarId)
+        protocol = self._pooled.pop(poolId)
+        protocol.setAvatarId(avatarId)
+        del self.avatars[poolId]
+        avatar.avatarId = avatar.logName = avatarId
+        self.avatars[avatarId] = avatar
+        self.addJobInfo(avatar.pid, jobInfo)
+        avatar.createComponent(jobInfo)
+        self._scheduleRefill()
+
+    def _scheduleRefill(self):
+        # wait for the burst of components being created to be over
+        # before starting more jobs
+        if not self._poolSize:
+            return
+        if self._refillDC is not None and self._refillDC.active():
+            self._refillDC.reset(self._refillDelay)
+        else:
+            self._refillDC = reactor.callLater(self._refillDelay,
+                                               self._fillPool)
+
+    def _fillPool(self):
+        # start the jobs of the pool one at a time
+        self._refillDC = None
+        if self._poolStarting or len(self._pooled) >= self._poolSize:
+            return
+
+        poolId = '%s%d' % (POOL_PREFIX, self._poolCount)
+        self._poolCount += 1
+        self.debug('starting job %s for the pool', poolId)
+        d = self._startSet.createStart(poolId)
+        pid = self._spawnJob(poolId)
+        self.addJobInfo(pid, ComponentJobInfo(pid, poolId, None, None, None,
+                                              None, [], None))
+        self._poolStarting = poolId
+
+        def started(_):
+            self._poolStarting = None
+            self._fillPool()
+
+        def failed(failure):
+            # do not keep on spawning failing jobs; try again when a job
+            # of the pool is used or lost
+            self._poolStarting = None
+            self.warning('could not start job %s for the pool: %s', poolId,
+                         log.getFailureMessage(failure))
+        d.addCallbacks(started, failed)
 
 
 class CheckJobAvatar(base.BaseJobAvatar):
@@ -25,7 +25,7 @@ from flumotion.common import log, errors
 from flumotion.common import connection
 from flumotion.common.options import OptionGroup, OptionParser
 from flumotion.common.process import startup
-from flumotion.worker import worker, config
+from flumotion.worker import worker, config, job
 from flumotion.twisted import pb
 
 __version__ = "$Rev$"
@@ -86,6 +86,16 @@ def _createParser():
                      action="store_true",
                      dest="randomFeederports",
                      help="Use randomly available feeder ports")
+    group.add_option('', '--job-pool',
+                     action="store", type="int", dest="jobPoolSize",
+                     help="number of job processes to start in advance "
+                          "(defaults to %d)" % job.JOB_POOL_SIZE)
+    group.add_option('', '--job-pool-refill-delay',
+                     action="store", type="float",
+                     dest="jobPoolRefillDelay",
+                     help="seconds to wait after a job of the pool was used "
+                          "before starting another (defaults to %d)" %
+                          job.JOB_POOL_REFILL_DELAY)
 
     parser.add_option_group(group)
 
@@ -144,6 +154,12 @@ def _readConfig(workerFile, options):
     if options.feederports is not None:
         log.debug('worker', 'Using feederports %r' % options.feederports)
 
+    # job pool
+    if options.jobPoolSize is None:
+        options.jobPoolSize = cfg.jobPoolSize
+    if options.jobPoolRefillDelay is None:
+        options.jobPoolRefillDelay = cfg.jobPoolRefillDelay
+
     # general
     # command-line debug > environment debug > config file debug
     if not options.debug and cfg.fludebug \
@@ -203,11 +219,20 @@ def main(args):
         log.debug('worker', 'Using default feederports %r' %
             options.feederports)
 
+    if options.jobPoolSize is None:
+        options.jobPoolSize = job.JOB_POOL_SIZE
+    if options.jobPoolRefillDelay is None:
+        options.jobPoolRefillDelay = job.JOB_POOL_REFILL_DELAY
+
     # check for wrong options/arguments
     if not options.transport in ['ssl', 'tcp']:
         sys.stderr.write('ERROR: wrong transport %s, must be ssl or tcp\n' %
             options.transport)
         return 1
+    if options.jobPoolSize < 0 or options.jobPoolRefillDelay < 0:
+        sys.stderr.write('ERROR: the job pool options must not be '
+                         'negative\n')
+        return 1
 
     # reset FLU_DEBUG which could be different after parsing XML file
     if options.debug:
@@ -133,6 +133,9 @@ class WorkerMedium(medium.PingingMedium):
     """
 
     logCategory = 'workermedium'
+    # the bundles of the components spawned in a row are all set up
+    # with the sums asked for the first one
+    bundleSumsTTL = 30
 
     implements(interfaces.IWorkerMedium)
 
@@ -23,7 +23,8 @@ import signal
 from twisted.internet import defer, error, reactor
 from zope.interface import implements
 
-from flumotion.common import errors, interfaces, log
+from flumotion.common import bundle, errors, interfaces, log
+from flumotion.configure import configure
 from flumotion.worker import medium, job, feedserver
 from flumotion.twisted.defer import defer_call_later
 
@@ -100,12 +101,16 @@ class WorkerBrain(log.Loggable):
         self.medium = medium.WorkerMedium(self)
 
         # really should be componentJobHeaven, but this is shorter :)
-        self.jobHeaven = job.ComponentJobHeaven(self)
+        self.jobHeaven = job.ComponentJobHeaven(
+            self, options.jobPoolSize, options.jobPoolRefillDelay)
         # for ephemeral checks
         self.checkHeaven = job.CheckJobHeaven(self)
 
         self.managerConnectionInfo = None
 
+        # bundles of all the jobs are unpacked in the cache directory
+        self._unbundler = bundle.Unbundler(configure.cachedir)
+
         # it's possible we don't have a feed server, if we are
         # configured to have 0 tcp ports; setup this in listen()
         self.feedServer = None
@@ -252,8 +257,10 @@ class WorkerBrain(log.Loggable):
             return self.medium.bundleLoader.getBundles(moduleName=moduleNames)
 
         def spawnJob(bundles):
-            return self.jobHeaven.spawn(avatarId, type, moduleName,
-                                        methodName, nice, bundles, conf)
+            d = self.jobHeaven.spawn(avatarId, type, moduleName,
+                                     methodName, nice, bundles, conf)
+            self._cleanupBundles([name for name, path in bundles])
+            return d
 
         def createError(failure):
             failure.trap(errors.ComponentCreateError)
@@ -293,3 +300,14 @@ class WorkerBrain(log.Loggable):
 
     def killJob(self, avatarId, signum):
         self.jobHeaven.killJob(avatarId, signum)
+
+
+    ## Private Methods ##
+
+    def _cleanupBundles(self, names):
+        # remove the old versions of the given bundles no job runs with
+        inUse = []
+        for jobInfo in self.jobHeaven.getJobInfos():
+            inUse.extend([path for name, path in jobInfo.bundles])
+        for path in self._unbundler.cleanup(names, exclude=inUse):
+            self.debug('removed unused bundle %s', path)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+# Compare the cost of authenticating, looking up, keeping alive and
+# expiring the keycards of a bouncer, the way the bouncer used to do it
+# and with its keycard indexes and timer wheel.
+#
+# usage: bouncer-keycards-bench.py [KEYCARDS]
+
+import sys
+import time
+
+from twisted.internet import defer
+
+from flumotion.common import keycards
+from flumotion.component.bouncers import component
+
+ISSUERS = 100
+REQUESTERS = 10
+LOOKUPS = 100
+TTL = 3600
+
+
+class LegacyBouncer(component.TrivialBouncer):
+    """
+    A bouncer doing what the bouncers used to do.
+    """
+
+    def hasKeycard(self, keycard):
+        return keycard in self._keycards.values()
+
+    def keepAlive(self, issuerName, ttl):
+        for k in self._keycards.itervalues():
+            if hasattr(k, 'issuerName') and k.issuerName == issuerName:
+                k.ttl = ttl
+
+    def expirePass(self, elapsed):
+        # the expirer poller decremented the ttl of every keycard
+        for k in self._keycards.values():
+            if hasattr(k, 'ttl'):
+                k.ttl -= elapsed
+                if k.ttl <= 0:
+                    self.expireKeycardId(k.id)
+
+    def expireAllKeycards(self):
+        return self.expireKeycardIds(self._keycards.keys())
+
+    def _expireNextKeycardBlock(self, total, keycardIds, finished):
+        keycardBlock = keycardIds[:component.EXPIRE_BLOCK_SIZE]
+        keycardIds = keycardIds[component.EXPIRE_BLOCK_SIZE:]
+        idByReq = {}
+        for keycardId in keycardBlock:
+            if keycardId in self._keycards:
+                keycard = self._keycards[keycardId]
+                requesterId = keycard.requesterId
+                idByReq.setdefault(requesterId, []).append(keycardId)
+                self.removeKeycardId(keycardId)
+        if not (idByReq and self.medium):
+            finished.callback(total)
+            return
+        defs = [self.medium.callRemote('expireKeycards', rid, ids)
+                for rid, ids in idByReq.items()]
+        dl = defer.DeferredList(defs, consumeErrors=True)
+        dl.addCallback(lambda _: total + 1)
+        dl.addCallback(self._expireNextKeycardBlock, keycardIds, finished)
+
+    def _scheduleExpiry(self, keycard):
+        pass
+
+
+class IndexedBouncer(component.TrivialBouncer):
+
+    def expirePass(self, elapsed):
+        # what the timer wheel does every second with no keycard due
+        self._timerWheel._tick()
+
+
+class FakeMedium(object):
+    """
+    I answer the remote calls of a bouncer later, like a real medium.
+    """
+
+    def __init__(self):
+        self.pending = []
+        self.calls = 0
+
+    def callRemote(self, method, *args):
+        self.calls += 1
+        d = defer.Deferred()
+        self.pending.append(d)
+        return d
+
+    def flush(self):
+        while self.pending:
+            self.pending.pop(0).callback(1)
+
+
+def createBouncer(bouncerClass):
+    bouncer = bouncerClass({'name': 'bench', 'avatarId': '/default/bench',
+                            'plugs': {}, 'properties': {}})
+    bouncer.medium = FakeMedium()
+    return bouncer
+
+
+def authenticate(bouncer, count):
+    added = []
+    for i in xrange(count):
+        k = keycards.KeycardGeneric()
+        k.requesterId = '/default/streamer-%d' % (i % REQUESTERS)
+        k.issuerName = 'issuer-%d' % (i % ISSUERS)
+        k.ttl = TTL
+        bouncer.authenticate(k)
+        added.append(k)
+    return added
+
+
+def lookup(bouncer, added):
+    step = max(len(added) / LOOKUPS, 1)
+    for k in added[::step]:
+        bouncer.hasKeycard(k)
+
+
+def expireAll(bouncer):
+    bouncer.expireAllKeycards()
+    bouncer.medium.flush()
+
+
+def timed(function, *args):
+    start = time.time()
+    result = function(*args)
+    return time.time() - start, result
+
+
+def main(args):
+    count = 500000
+    if len(args) > 1:
+        count = int(args[1])
+
+    print '%d keycards, %d issuers, %d requesters' % (count, ISSUERS,
+                                                      REQUESTERS)
+    print '%-10s %12s %12s %12s %12s %12s %8s' % (
+        'bouncer', 'auth (s)', 'lookups (s)', 'keepalive', 'expiry tick',
+        'expire all', 'calls')
+    for name, bouncerClass in [('legacy', LegacyBouncer),
+                               ('indexed', IndexedBouncer)]:
+        bouncer = createBouncer(bouncerClass)
+        auth, added = timed(authenticate, bouncer, count)
+        lookups, _ = timed(lookup, bouncer, added)
+        keepAlive, _ = timed(bouncer.keepAlive, 'issuer-0', TTL)
+        tick, _ = timed(bouncer.expirePass, 1)
+        expire, _ = timed(expireAll, bouncer)
+        print '%-10s %12.3f %12.3f %12.3f %12.3f %12.3f %8d' % (
+            name, auth, lookups, keepAlive, tick, expire,
+            bouncer.medium.calls)
+        del added
+
+
+if __name__ == '__main__':
+    main(sys.argv)
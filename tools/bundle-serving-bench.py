@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+# Simulate the cold start of a number of jobs, each asking the manager
+# for the sums and then the zips of the bundles of the registry. Compare
+# bundling on every request, as the manager used to do, with the
+# bundles cached by the basket.
+#
+# usage: bundle-serving-bench.py [JOBS]
+
+import sys
+import time
+
+from twisted.internet import defer, reactor
+
+from flumotion.common import setup
+from flumotion.common.registry import getRegistry
+
+
+def legacy(basket, names):
+    # what perspective_getBundleSums and perspective_getBundleZips did
+    for name in names:
+        basket.getBundlerByName(name).bundle().md5sum
+    for name in names:
+        basket.getBundlerByName(name).bundle().getZip()
+
+
+def timeLegacy(basket, names, jobs):
+    start = time.time()
+    legacy(basket, names)
+    cold = time.time() - start
+    start = time.time()
+    for i in range(jobs):
+        legacy(basket, names)
+    return cold, time.time() - start
+
+
+def cached(basket, names, jobs):
+    dl = []
+    for i in range(jobs):
+        d = basket.getBundles(names)
+        d.addCallback(lambda bundles: basket.getBundles(names))
+        dl.append(d)
+    return defer.DeferredList(dl, fireOnOneErrback=True)
+
+
+def timeCached(basket, names, jobs):
+    times = []
+
+    def timed(jobs):
+        start = time.time()
+        d = cached(basket, names, jobs)
+        d.addCallback(lambda _: times.append(time.time() - start))
+        return d
+    d = timed(1)
+    d.addCallback(lambda _: timed(jobs))
+    d.addCallback(lambda _: times)
+    return d
+
+
+def main(args):
+    jobs = 50
+    if len(args) > 1:
+        jobs = int(args[1])
+    setup.setupPackagePath()
+    registry = getRegistry()
+    basket = registry.makeBundlerBasket()
+    names = basket.getBundlerNames()
+
+    print '%d bundles, first job then %d jobs' % (len(names), jobs)
+    print 'bundling on each request: %.3f s, %.3f s' % timeLegacy(
+        basket, names, jobs)
+
+    def run():
+        basket = registry.makeBundlerBasket()
+        d = timeCached(basket, names, jobs)
+
+        def done(times):
+            print 'cached bundles:           %.3f s, %.3f s' % tuple(times)
+            basket.stopWatching()
+
+        def failed(failure):
+            failure.printTraceback()
+        d.addCallbacks(done, failed)
+        d.addBoth(lambda _: reactor.stop())
+    reactor.callWhenRunning(run)
+    reactor.run()
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+# Compare the cost of computing the usage of a cache directory and of
+# selecting the files to clean up, with du and a directory scan as the
+# cache manager used to do, and with the cache index.
+#
+# The synthetic cache is made of sparse files, so it uses little space.
+#
+# usage: cache-usage-bench.py [FILES]
+
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from flumotion.component.misc.httpserver import cacheindex
+
+# Part of the cache cleaned up, like the default watermarks do
+CLEANUP_RATIO = 0.4
+
+
+def createCache(directory, count):
+    now = int(time.time())
+    for i in xrange(count):
+        path = os.path.join(directory, "%040x" % i)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0644)
+        os.ftruncate(fd, random.randint(1024, 4 * 1024 * 1024))
+        os.close(fd)
+        atime = now - random.randint(0, 30 * 24 * 3600)
+        os.utime(path, (atime, atime))
+
+
+def timed(function, *args):
+    start = time.time()
+    result = function(*args)
+    return time.time() - start, result
+
+
+def du(directory):
+    output = subprocess.Popen(['du', '-bs', directory],
+                              stdout=subprocess.PIPE).communicate()[0]
+    return int(output.split('\t', 1)[0])
+
+
+def scanCleanup(directory):
+    files = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        files.append((path, os.stat(path)))
+    usage = sum([info.st_size for path, info in files])
+    target = usage * (1 - CLEANUP_RATIO)
+    files.sort(key=lambda d: d[1].st_atime)
+    rmlist = []
+    for path, info in files:
+        usage -= info.st_size
+        rmlist.append(path)
+        if usage <= target:
+            break
+    return rmlist
+
+
+def loadIndex(directory):
+    index = cacheindex.CacheIndex(directory, ".tmp")
+    index.load()
+    return index
+
+
+def indexCleanup(index):
+    return index.evict(index.usage * (1 - CLEANUP_RATIO))
+
+
+def main(args):
+    count = 500000
+    if len(args) > 1:
+        count = int(args[1])
+
+    directory = tempfile.mkdtemp(suffix=".cache-bench")
+    try:
+        print 'creating %d files...' % count
+        createCache(directory, count)
+
+        print '%-40s %10s' % ('operation', 'seconds')
+        t, usage = timed(du, directory)
+        print '%-40s %10.3f' % ('du -bs', t)
+        t, rmlist = timed(scanCleanup, directory)
+        print '%-40s %10.3f' % ('scan cleanup (%d files)' % len(rmlist), t)
+
+        t, index = timed(loadIndex, directory)
+        print '%-40s %10.3f' % ('index first load (scan)', t)
+        index.close()
+        t, index = timed(loadIndex, directory)
+        print '%-40s %10.3f' % ('index load from journal', t)
+        t, _ = timed(index.sync)
+        print '%-40s %10.6f' % ('index usage update', t)
+        t, rmlist = timed(indexCleanup, index)
+        print '%-40s %10.3f' % ('index cleanup (%d files)' % len(rmlist), t)
+        index.close()
+        t, index = timed(loadIndex, directory)
+        print '%-40s %10.3f' % ('index load after cleanup', t)
+        index.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+# Compare the cost of indexing a simulated 24 hours recording with
+# keyframes every 2 seconds, with one dict per entry and one file open
+# per entry as the disker index used to do, and with the array-backed
+# index and its buffered text and binary writers.
+#
+# usage: disker-index-bench.py [HOURS [GOP-SECONDS]]
+
+import bisect
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from flumotion.component.consumers.disker.index import Index
+
+BITRATE = 2 * 1000 * 1000 / 8 # bytes per second
+CLIPS = 1000
+CLIP_DURATION = 60
+
+
+class LegacyIndex(object):
+    """
+    The way the disker index used to keep and write its entries.
+    """
+
+    def __init__(self, location):
+        self.location = location
+        self._index = []
+
+    def addEntry(self, offset, timestamp, keyframe, tdt):
+        if self._index:
+            last = self._index[-1]
+            for key, value in [('offset', offset), ('timestamp', timestamp),
+                               ('tdt', tdt)]:
+                if value < last[key]:
+                    return
+            last['length'] = offset - last['offset']
+            last['duration'] = timestamp - last['timestamp']
+            last['tdt-duration'] = tdt - last['tdt']
+            f = open(self.location, 'a+')
+            f.write("%s %s %s %s %s %s %s %s\n" % (
+                len(self._index) - 1, last['offset'], last['length'],
+                last['timestamp'], last['duration'], last['keyframe'],
+                last['tdt'], last['tdt-duration']))
+            f.close()
+        self._index.append({'offset': offset, 'length': -1,
+                            'timestamp': timestamp, 'duration': -1,
+                            'keyframe': keyframe, 'tdt': tdt,
+                            'tdt-duration': -1})
+
+    def clipTimestamp(self, start, stop):
+        keys = [e['timestamp'] for e in self._index]
+        i_start = bisect.bisect_right(keys, start) - 1
+        i_stop = bisect.bisect_right(keys, stop)
+        return self._index[max(i_start, 0):i_stop]
+
+    def memory(self):
+        return sys.getsizeof(self._index) + sum(
+            [sys.getsizeof(e) for e in self._index])
+
+
+def entries(hours, gop):
+    start = int(time.time())
+    for i in xrange(int(hours * 3600 / gop)):
+        yield (i * gop * BITRATE, i * gop * 1000000000L, True,
+               start + i * gop)
+
+
+def arrayMemory(index):
+    total = 0
+    for key, attr in index._index.FIELDS:
+        values = getattr(index._index, attr)
+        total += values.buffer_info()[1] * values.itemsize
+    return total
+
+
+def timed(function, *args):
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+
+def fill(index, hours, gop):
+    for entry in entries(hours, gop):
+        index.addEntry(*entry)
+    if hasattr(index, 'flush'):
+        index.flush()
+
+
+def clip(index, hours):
+    end = hours * 3600 * 1000000000L
+    length = CLIP_DURATION * 1000000000L
+    random.seed(0)
+    for i in xrange(CLIPS):
+        start = random.randint(0, max(end - length, 1))
+        index.clipTimestamp(start, start + length)
+
+
+def main(args):
+    hours = 24
+    gop = 2
+    if len(args) > 1:
+        hours = float(args[1])
+    if len(args) > 2:
+        gop = float(args[2])
+
+    directory = tempfile.mkdtemp(suffix=".index-bench")
+    try:
+        print '%d entries' % int(hours * 3600 / gop)
+        print '%-16s %10s %12s %12s %12s' % (
+            'index', 'add (s)', 'clips (s)', 'memory (B)', 'file (B)')
+        path = os.path.join(directory, 'legacy.index')
+        index = LegacyIndex(path)
+        add = timed(fill, index, hours, gop)
+        clips = timed(clip, index, hours)
+        print '%-16s %10.3f %12.3f %12d %12d' % (
+            'dicts', add, clips, index.memory(), os.stat(path).st_size)
+        for name, binary in [('arrays, text', False),
+                             ('arrays, binary', True)]:
+            path = os.path.join(directory, name[8:] + '.index')
+            index = Index(location=path, binary=binary)
+            index.save()
+            add = timed(fill, index, hours, gop)
+            clips = timed(clip, index, hours)
+            print '%-16s %10.3f %12.3f %12d %12d' % (
+                name, add, clips, arrayMemory(index), os.stat(path).st_size)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+# Attach synthetic component avatars to the manager's feed map, looking
+# up their feeders and eaters as the component heaven does to connect
+# them, then detach and attach again the components of one worker.
+# Compare the feed map recalculated from scratch after every change, as
+# it used to be, with the one updated incrementally.
+#
+# usage: feed-map-bench.py [COMPONENTS]
+
+import sys
+import time
+
+from flumotion.common import common
+from flumotion.manager import component
+
+# components per flow, a producer, an encoder and a muxer
+FLOW = 3
+# components on the worker that reconnects
+WORKER = 100
+
+
+class Avatar(object):
+
+    def __init__(self, flow, name, eaters=(), vfeeds=()):
+        self.flow = flow
+        self.name = name
+        self.avatarId = common.componentId(flow, name)
+        self.eaters = {}
+        for feedId in eaters:
+            self.eaters.setdefault('default', []).append(
+                (feedId, feedId.replace(':', '-')))
+        self.vfeeds = {}
+        for vcomp, vfeed, feed in vfeeds:
+            self.vfeeds[common.fullFeedId(flow, vcomp, vfeed)] = (self, feed)
+
+    def getEaters(self):
+        return self.eaters
+
+    def getFeeders(self):
+        return ['default']
+
+    def getVirtualFeeds(self):
+        return self.vfeeds
+
+    def getParentName(self):
+        return self.flow
+
+    def getFeedId(self, feedName):
+        return common.feedId(self.name, feedName)
+
+    def getFullFeedId(self, feedName):
+        return common.fullFeedId(self.flow, self.name, feedName)
+
+
+class LegacyFeedMap(component.FeedMap):
+    # recalculated from scratch when looked up after a change
+
+    def __init__(self):
+        self.avatars = {}
+        self._ordered_avatars = []
+        self._dirty = True
+
+    def componentAttached(self, avatar):
+        self.avatars[avatar.avatarId] = avatar
+        self._ordered_avatars.append(avatar)
+        self._dirty = True
+
+    def componentDetached(self, avatar):
+        del self.avatars[avatar.avatarId]
+        self._ordered_avatars.remove(avatar)
+        self._dirty = True
+        return [(a, f) for a, f in self.feedDeps.pop(avatar, [])
+                if a.avatarId in self.avatars]
+
+    def _recalc(self):
+        if not self._dirty:
+            return
+        self.feedersForEaters = ffe = {}
+        self.eatersForFeeders = eff = component.dictlist()
+        self.feeds = component.dictlist()
+        self.feedDeps = component.dictlist()
+        for comp in self._ordered_avatars:
+            for feederName in comp.getFeeders():
+                self.feeds.add(comp.getFullFeedId(feederName),
+                               (comp, feederName))
+            for ffid, pair in comp.getVirtualFeeds().items():
+                self.feeds.add(ffid, pair)
+        for eater in self.avatars.values():
+            for pairs in eater.getEaters().values():
+                for feedId, eName in pairs:
+                    compName, feedName = common.parseFeedId(feedId)
+                    ffid = common.fullFeedId(eater.getParentName(),
+                                             compName, feedName)
+                    if ffid in self.feeds:
+                        feeder, fName = self.feeds[ffid][0]
+                        self.feedDeps.add(feeder, (eater, ffid))
+                        ffe[eater.getFullFeedId(eName)] = (
+                            eName, feeder, fName)
+                        eff.add(feeder.getFullFeedId(fName),
+                                (fName, eater, eName))
+        self._dirty = False
+
+    def getFeedersForEaters(self, avatar):
+        self._recalc()
+        return component.FeedMap.getFeedersForEaters(self, avatar)
+
+    def getEatersForFeeders(self, avatar):
+        self._recalc()
+        return component.FeedMap.getEatersForFeeders(self, avatar)
+
+
+def makeAvatars(count):
+    avatars = []
+    for i in range(count / FLOW):
+        flow = 'flow%d' % i
+        avatars.append(Avatar(flow, 'producer'))
+        avatars.append(Avatar(flow, 'encoder', ['producer:default'],
+                              [('live', 'video', 'default')]))
+        avatars.append(Avatar(flow, 'muxer', ['live:video']))
+    return avatars
+
+
+def wire(feedMap, avatar):
+    # what ComponentHeaven.componentAttached looks up
+    feedMap.componentAttached(avatar)
+    feedMap.getFeedersForEaters(avatar)
+    feedMap.getEatersForFeeders(avatar)
+
+
+def bench(feedMapClass, avatars):
+    feedMap = feedMapClass()
+    start = time.time()
+    for avatar in avatars:
+        wire(feedMap, avatar)
+    attached = time.time() - start
+
+    worker = avatars[-WORKER:]
+    start = time.time()
+    for avatar in worker:
+        feedMap.componentDetached(avatar)
+    for avatar in worker:
+        wire(feedMap, avatar)
+    return attached, time.time() - start
+
+
+def main(args):
+    count = 2000
+    if len(args) > 1:
+        count = int(args[1])
+    avatars = makeAvatars(count)
+    print '%d components, %d of them reconnecting' % (len(avatars), WORKER)
+    for label, feedMapClass in [('recalculated', LegacyFeedMap),
+                                ('incremental', component.FeedMap)]:
+        times = bench(feedMapClass, avatars)
+        print '%-14s attaching %.3f s, reconnecting %.3f s' % (
+            label + ':', times[0], times[1])
+
+if __name__ == '__main__':
+    main(sys.argv)
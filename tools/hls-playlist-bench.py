@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+# Measure how many HLS stream playlist requests per second the ring
+# renders when every client polls the playlist once per fragment,
+# with the playlist rendered for every request and with the playlist
+# rendered once per update.
+#
+# Every client has its own session argument, like the streamer adds.
+#
+# usage: hls-playlist-bench.py [CLIENTS [WINDOW [UPDATES]]]
+
+import sys
+import time
+
+from flumotion.component.consumers.hlsstreamer import hlsring
+
+
+def poll(ring, clients, updates, cached):
+    sequence = ring._counter
+    start = time.time()
+    for update in xrange(updates):
+        ring.addFragment('', sequence + update, 10)
+        for args in clients:
+            if not cached:
+                ring._playlists = {}
+            ring.renderPlaylist('stream.m3u8', dict(args))
+    return clients and len(clients) * updates / (time.time() - start)
+
+
+def main(args):
+    clients, window, updates = 10000, 5, 10
+    if len(args) > 1:
+        clients = int(args[1])
+    if len(args) > 2:
+        window = int(args[2])
+    if len(args) > 3:
+        updates = int(args[3])
+
+    ring = hlsring.HLSRing('main.m3u8', 'stream.m3u8', title='bench',
+                           window=window)
+    ring.setHostname('localhost:8800')
+    for i in xrange(window):
+        ring.addFragment('', i, 10)
+    sessions = [{'GKID': ['%032x' % i], 'FLUREQID': [str(i)]}
+                for i in xrange(clients)]
+
+    print '%d clients, window of %d fragments, %d updates' % (
+        clients, window, updates)
+    print '%-30s %12s' % ('playlist', 'requests/s')
+    print '%-30s %12.0f' % ('rendered by request',
+                            poll(ring, sessions, updates, False))
+    print '%-30s %12.0f' % ('rendered by update',
+                            poll(ring, sessions, updates, True))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
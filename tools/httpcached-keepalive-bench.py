@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+# Compare the time to retrieve small files one after the other with
+# the httpcached stream requester, opening a connection by request
+# and reusing kept alive connections.
+#
+# The files are served by a local twisted.web server, or by the server
+# given as HOST:PORT, in which case the requested path is /PATH.
+#
+# usage: httpcached-keepalive-bench.py [REQUESTS [HOST:PORT/PATH]]
+
+import sys
+import time
+
+from twisted.internet import defer, reactor
+from twisted.web import resource, server
+
+from flumotion.component.misc.httpserver.httpcached import common
+from flumotion.component.misc.httpserver.httpcached import http_client
+from flumotion.component.misc.httpserver.httpcached import http_utils
+
+DATA = "x" * 4096
+
+
+class Small(resource.Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader("Content-Length", str(len(DATA)))
+        return DATA
+
+
+class Consumer(common.StreamConsumer):
+
+    def __init__(self):
+        self.deferred = defer.Deferred()
+
+    def serverError(self, getter, code, message):
+        self.deferred.errback(Exception(message))
+
+    conditionFail = streamNotAvailable = serverError
+
+    def onInfo(self, getter, info):
+        pass
+
+    def onData(self, getter, data):
+        pass
+
+    def streamDone(self, getter):
+        self.deferred.callback(None)
+
+
+def retrieve(client, url, host, port):
+    consumer = Consumer()
+    client.retrieve(consumer, url, host, port)
+    return consumer.deferred
+
+
+def bench(count, client, url, host, port):
+    start = time.time()
+    d = defer.succeed(None)
+    for i in xrange(count):
+        d.addCallback(lambda _: retrieve(client, url, host, port))
+    d.addCallback(lambda _: time.time() - start)
+    return d
+
+
+def run(count, host, port, path):
+    url = http_utils.Url.fromString("http://%s:%d%s" % (host, port, path))
+    print '%-30s %10s %12s' % ('connections', 'seconds', 'ms/request')
+    d = defer.succeed(None)
+    for name, maxIdle in (('one by request', 0), ('kept alive', 4)):
+        client = http_client.StreamRequester(5, 5, maxIdle)
+        d.addCallback(lambda _, c=client: bench(count, c, url, host, port))
+        d.addCallback(report, name, count)
+        d.addCallback(lambda _, c=client: c.cleanup())
+    return d
+
+
+def report(elapsed, name, count):
+    print '%-30s %10.3f %12.3f' % (name, elapsed, elapsed * 1000 / count)
+
+
+def main(args):
+    count = 2000
+    if len(args) > 1:
+        count = int(args[1])
+    if len(args) > 2:
+        address, path = args[2].split('/', 1)
+        host, port = address.split(':')
+        port, path = int(port), '/' + path
+    else:
+        listening = reactor.listenTCP(0, server.Site(Small()),
+                                      interface='127.0.0.1')
+        host, port, path = '127.0.0.1', listening.getHost().port, '/small'
+
+    d = run(count, host, port, path)
+    d.addErrback(lambda f: sys.stderr.write(f.getTraceback()))
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+# Compare the throughput and server CPU use of on-demand file transfers
+# read through python strings and sent with sendfile(2).
+#
+# usage: httpfile-sendfile-bench.py [FILE_SIZE_MB [CLIENTS]]
+
+import os
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import time
+from multiprocessing import Process, Queue
+
+PORT = 18898
+DURATION = 10.0
+
+
+def runServer(root, useSendfile, duration, queue):
+    from flumotion.common import setup
+    setup.setup()
+    from twisted.internet import defer, reactor
+    from twisted.web import server
+    from flumotion.component.misc.httpserver import httpfile, localprovider
+
+    if not useSendfile:
+        httpfile.sendfile = None
+
+    class Request(server.Request):
+        # what CancellableRequest does for the transfers
+
+        def setResponseRange(self, first, last, size):
+            pass
+
+        def dataSent(self, size):
+            pass
+
+        def finish(self):
+            server.Request.finish(self)
+            self.transport.loseConnection()
+
+    class Auth:
+
+        def startAuthentication(self, request):
+            return defer.succeed(None)
+
+    plug = localprovider.FileProviderLocalPlug({'properties': {'path': root}})
+    site = server.Site(httpfile.File(plug.getRootPath(), Auth()))
+    site.requestFactory = Request
+    reactor.listenTCP(PORT, site)
+
+    def stop():
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        queue.put(usage.ru_utime + usage.ru_stime)
+        reactor.stop()
+    reactor.callLater(duration, stop)
+    reactor.run()
+
+
+def runClient(name, duration, queue):
+    request = 'GET /%s HTTP/1.0\r\n\r\n' % name
+    buf = bytearray(256 * 1024)
+    received = 0
+    end = time.time() + duration
+    while time.time() < end:
+        s = socket.socket()
+        s.connect(('127.0.0.1', PORT))
+        s.sendall(request)
+        while True:
+            n = s.recv_into(buf)
+            if not n:
+                break
+            received += n
+        s.close()
+    queue.put(received)
+
+
+def bench(root, name, clients, useSendfile):
+    serverQueue = Queue()
+    server = Process(target=runServer,
+                     args=(root, useSendfile, DURATION + 2.0, serverQueue))
+    server.start()
+    time.sleep(1.0)
+
+    queue = Queue()
+    processes = [Process(target=runClient, args=(name, DURATION, queue))
+                 for i in range(clients)]
+    for p in processes:
+        p.start()
+    received = sum([queue.get() for p in processes])
+    for p in processes:
+        p.join()
+    cpu = serverQueue.get()
+    server.join()
+    return received / DURATION / (1024 * 1024), cpu
+
+
+def main(args):
+    sizeMB = 64
+    clients = 4
+    if len(args) > 1:
+        sizeMB = int(args[1])
+    if len(args) > 2:
+        clients = int(args[2])
+
+    root = tempfile.mkdtemp()
+    name = 'file.bin'
+    f = open(os.path.join(root, name), 'wb')
+    chunk = os.urandom(1024 * 1024)
+    for i in range(sizeMB):
+        f.write(chunk)
+    f.close()
+
+    try:
+        print '%10s %10s %16s %14s' % ('transfer', 'MB/s', 'server cpu (s)',
+                                       'cpu s per GB')
+        for label, useSendfile in (('read', False), ('sendfile', True)):
+            rate, cpu = bench(root, name, clients, useSendfile)
+            perGB = cpu / (rate * DURATION / 1024)
+            print '%10s %10.1f %16.2f %14.3f' % (label, rate, cpu, perGB)
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
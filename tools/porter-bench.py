@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+# Compare porter prefix lookups per second using the old linear scan
+# and the radix tree, for different numbers of registered prefixes.
+
+import random
+import sys
+import time
+
+from flumotion.common import pathtree
+
+
+def linearMatch(prefixes, path):
+    found = None
+    for prefix in prefixes.keys():
+        if (path.startswith(prefix) and
+            (not found or len(found) < len(prefix))):
+            found = prefix
+    if found:
+        return prefixes[found]
+    return None
+
+
+def makePrefixes(count):
+    prefixes = []
+    for i in range(count):
+        prefixes.append('/%s/%s/stream-%d/' % (
+            random.choice(['live', 'vod', 'event']),
+            random.choice(['sports', 'news', 'music', 'kids']), i))
+    return prefixes
+
+
+def timeLookups(lookup, paths, minTime=1.0):
+    count = 0
+    start = time.time()
+    while True:
+        for path in paths:
+            lookup(path)
+        count += len(paths)
+        elapsed = time.time() - start
+        if elapsed >= minTime:
+            return count / elapsed
+
+
+def main(args):
+    sizes = [int(arg) for arg in args[1:]] or [10, 1000, 10000]
+    print '%10s %15s %15s %8s' % ('prefixes', 'linear/s', 'tree/s', 'speedup')
+    for size in sizes:
+        prefixes = makePrefixes(size)
+        avatars = dict((prefix, object()) for prefix in prefixes)
+        tree = pathtree.PathTree(avatars.items())
+
+        paths = [random.choice(prefixes) + 'fragment-%d.ts' % i
+                 for i in range(200)]
+        paths.extend(['/unknown/path-%d' % i for i in range(50)])
+
+        linear = timeLookups(lambda p: linearMatch(avatars, p), paths)
+        radix = timeLookups(tree.longestPrefixValue, paths)
+        print '%10d %15.0f %15.0f %7.1fx' % (size, linear, radix,
+                                             radix / linear)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+# Measure how many connections per second a porter can pass to a local
+# stand-in streamer, for different numbers of accept workers.
+#
+# usage: porter-load-bench.py [WORKERS...]
+#   e.g. porter-load-bench.py 0 1 3
+
+import os
+import signal
+import socket
+import sys
+import tempfile
+import time
+from multiprocessing import Process, Queue
+
+PORT = 18899
+MOUNT = '/bench'
+CLIENTS = 8
+DURATION = 10.0
+USERNAME = 'bench'
+PASSWORD = 'bench'
+
+
+def runPorter(socketPath, workers):
+    from flumotion.common import setup
+    setup.setup()
+    from twisted.internet import reactor
+    from flumotion.component.misc.porter import porter
+    porter.Porter({'name': 'porter',
+                   'avatarId': '/default/porter',
+                   'parent': 'default',
+                   'type': 'porter',
+                   'plugs': {},
+                   'properties': {'port': PORT,
+                                  'socket-path': socketPath,
+                                  'username': USERNAME,
+                                  'password': PASSWORD,
+                                  'accept-workers': workers}})
+    reactor.run()
+
+
+def runStreamer(socketPath):
+    from flumotion.common import setup
+    setup.setup()
+    from twisted.cred import credentials
+    from twisted.internet import reactor, defer
+    from twisted.web import server, resource
+    from flumotion.component.misc.porter import porterclient
+    from flumotion.twisted import fdserver
+
+    class Hello(resource.Resource):
+        isLeaf = True
+
+        def render_GET(self, request):
+            return 'hello'
+
+    factory = porterclient.HTTPPorterClientFactory(
+        server.Site(Hello()), [MOUNT], defer.Deferred())
+    factory.startLogin(credentials.UsernamePassword(USERNAME, PASSWORD),
+                       factory.medium)
+    reactor.connectWith(fdserver.FDConnector, socketPath, factory, 10,
+                        checkPID=False)
+    reactor.run()
+
+
+def runClient(queue, duration):
+    request = 'GET %s HTTP/1.0\r\n\r\n' % MOUNT
+    done = 0
+    failed = 0
+    end = time.time() + duration
+    while time.time() < end:
+        s = socket.socket()
+        try:
+            s.connect(('127.0.0.1', PORT))
+            s.sendall(request)
+            response = ''
+            while True:
+                data = s.recv(4096)
+                if not data:
+                    break
+                response += data
+            if response.startswith('HTTP/1.0 200') or \
+               response.startswith('HTTP/1.1 200'):
+                done += 1
+            else:
+                failed += 1
+        except socket.error:
+            failed += 1
+        s.close()
+    queue.put((done, failed))
+
+
+def bench(workers):
+    socketPath = tempfile.mktemp('.sock', 'porter-bench.')
+    porterProcess = Process(target=runPorter, args=(socketPath, workers))
+    porterProcess.start()
+    time.sleep(1.0)
+    streamerProcess = Process(target=runStreamer, args=(socketPath, ))
+    streamerProcess.start()
+    # give the streamer time to log in to the porter and its workers
+    time.sleep(2.0 + workers)
+
+    queue = Queue()
+    clients = [Process(target=runClient, args=(queue, DURATION))
+               for i in range(CLIENTS)]
+    for client in clients:
+        client.start()
+    results = [queue.get() for client in clients]
+    for client in clients:
+        client.join()
+
+    for process in (streamerProcess, porterProcess):
+        os.kill(process.pid, signal.SIGTERM)
+        process.join()
+    done = sum([r[0] for r in results])
+    failed = sum([r[1] for r in results])
+    return done / DURATION, failed
+
+
+def main(args):
+    workerCounts = [int(arg) for arg in args[1:]] or [0, 1, 3]
+    print '%8s %12s %8s' % ('workers', 'conns/s', 'failed')
+    for workers in workerCounts:
+        rate, failed = bench(workers)
+        print '%8d %12.0f %8d' % (workers, rate, failed)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+# Compare the cost of throttling many concurrent transfers with a delayed
+# call per transfer and a list of buffers, the way the token buckets used
+# to do, and with the shared scheduler of the token buckets.
+#
+# usage: rate-control-bench.py [TRANSFERS...]
+
+import sys
+import time
+
+from twisted.internet import selectreactor
+
+from flumotion.component.misc.httpserver import ratecontrol
+
+RATE = 16 * 1024
+CHUNK = 64 * 1024
+SECONDS = 10
+
+
+class ReactorClock(object):
+    """
+    I run the delayed calls of a reactor, in simulated time.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.reactor = selectreactor.SelectReactor()
+        self.reactor.seconds = self.seconds
+
+    def seconds(self):
+        return self.now
+
+    def callLater(self, delay, function, *args):
+        return self.reactor.callLater(delay, function, *args)
+
+    def getDelayedCalls(self):
+        self.reactor.runUntilCurrent()
+        return self.reactor.getDelayedCalls()
+
+    def advance(self, amount):
+        self.now += amount
+        self.reactor.runUntilCurrent()
+
+
+class LegacyTokenBucketConsumer(ratecontrol.TokenBucketConsumer):
+    """
+    A token bucket doing what the token buckets used to do.
+    """
+
+    clock = None
+
+    def __init__(self, *args):
+        ratecontrol.TokenBucketConsumer.__init__(self, *args)
+        self._buffers = []
+        self._dripDC = None
+
+    def _legacyDrip(self):
+        self._dripDC = None
+        self._waiting = False
+        self._dripAndTryWrite(self.clock.seconds())
+
+    def _tryWrite(self):
+        if not self.consumer:
+            return
+        while self.fillLevel > 0 and self._buffersSize > 0:
+            offset, buf = self._buffers[0]
+            sendbuf = buf[offset:offset+self.fillLevel]
+            sendBytes = len(sendbuf)
+            if sendBytes + offset == len(buf):
+                self._buffers.pop(0)
+            else:
+                self._buffers[0] = (offset + sendBytes, buf)
+            self._buffersSize -= sendBytes
+            self.consumer.write(sendbuf)
+            self.fillLevel -= sendBytes
+        if self._buffersSize > 0:
+            if not (self._dripDC or self._paused):
+                self._waiting = True
+                self._dripDC = self.clock.callLater(1.0, self._legacyDrip)
+        elif self.producer:
+            self.producer.resumeProducing()
+
+
+class NullConsumer(object):
+
+    def __init__(self):
+        self.written = 0
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+    def write(self, data):
+        self.written += len(data)
+
+    def finish(self):
+        pass
+
+
+class EndlessProducer(object):
+
+    data = 'x' * CHUNK
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+
+    def resumeProducing(self):
+        self.proxy.write(self.data)
+
+    def pauseProducing(self):
+        pass
+
+    def stopProducing(self):
+        pass
+
+
+def start(count, createProxy):
+    consumers = []
+    for i in xrange(count):
+        consumer = NullConsumer()
+        proxy = createProxy(consumer)
+        proxy.registerProducer(EndlessProducer(proxy), True)
+        consumers.append(consumer)
+    return consumers
+
+
+def run(clock):
+    for i in xrange(SECONDS):
+        clock.advance(1)
+
+
+def timed(function, *args):
+    start = time.time()
+    result = function(*args)
+    return time.time() - start, result
+
+
+def bench(count, name, createProxy, clock):
+    t, consumers = timed(start, count, createProxy)
+    calls = len(clock.getDelayedCalls())
+    t2, _ = timed(run, clock)
+    written = sum([c.written for c in consumers])
+    print '%-8d %-10s %10.3f %12.3f %10d %14d' % (
+        count, name, t, t2, calls, written)
+
+
+def main(args):
+    counts = [int(arg) for arg in args[1:]] or [10000, 50000]
+    print '%d seconds at %d bytes per second' % (SECONDS, RATE)
+    print '%-8s %-10s %10s %12s %10s %14s' % (
+        'clients', 'buckets', 'start (s)', 'throttle (s)', 'calls',
+        'bytes')
+    for count in counts:
+        clock = ReactorClock()
+        scheduler = ratecontrol.TokenBucketScheduler(clock=clock)
+        LegacyTokenBucketConsumer.clock = clock
+        bench(count, 'legacy', lambda consumer:
+              LegacyTokenBucketConsumer(consumer, RATE * 10, RATE, 0,
+                                        scheduler), clock)
+
+        clock = ReactorClock()
+        scheduler = ratecontrol.TokenBucketScheduler(clock=clock)
+        bench(count, 'shared', lambda consumer:
+              ratecontrol.TokenBucketConsumer(consumer, RATE * 10, RATE, 0,
+                                              scheduler), clock)
+
+        clock = ReactorClock()
+        scheduler = ratecontrol.TokenBucketScheduler(
+            rate=count * RATE / 2, clock=clock)
+        bench(count, 'capped', lambda consumer:
+              ratecontrol.TokenBucketConsumer(consumer, RATE * 10, RATE, 0,
+                                              scheduler), clock)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+# Measure how many completed requests per second the reactor thread can
+# log, without request logging, with the request logger file plug writing
+# each line synchronously, with its buffered mode, and with the aggregate
+# logger plug, and the size of the log file each of them writes.
+#
+# The requests are logged the way the streamer and the http-server do,
+# through the logger plugs and a DeferredList. A latency can be added to
+# every flush of the log file, to simulate a busy disk or a network file
+# system.
+#
+# usage: request-logger-bench.py [REQUESTS [LATENCY-MS [LOGFILE]]]
+
+import os
+import sys
+import tempfile
+import time
+
+from twisted.internet import defer
+
+from flumotion.component.plugs import request
+
+
+class SlowFile(object):
+    """
+    I am a file whose flushes take some time.
+    """
+
+    def __init__(self, file, latency):
+        self._file = file
+        self._latency = latency
+
+    def write(self, data):
+        self._file.write(data)
+
+    def flush(self):
+        self._file.flush()
+        time.sleep(self._latency)
+
+    def close(self):
+        self._file.close()
+
+
+def slowOpen(latency):
+
+    def open(*args):
+        return SlowFile(file(*args), latency)
+    return open
+
+
+def logWrite(loggers, uri):
+    args = {'ip': '192.168.1.10',
+            'time': time.gmtime(),
+            'method': 'GET',
+            'uri': uri,
+            'username': '-',
+            'get-parameters': {},
+            'clientproto': 'HTTP/1.1',
+            'response': 200,
+            'bytes-sent': 376000,
+            'referer': None,
+            'user-agent': 'Mozilla/5.0 (X11; Linux x86_64)',
+            'time-connected': 0}
+    l = []
+    for logger in loggers:
+        l.append(defer.maybeDeferred(
+            logger.event, 'http_session_completed', args))
+    return defer.DeferredList(l)
+
+
+def run(count, loggers):
+    start = time.time()
+    for i in xrange(count):
+        logWrite(loggers, '/live/stream-%d.ts' % (i % 1000))
+    return time.time() - start
+
+
+def main(args):
+    count = 200000
+    latency = 0
+    if len(args) > 1:
+        count = int(args[1])
+    if len(args) > 2:
+        latency = float(args[2]) / 1000
+    if len(args) > 3:
+        logfile = args[3]
+    else:
+        fd, logfile = tempfile.mkstemp(suffix='.log')
+        os.close(fd)
+    if latency:
+        # the plug opens its log file with the open builtin
+        request.open = slowOpen(latency)
+
+    print '%d requests, %.3f ms per flush' % (count, latency * 1000)
+    print '%-12s %12s %14s %10s %12s' % ('logging', 'seconds',
+                                         'requests/s', 'dropped', 'log (B)')
+    file = request.RequestLoggerFilePlug
+    aggregate = request.RequestLoggerAggregatePlug
+    try:
+        for name, plugClass, properties in [
+            ('off', None, None),
+            ('sync', file, {}),
+            ('buffered', file, {'buffered': True}),
+            ('json', aggregate, {}),
+            ('binary', aggregate, {'format': 'binary'}),
+            ('json 1%', aggregate, {'sample-rate': 0.01})]:
+            open(logfile, 'w').close()
+            loggers = []
+            if properties is not None:
+                properties['logfile'] = logfile
+                plug = plugClass({'properties': properties})
+                plug.start()
+                loggers.append(plug)
+            seconds = run(count, loggers)
+            dropped = 0
+            if loggers:
+                if getattr(plug, 'writer', None):
+                    dropped = plug.writer.dropped
+                plug.stop()
+            print '%-12s %12.3f %14d %10d %12d' % (
+                name, seconds, count / seconds, dropped,
+                os.stat(logfile).st_size)
+    finally:
+        if len(args) <= 3:
+            os.unlink(logfile)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+# Compare the cost of routing addresses with a routing table of many
+# subnets, scanning every subnet the way the routing table used to do and
+# with its hash tables per prefix length.
+#
+# usage: routing-table-bench.py [SUBNETS] [LOOKUPS]
+
+import random
+import sys
+import time
+
+from flumotion.common import netutils
+
+
+class LegacyRoutingTable(netutils.RoutingTable):
+    """
+    A routing table routing the way the routing table used to do.
+    """
+
+    def route(self, ip):
+        if isinstance(ip, str):
+            ip = netutils.ipv4StringToInt(ip)
+        for netmask, net, route in self:
+            if ip & netmask == net:
+                return route
+        return None
+
+
+def subnets(count):
+    random.seed(0)
+    result = {}
+    while len(result) < count:
+        bits = random.choice([8, 16, 20, 24, 24, 24, 28, 32])
+        mask = ~((1 << (32 - bits)) - 1) & 0xffffffffL
+        net = random.getrandbits(32) & mask
+        result[(net, bits)] = 'route-%d' % (len(result) % 10)
+    return [(route, netutils.ipv4IntToString(net), bits)
+            for (net, bits), route in result.items()]
+
+
+def addresses(count):
+    random.seed(1)
+    return [netutils.ipv4IntToString(random.getrandbits(32))
+            for i in xrange(count)]
+
+
+def fill(table, subnets):
+    for route, net, bits in subnets:
+        table.addSubnet(route, net, bits)
+
+
+def lookup(table, addresses):
+    routed = 0
+    for address in addresses:
+        if table.route(address) is not None:
+            routed += 1
+    return routed
+
+
+def timed(function, *args):
+    start = time.time()
+    result = function(*args)
+    return time.time() - start, result
+
+
+def main(args):
+    count = 20000
+    lookups = 10000
+    if len(args) > 1:
+        count = int(args[1])
+    if len(args) > 2:
+        lookups = int(args[2])
+
+    nets = subnets(count)
+    ips = addresses(lookups)
+    print '%d subnets, %d lookups' % (count, lookups)
+    print '%-10s %12s %12s %14s %8s' % (
+        'table', 'fill (s)', 'lookups (s)', 'lookups/s', 'routed')
+    for name, tableClass in [('legacy', LegacyRoutingTable),
+                             ('hashed', netutils.RoutingTable)]:
+        table = tableClass()
+        filling, _ = timed(fill, table, nets)
+        t, routed = timed(lookup, table, ips)
+        print '%-10s %12.3f %12.3f %14.0f %8d' % (
+            name, filling, t, lookups / max(t, 1e-9), routed)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+# Count the PB messages and bytes sent to the observers of the UI state
+# of the components of a planet, when each change is sent on its own and
+# when the changes of an update are batched.
+#
+# Each component updates its UI state the way the CPU poller and the
+# streamer statistics do. The messages are encoded the way PB sends
+# cache observer calls on the wire.
+#
+# usage: state-batch-bench.py [COMPONENTS [UPDATES]]
+
+import sys
+import time
+
+from twisted.internet import defer
+from twisted.spread import banana, jelly
+
+from flumotion.twisted import flavors
+
+STREAM_KEYS = ['stream-mime', 'stream-url', 'stream-uptime',
+               'stream-bitrate', 'stream-current-bitrate',
+               'stream-totalbytes', 'stream-totalbytes-raw',
+               'clients-current', 'clients-max', 'clients-peak',
+               'clients-peak-time', 'clients-average',
+               'consumption-bitrate', 'consumption-bitrate-current',
+               'consumption-totalbytes', 'consumption-totalbytes-raw']
+
+
+class _Encoder(banana.Banana):
+
+    def __init__(self):
+        banana.Banana.__init__(self)
+        self.connectionMade()
+        self._selectDialect("pb")
+
+    def encode(self, message):
+        data = []
+        self._encode(message, data.append)
+        return "".join(data)
+
+
+class CountingObserver:
+    """
+    I count the messages and bytes a PB cache observer would send.
+    """
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self._encoder = _Encoder()
+
+    def callRemote(self, name, *args):
+        self.messages += 1
+        message = ['cachemessage', self.messages, 1, 'observe_' + name, 1,
+                   jelly.jelly(args), jelly.jelly({})]
+        self.bytes += len(self._encoder.encode(message))
+        return defer.succeed(None)
+
+
+def createComponent(observer):
+    state = flavors.StateCacheable()
+    for key in ['cpu-percent', 'current-time', 'virtual-size'] + STREAM_KEYS:
+        state.addKey(key, 0)
+    state.getStateToCacheAndObserveFor(None, observer)
+    return state
+
+
+def update(state, round, batched):
+    if batched:
+        state.beginBatch()
+    state.set('cpu-percent', 0.01 * (round % 7))
+    state.set('current-time', time.time())
+    state.set('virtual-size', 100000000 + round * 4096)
+    for i, key in enumerate(STREAM_KEYS):
+        # like the streamer, only the values that changed are set
+        if (round + i) % 3:
+            state.set(key, '%d kbit/s' % (round * i))
+    if batched:
+        state.commitBatch()
+
+
+def run(components, updates, batched):
+    observer = CountingObserver()
+    states = [createComponent(observer) for i in range(components)]
+    start = time.time()
+    for round in range(updates):
+        for state in states:
+            update(state, round, batched)
+    return observer, time.time() - start
+
+
+def main(args):
+    components = 200
+    updates = 10
+    if len(args) > 1:
+        components = int(args[1])
+    if len(args) > 2:
+        updates = int(args[2])
+
+    print '%d components, %d updates each' % (components, updates)
+    print '%-12s %10s %12s %10s' % ('mode', 'messages', 'bytes', 'seconds')
+    for name, batched in [('unbatched', False), ('batched', True)]:
+        observer, seconds = run(components, updates, batched)
+        print '%-12s %10d %12d %10.3f' % (name, observer.messages,
+                                          observer.bytes, seconds)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+# Compare the cost of per-client timeouts with one delayed call of the
+# reactor per client, as the HTTP authentication used to do for
+# durations, and with the timer wheel. Also compare the periodic scan of
+# every client the http-server and the bouncers used to do with a tick
+# of the timer wheel.
+#
+# usage: timer-wheel-bench.py [TIMERS]
+
+import random
+import sys
+import time
+
+from twisted.internet import reactor, task
+
+from flumotion.common import timerwheel
+
+TIMEOUT = 30 * 60
+
+
+class FakeRequest(object):
+
+    def __init__(self, now):
+        self.lastTimeWritten = now
+
+
+def noop():
+    pass
+
+
+def timed(function, *args):
+    start = time.time()
+    result = function(*args)
+    return time.time() - start, result
+
+
+def delays(count):
+    random.seed(0)
+    return [random.uniform(TIMEOUT / 2, TIMEOUT) for i in xrange(count)]
+
+
+def callLaterSchedule(delays):
+    calls = [reactor.callLater(delay, noop) for delay in delays]
+    # the reactor adds the new calls to its heap on its next iteration
+    reactor.timeout()
+    return calls
+
+
+def callLaterReset(calls, delays):
+    for call, delay in zip(calls, delays):
+        call.reset(delay)
+    reactor.timeout()
+
+
+def cancelAll(calls):
+    for call in calls:
+        call.cancel()
+    reactor.timeout()
+
+
+def wheelSchedule(wheel, delays):
+    return [wheel.schedule(delay, noop) for delay in delays]
+
+
+def wheelReset(timers, delays):
+    for timer, delay in zip(timers, delays):
+        timer.reset(delay)
+
+
+def scan(requests):
+    # what the http-server did for every client every 30 seconds
+    now = time.time()
+    timedOut = 0
+    for request in requests.values():
+        if now - request.lastTimeWritten > TIMEOUT:
+            timedOut += 1
+    return timedOut
+
+
+def expire(clock, wheel, count):
+    for i in xrange(count):
+        wheel.schedule(random.uniform(0, 60), noop)
+    for i in xrange(61):
+        clock.advance(1)
+
+
+def main(args):
+    count = 100000
+    if len(args) > 1:
+        count = int(args[1])
+
+    first = delays(count)
+    second = delays(count)
+    print '%d timers' % count
+    print '%-36s %10s' % ('operation', 'seconds')
+
+    t, calls = timed(callLaterSchedule, first)
+    print '%-36s %10.3f' % ('callLater schedule', t)
+    t, _ = timed(callLaterReset, calls, second)
+    print '%-36s %10.3f' % ('callLater reset', t)
+    t, _ = timed(cancelAll, calls)
+    print '%-36s %10.3f' % ('callLater cancel', t)
+
+    wheel = timerwheel.TimerWheel()
+    t, timers = timed(wheelSchedule, wheel, first)
+    print '%-36s %10.3f' % ('wheel schedule', t)
+    t, _ = timed(wheelReset, timers, second)
+    print '%-36s %10.3f' % ('wheel reset', t)
+    t, _ = timed(wheel._tick)
+    print '%-36s %10.6f' % ('wheel tick', t)
+    t, _ = timed(cancelAll, timers)
+    print '%-36s %10.3f' % ('wheel cancel', t)
+
+    now = time.time()
+    requests = dict([(fd, FakeRequest(now)) for fd in xrange(count)])
+    t, _ = timed(scan, requests)
+    print '%-36s %10.3f' % ('scan of all the clients', t)
+
+    clock = task.Clock()
+    wheel = timerwheel.TimerWheel(clock=clock)
+    t, _ = timed(expire, clock, wheel, count)
+    print '%-36s %10.3f' % ('wheel schedule and expire in 60s', t)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# Flumotion - a streaming media server
+# Copyright (C) 2004,2005,2006,2007,2008,2009 Fluendo, S.L.
+# Copyright (C) 2010,2011 Flumotion Services, S.A.
+# All rights reserved.
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU Lesser General Public License version 2.1 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.LGPL" in the source distribution for more information.
+#
+# Headers in this file shall remain intact.
+
+# Simulate a worker setting up the bundles of a number of components
+# spawned in a row, against a manager serving the bundles of the
+# registry with some latency. Compare asking the manager for the sums
+# and all the zips for every component, as the worker used to do, with
+# the bundle loader reusing the sums and the bundles unpacked in its
+# cache directory.
+#
+# usage: worker-bundles-bench.py [COMPONENTS [LATENCY_MS]]
+
+import shutil
+import sys
+import tempfile
+import time
+
+from twisted.internet import defer, reactor
+
+from flumotion.common import bundleclient, setup
+from flumotion.common.registry import getRegistry
+from flumotion.configure import configure
+
+MODULE = 'flumotion.component.producers.videotest.videotest'
+
+
+class Manager:
+    # answers like the manager's perspective_getBundleSums and
+    # perspective_getBundleZips, after the given latency
+
+    def __init__(self, basket, latency):
+        self.basket = basket
+        self.latency = latency
+        self.calls = 0
+        self.bytes = 0
+
+    def callRemote(self, methodName, *args, **kwargs):
+        self.calls += 1
+        basket = self.basket
+        if methodName == 'getBundleSums':
+            name = basket.getBundlerNameByImport(kwargs['moduleName'][0])
+            result = [(dep, basket.getBundlerByName(dep).bundle().md5sum)
+                      for dep in basket.getDependencies(name)]
+        else:
+            result = {}
+            for name in args[0]:
+                result[name] = basket.getBundlerByName(name).bundle().getZip()
+                self.bytes += len(result[name])
+        d = defer.Deferred()
+        reactor.callLater(self.latency, d.callback, result)
+        return d
+
+
+class LegacyLoader(bundleclient.BundleLoader):
+    # asks for the sums and fetches every zip for each request
+
+    def _getSums(self, kwargs):
+        return self.callRemote('getBundleSums', **kwargs)
+
+    def _fetchMissing(self, sums):
+        d = self.callRemote('getBundleZips', [name for name, md5 in sums])
+
+        def unpack(zips):
+            for name, md5 in sums:
+                self._unpack(name, zips)
+            return sums
+        d.addCallback(unpack)
+        return d
+
+
+def spawn(loaderClass, manager, components):
+    loader = loaderClass(manager.callRemote, sumsTTL=30)
+    start = time.time()
+    d = defer.succeed(None)
+    for i in range(components):
+        d.addCallback(lambda _: loader.getBundles(moduleName=[MODULE]))
+    d.addCallback(lambda _: time.time() - start)
+    return d
+
+
+def main(args):
+    components = 50
+    latency = 0.005
+    if len(args) > 1:
+        components = int(args[1])
+    if len(args) > 2:
+        latency = int(args[2]) / 1000.0
+    setup.setupPackagePath()
+    basket = getRegistry().makeBundlerBasket()
+    print '%d components spawned in a row, %d ms latency' % (
+        components, latency * 1000)
+
+    def run():
+        dl = defer.succeed(None)
+        for label, loaderClass in [
+            ('fetching every bundle', LegacyLoader),
+            ('cached bundles', bundleclient.BundleLoader)]:
+            dl.addCallback(bench, label, loaderClass)
+        dl.addErrback(lambda failure: failure.printTraceback())
+        dl.addBoth(lambda _: reactor.stop())
+
+    def bench(_, label, loaderClass):
+        cachedir = tempfile.mkdtemp()
+        configure.cachedir = cachedir
+        manager = Manager(basket, latency)
+        d = spawn(loaderClass, manager, components)
+
+        def done(elapsed):
+            shutil.rmtree(cachedir)
+            print '%-22s %.3f s, %4d calls, %8d bytes' % (
+                label + ':', elapsed, manager.calls, manager.bytes)
+        d.addCallback(done)
+        return d
+    reactor.callWhenRunning(run)
+    reactor.run()
+
+if __name__ == '__main__':
+    main(sys.argv)